@@ -1,7 +1,7 @@
 import cv2
 
 def hook(frame_data, _):
-    frame = frame_data['original']
+    frame = frame_data['original'].copy() # The original frame is read-only
     original_height, original_width, _ = frame.shape
     reduced_height, reduced_width, _ = frame_data['modified'].shape
     bounding_boxes = frame_data['inference_output']
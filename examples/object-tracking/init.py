@@ -1,3 +1,5 @@
+# make context per stream
+
 from norfair import Tracker
 
 def init():
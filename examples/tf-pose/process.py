@@ -1,7 +1,7 @@
 import cv2
 def hook(frame_data, context):
     # Get RG frame
-    frame = frame_data['original']
+    frame = frame_data['modified']
     # Load model
     model = context["model"]
     # Run inference
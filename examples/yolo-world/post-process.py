@@ -2,7 +2,7 @@ import cv2
 import numpy as np
 
 def hook(frame_data, _):
-    frame = frame_data['original']
+    frame = frame_data['modified']
     model_output = frame_data['inference_output']
     if len(model_output) > 0:
         yolo_input_shape = (640, 640, 3) # h,w,c
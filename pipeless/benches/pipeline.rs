@@ -0,0 +1,281 @@
+//! Throughput and latency of whole streams going through the dispatcher, the event bus and
+//! the frame path, using synthetic videotestsrc sources, so no files nor network are required.
+//! Every combination of resolution, number of streams, max in flight frames and scenario
+//! is run and reported as a JSON line, easy to diff between releases.
+//! Run with: cargo bench --bench pipeline
+//! Configuration:
+//!   BENCH_FRAMES: frames per stream. 300 by default.
+//!   BENCH_RESOLUTIONS: comma separated list of frame sizes. 640x480,1280x720,1920x1080 by default.
+//!   BENCH_STREAMS: comma separated list of numbers of concurrent streams. 1,4 by default.
+//!   BENCH_MAX_IN_FLIGHT: comma separated list of max frames in flight. Twice the number of CPUs by default.
+//!   BENCH_SCENARIOS: comma separated list of the scenarios to run. All by default.
+//!   BENCH_ONNX_STAGES: comma separated list of stage directories, for example, the ONNX examples.
+//!       Each one is added as the 'onnx_<stage name>' scenario. Use local model URIs to avoid the network.
+//!   BENCH_LIVE: when 'true', the sources produce frames at their framerate (30 fps) instead of as fast as possible.
+//!   BENCH_TIMEOUT: max seconds per run. 300 by default.
+//! The CPU time and RSS are read from /proc, so they are only reported on Linux.
+use std::{env, sync::Arc, time::{Duration, Instant}};
+use tokio::sync::RwLock;
+use pipeless_ai as pipeless;
+use pipeless::stages::hook::{Hook, HookTrait, HookType};
+
+const NOOP_PYTHON_HOOK: &str = "
+def hook(frame_data, context):
+    pass
+";
+/// Clock ticks per second of the CPU times in /proc. 100 on most Linux systems.
+const CLOCK_TICKS: f64 = 100.0;
+
+/// Returns the frame untouched, to measure the overhead of the runtime
+struct NoopHook;
+impl HookTrait for NoopHook {
+    fn exec_hook(
+        &self,
+        frame: pipeless::data::Frame,
+        _: &pipeless::stages::stage::Context
+    ) -> Option<pipeless::data::Frame> {
+        Some(frame)
+    }
+}
+
+fn new_stage(name: &str, hook: Hook) -> pipeless::stages::stage::Stage {
+    let mut stage = pipeless::stages::stage::Stage::new(name);
+    stage.add_hook(hook);
+    stage
+}
+
+fn create_stages() -> Vec<pipeless::stages::stage::Stage> {
+    let mut stages = vec![
+        new_stage("noop_rust", Hook::new_stateless(HookType::Process, Arc::new(NoopHook))),
+        new_stage("noop_rust_stateful", Hook::new_stateful(HookType::Process, Arc::new(tokio::sync::Mutex::new(NoopHook)))),
+        new_stage("noop_python", Hook::new_stateless(HookType::Process, Arc::new(
+            pipeless::stages::languages::python::PythonHook::new(HookType::Process, "noop_python", NOOP_PYTHON_HOOK)
+        ))),
+        new_stage("noop_python_stateful", Hook::new_stateful(HookType::Process, Arc::new(tokio::sync::Mutex::new(
+            pipeless::stages::languages::python::PythonHook::new(HookType::Process, "noop_python_stateful", NOOP_PYTHON_HOOK)
+        )))),
+    ];
+    if let Ok(stage_dirs) = env::var("BENCH_ONNX_STAGES") {
+        for stage_dir in stage_dirs.split(',').filter(|dir| !dir.is_empty()) {
+            let path = std::path::PathBuf::from(stage_dir);
+            let dir_name = path.file_name()
+                .and_then(|name| name.to_str())
+                .unwrap_or_else(|| panic!("Invalid stage directory {}", stage_dir));
+            let stage_name = format!("onnx_{}", dir_name.replace('-', "_"));
+            stages.push(pipeless::stages::parser::load_stage(&stage_name, &path, 0));
+        }
+    }
+    stages
+}
+
+fn parse_list<T: std::str::FromStr>(var: &str, default: Vec<T>) -> Vec<T> {
+    match env::var(var) {
+        Ok(value) => value.split(',')
+            .map(|item| item.trim().parse().unwrap_or_else(|_| panic!("Invalid value '{}' in {}", item, var)))
+            .collect(),
+        Err(_) => default,
+    }
+}
+
+/// User plus system CPU time of the process
+fn process_cpu_time() -> Option<Duration> {
+    let stat = std::fs::read_to_string("/proc/self/stat").ok()?;
+    // The process name can contain spaces, the fields are counted after it
+    let fields: Vec<&str> = stat.rsplit_once(')')?.1.split_whitespace().collect();
+    let utime: f64 = fields.get(11)?.parse().ok()?;
+    let stime: f64 = fields.get(12)?.parse().ok()?;
+    Some(Duration::from_secs_f64((utime + stime) / CLOCK_TICKS))
+}
+
+/// Resident memory of the process in MB
+fn process_rss_mb() -> Option<f64> {
+    let status = std::fs::read_to_string("/proc/self/status").ok()?;
+    let rss_kb: f64 = status.lines()
+        .find(|line| line.starts_with("VmRSS:"))?
+        .split_whitespace()
+        .nth(1)?
+        .parse().ok()?;
+    Some(rss_kb / 1024.0)
+}
+
+struct RunParams<'a> {
+    scenario: &'a str,
+    width: usize,
+    height: usize,
+    streams: usize,
+    frames: u64,
+    max_in_flight: usize,
+    live: bool,
+    timeout: Duration,
+}
+
+/// Adds the streams to the table, waits for them to finish and returns the results as JSON
+async fn run(
+    params: &RunParams<'_>,
+    streams_table: &Arc<RwLock<pipeless::config::streams::StreamsTable>>,
+    dispatcher_sender: &tokio::sync::mpsc::UnboundedSender<pipeless::dispatcher::DispatcherEvent>,
+) -> serde_json::Value {
+    let input_uri = format!(
+        "videotestsrc://{}x{}?frames={}&live={}",
+        params.width, params.height, params.frames, params.live
+    );
+    let cpu_start = process_cpu_time();
+    let start = Instant::now();
+    let mut entry_ids = vec![];
+    {
+        let mut table = streams_table.write().await;
+        for stream in 0..params.streams {
+            // The input URIs of the streams table must be unique
+            let entry = pipeless::config::streams::StreamsTableEntry::new(
+                format!("{}&id={}", input_uri, stream), None, vec![params.scenario.to_string()],
+                pipeless::config::streams::RestartPolicy::Never,
+            );
+            entry_ids.push(entry.get_id());
+            table.add(entry).expect("Unable to add the stream to the table");
+        }
+    }
+    dispatcher_sender.send(pipeless::dispatcher::DispatcherEvent::TableChange)
+        .expect("Unable to notify the dispatcher");
+
+    // The metrics are unregistered when the streams end, keep them while running
+    let mut streams_metrics: Vec<(uuid::Uuid, Arc<pipeless::metrics::StreamMetrics>)> = vec![];
+    let mut timed_out = false;
+    loop {
+        tokio::time::sleep(Duration::from_millis(10)).await;
+        let table = streams_table.read().await.get_table();
+        let entries: Vec<_> = table.iter().filter(|entry| entry_ids.contains(&entry.get_id())).collect();
+        for entry in &entries {
+            if let Some(pipeline_id) = entry.get_pipeline() {
+                if !streams_metrics.iter().any(|(id, _)| *id == pipeline_id) {
+                    if let Some(metrics) = pipeless::metrics::get_stream_metrics(&pipeline_id) {
+                        streams_metrics.push((pipeline_id, metrics));
+                    }
+                }
+            }
+        }
+        let running = entries.iter()
+            .any(|entry| entry.get_target_state() == pipeless::config::streams::StreamEntryState::Running);
+        if !running {
+            break;
+        }
+        if start.elapsed() > params.timeout {
+            timed_out = true;
+            break;
+        }
+    }
+    let elapsed = start.elapsed().as_secs_f64();
+    let cpu_time = match (cpu_start, process_cpu_time()) {
+        (Some(cpu_start), Some(cpu_end)) => Some((cpu_end - cpu_start).as_secs_f64()),
+        _ => None,
+    };
+
+    {
+        let mut table = streams_table.write().await;
+        for id in &entry_ids {
+            table.remove(*id);
+        }
+    }
+    let _ = dispatcher_sender.send(pipeless::dispatcher::DispatcherEvent::TableChange);
+
+    let frame_latency = pipeless::metrics::Histogram::default();
+    let (mut decoded_frames, mut processed_frames, mut discarded_frames, mut skipped_frames) = (0, 0, 0, 0);
+    for (_, metrics) in &streams_metrics {
+        let snapshot = metrics.snapshot();
+        decoded_frames += snapshot.decoded_frames;
+        processed_frames += snapshot.processed_frames;
+        discarded_frames += snapshot.discarded_frames;
+        skipped_frames += snapshot.skipped_frames;
+        frame_latency.merge(metrics.get_frame_latency());
+    }
+    let to_ms = |seconds: Option<f64>| seconds.map(|seconds| seconds * 1000.0);
+
+    serde_json::json!({
+        "version": env!("CARGO_PKG_VERSION"),
+        "scenario": params.scenario,
+        "resolution": format!("{}x{}", params.width, params.height),
+        "streams": params.streams,
+        "frames_per_stream": params.frames,
+        "max_in_flight": params.max_in_flight,
+        "live": params.live,
+        "timed_out": timed_out,
+        "measured_streams": streams_metrics.len(),
+        "elapsed_s": elapsed,
+        "fps": processed_frames as f64 / elapsed,
+        "latency_p50_ms": to_ms(frame_latency.quantile(0.5)),
+        "latency_p99_ms": to_ms(frame_latency.quantile(0.99)),
+        "decoded_frames": decoded_frames,
+        "processed_frames": processed_frames,
+        // Frames that did not reach the end of the frame path, including the ones in flight at the end of the stream
+        "dropped_frames": decoded_frames.saturating_sub(processed_frames),
+        "discarded_frames": discarded_frames,
+        "skipped_frames": skipped_frames,
+        "cpu_percent": cpu_time.map(|cpu_time| cpu_time / elapsed * 100.0),
+        "rss_mb": process_rss_mb(),
+    })
+}
+
+fn main() {
+    pyo3::prepare_freethreaded_python();
+    gstreamer::init().expect("Unable to initialize gstreamer");
+    // The pipelines watch their gst buses from the GLib main loop
+    let glib_main_loop = glib::MainLoop::new(None, false);
+    std::thread::spawn({
+        let glib_main_loop = glib_main_loop.clone();
+        move || glib_main_loop.run()
+    });
+
+    let frames: u64 = env::var("BENCH_FRAMES").ok()
+        .and_then(|v| v.parse().ok())
+        .unwrap_or(300);
+    let resolutions: Vec<(usize, usize)> = parse_list::<String>("BENCH_RESOLUTIONS", vec![
+        "640x480".to_string(), "1280x720".to_string(), "1920x1080".to_string()
+    ]).iter()
+        .map(|resolution| resolution.split_once('x')
+            .and_then(|(w, h)| Some((w.parse().ok()?, h.parse().ok()?)))
+            .unwrap_or_else(|| panic!("Invalid resolution '{}'. Use WIDTHxHEIGHT", resolution)))
+        .collect();
+    let stream_counts: Vec<usize> = parse_list("BENCH_STREAMS", vec![1, 4]);
+    let max_in_flight_values: Vec<usize> = parse_list("BENCH_MAX_IN_FLIGHT", vec![num_cpus::get() * 2]);
+    let live = env::var("BENCH_LIVE").map_or(false, |v| v == "true");
+    let timeout = Duration::from_secs(env::var("BENCH_TIMEOUT").ok()
+        .and_then(|v| v.parse().ok())
+        .unwrap_or(300));
+
+    let stages = create_stages();
+    let all_scenarios: Vec<String> = stages.iter().map(|stage| stage.get_name().to_string()).collect();
+    let scenarios: Vec<String> = parse_list("BENCH_SCENARIOS", all_scenarios.clone());
+    for scenario in &scenarios {
+        if !all_scenarios.contains(scenario) {
+            panic!("Unknown scenario '{}'. Available scenarios: {}", scenario, all_scenarios.join(", "));
+        }
+    }
+    let frame_path_executor = Arc::new(RwLock::new(
+        pipeless::stages::path::FramePathExecutor::from_stages(stages)
+    ));
+
+    let rt = tokio::runtime::Runtime::new().expect("Unable to create Tokio runtime");
+    rt.block_on(async {
+        for max_in_flight in &max_in_flight_values {
+            let frame_scheduler = Arc::new(pipeless::scheduler::FrameScheduler::new(*max_in_flight));
+            let streams_table = Arc::new(RwLock::new(pipeless::config::streams::StreamsTable::new()));
+            let dispatcher = pipeless::dispatcher::Dispatcher::new(streams_table.clone());
+            let dispatcher_sender = dispatcher.get_sender();
+            pipeless::dispatcher::start(dispatcher, frame_path_executor.clone(), frame_scheduler, 240);
+
+            for (width, height) in &resolutions {
+                for streams in &stream_counts {
+                    for scenario in &scenarios {
+                        let params = RunParams {
+                            scenario, width: *width, height: *height, streams: *streams,
+                            frames, max_in_flight: *max_in_flight, live, timeout,
+                        };
+                        let result = run(&params, &streams_table, &dispatcher_sender).await;
+                        println!("{}", result);
+                    }
+                }
+            }
+        }
+    });
+
+    glib_main_loop.quit();
+}
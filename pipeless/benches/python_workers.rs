@@ -0,0 +1,86 @@
+//! Frames per second processed by a CPU bound stateless Python hook when running on the
+//! embedded interpreter (0 workers) and on different numbers of Python worker processes.
+//! Run with: cargo bench --bench python_workers
+//! BENCH_FRAMES sets the number of frames and BENCH_RESOLUTION the frame size (ex: 1280x720).
+//! The Python workers use the interpreter at PIPELESS_PYTHON, python3 by default.
+use std::{env, sync::Arc, time::Instant};
+use futures::StreamExt;
+use gstreamer as gst;
+use pipeless_ai as pipeless;
+use pipeless::stages::hook::{Hook, HookType};
+
+/// Holds the GIL during the whole execution, like most pure Python hooks
+const HOOK_CODE: &str = "
+def hook(frame_data, _):
+    frame = frame_data['modified']
+    total = 0
+    for i in range(200000):
+        total += i
+    frame[0, 0, 0] = total % 256
+";
+
+fn new_frame(width: usize, height: usize, frame_number: u64) -> pipeless::data::Frame {
+    let pixels = ndarray::Array3::<u8>::zeros((height, width, 3));
+    pipeless::data::Frame::new_rgb(
+        pixels.into(), width, height,
+        gst::ClockTime::ZERO, gst::ClockTime::ZERO, gst::ClockTime::ZERO,
+        30, 0.0,
+        uuid::Uuid::new_v4(), frame_number
+    )
+}
+
+/// Executes the hook over the frames with the same concurrency than the pipeline manager
+async fn run(hook: &Hook, frames: usize, width: usize, height: usize) -> f64 {
+    let context = Arc::new(pipeless::stages::stage::Context::EmptyContext);
+    let concurrency = num_cpus::get() * 2;
+    let start = Instant::now();
+    futures::stream::iter(0..frames)
+        .map(|n| hook.exec_hook(new_frame(width, height, n as u64 + 1), context.clone()))
+        .buffer_unordered(concurrency)
+        .for_each(|_| async {})
+        .await;
+    frames as f64 / start.elapsed().as_secs_f64()
+}
+
+fn main() {
+    pyo3::prepare_freethreaded_python();
+
+    let frames: usize = env::var("BENCH_FRAMES").ok()
+        .and_then(|v| v.parse().ok())
+        .unwrap_or(200);
+    let (width, height) = env::var("BENCH_RESOLUTION").ok()
+        .and_then(|v| {
+            let (w, h) = v.split_once('x')?;
+            Some((w.parse().ok()?, h.parse().ok()?))
+        })
+        .unwrap_or((1280, 720));
+
+    let max_workers = num_cpus::get();
+    let mut worker_counts = vec![0];
+    let mut workers = 1;
+    while workers < max_workers {
+        worker_counts.push(workers);
+        workers *= 2;
+    }
+    worker_counts.push(max_workers);
+
+    let rt = tokio::runtime::Runtime::new().expect("Unable to create Tokio runtime");
+    println!("workers,frames,resolution,fps");
+    for workers in worker_counts {
+        let hook = if workers == 0 {
+            Hook::new_stateless(HookType::Process, Arc::new(
+                pipeless::stages::languages::python::PythonHook::new(HookType::Process, "bench", HOOK_CODE)
+            ))
+        } else {
+            Hook::new_stateless(HookType::Process, Arc::new(
+                pipeless::stages::languages::python_workers::PythonWorkerPool::new(
+                    HookType::Process, "bench", HOOK_CODE, None, workers
+                ).expect("Unable to start the Python workers")
+            ))
+        };
+        // Warm up
+        rt.block_on(run(&hook, max_workers, width, height));
+        let fps = rt.block_on(run(&hook, frames, width, height));
+        println!("{},{},{}x{},{:.2}", workers, frames, width, height, fps);
+    }
+}
@@ -7,14 +7,17 @@ use tokio;
 use ctrlc;
 
 use crate as pipeless;
+use crate::stages::languages::python::pipeless_module;
 
-pub fn start_pipeless_node(project_dir: &str, export_redis_events: bool, stream_buffer_size: usize) {
+pub fn start_pipeless_node(project_dir: &str, export_redis_events: bool, export_events_file: Option<&str>, stream_buffer_size: usize, python_workers: usize, max_in_flight_frames: Option<usize>, lazy_stages: bool, watch: bool) {
     ctrlc::set_handler(|| {
         println!("Exiting...");
         std::process::exit(0);
     }).expect("Error setting Ctrl+C handler");
 
     pipeless::setup_logger();
+    // Register the native pipeless module. Must happen before the Python interpreter is initialized
+    pyo3::append_to_inittab!(pipeless_module);
     pyo3::prepare_freethreaded_python(); // Setup Pyo3
 
     // Initialize GLib mainloop
@@ -24,34 +27,43 @@ pub fn start_pipeless_node(project_dir: &str, export_redis_events: bool, stream_
     // Initialize Gstreamer
     gst::init().expect("Unable to initialize gstreamer");
 
-    let frame_path_executor = Arc::new(RwLock::new(pipeless::stages::path::FramePathExecutor::new(project_dir)));
+    let frame_path_executor = Arc::new(RwLock::new(pipeless::stages::path::FramePathExecutor::new(project_dir, python_workers, lazy_stages)));
+
+    // NOTE: Making benchmarks we found twice the number of CPUs is a good default
+    let max_in_flight_frames = max_in_flight_frames.unwrap_or_else(|| num_cpus::get() * 2);
+    let frame_scheduler = Arc::new(pipeless::scheduler::FrameScheduler::new(max_in_flight_frames));
 
     // Init Tokio runtime
     let tokio_rt = tokio::runtime::Runtime::new().expect("Unable to create Tokio runtime");
     tokio_rt.block_on(async {
         // Create event exporter when enabled
-        let event_exporter =
+        let mut event_sinks = vec![];
         if export_redis_events {
             let redis_url = env::var("PIPELESS_REDIS_URL")
                 .expect("Please export the PIPELESS_REDIS_URL environment variable in order to export events to Redis");
             let redis_channel = env::var("PIPELESS_REDIS_CHANNEL")
                 .expect("Please export the PIPELESS_REDIS_CHANNEL environment variable in order to export events to Redis");
-            pipeless::event_exporters::EventExporter::new_redis_exporter(&redis_url, &redis_channel).await
-        } else {
-            pipeless::event_exporters::EventExporter::new_none_exporter()
-        };
+            event_sinks.push(pipeless::event_exporters::EventSink::new_redis(&redis_url, &redis_channel));
+        }
+        if let Some(events_file) = export_events_file {
+            event_sinks.push(pipeless::event_exporters::EventSink::new_file(events_file));
+        }
         { // Context to lock the global event exporter in order to set it
-            let mut e_exp = pipeless::event_exporters::EVENT_EXPORTER.lock().await;
-            *e_exp = event_exporter;
+            let mut e_exp = pipeless::event_exporters::EVENT_EXPORTER.write().unwrap();
+            *e_exp = pipeless::event_exporters::EventExporter::new(event_sinks);
         }
 
         let streams_table = Arc::new(RwLock::new(pipeless::config::streams::StreamsTable::new()));
         let dispatcher = pipeless::dispatcher::Dispatcher::new(streams_table.clone());
         let dispatcher_sender = dispatcher.get_sender().clone();
-        pipeless::dispatcher::start(dispatcher, frame_path_executor, stream_buffer_size);
+        pipeless::dispatcher::start(dispatcher, frame_path_executor.clone(), frame_scheduler, stream_buffer_size);
+
+        if watch {
+            pipeless::stages::watcher::start(frame_path_executor.clone());
+        }
 
         // Use the REST adapter to manage streams
-        let rest_adapter = pipeless::config::adapters::rest::RestAdapter::new(streams_table.clone());
+        let rest_adapter = pipeless::config::adapters::rest::RestAdapter::new(streams_table.clone(), frame_path_executor);
         rest_adapter.start(dispatcher_sender);
     });
 
@@ -28,6 +28,12 @@ pub fn add(
     output_uri: &Option<String>,
     frame_path: &str,
     restart_policy: &Option<String>,
+    target_fps: &Option<u32>,
+    every_n_frames: &Option<u64>,
+    adaptive_skip: bool,
+    overload_mode: &Option<String>,
+    priority: &Option<u32>,
+    max_in_flight: &Option<usize>,
 ) {
     let url = "http://localhost:3030/streams";
 
@@ -37,6 +43,16 @@ pub fn add(
         "output_uri": output_uri,
         "frame_path": stages_vec,
         "restart_policy": restart_policy,
+        "input_rate_policy": {
+            "target_fps": target_fps,
+            "every_n_frames": every_n_frames,
+            "adaptive_skip": adaptive_skip,
+        },
+        "overload_mode": overload_mode,
+        "scheduling_policy": {
+            "priority": priority.unwrap_or(1),
+            "max_in_flight": max_in_flight,
+        },
     });
 
     let client = reqwest::blocking::Client::new();
@@ -68,6 +84,12 @@ pub fn update(
     output_uri: &Option<String>,
     frame_path: &Option<String>,
     restart_policy: &Option<String>,
+    target_fps: &Option<u32>,
+    every_n_frames: &Option<u64>,
+    adaptive_skip: &Option<bool>,
+    overload_mode: &Option<String>,
+    priority: &Option<u32>,
+    max_in_flight: &Option<usize>,
 ) {
     let url = "http://localhost:3030/streams";
 
@@ -81,12 +103,28 @@ pub fn update(
         None => vec![]
     };
 
-    let payload = json!({
+    let mut payload = json!({
         "input_uri": input_uri,
         "output_uri": output_uri,
         "frame_path": stages_vec,
         "restart_policy": restart_policy,
+        "overload_mode": overload_mode,
     });
+    // The input rate policy is replaced as a whole, so it is only sent when any option is provided
+    if target_fps.is_some() || every_n_frames.is_some() || adaptive_skip.is_some() {
+        payload["input_rate_policy"] = json!({
+            "target_fps": target_fps,
+            "every_n_frames": every_n_frames,
+            "adaptive_skip": adaptive_skip.unwrap_or(false),
+        });
+    }
+    // Same for the scheduling policy
+    if priority.is_some() || max_in_flight.is_some() {
+        payload["scheduling_policy"] = json!({
+            "priority": priority.unwrap_or(1),
+            "max_in_flight": max_in_flight,
+        });
+    }
 
     let client = reqwest::blocking::Client::new();
     let response = client.put(update_endpoint)
@@ -14,6 +14,9 @@ struct StreamBody {
     output_uri: Option<String>,
     frame_path: Option<Vec<String>>,
     restart_policy: Option<pipeless::config::streams::RestartPolicy>,
+    input_rate_policy: Option<pipeless::config::streams::InputRatePolicy>,
+    overload_mode: Option<pipeless::config::streams::OverloadMode>,
+    scheduling_policy: Option<pipeless::config::streams::SchedulingPolicy>,
 }
 
 async fn handle_get_streams(
@@ -29,43 +32,124 @@ async fn handle_get_streams(
     ))
 }
 
-async fn handle_add_stream(
-    stream: StreamBody,
-    streams_table: Arc<RwLock<pipeless::config::streams::StreamsTable>>,
-    dispatcher_sender: tokio::sync::mpsc::UnboundedSender<pipeless::dispatcher::DispatcherEvent>
+async fn handle_get_streams_metrics() -> Result<warp::reply::WithStatus<warp::reply::Json>, Infallible> {
+    let metrics = pipeless::metrics::get_streams_metrics();
+
+    Ok(warp::reply::with_status(
+        warp::reply::json(&json!(metrics)),
+        warp::http::StatusCode::OK,
+    ))
+}
+
+/// Metrics of the running streams in the Prometheus text format
+async fn handle_get_metrics() -> Result<warp::reply::WithHeader<String>, Infallible> {
+    Ok(warp::reply::with_header(
+        pipeless::metrics::render_prometheus(),
+        "content-type",
+        "text/plain; version=0.0.4",
+    ))
+}
+
+/// The node is ready when no stage is loading or failed to load.
+/// Cold stages are loaded by the first stream that uses them.
+async fn handle_get_ready(
+    frame_path_executor: Arc<RwLock<pipeless::stages::path::FramePathExecutor>>,
 ) -> Result<warp::reply::WithStatus<warp::reply::Json>, Infallible> {
-    let input_uri: String;
-    if let Some(uri) = stream.clone().input_uri {
-        input_uri = uri;
+    let stages = frame_path_executor.read()
+        .await
+        .get_stages_status();
+    let ready = stages.iter().all(|stage| matches!(
+        stage.get_state(),
+        pipeless::stages::stage::StageState::Warm | pipeless::stages::stage::StageState::Cold
+    ));
+    let status_code = if ready {
+        warp::http::StatusCode::OK
     } else {
+        warp::http::StatusCode::SERVICE_UNAVAILABLE
+    };
+
+    Ok(warp::reply::with_status(
+        warp::reply::json(&json!({"ready": ready, "stages": stages})),
+        status_code,
+    ))
+}
+
+/// Versions and load state of the stages in use
+async fn handle_get_stages(
+    frame_path_executor: Arc<RwLock<pipeless::stages::path::FramePathExecutor>>,
+) -> Result<warp::reply::Json, Infallible> {
+    let stages = frame_path_executor.read()
+        .await
+        .get_stages_status();
+    Ok(warp::reply::json(&json!({"stages": stages})))
+}
+
+/// Loads a new version of the stage from its files and replaces the running one
+async fn handle_reload_stage(
+    stage_name: String,
+    frame_path_executor: Arc<RwLock<pipeless::stages::path::FramePathExecutor>>,
+) -> Result<warp::reply::WithStatus<warp::reply::Json>, Infallible> {
+    let frame_path_executor = frame_path_executor.read().await;
+    if !frame_path_executor.get_stages_status().iter().any(|stage| stage.get_name() == stage_name) {
         return Ok(warp::reply::with_status(
-            warp::reply::json(&json!({"error": "Missing input URI"})),
-            warp::http::StatusCode::BAD_REQUEST,
+            warp::reply::json(&json!({"error": format!("{} stage does not exist", stage_name)})),
+            warp::http::StatusCode::NOT_FOUND,
         ));
     }
-    let frame_path;
-    if let Some(path) = stream.clone().frame_path {
-        frame_path = path;
-    } else {
-        return Ok(warp::reply::with_status(
-            warp::reply::json(&json!({"error": "Missing frame path. The ordered array of stages that the frame will go through"})),
-            warp::http::StatusCode::BAD_REQUEST,
-        ));
+    match frame_path_executor.reload_stage(&stage_name).await {
+        Ok(stage) => Ok(warp::reply::with_status(
+            warp::reply::json(&json!({"stage": stage})),
+            warp::http::StatusCode::OK,
+        )),
+        Err(err) => {
+            warn!("⚠️  {}", err);
+            Ok(warp::reply::with_status(
+                warp::reply::json(&json!({"error": err})),
+                warp::http::StatusCode::INTERNAL_SERVER_ERROR,
+            ))
+        }
     }
-    let output_uri = stream.output_uri.clone();
-    let restart_policy = match stream.clone().restart_policy {
+}
+
+/// Creates the table entry of a new stream
+fn new_entry_from_body(stream: StreamBody) -> Result<pipeless::config::streams::StreamsTableEntry, String> {
+    let input_uri = stream.input_uri
+        .ok_or("Missing input URI")?;
+    let frame_path = stream.frame_path
+        .ok_or("Missing frame path. The ordered array of stages that the frame will go through")?;
+    let restart_policy = match stream.restart_policy {
         Some(policy) => policy,
         None => {
             warn!("Restart policy not specified for stream, defaulting to 'never'");
             pipeless::config::streams::RestartPolicy::Never
         }
     };
-    let new_entry = pipeless::config::streams::StreamsTableEntry::new(
+    let input_rate_policy = stream.input_rate_policy.unwrap_or_default();
+    input_rate_policy.validate()?;
+    Ok(pipeless::config::streams::StreamsTableEntry::new(
         input_uri,
-        output_uri,
+        stream.output_uri,
         frame_path,
         restart_policy,
-    );
+    ).with_input_rate_policy(input_rate_policy)
+    .with_overload_mode(stream.overload_mode.unwrap_or_default())
+    .with_scheduling_policy(stream.scheduling_policy.unwrap_or_default()))
+}
+
+async fn handle_add_stream(
+    stream: StreamBody,
+    streams_table: Arc<RwLock<pipeless::config::streams::StreamsTable>>,
+    dispatcher_sender: tokio::sync::mpsc::UnboundedSender<pipeless::dispatcher::DispatcherEvent>
+) -> Result<warp::reply::WithStatus<warp::reply::Json>, Infallible> {
+    let new_entry = match new_entry_from_body(stream) {
+        Ok(entry) => entry,
+        Err(err) => {
+            return Ok(warp::reply::with_status(
+                warp::reply::json(&json!({"error": err})),
+                warp::http::StatusCode::BAD_REQUEST,
+            ));
+        }
+    };
     {
         let res = streams_table.write()
             .await
@@ -74,7 +158,7 @@ async fn handle_add_stream(
         if let Err(err) = res {
             return Ok(warp::reply::with_status(
                 warp::reply::json(&json!({"error": format!("Error adding new stream to the table: {}", err)})),
-                warp::http::StatusCode::INTERNAL_SERVER_ERROR,
+                warp::http::StatusCode::CONFLICT,
             ));
         }
     }
@@ -95,6 +179,51 @@ async fn handle_add_stream(
     ))
 }
 
+/// Adds several streams at once. No stream is added when any of them is not valid.
+async fn handle_add_streams(
+    streams: Vec<StreamBody>,
+    streams_table: Arc<RwLock<pipeless::config::streams::StreamsTable>>,
+    dispatcher_sender: tokio::sync::mpsc::UnboundedSender<pipeless::dispatcher::DispatcherEvent>
+) -> Result<warp::reply::WithStatus<warp::reply::Json>, Infallible> {
+    let mut new_entries = Vec::with_capacity(streams.len());
+    for (index, stream) in streams.into_iter().enumerate() {
+        match new_entry_from_body(stream) {
+            Ok(entry) => new_entries.push(entry),
+            Err(err) => {
+                return Ok(warp::reply::with_status(
+                    warp::reply::json(&json!({"error": format!("Stream {}: {}", index, err)})),
+                    warp::http::StatusCode::BAD_REQUEST,
+                ));
+            }
+        }
+    }
+    {
+        let res = streams_table.write()
+            .await
+            .add_many(new_entries.clone());
+
+        if let Err(err) = res {
+            return Ok(warp::reply::with_status(
+                warp::reply::json(&json!({"error": format!("Error adding new streams to the table: {}", err)})),
+                warp::http::StatusCode::CONFLICT,
+            ));
+        }
+    }
+
+    // A single reconciliation for all the streams
+    if let Err(err) = dispatcher_sender.send(pipeless::dispatcher::DispatcherEvent::TableChange) {
+        return Ok(warp::reply::with_status(
+            warp::reply::json(&json!({"error": err.to_string()})),
+            warp::http::StatusCode::INTERNAL_SERVER_ERROR,
+        ));
+    }
+
+    Ok(warp::reply::with_status(
+        warp::reply::json(&new_entries),
+        warp::http::StatusCode::OK,
+    ))
+}
+
 async fn handle_update_stream(
     id: uuid::Uuid,
     stream: StreamBody,
@@ -164,10 +293,74 @@ async fn handle_update_stream(
             ));
         }
     }
+    let input_rate_policy: pipeless::config::streams::InputRatePolicy;
+    if let Some(policy) = stream.clone().input_rate_policy {
+        if let Err(err) = policy.validate() {
+            return Ok(warp::reply::with_status(
+                warp::reply::json(&json!({"error": err})),
+                warp::http::StatusCode::BAD_REQUEST,
+            ));
+        }
+        input_rate_policy = policy;
+    } else {
+        if let Some(entry) = streams_table.read()
+            .await
+            .get_entry_by_id(id)
+        {
+            input_rate_policy = entry.get_input_rate_policy();
+        } else {
+            return Ok(warp::reply::with_status(
+                warp::reply::json(&json!({"error": "Stream entry not found"})),
+                warp::http::StatusCode::NOT_FOUND,
+            ));
+        }
+    }
+    let overload_mode: pipeless::config::streams::OverloadMode;
+    if let Some(mode) = stream.clone().overload_mode {
+        overload_mode = mode;
+    } else {
+        if let Some(entry) = streams_table.read()
+            .await
+            .get_entry_by_id(id)
+        {
+            overload_mode = entry.get_overload_mode();
+        } else {
+            return Ok(warp::reply::with_status(
+                warp::reply::json(&json!({"error": "Stream entry not found"})),
+                warp::http::StatusCode::NOT_FOUND,
+            ));
+        }
+    }
+    let scheduling_policy: pipeless::config::streams::SchedulingPolicy;
+    if let Some(policy) = stream.clone().scheduling_policy {
+        scheduling_policy = policy;
+    } else {
+        if let Some(entry) = streams_table.read()
+            .await
+            .get_entry_by_id(id)
+        {
+            scheduling_policy = entry.get_scheduling_policy();
+        } else {
+            return Ok(warp::reply::with_status(
+                warp::reply::json(&json!({"error": "Stream entry not found"})),
+                warp::http::StatusCode::NOT_FOUND,
+            ));
+        }
+    }
     {
-        streams_table.write()
+        let res = streams_table.write()
             .await
-            .update_by_entry_id(id, &input_uri, output_uri, frame_path, restart_policy);
+            .update_by_entry_id(
+                id, &input_uri, output_uri, frame_path, restart_policy,
+                input_rate_policy, overload_mode, scheduling_policy
+            );
+
+        if let Err(err) = res {
+            return Ok(warp::reply::with_status(
+                warp::reply::json(&json!({"error": format!("Error updating the stream: {}", err)})),
+                warp::http::StatusCode::CONFLICT,
+            ));
+        }
     }
 
     match dispatcher_sender.send(pipeless::dispatcher::DispatcherEvent::TableChange) {
@@ -201,6 +394,9 @@ async fn handle_remove_stream(
             output_uri: entry.get_output_uri().map(|s| s.to_string()),
             frame_path: Some(entry.get_frame_path().to_owned()),
             restart_policy: Some(entry.get_restart_policy()),
+            input_rate_policy: Some(entry.get_input_rate_policy()),
+            overload_mode: Some(entry.get_overload_mode()),
+            scheduling_policy: Some(entry.get_scheduling_policy()),
         };
 
         match dispatcher_sender.send(pipeless::dispatcher::DispatcherEvent::TableChange) {
@@ -226,16 +422,53 @@ async fn handle_remove_stream(
 
 }
 
+/// Removes several streams at once. Returns the ids of the removed streams and the ones not found.
+async fn handle_remove_streams(
+    ids: Vec<uuid::Uuid>,
+    streams_table: Arc<RwLock<pipeless::config::streams::StreamsTable>>,
+    dispatcher_sender: tokio::sync::mpsc::UnboundedSender<pipeless::dispatcher::DispatcherEvent>
+) -> Result<warp::reply::WithStatus<warp::reply::Json>, Infallible> {
+    let mut removed = vec![];
+    let mut not_found = vec![];
+    {
+        let mut streams_table_guard = streams_table.write().await;
+        for id in ids {
+            match streams_table_guard.remove(id) {
+                Some(_) => removed.push(id),
+                None => not_found.push(id),
+            }
+        }
+    }
+
+    if !removed.is_empty() {
+        if let Err(err) = dispatcher_sender.send(pipeless::dispatcher::DispatcherEvent::TableChange) {
+            return Ok(warp::reply::with_status(
+                warp::reply::json(&json!({"error": err.to_string()})),
+                warp::http::StatusCode::INTERNAL_SERVER_ERROR,
+            ));
+        }
+    }
+
+    Ok(warp::reply::with_status(
+        warp::reply::json(&json!({"removed": removed, "not_found": not_found})),
+        warp::http::StatusCode::OK,
+    ))
+}
+
 /// The REST config adapter allows to edit the streams config table via a REST API
 /// Ex:
 ///    $ curl -X POST localhost:1234/new_stream?input="some_uri"&output="some_uri"
 ///
 pub struct RestAdapter {
     streams_table: Arc<RwLock<pipeless::config::streams::StreamsTable>>,
+    frame_path_executor: Arc<RwLock<pipeless::stages::path::FramePathExecutor>>,
 }
 impl RestAdapter {
-    pub fn new(streams_table: Arc<RwLock<pipeless::config::streams::StreamsTable>>) -> Self {
-        Self { streams_table }
+    pub fn new(
+        streams_table: Arc<RwLock<pipeless::config::streams::StreamsTable>>,
+        frame_path_executor: Arc<RwLock<pipeless::stages::path::FramePathExecutor>>,
+    ) -> Self {
+        Self { streams_table, frame_path_executor }
     }
 
     pub fn start(
@@ -244,6 +477,49 @@ impl RestAdapter {
     ) {
         let streams_table = self.streams_table.clone();
         let dispatcher_sender = _dispatcher_sender.clone();
+        let frame_path_executor = self.frame_path_executor.clone();
+
+        let get_ready = warp::get()
+            .and(warp::path("ready"))
+            .then(move || {
+                let frame_path_executor = frame_path_executor.clone();
+                async move {
+                    handle_get_ready(frame_path_executor).await
+                }
+            });
+
+        let get_stages = warp::get()
+            .and(warp::path!("stages"))
+            .then({
+                let frame_path_executor = self.frame_path_executor.clone();
+                move || {
+                    let frame_path_executor = frame_path_executor.clone();
+                    async move {
+                        handle_get_stages(frame_path_executor).await
+                    }
+                }
+            });
+
+        let reload_stage = warp::post()
+            .and(warp::path!("stages" / String / "reload"))
+            .then({
+                let frame_path_executor = self.frame_path_executor.clone();
+                move |stage_name: String| {
+                    let frame_path_executor = frame_path_executor.clone();
+                    async move {
+                        handle_reload_stage(stage_name, frame_path_executor).await
+                    }
+                }
+            });
+
+        // Must be defined before get_streams, which matches any path starting with streams
+        let get_streams_metrics = warp::get()
+            .and(warp::path!("streams" / "metrics"))
+            .then(|| async { handle_get_streams_metrics().await });
+
+        let get_metrics = warp::get()
+            .and(warp::path!("metrics"))
+            .then(|| async { handle_get_metrics().await });
 
         let get_streams = warp::get()
             .and(warp::path("streams"))
@@ -257,6 +533,37 @@ impl RestAdapter {
                 }
             });
 
+        // Must be defined before the single stream routes
+        let add_streams = warp::post()
+            .and(warp::path!("streams" / "bulk"))
+            .and(warp::body::json())
+            .then({
+                let streams_table = streams_table.clone();
+                let dispatcher_sender = dispatcher_sender.clone();
+                move |streams: Vec<StreamBody>| {
+                    let streams_table = streams_table.clone();
+                    let dispatcher_sender = dispatcher_sender.clone();
+                    async move {
+                        handle_add_streams(streams, streams_table, dispatcher_sender).await
+                    }
+                }
+            });
+
+        let remove_streams = warp::delete()
+            .and(warp::path!("streams" / "bulk"))
+            .and(warp::body::json())
+            .then({
+                let streams_table = streams_table.clone();
+                let dispatcher_sender = dispatcher_sender.clone();
+                move |ids: Vec<uuid::Uuid>| {
+                    let streams_table = streams_table.clone();
+                    let dispatcher_sender = dispatcher_sender.clone();
+                    async move {
+                        handle_remove_streams(ids, streams_table, dispatcher_sender).await
+                    }
+                }
+            });
+
         let add_stream = warp::post()
             .and(warp::path("streams"))
             .and(warp::body::json())
@@ -303,10 +610,17 @@ impl RestAdapter {
                 }
             });
 
-        let streams_endpoint = get_streams
+        let streams_endpoint = get_streams_metrics
+            .or(add_streams)
+            .or(remove_streams)
+            .or(get_streams)
             .or(add_stream)
             .or(update_stream)
-            .or(remove_stream);
+            .or(remove_stream)
+            .or(get_ready)
+            .or(get_metrics)
+            .or(get_stages)
+            .or(reload_stage);
 
         let server = warp::serve(streams_endpoint)
             .run(([0, 0, 0, 0], 3030));
@@ -1,6 +1,6 @@
 use std::fmt;
 use std::hash::{Hash, Hasher};
-use std::collections::hash_map::DefaultHasher;
+use std::collections::{hash_map::DefaultHasher, HashMap, HashSet};
 use std::str::FromStr;
 use log::{error, warn};
 use serde_derive::{Serialize, Deserialize};
@@ -75,6 +75,180 @@ impl fmt::Display for RestartPolicy {
     }
 }
 
+#[derive(Debug,Clone,Serialize,Deserialize,PartialEq)]
+pub struct OverloadModeError;
+impl fmt::Display for OverloadModeError {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        write!(f, "Unknown overload mode")
+    }
+}
+
+/// Defines what happens with the input frames that can't enter
+/// the frame path because the stream buffer is full.
+/// The output drops the frames older than the last frame it pushed, so a pass-through frame
+/// is held back until the processed frames before it reach the output (up to 1 second).
+/// The hold is reported by pipeless_passthrough_hold_seconds.
+#[derive(Debug,Copy,Clone,Default,Serialize,PartialEq)]
+pub enum OverloadMode {
+    #[default]
+    Discard, // The frames are lost
+    PassThrough, // The frames are sent to the output without processing them
+    PassThroughAnnotated, // Same as PassThrough, redrawing the annotations of the last processed frame
+}
+impl FromStr for OverloadMode {
+    type Err = OverloadModeError;
+    fn from_str(s: &str) -> Result<Self, Self::Err> {
+        match s {
+            "discard" | "Discard" => Ok(Self::Discard),
+            "pass_through" | "PassThrough" | "passthrough" => Ok(Self::PassThrough),
+            "pass_through_annotated" | "PassThroughAnnotated" | "passthrough_annotated" => Ok(Self::PassThroughAnnotated),
+            _ => Err(OverloadModeError),
+        }
+    }
+}
+impl<'de> serde::Deserialize<'de> for OverloadMode {
+    fn deserialize<D>(deserializer: D) -> Result<Self, D::Error>
+    where
+        D: serde::Deserializer<'de>,
+    {
+        let s: String = serde::Deserialize::deserialize(deserializer)?;
+
+        match s.parse::<OverloadMode>() {
+            Ok(overload_mode) => Ok(overload_mode),
+            Err(err) => Err(serde::de::Error::custom(format!("Error parsing overload mode: {}", err))),
+        }
+    }
+}
+impl fmt::Display for OverloadMode {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        match self {
+            OverloadMode::Discard => write!(f, "discard"),
+            OverloadMode::PassThrough => write!(f, "pass_through"),
+            OverloadMode::PassThroughAnnotated => write!(f, "pass_through_annotated"),
+        }
+    }
+}
+
+/// The input max rate is a positive i32
+fn is_valid_target_fps(fps: u32) -> bool {
+    fps > 0 && fps <= i32::MAX as u32
+}
+
+/// Rate policy applied to the input frames of a stream.
+/// The frames skipped by the policy are dropped right after decoding,
+/// before they are converted and copied into Pipeless frames.
+/// The different options can be combined.
+#[derive(Debug,Copy,Clone,Default,Serialize,Deserialize,PartialEq)]
+pub struct InputRatePolicy {
+    /// Max number of frames per second taken from the input
+    #[serde(default)]
+    target_fps: Option<u32>,
+    /// Take only one of every N input frames
+    #[serde(default)]
+    every_n_frames: Option<u64>,
+    /// Skip frames according to the occupancy of the stream buffer
+    #[serde(default)]
+    adaptive_skip: bool,
+}
+impl InputRatePolicy {
+    pub fn new(target_fps: Option<u32>, every_n_frames: Option<u64>, adaptive_skip: bool) -> Self {
+        Self {
+            // 0 would mean to drop every frame, which makes no sense
+            target_fps: target_fps.filter(|fps| is_valid_target_fps(*fps)),
+            every_n_frames: every_n_frames.filter(|n| *n > 1),
+            adaptive_skip,
+        }
+    }
+
+    /// Returns an error when the policy can't be applied to the input
+    pub fn validate(&self) -> Result<(), String> {
+        match self.target_fps {
+            Some(fps) if !is_valid_target_fps(fps) => Err(format!("Invalid target_fps {}. It must be between 1 and {}", fps, i32::MAX)),
+            _ => Ok(()),
+        }
+    }
+
+    pub fn get_target_fps(&self) -> Option<u32> {
+        self.target_fps.filter(|fps| is_valid_target_fps(*fps))
+    }
+
+    pub fn get_every_n_frames(&self) -> Option<u64> {
+        self.every_n_frames.filter(|n| *n > 1)
+    }
+
+    pub fn get_adaptive_skip(&self) -> bool {
+        self.adaptive_skip
+    }
+
+    /// True when every input frame is taken
+    pub fn is_all_frames(&self) -> bool {
+        self.get_target_fps().is_none() && self.get_every_n_frames().is_none() && !self.adaptive_skip
+    }
+}
+impl fmt::Display for InputRatePolicy {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        if self.is_all_frames() {
+            return write!(f, "all");
+        }
+        let mut parts = vec![];
+        if let Some(fps) = self.get_target_fps() {
+            parts.push(format!("max {} fps", fps));
+        }
+        if let Some(n) = self.get_every_n_frames() {
+            parts.push(format!("1 every {}", n));
+        }
+        if self.adaptive_skip {
+            parts.push("adaptive".to_string());
+        }
+        write!(f, "{}", parts.join(", "))
+    }
+}
+
+fn default_priority() -> u32 { 1 }
+
+/// Share of the node processing capacity that a stream gets.
+/// The frame scheduler splits the in-flight frame budget of the node among the streams
+/// proportionally to their priority, and never runs more than max_in_flight frames of the stream at once.
+#[derive(Debug,Copy,Clone,Serialize,Deserialize,PartialEq)]
+pub struct SchedulingPolicy {
+    /// Weight of the stream. A stream with priority 2 gets twice the frames processed than one with priority 1
+    #[serde(default = "default_priority")]
+    priority: u32,
+    /// Max number of frames of the stream processed concurrently. Unbounded when not provided.
+    #[serde(default)]
+    max_in_flight: Option<usize>,
+}
+impl Default for SchedulingPolicy {
+    fn default() -> Self {
+        Self { priority: default_priority(), max_in_flight: None }
+    }
+}
+impl SchedulingPolicy {
+    pub fn new(priority: Option<u32>, max_in_flight: Option<usize>) -> Self {
+        Self {
+            // A stream with priority 0 would never be processed
+            priority: priority.filter(|p| *p > 0).unwrap_or_else(default_priority),
+            max_in_flight: max_in_flight.filter(|n| *n > 0),
+        }
+    }
+
+    pub fn get_priority(&self) -> u32 {
+        self.priority.max(1)
+    }
+
+    pub fn get_max_in_flight(&self) -> Option<usize> {
+        self.max_in_flight.filter(|n| *n > 0)
+    }
+}
+impl fmt::Display for SchedulingPolicy {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        match self.get_max_in_flight() {
+            Some(max) => write!(f, "priority {}, max {} in flight", self.get_priority(), max),
+            None => write!(f, "priority {}", self.get_priority()),
+        }
+    }
+}
+
 fn calculate_hash<T: Hash>(data: &T) -> u64 {
     let mut hasher = DefaultHasher::new();
     data.hash(&mut hasher);
@@ -85,7 +259,10 @@ fn calculate_entry_hash(
     input_uri: &str,
     output_uri: Option<&str>,
     frame_path: &Vec<String>,
-    restart_policy: &RestartPolicy
+    restart_policy: &RestartPolicy,
+    input_rate_policy: &InputRatePolicy,
+    overload_mode: &OverloadMode,
+    scheduling_policy: &SchedulingPolicy,
 ) -> u64 {
     let mut hash = calculate_hash(&input_uri);
     if let Some(out_uri) = output_uri {
@@ -94,6 +271,9 @@ fn calculate_entry_hash(
     }
     hash = hash ^ calculate_hash(&frame_path.join("/"));
     hash = hash ^ calculate_hash(&restart_policy.to_string());
+    hash = hash ^ calculate_hash(&format!("{:?}", input_rate_policy));
+    hash = hash ^ calculate_hash(&overload_mode.to_string());
+    hash = hash ^ calculate_hash(&format!("{:?}", scheduling_policy));
     hash
 }
 
@@ -120,6 +300,12 @@ pub struct StreamsTableEntry {
     hash: u64,
     target_state: StreamEntryState,
     restart_policy: RestartPolicy,
+    #[serde(default)]
+    input_rate_policy: InputRatePolicy,
+    #[serde(default)]
+    overload_mode: OverloadMode,
+    #[serde(default)]
+    scheduling_policy: SchedulingPolicy,
 }
 impl StreamsTableEntry {
     pub fn new(
@@ -131,7 +317,13 @@ impl StreamsTableEntry {
         // We have to use underscores when providing the stage names as modules to some laguages like Python.
         let sanitized_frame_path: Vec<String> = frame_path.iter().map(|s| s.replace("-", "_")).collect();
 
-        let entry_hash = calculate_entry_hash(&input_uri, output_uri.as_deref(), &sanitized_frame_path, &restart_policy);
+        let input_rate_policy = InputRatePolicy::default();
+        let overload_mode = OverloadMode::default();
+        let scheduling_policy = SchedulingPolicy::default();
+        let entry_hash = calculate_entry_hash(
+            &input_uri, output_uri.as_deref(), &sanitized_frame_path,
+            &restart_policy, &input_rate_policy, &overload_mode, &scheduling_policy
+        );
 
         let mut restart_policy = restart_policy;
         let using_input_file = input_uri.starts_with("file://");
@@ -155,9 +347,33 @@ impl StreamsTableEntry {
             hash: entry_hash,
             target_state: StreamEntryState::Running,
             restart_policy,
+            input_rate_policy,
+            overload_mode,
+            scheduling_policy,
         }
     }
 
+    /// Sets the input rate policy of a new entry
+    pub fn with_input_rate_policy(mut self, input_rate_policy: InputRatePolicy) -> Self {
+        self.input_rate_policy = input_rate_policy;
+        self.hash = self.hash();
+        self
+    }
+
+    /// Sets the overload mode of a new entry
+    pub fn with_overload_mode(mut self, overload_mode: OverloadMode) -> Self {
+        self.overload_mode = overload_mode;
+        self.hash = self.hash();
+        self
+    }
+
+    /// Sets the scheduling policy of a new entry
+    pub fn with_scheduling_policy(mut self, scheduling_policy: SchedulingPolicy) -> Self {
+        self.scheduling_policy = scheduling_policy;
+        self.hash = self.hash();
+        self
+    }
+
     pub fn get_id(&self) -> uuid::Uuid {
         self.id
     }
@@ -206,7 +422,10 @@ impl StreamsTableEntry {
             self.get_input_uri(),
             self.get_output_uri(),
             self.get_frame_path(),
-            &self.get_restart_policy()
+            &self.get_restart_policy(),
+            &self.get_input_rate_policy(),
+            &self.get_overload_mode(),
+            &self.get_scheduling_policy(),
         )
     }
 
@@ -225,9 +444,33 @@ impl StreamsTableEntry {
     pub fn get_restart_policy(&self) -> RestartPolicy {
         self.restart_policy
     }
+
+    pub fn set_input_rate_policy(&mut self, input_rate_policy: InputRatePolicy) {
+        self.input_rate_policy = input_rate_policy;
+    }
+
+    pub fn get_input_rate_policy(&self) -> InputRatePolicy {
+        self.input_rate_policy
+    }
+
+    pub fn set_overload_mode(&mut self, overload_mode: OverloadMode) {
+        self.overload_mode = overload_mode;
+    }
+
+    pub fn get_overload_mode(&self) -> OverloadMode {
+        self.overload_mode
+    }
+
+    pub fn set_scheduling_policy(&mut self, scheduling_policy: SchedulingPolicy) {
+        self.scheduling_policy = scheduling_policy;
+    }
+
+    pub fn get_scheduling_policy(&self) -> SchedulingPolicy {
+        self.scheduling_policy
+    }
 }
 impl Tabled for StreamsTableEntry {
-    const LENGTH: usize = 6;
+    const LENGTH: usize = 9;
 
     fn fields(&self) -> Vec<std::borrow::Cow<'_, str>> {
         vec![
@@ -237,6 +480,9 @@ impl Tabled for StreamsTableEntry {
             self.frame_path.join(" -> ").into(),
             self.target_state.to_string().into(),
             self.restart_policy.to_string().into(),
+            self.input_rate_policy.to_string().into(),
+            self.overload_mode.to_string().into(),
+            self.scheduling_policy.to_string().into(),
         ]
     }
 
@@ -247,84 +493,231 @@ impl Tabled for StreamsTableEntry {
             "Output URI".into(),
             "Frame Path".into(),
             "State".into(),
-            "Restart Policy".into()
+            "Restart Policy".into(),
+            "Input Rate".into(),
+            "Overload Mode".into(),
+            "Scheduling".into(),
         ]
     }
 }
 
+/// Changes of the streams table since the last reconciliation
+#[derive(Default)]
+pub struct TableChanges {
+    /// Entries added or modified since the last reconciliation
+    entries: Vec<StreamsTableEntry>,
+    /// Pipelines of the removed or updated entries, which must be stopped
+    stale_pipelines: Vec<uuid::Uuid>,
+}
+impl TableChanges {
+    pub fn get_entries(&self) -> &Vec<StreamsTableEntry> {
+        &self.entries
+    }
+    pub fn get_stale_pipelines(&self) -> &Vec<uuid::Uuid> {
+        &self.stale_pipelines
+    }
+}
+
 /// Represents the Pipeless dynamic streams configuration
-/// which is modified by the user ahdn automatically handled
+/// which is modified by the user ahdn automatically handled.
+/// The entries are indexed by id, pipeline id and URIs, and the table records
+/// the changed entries, so the dispatcher only reconciles those.
+/// The URIs and pipeline of the entries must be modified through the table to keep the indexes.
 pub struct StreamsTable {
-    table: Vec<StreamsTableEntry>,
+    table: indexmap::IndexMap<uuid::Uuid, StreamsTableEntry>,
+    by_pipeline_id: HashMap<uuid::Uuid, uuid::Uuid>,
+    by_input_uri: HashMap<String, uuid::Uuid>,
+    by_output_uri: HashMap<String, uuid::Uuid>,
+    changed_entries: HashSet<uuid::Uuid>,
+    stale_pipelines: Vec<uuid::Uuid>,
 }
 impl StreamsTable {
     pub fn new() -> Self {
         Self {
-            table: Vec::new(),
+            table: indexmap::IndexMap::new(),
+            by_pipeline_id: HashMap::new(),
+            by_input_uri: HashMap::new(),
+            by_output_uri: HashMap::new(),
+            changed_entries: HashSet::new(),
+            stale_pipelines: Vec::new(),
         }
     }
 
     /// Get a copy of the streams table
     pub fn get_table(&self) -> Vec<StreamsTableEntry> {
-        self.table.clone()
+        self.table.values().cloned().collect()
+    }
+
+    /// Returns an error when another entry uses the same input or output URI
+    fn check_uris(&self, entry_id: uuid::Uuid, input_uri: &str, output_uri: Option<&str>) -> Result<(), String> {
+        if self.by_input_uri.get(input_uri).map_or(false, |id| *id != entry_id) {
+            return Err(format!("Duplicated input URI {}", input_uri));
+        }
+        if let Some(output_uri) = output_uri {
+            if self.by_output_uri.get(output_uri).map_or(false, |id| *id != entry_id) {
+                return Err(format!("Duplicated output URI {}", output_uri));
+            }
+        }
+        Ok(())
+    }
+
+    fn index(&mut self, entry: &StreamsTableEntry) {
+        self.by_input_uri.insert(entry.input_uri.clone(), entry.id);
+        if let Some(output_uri) = &entry.output_uri {
+            self.by_output_uri.insert(output_uri.clone(), entry.id);
+        }
+        if let Some(pipeline_id) = entry.pipeline_id {
+            self.by_pipeline_id.insert(pipeline_id, entry.id);
+        }
+    }
+
+    fn unindex(&mut self, entry: &StreamsTableEntry) {
+        self.by_input_uri.remove(&entry.input_uri);
+        if let Some(output_uri) = &entry.output_uri {
+            self.by_output_uri.remove(output_uri);
+        }
+        if let Some(pipeline_id) = entry.pipeline_id {
+            self.by_pipeline_id.remove(&pipeline_id);
+        }
     }
 
     pub fn add(&mut self, entry: StreamsTableEntry) -> Result<(), String> {
-        self.table.push(entry);
+        if self.table.contains_key(&entry.id) {
+            return Err(format!("Duplicated stream id {}", entry.id));
+        }
+        self.check_uris(entry.id, &entry.input_uri, entry.output_uri.as_deref())?;
+        if entry.pipeline_id.map_or(false, |pipeline_id| self.by_pipeline_id.contains_key(&pipeline_id)) {
+            return Err("Pipeline ID already assigned to another entry".to_string());
+        }
+        self.index(&entry);
+        self.changed_entries.insert(entry.id);
+        self.table.insert(entry.id, entry);
+        Ok(())
+    }
+
+    /// Adds all the entries or none of them when any of them can't be added
+    pub fn add_many(&mut self, entries: Vec<StreamsTableEntry>) -> Result<(), String> {
+        let mut input_uris = HashSet::new();
+        let mut output_uris = HashSet::new();
+        for entry in &entries {
+            self.check_uris(entry.id, &entry.input_uri, entry.output_uri.as_deref())?;
+            if !input_uris.insert(entry.input_uri.as_str()) {
+                return Err(format!("Duplicated input URI {}", entry.input_uri));
+            }
+            if let Some(output_uri) = &entry.output_uri {
+                if !output_uris.insert(output_uri.as_str()) {
+                    return Err(format!("Duplicated output URI {}", output_uri));
+                }
+            }
+        }
+        for entry in entries {
+            self.add(entry)?;
+        }
         Ok(())
     }
 
     pub fn get_entry_by_id(&self, entry_id: uuid::Uuid) -> Option<&StreamsTableEntry> {
-        self.table.iter().find(|entry| entry.get_id() == entry_id)
+        self.table.get(&entry_id)
+    }
+
+    pub fn find_by_input_uri(&self, input_uri: &str) -> Option<&StreamsTableEntry> {
+        self.by_input_uri.get(input_uri).and_then(|id| self.table.get(id))
+    }
+
+    pub fn find_by_output_uri(&self, output_uri: &str) -> Option<&StreamsTableEntry> {
+        self.by_output_uri.get(output_uri).and_then(|id| self.table.get(id))
     }
 
     pub fn remove(&mut self, stream_id: uuid::Uuid) -> Option<StreamsTableEntry> {
-        if let Some(index) = self.table.iter().position(|entry| entry.id == stream_id) {
-            let removed_entry = self.table.remove(index);
-            Some(removed_entry)
-        } else {
-            None
+        let removed_entry = self.table.shift_remove(&stream_id)?;
+        self.unindex(&removed_entry);
+        self.changed_entries.remove(&stream_id);
+        if let Some(pipeline_id) = removed_entry.pipeline_id {
+            self.stale_pipelines.push(pipeline_id);
         }
+        Some(removed_entry)
     }
 
     pub fn set_stream_pipeline(&mut self, stream_id: uuid::Uuid, pipeline_id: uuid::Uuid) -> Result<(), String> {
-        if self.table.iter().any(|entry| entry.pipeline_id == Some(pipeline_id)) {
+        if self.by_pipeline_id.contains_key(&pipeline_id) {
             return Err("Pipeline ID already assigned to another entry".to_string());
         }
 
-        if let Some(entry) = self.table.iter_mut().find(|entry| entry.id == stream_id) {
+        if let Some(entry) = self.table.get_mut(&stream_id) {
+            if let Some(previous_pipeline_id) = entry.pipeline_id {
+                self.by_pipeline_id.remove(&previous_pipeline_id);
+            }
             entry.assign_pipeline(pipeline_id);
+            self.by_pipeline_id.insert(pipeline_id, stream_id);
             Ok(())
         } else {
             Err("Entry not found".to_string())
         }
     }
 
+    /// Removes the pipeline from its entry, which will be reconciled again,
+    /// and returns the entry to update its target state
+    pub fn unassign_pipeline(&mut self, pipeline_id: uuid::Uuid) -> Option<&mut StreamsTableEntry> {
+        let stream_id = self.by_pipeline_id.remove(&pipeline_id)?;
+        self.changed_entries.insert(stream_id);
+        let entry = self.table.get_mut(&stream_id)?;
+        entry.unassign_pipeline();
+        Some(entry)
+    }
+
     /// Since pipeline_ids are unique we can get an entry by pipeline id
     pub fn get_entry_by_pipeline_id(&mut self, pipeline_id: uuid::Uuid) -> Option<&mut StreamsTableEntry> {
-        self.table.iter_mut().find(|entry| entry.pipeline_id == Some(pipeline_id))
+        self.find_by_pipeline_id_mut(pipeline_id)
     }
 
     pub fn find_by_pipeline_id(&self, pipeline_id: uuid::Uuid) -> Option<&StreamsTableEntry> {
-        self.table.iter().find(|entry| entry.get_pipeline() == Some(pipeline_id))
+        self.by_pipeline_id.get(&pipeline_id).and_then(|id| self.table.get(id))
     }
     pub fn find_by_pipeline_id_mut(&mut self, pipeline_id: uuid::Uuid) -> Option<&mut StreamsTableEntry> {
-        self.table.iter_mut().find(|entry| entry.get_pipeline() == Some(pipeline_id))
+        let stream_id = self.by_pipeline_id.get(&pipeline_id)?;
+        self.table.get_mut(stream_id)
     }
 
+    /// Updates an entry. Its pipeline, if any, must be stopped and a new one created.
     pub fn update_by_entry_id(
         &mut self, entry_id: uuid::Uuid, input_uri: &str, output_uri: Option<String>,
-        frame_path: Vec<String>, restart_policy: RestartPolicy
-    ) {
-        if let Some(entry) = self.table.iter_mut().find(|entry| entry.id == entry_id) {
-            entry.unassign_pipeline();
-            entry.set_input_uri(input_uri);
-            entry.set_output_uri(output_uri);
-            entry.set_frame_path(frame_path);
-            entry.set_restart_policy(restart_policy);
-        } else {
-            error!("Unable to update stream entry. Stream id not found {}", entry_id);
+        frame_path: Vec<String>, restart_policy: RestartPolicy,
+        input_rate_policy: InputRatePolicy, overload_mode: OverloadMode,
+        scheduling_policy: SchedulingPolicy,
+    ) -> Result<(), String> {
+        self.check_uris(entry_id, input_uri, output_uri.as_deref())?;
+        let mut entry = match self.table.get(&entry_id) {
+            Some(entry) => entry.clone(),
+            None => {
+                error!("Unable to update stream entry. Stream id not found {}", entry_id);
+                return Err("Stream entry not found".to_string());
+            }
+        };
+        self.unindex(&entry);
+        if let Some(pipeline_id) = entry.get_pipeline() {
+            self.stale_pipelines.push(pipeline_id);
         }
+        entry.unassign_pipeline();
+        entry.set_input_uri(input_uri);
+        entry.set_output_uri(output_uri);
+        entry.set_frame_path(frame_path);
+        entry.set_restart_policy(restart_policy);
+        entry.set_input_rate_policy(input_rate_policy);
+        entry.set_overload_mode(overload_mode);
+        entry.set_scheduling_policy(scheduling_policy);
+        entry.hash = entry.hash();
+        self.index(&entry);
+        self.changed_entries.insert(entry_id);
+        self.table.insert(entry_id, entry);
+        Ok(())
+    }
+
+    /// Returns the changes since the previous call
+    pub fn take_changes(&mut self) -> TableChanges {
+        let entries = self.changed_entries.drain()
+            .filter_map(|id| self.table.get(&id).cloned())
+            .collect();
+        TableChanges { entries, stale_pipelines: std::mem::take(&mut self.stale_pipelines) }
     }
 }
 
@@ -445,4 +838,67 @@ mod tests {
         let not_found_entry = table.find_by_pipeline_id(non_existent_pipeline_id);
         assert_eq!(not_found_entry, None);
     }
+
+    #[test]
+    fn test_add_many_entries_atomic() {
+        let mut table = StreamsTable::new();
+        let entries = vec![
+            StreamsTableEntry::new("input1".to_string(), None, vec!["s1".to_owned()], RestartPolicy::Never),
+            StreamsTableEntry::new("input2".to_string(), None, vec!["s1".to_owned()], RestartPolicy::Never),
+            StreamsTableEntry::new("input1".to_string(), None, vec!["s1".to_owned()], RestartPolicy::Never),
+        ];
+        // No entry is added when one of them is duplicated
+        assert!(table.add_many(entries.clone()).is_err());
+        assert_eq!(table.get_table().len(), 0);
+
+        assert!(table.add_many(entries[..2].to_vec()).is_ok());
+        assert_eq!(table.get_table().len(), 2);
+        assert_eq!(table.find_by_input_uri("input2").map(|entry| entry.get_id()), Some(entries[1].get_id()));
+    }
+
+    #[test]
+    fn test_update_entry_indexes() {
+        let mut table = StreamsTable::new();
+        let entry1 = StreamsTableEntry::new(
+            "input1".to_string(),
+            Some("output1".to_string()),
+            vec!["s1".to_owned()],
+            RestartPolicy::Never,
+        );
+        table.add(entry1.clone()).unwrap();
+        let pipeline_id = uuid::Uuid::new_v4();
+        table.set_stream_pipeline(entry1.get_id(), pipeline_id).unwrap();
+
+        table.update_by_entry_id(
+            entry1.get_id(), "input2", Some("output1".to_string()), vec!["s1".to_owned()],
+            RestartPolicy::Never, InputRatePolicy::default(), OverloadMode::default(), SchedulingPolicy::default(),
+        ).unwrap();
+        assert!(table.find_by_input_uri("input1").is_none());
+        assert!(table.find_by_input_uri("input2").is_some());
+        // The pipeline of the updated entry must be stopped
+        assert!(table.find_by_pipeline_id(pipeline_id).is_none());
+        let changes = table.take_changes();
+        assert_eq!(changes.get_stale_pipelines(), &vec![pipeline_id]);
+        assert_eq!(changes.get_entries().len(), 1);
+        assert_eq!(changes.get_entries()[0].get_stored_hash(), changes.get_entries()[0].hash());
+
+        // The changes are returned only once
+        assert!(table.take_changes().get_entries().is_empty());
+    }
+
+    #[test]
+    fn test_input_rate_policy_target_fps() {
+        let policy: InputRatePolicy = serde_json::from_str(r#"{"target_fps": 0}"#).unwrap();
+        assert!(policy.validate().is_err());
+        assert_eq!(policy.get_target_fps(), None);
+        assert!(policy.is_all_frames());
+
+        let policy: InputRatePolicy = serde_json::from_str(r#"{"target_fps": 3000000000}"#).unwrap();
+        assert!(policy.validate().is_err());
+        assert_eq!(policy.get_target_fps(), None);
+
+        let policy: InputRatePolicy = serde_json::from_str(r#"{"target_fps": 10}"#).unwrap();
+        assert!(policy.validate().is_ok());
+        assert_eq!(policy.get_target_fps(), Some(10));
+    }
 }
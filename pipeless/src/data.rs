@@ -4,25 +4,292 @@ use uuid;
 use gstreamer as gst;
 
 /// Custom data that the user can add to the frame in a stage
-/// allowing to pass data to subsequent stages
+/// allowing to pass data to subsequent stages.
+/// Arrays of numbers are kept as contiguous typed buffers, so they are
+/// exchanged with the hooks (ex: as NumPy arrays) without converting every element.
+#[derive(Clone, PartialEq)]
 pub enum UserData {
     Empty,
+    Bool(bool),
     Integer(i32),
+    Integer64(i64), // Integers that do not fit in 32 bits
     Float(f64),
     String(String),
+    Bytes(Vec<u8>),
     Array(Vec<UserData>),
-    Dictionary(Vec<(String, UserData)>),
+    Dictionary(UserDataDictionary),
+    F32Array(ndarray::ArrayD<f32>),
+    F64Array(ndarray::ArrayD<f64>),
+    I32Array(ndarray::ArrayD<i32>),
+    I64Array(ndarray::ArrayD<i64>),
+    U8Array(ndarray::ArrayD<u8>),
+    BoolArray(ndarray::ArrayD<bool>),
 }
+impl UserData {
+    /// Returns the value of a key when the user data is a dictionary
+    pub fn get(&self, key: &str) -> Option<&UserData> {
+        match self {
+            UserData::Dictionary(dict) => dict.get(key),
+            _ => None,
+        }
+    }
+}
+
+/// Keeps the insertion order of the keys, like Python dictionaries, with constant time lookups
+pub type UserDataDictionary = indexmap::IndexMap<String, UserData>;
+
+/// Element type of an inference tensor
+#[derive(Clone, Copy, PartialEq, Debug)]
+pub enum TensorType {
+    U8,
+    I8,
+    F16,
+    F32,
+    I64,
+}
+impl TensorType {
+    pub fn from_str(dtype: &str) -> Option<Self> {
+        match dtype {
+            "uint8" | "u8" => Some(TensorType::U8),
+            "int8" | "i8" => Some(TensorType::I8),
+            "float16" | "f16" | "half" => Some(TensorType::F16),
+            "float32" | "f32" | "float" => Some(TensorType::F32),
+            "int64" | "i64" => Some(TensorType::I64),
+            _ => None,
+        }
+    }
+
+    /// NumPy name of the type
+    pub fn as_str(&self) -> &'static str {
+        match self {
+            TensorType::U8 => "uint8",
+            TensorType::I8 => "int8",
+            TensorType::F16 => "float16",
+            TensorType::F32 => "float32",
+            TensorType::I64 => "int64",
+        }
+    }
+
+    pub fn item_size(&self) -> usize {
+        match self {
+            TensorType::U8 | TensorType::I8 => 1,
+            TensorType::F16 => 2,
+            TensorType::F32 => 4,
+            TensorType::I64 => 8,
+        }
+    }
+}
+
+/// Tensor that keeps the element type of the model input, so models that do not
+/// take float32 values (ex: uint8 or quantized models) get their input without conversions.
+#[derive(Clone)]
+pub enum Tensor {
+    U8(ndarray::ArrayD<u8>),
+    I8(ndarray::ArrayD<i8>),
+    F16(ndarray::ArrayD<half::f16>),
+    F32(ndarray::ArrayD<f32>),
+    I64(ndarray::ArrayD<i64>),
+}
+impl Tensor {
+    pub fn empty() -> Self {
+        Tensor::F32(ndarray::ArrayD::zeros(ndarray::IxDyn(&[0])))
+    }
+
+    pub fn zeros(dtype: TensorType, shape: &[usize]) -> Self {
+        let shape = ndarray::IxDyn(shape);
+        match dtype {
+            TensorType::U8 => Tensor::U8(ndarray::ArrayD::zeros(shape)),
+            TensorType::I8 => Tensor::I8(ndarray::ArrayD::zeros(shape)),
+            TensorType::F16 => Tensor::F16(ndarray::ArrayD::from_elem(shape, half::f16::ZERO)),
+            TensorType::F32 => Tensor::F32(ndarray::ArrayD::zeros(shape)),
+            TensorType::I64 => Tensor::I64(ndarray::ArrayD::zeros(shape)),
+        }
+    }
+
+    pub fn get_type(&self) -> TensorType {
+        match self {
+            Tensor::U8(_) => TensorType::U8,
+            Tensor::I8(_) => TensorType::I8,
+            Tensor::F16(_) => TensorType::F16,
+            Tensor::F32(_) => TensorType::F32,
+            Tensor::I64(_) => TensorType::I64,
+        }
+    }
+
+    pub fn shape(&self) -> &[usize] {
+        match self {
+            Tensor::U8(t) => t.shape(),
+            Tensor::I8(t) => t.shape(),
+            Tensor::F16(t) => t.shape(),
+            Tensor::F32(t) => t.shape(),
+            Tensor::I64(t) => t.shape(),
+        }
+    }
 
+    pub fn len(&self) -> usize {
+        self.shape().iter().product()
+    }
+
+    /// Copies the values into a float32 array
+    pub fn to_f32(&self) -> ndarray::ArrayD<f32> {
+        match self {
+            Tensor::U8(t) => t.mapv(|v| v as f32),
+            Tensor::I8(t) => t.mapv(|v| v as f32),
+            Tensor::F16(t) => t.mapv(|v| v.to_f32()),
+            Tensor::F32(t) => t.clone(),
+            Tensor::I64(t) => t.mapv(|v| v as f32),
+        }
+    }
+
+    /// Copies the tensor into another element type. Integer types saturate and round the values.
+    pub fn to_type(&self, dtype: TensorType) -> Self {
+        let values = match self {
+            _ if self.get_type() == dtype => return self.clone(),
+            Tensor::F32(t) => std::borrow::Cow::Borrowed(t),
+            other => std::borrow::Cow::Owned(other.to_f32()),
+        };
+        match dtype {
+            TensorType::U8 => Tensor::U8(values.mapv(|v| v.round().clamp(0.0, 255.0) as u8)),
+            TensorType::I8 => Tensor::I8(values.mapv(|v| v.round().clamp(-128.0, 127.0) as i8)),
+            TensorType::F16 => Tensor::F16(values.mapv(half::f16::from_f32)),
+            TensorType::F32 => Tensor::F32(values.into_owned()),
+            TensorType::I64 => Tensor::I64(values.mapv(|v| v.round() as i64)),
+        }
+    }
+}
+
+/// Inference input of a frame. Default is bound to the first model input,
+/// for models with several inputs the tensors are bound by input name.
+#[derive(Clone)]
+pub enum InferenceInput {
+    Default(Tensor),
+    Named(std::collections::HashMap<String, Tensor>),
+}
+impl InferenceInput {
+    pub fn is_empty(&self) -> bool {
+        match self {
+            InferenceInput::Default(tensor) => tensor.len() == 0,
+            InferenceInput::Named(tensors) => tensors.is_empty(),
+        }
+    }
+}
+
+#[derive(Clone, PartialEq)]
 pub enum InferenceOutput {
     Default(ndarray::ArrayBase<ndarray::OwnedRepr<f32>, ndarray::Dim<ndarray::IxDynImpl>>),
     OnnxInferenceOutput(crate::stages::inference::onnx::OnnxInferenceOutput)
 }
 
+/// Read-only pixels of a decoded frame, backed by the mapped input gst buffer.
+/// Allows to work with the decoded frame without copying it.
+pub struct BufferPixels {
+    mapped_buffer: gst::MappedBuffer<gst::buffer::Readable>,
+    shape: (usize, usize, usize), // height, width, channels
+}
+impl BufferPixels {
+    pub fn new(buffer: gst::Buffer, shape: (usize, usize, usize)) -> Result<Self, String> {
+        let expected_size = shape.0 * shape.1 * shape.2;
+        if buffer.size() != expected_size {
+            return Err(format!(
+                "The buffer size ({}) does not match the frame shape {:?}",
+                buffer.size(), shape
+            ));
+        }
+        let mapped_buffer = buffer.into_mapped_buffer_readable()
+            .map_err(|_| "Unable to map the buffer as readable".to_string())?;
+        Ok(Self { mapped_buffer, shape })
+    }
+
+    pub fn view(&self) -> ndarray::ArrayView3<u8> {
+        // The buffer size was validated on creation
+        ndarray::ArrayView3::from_shape(self.shape, self.mapped_buffer.as_slice())
+            .expect("The buffer size does not match the frame shape")
+    }
+
+    /// Unmaps the buffer and returns it
+    pub fn into_buffer(self) -> gst::Buffer {
+        self.mapped_buffer.into_buffer()
+    }
+}
+impl Clone for BufferPixels {
+    fn clone(&self) -> Self {
+        // Only increases the buffer reference count, the data is not copied
+        let buffer = self.mapped_buffer.buffer().to_owned();
+        let mapped_buffer = buffer.into_mapped_buffer_readable()
+            .expect("Unable to map an already readable buffer");
+        Self { mapped_buffer, shape: self.shape }
+    }
+}
+
+/// Pixels of a frame. Decoded frames keep the input buffer and are only
+/// copied when they have to be modified (copy-on-write).
+#[derive(Clone)]
+pub enum Pixels {
+    Buffer(BufferPixels),
+    Owned(ndarray::Array3<u8>),
+}
+impl Pixels {
+    pub fn view(&self) -> ndarray::ArrayView3<u8> {
+        match self {
+            Pixels::Buffer(buffer_pixels) => buffer_pixels.view(),
+            Pixels::Owned(array) => array.view(),
+        }
+    }
+
+    /// Copies the buffer pixels the first time they are modified
+    pub fn view_mut(&mut self) -> ndarray::ArrayViewMut3<u8> {
+        let owned = match self {
+            Pixels::Buffer(buffer_pixels) => Some(buffer_pixels.view().to_owned()),
+            Pixels::Owned(_) => None,
+        };
+        if let Some(array) = owned {
+            *self = Pixels::Owned(array);
+        }
+        match self {
+            Pixels::Owned(array) => array.view_mut(),
+            Pixels::Buffer(_) => unreachable!("Buffer pixels are always copied before modifying them"),
+        }
+    }
+}
+impl From<ndarray::Array3<u8>> for Pixels {
+    fn from(array: ndarray::Array3<u8>) -> Self {
+        Pixels::Owned(array)
+    }
+}
+
+/// Geometric transformation applied to the original frame to create the inference input.
+/// Allows to map coordinates from the inference input back to the original frame:
+///   original_x = (input_x - pad_x) / scale_x
+#[derive(Clone, Copy, Debug)]
+pub struct Letterbox {
+    scale_x: f32,
+    scale_y: f32,
+    pad_x: f32,
+    pad_y: f32,
+}
+impl Letterbox {
+    pub fn new(scale_x: f32, scale_y: f32, pad_x: f32, pad_y: f32) -> Self {
+        Self { scale_x, scale_y, pad_x, pad_y }
+    }
+    pub fn get_scale_x(&self) -> f32 {
+        self.scale_x
+    }
+    pub fn get_scale_y(&self) -> f32 {
+        self.scale_y
+    }
+    pub fn get_pad_x(&self) -> f32 {
+        self.pad_x
+    }
+    pub fn get_pad_y(&self) -> f32 {
+        self.pad_y
+    }
+}
+
+#[derive(Clone)]
 pub struct RgbFrame {
     uuid: uuid::Uuid,
-    original: ndarray::Array3<u8>,
-    modified: ndarray::Array3<u8>,
+    original: Pixels,
+    modified: Pixels, // Shares the original buffer until it is modified
     width: usize,
     height: usize,
     pts: gst::ClockTime,
@@ -30,30 +297,33 @@ pub struct RgbFrame {
     duration: gst::ClockTime,
     fps: u8,
     input_ts: f64, // epoch in seconds
-    inference_input: ndarray::ArrayBase<ndarray::OwnedRepr<f32>, ndarray::Dim<ndarray::IxDynImpl>>,
+    inference_input: InferenceInput,
     // We can convert the output into an arrayview since the user does not need to modify it and the inference runtimes returns a view, so we avoid a copy
     inference_output: InferenceOutput,
+    letterbox: Option<Letterbox>,
     pipeline_id: uuid::Uuid,
     user_data: UserData,
     frame_number: u64,
 }
 impl RgbFrame {
     pub fn new(
-        original: ndarray::Array3<u8>,
+        original: Pixels,
         width: usize, height: usize,
         pts: gst::ClockTime, dts: gst::ClockTime, duration: gst::ClockTime,
         fps: u8, input_ts: f64,
         pipeline_id: uuid::Uuid, frame_number: u64
     ) -> Self {
-        let modified = original.to_owned();
+        // For buffer pixels this does not copy the data
+        let modified = original.clone();
         RgbFrame {
             uuid: uuid::Uuid::new_v4(),
             original, modified,
             width, height,
             pts, dts, duration, fps,
             input_ts,
-            inference_input: ndarray::ArrayBase::zeros(ndarray::IxDyn(&[0])),
+            inference_input: InferenceInput::Default(Tensor::empty()),
             inference_output: InferenceOutput::Default(ndarray::ArrayBase::zeros(ndarray::IxDyn(&[0]))),
+            letterbox: None,
             pipeline_id,
             user_data: UserData::Empty,
             frame_number,
@@ -67,20 +337,22 @@ impl RgbFrame {
         width: usize, height: usize,
         pts: u64, dts: u64, duration: u64,
         fps: u8, input_ts: f64,
-        inference_input: ndarray::ArrayBase<ndarray::OwnedRepr<f32>, ndarray::Dim<ndarray::IxDynImpl>>,
+        inference_input: InferenceInput,
         inference_output: InferenceOutput,
         pipeline_id: &str,
         user_data: UserData, frame_number: u64,
     ) -> Self {
         RgbFrame {
             uuid: uuid::Uuid::from_str(uuid).unwrap(),
-            original, modified,
+            original: Pixels::Owned(original),
+            modified: Pixels::Owned(modified),
             width, height,
             pts: gst::ClockTime::from_mseconds(pts),
             dts: gst::ClockTime::from_mseconds(dts),
             duration: gst::ClockTime::from_mseconds(duration),
             fps, input_ts,
             inference_input, inference_output,
+            letterbox: None,
             pipeline_id: uuid::Uuid::from_str(pipeline_id).unwrap(),
             user_data: user_data,
             frame_number,
@@ -88,18 +360,34 @@ impl RgbFrame {
     }
 
     pub fn set_original_pixels(&mut self, original_pixels: ndarray::Array3<u8>) {
-        self.original = original_pixels
+        self.original = Pixels::Owned(original_pixels)
     }
     pub fn get_original_pixels(&self) -> ndarray::ArrayView3<u8> {
         self.original.view()
     }
+    /// Copies the pixels if they are still shared with the input buffer
     pub fn get_modified_pixels(&mut self) -> ndarray::ArrayViewMut3<u8> {
         self.modified.view_mut()
     }
+    pub fn get_modified_pixels_view(&self) -> ndarray::ArrayView3<u8> {
+        self.modified.view()
+    }
+    pub fn set_modified_pixels(&mut self, modified_pixels: ndarray::Array3<u8>) {
+        self.modified = Pixels::Owned(modified_pixels)
+    }
     pub fn update_mutable_pixels(
         &mut self, view_mut: ndarray::ArrayViewMut3<u8>
     ) {
-        self.modified.assign(&view_mut);
+        self.modified.view_mut().assign(&view_mut);
+    }
+    /// Consumes the frame returning the modified pixels. Releases the original pixels,
+    /// so when the frame was not modified the input buffer can be re-used.
+    pub fn into_modified_pixels(self) -> Pixels {
+        self.modified
+    }
+    /// True while the modified pixels still share the input buffer with the original pixels
+    pub fn is_modified_shared(&self) -> bool {
+        matches!((&self.original, &self.modified), (Pixels::Buffer(_), Pixels::Buffer(_)))
     }
     pub fn get_uuid(&self) -> uuid::Uuid {
         self.uuid
@@ -125,18 +413,29 @@ impl RgbFrame {
     pub fn get_input_ts(&self) -> f64 {
         self.input_ts
     }
-    pub fn get_inference_input(&self) -> &ndarray::ArrayBase<ndarray::OwnedRepr<f32>, ndarray::Dim<ndarray::IxDynImpl>> {
+    pub fn get_inference_input(&self) -> &InferenceInput {
         &self.inference_input
     }
     pub fn get_inference_output(&self) -> &InferenceOutput{
         &self.inference_output
     }
-    pub fn set_inference_input(&mut self, input_data: ndarray::ArrayBase<ndarray::OwnedRepr<f32>, ndarray::Dim<ndarray::IxDynImpl>>) {
+    pub fn set_inference_input(&mut self, input_data: InferenceInput) {
         self.inference_input = input_data;
     }
     pub fn set_inference_output(&mut self, output_data: InferenceOutput) {
         self.inference_output = output_data;
     }
+    /// Moves the inference input out of the frame, leaving an empty input
+    pub fn take_inference_input(&mut self) -> InferenceInput {
+        std::mem::replace(&mut self.inference_input, InferenceInput::Default(Tensor::empty()))
+    }
+    /// Moves the inference output out of the frame, leaving an empty default output
+    pub fn take_inference_output(&mut self) -> InferenceOutput {
+        std::mem::replace(
+            &mut self.inference_output,
+            InferenceOutput::Default(ndarray::ArrayBase::zeros(ndarray::IxDyn(&[0])))
+        )
+    }
     pub fn get_pipeline_id(&self) -> &uuid::Uuid {
         &self.pipeline_id
     }
@@ -146,17 +445,27 @@ impl RgbFrame {
     pub fn get_user_data(&self) -> &UserData {
         &self.user_data
     }
+    pub fn set_user_data(&mut self, user_data: UserData) {
+        self.user_data = user_data;
+    }
     pub fn get_frame_number(&self) -> &u64 {
         &self.frame_number
     }
+    pub fn get_letterbox(&self) -> Option<&Letterbox> {
+        self.letterbox.as_ref()
+    }
+    pub fn set_letterbox(&mut self, letterbox: Option<Letterbox>) {
+        self.letterbox = letterbox;
+    }
 }
 
+#[derive(Clone)]
 pub enum Frame {
     RgbFrame(RgbFrame)
 }
 impl Frame {
     pub fn new_rgb(
-        original: ndarray::Array3<u8>,
+        original: Pixels,
         width: usize, height: usize,
         pts: gst::ClockTime, dts: gst::ClockTime, duration: gst::ClockTime,
         fps: u8, input_ts: f64,
@@ -181,7 +490,7 @@ impl Frame {
             Frame::RgbFrame(frame) => frame.get_original_pixels()
         }
     }
-    pub fn get_inference_input(&self) -> &ndarray::ArrayBase<ndarray::OwnedRepr<f32>, ndarray::Dim<ndarray::IxDynImpl>> {
+    pub fn get_inference_input(&self) -> &InferenceInput {
         match self {
             Frame::RgbFrame(frame) => frame.get_inference_input()
         }
@@ -191,7 +500,7 @@ impl Frame {
             Frame::RgbFrame(frame) => frame.get_inference_output()
         }
     }
-    pub fn set_inference_input(&mut self, input_data: ndarray::ArrayBase<ndarray::OwnedRepr<f32>, ndarray::Dim<ndarray::IxDynImpl>>) {
+    pub fn set_inference_input(&mut self, input_data: InferenceInput) {
         match self {
             Frame::RgbFrame(frame) => { frame.set_inference_input(input_data); },
         }
@@ -211,4 +520,54 @@ impl Frame {
             Frame::RgbFrame(frame) => frame.get_frame_number(),
         }
     }
+    pub fn get_width(&self) -> usize {
+        match self {
+            Frame::RgbFrame(frame) => frame.get_width(),
+        }
+    }
+    pub fn get_height(&self) -> usize {
+        match self {
+            Frame::RgbFrame(frame) => frame.get_height(),
+        }
+    }
+    pub fn take_inference_output(&mut self) -> InferenceOutput {
+        match self {
+            Frame::RgbFrame(frame) => frame.take_inference_output(),
+        }
+    }
+    pub fn get_pts(&self) -> gst::ClockTime {
+        match self {
+            Frame::RgbFrame(frame) => frame.get_pts(),
+        }
+    }
+    pub fn get_input_ts(&self) -> f64 {
+        match self {
+            Frame::RgbFrame(frame) => frame.get_input_ts(),
+        }
+    }
+    pub fn is_modified_shared(&self) -> bool {
+        match self {
+            Frame::RgbFrame(frame) => frame.is_modified_shared(),
+        }
+    }
+    pub fn get_user_data(&self) -> &UserData {
+        match self {
+            Frame::RgbFrame(frame) => frame.get_user_data(),
+        }
+    }
+    pub fn set_user_data(&mut self, user_data: UserData) {
+        match self {
+            Frame::RgbFrame(frame) => { frame.set_user_data(user_data); },
+        }
+    }
+    pub fn get_letterbox(&self) -> Option<&Letterbox> {
+        match self {
+            Frame::RgbFrame(frame) => frame.get_letterbox(),
+        }
+    }
+    pub fn set_letterbox(&mut self, letterbox: Option<Letterbox>) {
+        match self {
+            Frame::RgbFrame(frame) => { frame.set_letterbox(letterbox); },
+        }
+    }
 }
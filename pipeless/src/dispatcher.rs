@@ -65,9 +65,23 @@ impl Dispatcher {
 }
 
 
+/// Releases the data kept for a pipeline that ended
+async fn clean_pipeline(
+    pipeline_id: &uuid::Uuid,
+    frame_path_executor_arc: &Arc<RwLock<pipeless::stages::path::FramePathExecutor>>,
+) {
+    // Cleanup KV store keys of that pipeline
+    pipeless::kvs::store::KV_STORE.clean(&pipeline_id.to_string());
+    // Cleanup the inference outputs cached for that pipeline
+    pipeless::stages::inference::motion::INFERENCE_CACHE.clean(pipeline_id);
+    // Cleanup the data kept by the stages for the pipeline
+    frame_path_executor_arc.read().await.forget_stream(pipeline_id);
+}
+
 pub fn start(
     dispatcher: Dispatcher,
     frame_path_executor_arc: Arc<RwLock<pipeless::stages::path::FramePathExecutor>>,
+    frame_scheduler: Arc<pipeless::scheduler::FrameScheduler>,
     buffer_size: usize,
 ) {
     let running_managers: Arc<RwLock<HashMap<uuid::Uuid, pipeless::pipeline::Manager>>> = Arc::new(RwLock::new(HashMap::new()));
@@ -81,57 +95,45 @@ pub fn start(
         let concurrent_limit = 3;
         dispatcher.process_events(concurrent_limit, move |event, _end_signal| {
             let frame_path_executor_arc = frame_path_executor_arc.clone();
+            let frame_scheduler = frame_scheduler.clone();
             let running_managers = running_managers.clone();
             let dispatcher_sender = dispatcher_sender.clone();
             let streams_table = streams_table.clone();
             async move {
                 match event {
                     DispatcherEvent::TableChange => {
-                        // When an entry has changed (the URIs hash does not match the content) stop the pipeline and create a new one
-                        let different_hash =
-                            |x: &&pipeless::config::streams::StreamsTableEntry| x.get_stored_hash() != x.hash();
-                        {
-                            let streams_table_guard = streams_table.read().await;
-                            let streams_table_copy = streams_table_guard.get_table();
-                            let modified_entries: Vec<&pipeless::config::streams::StreamsTableEntry> =
-                                streams_table_copy.iter().filter(different_hash).collect();
-                            for entry in modified_entries {
-                                if let Some(pipeline_id) = entry.get_pipeline() {
-                                    let managers_map_guard = running_managers.read().await;
-                                    if let Some(manager) = managers_map_guard.get(&pipeline_id) {
-                                        info!("Stopping pipeline due to stream config change. Pipeline id: {}", pipeline_id);
-                                        manager.stop().await;
-                                        // Handling PipelineFinish will remove the pipeline from the entry and
-                                        // will emit a TableChange again, when we will find a stream without
-                                        // a pipeline and create a new one.
-                                        let message = DispatcherEvent::PipelineFinished(
-                                            pipeline_id, pipeless::pipeline::PipelineEndReason::Updated
-                                        );
-                                        if let Err(err) = dispatcher_sender.send(message) {
-                                            warn!("Unable to send dispatcher event for finished pipeline. Error: {}", err.to_string());
-                                        }
-                                    }
-                                }
+                        // Only the entries changed since the last reconciliation are visited
+                        let changes = streams_table.write().await.take_changes();
+
+                        // When an entry was removed or updated, stop its pipeline and remove it from the hash_map to be dropped.
+                        // The updated entries get a new pipeline below.
+                        for pipeline_id in changes.get_stale_pipelines() {
+                            let manager = running_managers.write().await.remove(pipeline_id);
+                            if let Some(manager) = manager {
+                                info!("Stream config entry removed or updated. Stopping associated pipeline. Pipeline id: {}", pipeline_id);
+                                manager.stop().await;
+                                clean_pipeline(pipeline_id, &frame_path_executor_arc).await;
                             }
                         }
 
                         // When an entry does not have an associated pipeline, create one and assign it
-                        let without_pipeline =
-                            |x: &&pipeless::config::streams::StreamsTableEntry| x.get_pipeline().is_none();
-                        {
-                            let mut streams_table_guard = streams_table.write().await;
-                            let streams_table_copy = streams_table_guard.get_table();
-                            let entries_without_pipeline: Vec<&pipeless::config::streams::StreamsTableEntry> =
-                                streams_table_copy.iter().filter(without_pipeline).collect();
-                            for entry in entries_without_pipeline {
-                                if entry.get_target_state() != pipeless::config::streams::StreamEntryState::Running {
-                                    // Skip the creation of pipelines for streams whose target state is not running
-                                    continue;
-                                }
-                                let dispatcher_event_sender = dispatcher_sender.clone();
-                                let input_uri = entry.get_input_uri().to_string();
-                                let output_uri = entry.get_output_uri().map(|s| s.to_string());
-                                let frame_path_vec = entry.get_frame_path();
+                        for entry in changes.get_entries() {
+                            if entry.get_pipeline().is_some() {
+                                continue;
+                            }
+                            if entry.get_target_state() != pipeless::config::streams::StreamEntryState::Running {
+                                // Skip the creation of pipelines for streams whose target state is not running
+                                continue;
+                            }
+                            let dispatcher_event_sender = dispatcher_sender.clone();
+                            let input_uri = entry.get_input_uri().to_string();
+                            let output_uri = entry.get_output_uri().map(|s| s.to_string());
+                            let frame_path_vec = entry.get_frame_path();
+                            let input_rate_policy = entry.get_input_rate_policy();
+                            let overload_mode = entry.get_overload_mode();
+                            let scheduling_policy = entry.get_scheduling_policy();
+                            // The pipeline is created without locking the streams table
+                            let new_manager_result = {
                                 let frame_path_executor = frame_path_executor_arc.read().await;
                                 let frame_path = pipeless::stages::path::FramePath::new(
                                     frame_path_vec.join("/").as_str(),
@@ -140,73 +142,78 @@ pub fn start(
                                 match frame_path {
                                     Ok(frame_path) => {
                                         info!("New stream entry detected, creating pipeline");
+                                        // Lazy stages start loading before the first frame arrives
+                                        frame_path_executor.preload(&frame_path);
                                         let new_pipeless_bus = pipeless::events::Bus::new(buffer_size);
-                                        let new_manager_result = pipeless::pipeline::Manager::new(
+                                        pipeless::pipeline::Manager::new(
                                             input_uri, output_uri, frame_path,
+                                            input_rate_policy,
+                                            overload_mode,
+                                            scheduling_policy,
                                             &new_pipeless_bus.get_sender(),
                                             dispatcher_event_sender.clone(),
-                                        );
-                                        match new_manager_result {
-                                            Ok(new_manager) => {
-                                                new_manager.start(new_pipeless_bus, frame_path_executor_arc.clone());
-                                                if let Err(err) = streams_table_guard.set_stream_pipeline(
-                                                    entry.get_id(),
-                                                    new_manager.get_pipeline_id().await
-                                                ) {
-                                                    error!("Error adding new stream to the streams config table: {}", err);
-                                                    pipeless::event_exporters::events::export_stream_start_error_event(entry.get_id()).await;
-                                                }
-                                                let mut managers_map_guard = running_managers.write().await;
-                                                managers_map_guard.insert(new_manager.get_pipeline_id().await, new_manager);
-                                            },
-                                            Err(err) => {
-                                                error!("Unable to create new pipeline: {}. Rolling back streams configuration.", err.to_string());
-                                                let removed = streams_table_guard.remove(entry.get_id());
-                                                if removed.is_none() { warn!("Error rolling back table, entry not found.") };
-                                                pipeless::event_exporters::events::export_stream_start_error_event(entry.get_id()).await;
-                                            }
-                                        }
+                                        ).map(|new_manager| (new_manager, new_pipeless_bus))
+                                        .map_err(|err| {
+                                            error!("Unable to create new pipeline: {}. Rolling back streams configuration.", err.to_string());
+                                            pipeless::event_exporters::events::export_stream_start_error_event(entry.get_id());
+                                        })
                                     },
                                     Err(err) => {
                                         warn!("Rolling back streams table configuration due to error. Error: {}", err);
-                                        let removed = streams_table_guard.remove(entry.get_id());
-                                        if removed.is_none() { warn!("Error rolling back table, entry not found.") };
+                                        Err(())
                                     }
                                 }
-                            }
-                        }
-
-                        // When we have a running manager whose pipeline id is not in any entry, that means the entry was deleted, stop the manager
-                        // and remove it from the hash_map to be dropped
-                        let mut manager_to_remove = None;
-                        {
-                            let managers_map_guard = running_managers.read().await;
-                            for (pipeline_id, manager) in managers_map_guard.iter() {
-                                let streams_table = streams_table.read().await;
-                                if streams_table.find_by_pipeline_id(*pipeline_id).is_none() {
-                                    info!("Stream config entry removed. Stopping associated pipeline");
-                                    manager.stop().await;
-                                    manager_to_remove = Some(pipeline_id.clone());
-
-                                    // Cleanup KV store keys of that pipeline
-                                    pipeless::kvs::store::KV_STORE.clean(&pipeline_id.to_string());
+                            };
+                            match new_manager_result {
+                                Ok((new_manager, new_pipeless_bus)) => {
+                                    let pipeline_id = new_manager.get_pipeline_id().await;
+                                    // The entry could have been removed or updated while the pipeline was created
+                                    let assign_result = {
+                                        let mut streams_table_guard = streams_table.write().await;
+                                        match streams_table_guard.get_entry_by_id(entry.get_id()) {
+                                            Some(current) if current.get_pipeline().is_none() && current.hash() == entry.hash() => {
+                                                streams_table_guard.set_stream_pipeline(entry.get_id(), pipeline_id)
+                                            },
+                                            _ => Err("The stream entry changed while its pipeline was created".to_string()),
+                                        }
+                                    };
+                                    match assign_result {
+                                        Ok(()) => {
+                                            // Hold the managers map until the manager is inserted, the pipeline could finish right away
+                                            let mut managers_map_guard = running_managers.write().await;
+                                            new_manager.start(new_pipeless_bus, frame_path_executor_arc.clone(), frame_scheduler.clone());
+                                            managers_map_guard.insert(pipeline_id, new_manager);
+                                        },
+                                        Err(err) => {
+                                            warn!("Discarding the new pipeline of the stream {}: {}", entry.get_id(), err);
+                                            // The input pipeline is already playing and the stream metrics registered
+                                            new_manager.stop().await;
+                                            clean_pipeline(&pipeline_id, &frame_path_executor_arc).await;
+                                        },
+                                    }
+                                },
+                                Err(()) => {
+                                    // Nothing to stop, Manager::new does not leave running pipelines on error
+                                    let removed = streams_table.write().await.remove(entry.get_id());
+                                    if removed.is_none() { warn!("Error rolling back table, entry not found.") };
                                 }
                             }
                         }
-                        if let Some(manager) = manager_to_remove {
-                            let mut managers_map_guard = running_managers.write().await;
-                            managers_map_guard.remove(&manager);
-                        }
                     }
                     DispatcherEvent::PipelineFinished(pipeline_id, finish_state) => {
+                        // A restarted stream gets a new pipeline, release the data kept for the finished one
+                        let manager = running_managers.write().await.remove(&pipeline_id);
+                        if let Some(manager) = manager {
+                            manager.stop().await;
+                        }
+                        clean_pipeline(&pipeline_id, &frame_path_executor_arc).await;
                         let mut stream_uuid: Option<uuid::Uuid> = None;
                         { // context to release the write lock
                             let mut table_write_guard = streams_table.write().await;
-                            let stream_entry_option = table_write_guard.find_by_pipeline_id_mut(pipeline_id);
+                            // Remove the pipeline from the stream entry since it finished
+                            let stream_entry_option = table_write_guard.unassign_pipeline(pipeline_id);
                             if let Some(entry) = stream_entry_option {
                                 stream_uuid = Some(entry.get_id());
-                                // Remove the pipeline from the stream entry since it finished
-                                entry.unassign_pipeline();
 
                                 // Update the target state of the stream based on the restart policy
                                 match entry.get_restart_policy() {
@@ -251,7 +258,7 @@ pub fn start(
                         pipeless::event_exporters::events::export_stream_finished_event(
                             stream_uuid.unwrap_or_default(),
                             finish_state.to_string().as_str()
-                        ).await;
+                        );
                     }
                 }
             }
@@ -14,36 +14,45 @@ impl fmt::Display for EventType {
     }
 }
 
+/*
+ * Queues an event on the external event exporter when it is enabled.
+ * Never waits for the exporter, so it can be used for events produced on every frame.
+ */
+pub fn export_event(ext_event: &serde_json::Value) {
+    let exporter = match super::EVENT_EXPORTER.read() {
+        Ok(exporter) => exporter,
+        Err(err) => {
+            warn!("Unable to read the event exporter, skipping external publishing: {}", err);
+            return;
+        }
+    };
+    if !exporter.is_enabled() {
+        return;
+    }
+    match serde_json::to_string(ext_event) {
+        Ok(json_str) => exporter.publish(&json_str),
+        Err(_) => warn!("Error serializing event to JSON string, skipping external publishing"),
+    }
+}
+
 /*
  * Exports a stream finished event to the external event exporter when it is enabled
  */
-pub async fn export_stream_finished_event(stream_uuid: uuid::Uuid, stream_end_state: &str) {
-    let ext_event: serde_json::Value = serde_json::json!({
+pub fn export_stream_finished_event(stream_uuid: uuid::Uuid, stream_end_state: &str) {
+    export_event(&serde_json::json!({
         "type": EventType::StreamFinished.to_string(),
         "end_state": stream_end_state,
         "stream_uuid": stream_uuid.to_string(),
-    });
-    let ext_event_json_str = serde_json::to_string(&ext_event);
-    if let Ok(json_str) = ext_event_json_str {
-        super::EVENT_EXPORTER.lock().await.publish(&json_str).await;
-    } else {
-        warn!("Error serializing event to JSON string, skipping external publishing");
-    }
+    }));
 }
 
 /*
  * Exports a stream start error event to the external event exporter when it is enabled
  */
-pub async fn export_stream_start_error_event(stream_uuid: uuid::Uuid) {
-    let ext_event: serde_json::Value = serde_json::json!({
+pub fn export_stream_start_error_event(stream_uuid: uuid::Uuid) {
+    export_event(&serde_json::json!({
         "type": EventType::StreamStartError.to_string(),
         "end_state": "error",
         "stream_uuid": stream_uuid.to_string(),
-    });
-    let ext_event_json_str = serde_json::to_string(&ext_event);
-    if let Ok(json_str) = ext_event_json_str {
-        super::EVENT_EXPORTER.lock().await.publish(&json_str).await;
-    } else {
-        warn!("Error serializing event to JSON string, skipping external publishing");
-    }
+    }));
 }
@@ -1,66 +1,249 @@
-use std::sync::Arc;
+use std::{sync::{Arc, RwLock, atomic::{AtomicU64, Ordering}}, time::Duration};
 
-use log::warn;
-use redis::AsyncCommands;
+use log::{info, warn};
 use lazy_static::lazy_static;
-use tokio::sync::Mutex;
+use tokio::{io::AsyncWriteExt, sync::mpsc};
 
 pub mod events;
 
-pub enum EventExporterEnum {
+/// Max number of events waiting to be published by each sink. When the queue is full new events are dropped.
+const EVENTS_QUEUE_SIZE: usize = 10000;
+/// Max number of events published at once
+const MAX_BATCH_SIZE: usize = 500;
+/// Number of times a batch is sent before dropping it
+const MAX_PUBLISH_ATTEMPTS: u32 = 3;
+const MIN_RECONNECT_DELAY: Duration = Duration::from_millis(100);
+const MAX_RECONNECT_DELAY: Duration = Duration::from_secs(30);
+
+/*
+ * Destination of the exported events.
+ * We cannot use the typical Box<dyn SinkTrait> to create a common interface because trait methods cannot be async so we just create variants and invoke their methods
+ */
+pub enum EventSink {
     Redis(Redis),
+    File(JsonlFile),
+}
+impl EventSink {
+    pub fn new_redis(redis_url: &str, channel: &str) -> Self {
+        EventSink::Redis(Redis::new(redis_url, channel))
+    }
+    pub fn new_file(path: &str) -> Self {
+        EventSink::File(JsonlFile::new(path))
+    }
+    fn get_name(&self) -> &'static str {
+        match self {
+            EventSink::Redis(_) => "redis",
+            EventSink::File(_) => "file",
+        }
+    }
+    async fn publish(&mut self, messages: &[String]) -> Result<(), String> {
+        match self {
+            EventSink::Redis(sink) => sink.publish(messages).await,
+            EventSink::File(sink) => sink.publish(messages).await,
+        }
+    }
+}
+
+/// Counters of the events of a sink
+#[derive(Default)]
+pub struct ExporterStats {
+    queued: AtomicU64,
+    exported: AtomicU64,
+    dropped: AtomicU64,
+}
+impl ExporterStats {
+    pub fn get_queued(&self) -> u64 {
+        self.queued.load(Ordering::Relaxed)
+    }
+    pub fn get_exported(&self) -> u64 {
+        self.exported.load(Ordering::Relaxed)
+    }
+    pub fn get_dropped(&self) -> u64 {
+        self.dropped.load(Ordering::Relaxed)
+    }
+}
+
+struct SinkHandle {
+    name: &'static str,
+    sender: mpsc::Sender<String>,
+    stats: Arc<ExporterStats>,
 }
 
 /*
- * General event exporter that wraps many types of event exporters
- * We cannot use the typical Box<dyn ExporterTrait> to create a common interface because trait methods cannot be async so we just create variants and invoke theit methods
+ * General event exporter that feeds the event sinks.
+ * Every sink publishes from its own background task, so publishing never waits for the network
+ * and a slow sink does not delay the others.
  */
 pub struct EventExporter {
-    exporter: Option<EventExporterEnum>,
+    sinks: Vec<SinkHandle>,
 }
 impl EventExporter {
     pub fn new_none_exporter() -> Self {
-        Self { exporter: None }
+        Self { sinks: vec![] }
+    }
+    /// Starts the tasks of the sinks. Must be invoked from the Tokio runtime.
+    pub fn new(sinks: Vec<EventSink>) -> Self {
+        let sinks = sinks.into_iter().map(|sink| {
+            let (sender, receiver) = mpsc::channel(EVENTS_QUEUE_SIZE);
+            let stats = Arc::new(ExporterStats::default());
+            let name = sink.get_name();
+            tokio::spawn(run_sink(sink, receiver, stats.clone()));
+            SinkHandle { name, sender, stats }
+        }).collect();
+        Self { sinks }
     }
-    pub async fn new_redis_exporter(redis_url: &str, channel: &str) -> Self {
-        Self {
-            exporter: Some(EventExporterEnum::Redis(Redis::new(redis_url, channel).await)),
+    /// Queues the message on every sink without waiting
+    pub fn publish(&self, message: &str) {
+        for sink in &self.sinks {
+            // Count before sending, the task may take the message right away
+            sink.stats.queued.fetch_add(1, Ordering::Relaxed);
+            if sink.sender.try_send(message.to_string()).is_err() {
+                sink.stats.queued.fetch_sub(1, Ordering::Relaxed);
+                let dropped = sink.stats.dropped.fetch_add(1, Ordering::Relaxed) + 1;
+                // Avoid flooding the logs when the sink can't keep up
+                if dropped.is_power_of_two() {
+                    warn!("The {} event exporter queue is full. {} events dropped so far", sink.name, dropped);
+                }
+            }
         }
     }
-    pub async fn publish(&mut self, message: &str) {
-        if let Some(exporter) = &mut self.exporter {
-            match exporter {
-                EventExporterEnum::Redis(pblsr) => pblsr.publish(message).await,
+    pub fn is_enabled(&self) -> bool {
+        !self.sinks.is_empty()
+    }
+    /// Returns the name and the counters of every sink
+    pub fn get_stats(&self) -> Vec<(&'static str, Arc<ExporterStats>)> {
+        self.sinks.iter().map(|sink| (sink.name, sink.stats.clone())).collect()
+    }
+}
+
+/// Publishes the queued events in batches
+async fn run_sink(mut sink: EventSink, mut receiver: mpsc::Receiver<String>, stats: Arc<ExporterStats>) {
+    let mut batch = Vec::with_capacity(MAX_BATCH_SIZE);
+    while let Some(message) = receiver.recv().await {
+        batch.push(message);
+        while batch.len() < MAX_BATCH_SIZE {
+            match receiver.try_recv() {
+                Ok(message) => batch.push(message),
+                Err(_) => break,
+            }
+        }
+        stats.queued.fetch_sub(batch.len() as u64, Ordering::Relaxed);
+        match sink.publish(&batch).await {
+            Ok(()) => { stats.exported.fetch_add(batch.len() as u64, Ordering::Relaxed); },
+            Err(err) => {
+                warn!("Dropping {} events that could not be exported to {}: {}", batch.len(), sink.get_name(), err);
+                stats.dropped.fetch_add(batch.len() as u64, Ordering::Relaxed);
             }
         }
+        batch.clear();
     }
 }
 
 /*
- * Redis event exporter
+ * Redis event exporter. Publishes every batch in a single pipeline.
  */
 pub struct Redis {
-    connection: redis::aio::Connection,
+    client: redis::Client,
+    connection: Option<redis::aio::Connection>,
     channel: String,
 }
 impl Redis {
-    async fn new(redis_url: &str, channel: &str) -> Self {
+    fn new(redis_url: &str, channel: &str) -> Self {
         let client = redis::Client::open(redis_url).expect("Unable to create Redis client with the provided URL, please check the value of the PIPELESS_REDIS_URL env var");
-        let con = client.get_tokio_connection().await.expect("Failed to connect to Redis");
+        Self { client, connection: None, channel: channel.to_owned() }
+    }
+
+    /// Returns the connection, connecting with exponential backoff when there is none
+    async fn get_connection(&mut self) -> &mut redis::aio::Connection {
+        let mut delay = MIN_RECONNECT_DELAY;
+        while self.connection.is_none() {
+            match self.client.get_tokio_connection().await {
+                Ok(connection) => {
+                    info!("Connected to Redis to export events");
+                    self.connection = Some(connection);
+                },
+                Err(err) => {
+                    warn!("Unable to connect to Redis to export events, retrying in {:?}. Error: {}", delay, err);
+                    tokio::time::sleep(delay).await;
+                    delay = (delay * 2).min(MAX_RECONNECT_DELAY);
+                }
+            }
+        }
+        self.connection.as_mut().unwrap()
+    }
+
+    async fn publish(&mut self, messages: &[String]) -> Result<(), String> {
+        let mut pipe = redis::pipe();
+        for message in messages {
+            pipe.publish(&self.channel, message).ignore();
+        }
+        let mut attempts = 0;
+        loop {
+            let connection = self.get_connection().await;
+            match pipe.query_async::<_, ()>(connection).await {
+                Ok(()) => return Ok(()),
+                Err(err) => {
+                    // Reconnect, the connection may be broken
+                    self.connection = None;
+                    attempts += 1;
+                    if attempts >= MAX_PUBLISH_ATTEMPTS {
+                        return Err(format!("Error publishing messages to Redis: {}", err));
+                    }
+                    warn!("Error publishing messages to Redis, retrying: {}", err);
+                }
+            }
+        }
+    }
+}
 
-        Self { connection: con, channel: channel.to_owned() }
+/*
+ * Appends the events to a file, one JSON per line
+ */
+pub struct JsonlFile {
+    path: String,
+    file: Option<tokio::fs::File>,
+}
+impl JsonlFile {
+    fn new(path: &str) -> Self {
+        Self { path: path.to_owned(), file: None }
     }
 
-    async fn publish(&mut self, message: &str) {
-        if let Err(err) = self.connection.publish::<&str, &str, i32>(&self.channel, message).await  {
-            warn!("Error publishing message to Redis: {}", err.to_string());
+    async fn publish(&mut self, messages: &[String]) -> Result<(), String> {
+        if self.file.is_none() {
+            let file = tokio::fs::OpenOptions::new()
+                .create(true).append(true)
+                .open(&self.path).await
+                .map_err(|err| format!("Unable to open the events file {}: {}", self.path, err))?;
+            self.file = Some(file);
         }
+        let mut data = messages.join("\n");
+        data.push('\n');
+        let file = self.file.as_mut().unwrap();
+        let result = match file.write_all(data.as_bytes()).await {
+            Ok(()) => file.flush().await,
+            Err(err) => Err(err),
+        };
+        result.map_err(|err| {
+            // Reopen the file on the next batch
+            self.file = None;
+            format!("Error writing to the events file {}: {}", self.path, err)
+        })
     }
 }
 
-// Create global variable to access the event exporter from any point of the code
-// It uses an Arc to be shared among threads and a Mutex since the connection is updated on every push
+// Create global variable to access the event exporter from any point of the code.
+// It is set once on start, publishing only requires the read lock.
 lazy_static! {
-    pub static ref EVENT_EXPORTER: Arc<Mutex<EventExporter>> =
-        Arc::new(Mutex::new(EventExporter::new_none_exporter()));
+    pub static ref EVENT_EXPORTER: RwLock<EventExporter> = RwLock::new(EventExporter::new_none_exporter());
+}
+
+/// Returns the name and the counters of every sink of the event exporter
+pub fn get_exporter_stats() -> Vec<(&'static str, Arc<ExporterStats>)> {
+    match EVENT_EXPORTER.read() {
+        Ok(exporter) => exporter.get_stats(),
+        Err(err) => {
+            warn!("Unable to read the event exporter: {}", err);
+            vec![]
+        }
+    }
 }
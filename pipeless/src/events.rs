@@ -197,16 +197,24 @@ Utils to produce sync events. Can be called anywhere within sync code.
 We use them to publish events from Gstreamer pipeline callback.
 */
 
+/// Returns the frame back when it could not be published
 pub fn publish_new_frame_change_event_sync(
     bus_sender: &tokio::sync::mpsc::Sender<Event>,
     frame: pipeless::data::Frame
-) {
+) -> Option<pipeless::data::Frame> {
     let new_frame_event = Event::new_frame_change(frame);
-    // By using try_send frames are discarded when the channel is full
-    // However, note this does not produce a fluid output video. For that instead of discarding the frame
-    // we would need to send it to the output without processing it
-    if let Err(err) = bus_sender.try_send(new_frame_event) {
-        debug!("Discarding frame: {}", err);
+    // By using try_send frames are not published when the channel is full.
+    // The caller decides whether to discard them or to send them to the output without processing
+    // them, which produces a more fluid output video.
+    match bus_sender.try_send(new_frame_event) {
+        Ok(_) => None,
+        Err(err) => {
+            debug!("Unable to publish frame: {}", err);
+            match err.into_inner() {
+                Event::FrameChangeEvent(e) => Some(e.into_frame()),
+                _ => None,
+            }
+        }
     }
 }
 
@@ -2,6 +2,7 @@ use glib::BoolError;
 use log::{error, info, warn, debug};
 use std;
 use std::str::FromStr;
+use std::sync::{Arc, atomic::{AtomicU64, Ordering}};
 use gstreamer as gst;
 use gst::prelude::*;
 use gstreamer_app as gst_app;
@@ -45,16 +46,174 @@ impl From<pipeless::config::video::VideoConfigError> for InputPipelineError {
 #[derive(Clone)]
 pub struct StreamDef {
     video: pipeless::config::video::Video,
+    input_rate_policy: pipeless::config::streams::InputRatePolicy,
 }
 impl StreamDef {
-    pub fn new(uri: String) -> Result<Self, InputPipelineError> {
+    pub fn new(
+        uri: String,
+        input_rate_policy: pipeless::config::streams::InputRatePolicy,
+    ) -> Result<Self, InputPipelineError> {
         let video = pipeless::config::video::Video::new(uri)?;
-        Ok(Self { video })
+        Ok(Self { video, input_rate_policy })
     }
 
     pub fn get_video(&self) -> &pipeless::config::video::Video {
         &self.video
     }
+
+    pub fn get_input_rate_policy(&self) -> &pipeless::config::streams::InputRatePolicy {
+        &self.input_rate_policy
+    }
+}
+
+/// Prefix of the URIs of synthetic input sources
+const TEST_SOURCE_PREFIX: &str = "videotestsrc://";
+
+/// Synthetic input source, useful for benchmarks since it requires no files nor network.
+/// Example: videotestsrc://1280x720?fps=30&frames=300&live=true
+/// Without 'frames' the source never ends. When not live, the frames are produced as fast
+/// as the pipeline consumes them instead of at the source framerate.
+struct TestSource {
+    width: u32,
+    height: u32,
+    fps: u32,
+    frames: Option<u64>,
+    live: bool,
+}
+impl TestSource {
+    fn from_uri(uri: &str) -> Result<Self, InputPipelineError> {
+        let params = uri.strip_prefix(TEST_SOURCE_PREFIX)
+            .ok_or_else(|| InputPipelineError::new("Not a videotestsrc URI"))?;
+        let (size, query) = params.split_once('?').unwrap_or((params, ""));
+        let (width, height) = if size.is_empty() {
+            (1280, 720)
+        } else {
+            size.split_once('x')
+                .and_then(|(width, height)| Some((width.parse().ok()?, height.parse().ok()?)))
+                .ok_or_else(|| InputPipelineError::new("The videotestsrc size must have the format WIDTHxHEIGHT"))?
+        };
+        let mut test_source = Self { width, height, fps: 30, frames: None, live: false };
+        for param in query.split('&').filter(|param| !param.is_empty()) {
+            let (key, value) = param.split_once('=').unwrap_or((param, ""));
+            let invalid = || InputPipelineError::new(&format!("Invalid videotestsrc parameter '{}'", param));
+            match key {
+                "fps" => test_source.fps = value.parse().map_err(|_| invalid())?,
+                "frames" => test_source.frames = Some(value.parse().map_err(|_| invalid())?),
+                "live" => test_source.live = value.parse().map_err(|_| invalid())?,
+                "id" => {}, // Distinguishes streams reading the same test source
+                _ => return Err(invalid()),
+            }
+        }
+        Ok(test_source)
+    }
+
+    fn get_caps_str(&self) -> String {
+        format!("video/x-raw,width={},height={},framerate={}/1", self.width, self.height, self.fps)
+    }
+}
+
+/// Min occupancy of the stream buffer to start skipping frames with the adaptive policy
+const ADAPTIVE_SKIP_MIN_OCCUPANCY: f64 = 0.5;
+
+/// Decides which decoded frames are skipped according to the every N frames
+/// and adaptive options of the input rate policy.
+/// The adaptive skip keeps less frames as the stream buffer fills, from all the frames
+/// at half occupancy to one of every 4 frames when almost full. When the buffer is full
+/// every frame is skipped since it would be discarded anyway.
+struct FrameSkipper {
+    every_n_frames: Option<u64>,
+    adaptive_skip: bool,
+    frame_count: AtomicU64, // Used from a pad probe, which only gets a shared reference
+    pipeless_bus_sender: tokio::sync::mpsc::Sender<pipeless::events::Event>,
+}
+impl FrameSkipper {
+    fn new(
+        input_rate_policy: &pipeless::config::streams::InputRatePolicy,
+        pipeless_bus_sender: tokio::sync::mpsc::Sender<pipeless::events::Event>,
+    ) -> Self {
+        Self {
+            every_n_frames: input_rate_policy.get_every_n_frames(),
+            adaptive_skip: input_rate_policy.get_adaptive_skip(),
+            frame_count: AtomicU64::new(0),
+            pipeless_bus_sender,
+        }
+    }
+
+    fn should_skip(&self) -> bool {
+        let frame_count = self.frame_count.fetch_add(1, Ordering::Relaxed);
+        if let Some(n) = self.every_n_frames {
+            if frame_count % n != 0 {
+                return true;
+            }
+        }
+        if self.adaptive_skip {
+            let free_slots = self.pipeless_bus_sender.capacity();
+            if free_slots == 0 {
+                return true;
+            }
+            let occupancy = 1.0 - free_slots as f64 / self.pipeless_bus_sender.max_capacity() as f64;
+            if occupancy >= ADAPTIVE_SKIP_MIN_OCCUPANCY {
+                let keep_every = 1 + ((occupancy - ADAPTIVE_SKIP_MIN_OCCUPANCY) * 8.0) as u64;
+                return frame_count % keep_every != 0;
+            }
+        }
+        false
+    }
+}
+
+/// Adds the elements that apply the input rate policy to the input bin.
+/// Returns the element to which the decoded frames must be linked.
+/// The target fps is applied by a videorate element, while the every N frames and
+/// adaptive options are applied by a probe. Both run before the color conversion,
+/// so skipped frames are never converted nor copied.
+fn add_rate_control(
+    bin: &gst::Bin,
+    videoconvert: &gst::Element,
+    input_rate_policy: &pipeless::config::streams::InputRatePolicy,
+    stream_metrics: &Arc<pipeless::metrics::StreamMetrics>,
+    pipeless_bus_sender: &tokio::sync::mpsc::Sender<pipeless::events::Event>,
+) -> Result<gst::Element, InputPipelineError> {
+    let entry = match input_rate_policy.get_target_fps() {
+        Some(target_fps) => {
+            let videorate = pipeless::gst::utils::create_generic_component("videorate", "videorate")?;
+            videorate.set_property("drop-only", true);
+            videorate.set_property("max-rate", target_fps as i32);
+            // Required to be notified about the dropped frames
+            videorate.set_property("silent", false);
+            videorate.connect_notify(Some("drop"), {
+                let stream_metrics = stream_metrics.clone();
+                move |_, _| stream_metrics.inc_skipped_frames()
+            });
+            bin.add(&videorate)
+                .map_err(|_| { InputPipelineError::new("Unable to add videorate to the input bin") })?;
+            videorate.link(videoconvert)
+                .map_err(|_| { InputPipelineError::new("Error linking videorate to videoconvert") })?;
+            videorate
+        },
+        None => videoconvert.clone(),
+    };
+
+    let entry_sink_pad = entry.static_pad("sink")
+        .ok_or_else(|| { InputPipelineError::new("Unable to get the sink pad of the rate control") })?;
+    let frame_skipper = FrameSkipper::new(input_rate_policy, pipeless_bus_sender.clone());
+    let stream_metrics = stream_metrics.clone();
+    entry_sink_pad.add_probe(
+        gst::PadProbeType::BUFFER,
+        move |_pad: &gst::Pad, info: &mut gst::PadProbeInfo| {
+            stream_metrics.inc_decoded_frames();
+            if frame_skipper.should_skip() {
+                stream_metrics.inc_skipped_frames();
+                gst::PadProbeReturn::Drop
+            } else {
+                if let Some(pts) = info.buffer().and_then(|buffer| buffer.pts()) {
+                    stream_metrics.mark_decoded(pts.nseconds());
+                }
+                gst::PadProbeReturn::Ok
+            }
+        }
+    );
+
+    Ok(entry)
 }
 
 fn on_new_sample(
@@ -62,6 +221,9 @@ fn on_new_sample(
     appsink: &gst_app::AppSink,
     pipeless_bus_sender: &tokio::sync::mpsc::Sender<pipeless::events::Event>,
     frame_number: &mut u64,
+    stream_metrics: &pipeless::metrics::StreamMetrics,
+    passthrough_sender: Option<&tokio::sync::mpsc::Sender<pipeless::data::Frame>>,
+    pending_frames: Option<&Arc<pipeless::pipeline::PendingFrames>>,
 ) -> Result<gst::FlowSuccess, gst::FlowError> {
     let sample = appsink.pull_sample().map_err(|_err| {
         error!("Sample is None");
@@ -105,29 +267,52 @@ fn on_new_sample(
         }
     };
     let duration = buffer.duration().or(Some(gst::ClockTime::from_mseconds(0))).unwrap();
-    let buffer_info = buffer.map_readable().or_else(|_| {
-        error!("Unable to extract the info from the sample buffer.");
-        Err(gst::FlowError::Error)
-    })?;
-
-    let ndframe = ndarray::Array3::from_shape_vec(
-        (height, width, channels), buffer_info.to_vec()
+    // The frame keeps a reference to the decoded buffer instead of copying it
+    let pixels = pipeless::data::BufferPixels::new(
+        buffer.to_owned(), (height, width, channels)
     ).map_err(|err| {
-        error!("Failed to create ndarray from buffer data: {}", err.to_string());
+        error!("Failed to create frame from buffer data: {}", err);
         gst::FlowError::Error
     })?;
 
-    *frame_number += 1;
+    stream_metrics.observe_input_latency(pts.nseconds());
+    // Only the published frames consume a frame number. The stateful hooks order the frames
+    // by number, so a gap left by a frame that never reaches the stages would stall them.
     let frame = pipeless::data::Frame::new_rgb(
-        ndframe, width, height,
+        pipeless::data::Pixels::Buffer(pixels), width, height,
         pts, dts, duration,
         fps as u8, frame_input_instant,
-        pipeless_pipeline_id, *frame_number,
+        pipeless_pipeline_id, *frame_number + 1,
     );
+    // Added before publishing, the frame can be processed before the publish returns
+    if let Some(pending_frames) = pending_frames {
+        pending_frames.add(pts.nseconds());
+    }
     // The event takes ownership of the frame
-    pipeless::events::publish_new_frame_change_event_sync(
+    let unpublished_frame = pipeless::events::publish_new_frame_change_event_sync(
         pipeless_bus_sender, frame
     );
+    if let (Some(_), Some(pending_frames)) = (&unpublished_frame, pending_frames) {
+        pending_frames.remove(pts.nseconds());
+    }
+    match (unpublished_frame, passthrough_sender) {
+        (None, _) => {
+            *frame_number += 1;
+            stream_metrics.set_overloaded(false);
+        },
+        (Some(frame), Some(passthrough_sender)) => {
+            stream_metrics.set_overloaded(true);
+            // Send the frame to the output without processing it
+            match passthrough_sender.try_send(frame) {
+                Ok(_) => stream_metrics.inc_passthrough_frames(),
+                Err(_) => stream_metrics.inc_discarded_frames(),
+            }
+        },
+        (Some(_), None) => {
+            stream_metrics.set_overloaded(true);
+            stream_metrics.inc_discarded_frames();
+        },
+    }
 
     Ok(gst::FlowSuccess::Ok)
 }
@@ -157,6 +342,8 @@ fn on_pad_added (
 
 fn create_input_bin(
     uri: &str,
+    input_rate_policy: &pipeless::config::streams::InputRatePolicy,
+    stream_metrics: &Arc<pipeless::metrics::StreamMetrics>,
     pipeless_bus_sender: &tokio::sync::mpsc::Sender<pipeless::events::Event>,
 ) -> Result<gst::Bin, InputPipelineError> {
     let bin = gst::Bin::new();
@@ -188,7 +375,8 @@ fn create_input_bin(
         bin.add_many([&v4l2src, &videoconvert, &videoscale, &capsfilter])
             .map_err(|_| { InputPipelineError::new("Unable to add elements to input bin") })?;
 
-        v4l2src.link(&videoconvert).map_err(|_| { InputPipelineError::new("Error linking v4l2src to videoconvert") })?;
+        let rate_control = add_rate_control(&bin, &videoconvert, input_rate_policy, stream_metrics, pipeless_bus_sender)?;
+        v4l2src.link(&rate_control).map_err(|_| { InputPipelineError::new("Error linking v4l2src to videoconvert") })?;
         videoconvert.link(&videoscale).map_err(|_| { InputPipelineError::new("Error linking videoconvert to videoscale") })?;
         videoscale.link(&capsfilter).map_err(|_| { InputPipelineError::new("Error linking videoscale to capsfilter") })?;
 
@@ -206,6 +394,41 @@ fn create_input_bin(
         pipeless::events::publish_new_input_caps_event_sync(
             pipeless_bus_sender, forced_caps_str
         );
+    } else if uri.starts_with(TEST_SOURCE_PREFIX) {
+        let test_source = TestSource::from_uri(uri)?;
+        let videotestsrc = pipeless::gst::utils::create_generic_component("videotestsrc", "videotestsrc")?;
+        let videoconvert = pipeless::gst::utils::create_generic_component("videoconvert", "videoconvert")?;
+        videotestsrc.set_property("is-live", test_source.live);
+        if let Some(frames) = test_source.frames {
+            videotestsrc.set_property("num-buffers", frames as i32);
+        }
+        let caps_str = test_source.get_caps_str();
+        let caps = gst::Caps::from_str(&caps_str)
+            .map_err(|_| { InputPipelineError::new("Unable to create caps from string") })?;
+        let capsfilter = gst::ElementFactory::make("capsfilter")
+            .name("capsfilter")
+            .property("caps", caps)
+            .build()
+            .map_err(|_| { InputPipelineError::new("Failed to create capsfilter") })?;
+
+        bin.add_many([&videotestsrc, &capsfilter, &videoconvert])
+            .map_err(|_| { InputPipelineError::new("Unable to add elements to input bin") })?;
+
+        let rate_control = add_rate_control(&bin, &videoconvert, input_rate_policy, stream_metrics, pipeless_bus_sender)?;
+        videotestsrc.link(&capsfilter).map_err(|_| { InputPipelineError::new("Error linking videotestsrc to capsfilter") })?;
+        capsfilter.link(&rate_control).map_err(|_| { InputPipelineError::new("Error linking capsfilter to videoconvert") })?;
+
+        let videoconvert_src_pad = videoconvert.static_pad("src")
+            .ok_or_else(|| { InputPipelineError::new("Failed to create the pipeline. Unable to get videoconvert source pad.") })?;
+        let ghostpath_src = gst::GhostPad::with_target(&videoconvert_src_pad)
+            .map_err(|_| { InputPipelineError::new("Unable to create the ghost pad to link bin") })?;
+        bin.add_pad(&ghostpath_src)
+            .map_err(|_| { InputPipelineError::new("Unable to add ghostpad to input bin") })?;
+
+        // The caps are fixed, notify the output about the new stream
+        pipeless::events::publish_new_input_caps_event_sync(
+            pipeless_bus_sender, format!("{},format=RGB", caps_str)
+        );
     } else {
         // Use uridecodebin by default
         let uridecodebin = pipeless::gst::utils::create_generic_component("uridecodebin3", "source")?;
@@ -215,10 +438,12 @@ fn create_input_bin(
 
         bin.add_many([&uridecodebin, &videoconvert])
             .map_err(|_| { InputPipelineError::new("Unable to add elements to the input bin")})?;
+        // Decoded frames are linked to the rate control, which is linked to videoconvert
+        let rate_control = add_rate_control(&bin, &videoconvert, input_rate_policy, stream_metrics, pipeless_bus_sender)?;
         if let Ok(nvvidconv) = &nvvidconv_opt {
             bin.add(nvvidconv)
                 .map_err(|_| { InputPipelineError::new("Unable to add nvidconv to the input bin")})?;
-            nvvidconv.link(&videoconvert) // We use unwrap here because it cannot be none
+            nvvidconv.link(&rate_control) // We use unwrap here because it cannot be none
                 .map_err(|_| { InputPipelineError::new("Error linking nvvidconv to videoconvert") })?;
         }
         uridecodebin.set_property("uri", uri);
@@ -236,7 +461,7 @@ fn create_input_bin(
             .map_err(|_| { InputPipelineError::new("Unable to add ghostpad to input bin")})?;
 
         // Uridecodebin uses dynamic linking (creates pads automatically for new detected streams)
-        let videoconvert_sink_pad = videoconvert.static_pad("sink")
+        let videoconvert_sink_pad = rate_control.static_pad("sink")
             .ok_or_else(|| { InputPipelineError::new("Unable to get videoconvert pad") })?;
         let link_new_pad_fn = move |pad: &gst::Pad| -> Result<gst::PadLinkSuccess, InputPipelineError> {
             let pad_caps = pad.query_caps(None);
@@ -395,10 +620,14 @@ fn on_bus_message(
 fn create_gst_pipeline(
     pipeless_pipeline_id: uuid::Uuid,
     input_uri: &str,
+    input_rate_policy: &pipeless::config::streams::InputRatePolicy,
+    stream_metrics: &Arc<pipeless::metrics::StreamMetrics>,
+    passthrough_sender: Option<tokio::sync::mpsc::Sender<pipeless::data::Frame>>,
+    pending_frames: Option<Arc<pipeless::pipeline::PendingFrames>>,
     pipeless_bus_sender: &tokio::sync::mpsc::Sender<pipeless::events::Event>,
 ) -> Result<gst::Pipeline, InputPipelineError> {
     let pipeline = gst::Pipeline::new();
-    let input_bin = create_input_bin(input_uri, pipeless_bus_sender)?;
+    let input_bin = create_input_bin(input_uri, input_rate_policy, stream_metrics, pipeless_bus_sender)?;
     // Force RGB output since workers process RGB
     let sink_caps = gst::Caps::from_str("video/x-raw,format=RGB")
         .map_err(|_| { InputPipelineError::new("Unable to create caps from string") })?;
@@ -410,11 +639,21 @@ fn create_gst_pipeline(
         .map_err(|_| { InputPipelineError::new("Failed to create appsink") })?
         .dynamic_cast::<gst_app::AppSink>()
         .map_err(|_| { InputPipelineError::new("Unable to cast element to AppSink") })?;
+    if input_uri.starts_with(TEST_SOURCE_PREFIX) && !TestSource::from_uri(input_uri)?.live {
+        // Produce the frames as fast as they are consumed instead of at the source framerate
+        appsink.set_sync(false);
+    }
+    if input_rate_policy.get_adaptive_skip() {
+        // Never queue frames on the appsink. Old frames are dropped instead of delaying new ones
+        appsink.set_max_buffers(1);
+        appsink.set_drop(true);
+    }
 
     let appsink_callbacks = gst_app::AppSinkCallbacks::builder()
         .new_sample(
             {
                 let pipeless_bus_sender = pipeless_bus_sender.clone();
+                let stream_metrics = stream_metrics.clone();
                 let mut frame_number: u64 = 0; // Used to set the frame number
                 move |appsink: &gst_app::AppSink| {
                 on_new_sample(
@@ -422,6 +661,9 @@ fn create_gst_pipeline(
                     appsink,
                     &pipeless_bus_sender,
                     &mut frame_number,
+                    &stream_metrics,
+                    passthrough_sender.as_ref(),
+                    pending_frames.as_ref(),
                 )
             }
         }).build();
@@ -445,10 +687,18 @@ impl Pipeline {
     pub fn new(
         id: uuid::Uuid,
         stream: pipeless::input::pipeline::StreamDef,
+        stream_metrics: &Arc<pipeless::metrics::StreamMetrics>,
+        // When provided, the frames that can't be published in the bus are sent to the output through it
+        passthrough_sender: Option<tokio::sync::mpsc::Sender<pipeless::data::Frame>>,
+        // Frames published in the bus that the pass-through frames must wait for
+        pending_frames: Option<Arc<pipeless::pipeline::PendingFrames>>,
         pipeless_bus_sender: &tokio::sync::mpsc::Sender<pipeless::events::Event>,
     ) -> Result<Self, InputPipelineError> {
         let input_uri = stream.get_video().get_uri();
-        let gst_pipeline = create_gst_pipeline(id, input_uri, pipeless_bus_sender)?;
+        let gst_pipeline = create_gst_pipeline(
+            id, input_uri, stream.get_input_rate_policy(),
+            stream_metrics, passthrough_sender, pending_frames, pipeless_bus_sender
+        )?;
         let pipeline = Pipeline {
             id,
             _stream: stream,
@@ -1,63 +1,560 @@
-use log::{error, warn};
+use std::{collections::{hash_map::DefaultHasher, HashMap}, hash::{Hash, Hasher}, sync::{mpsc, Arc, Mutex, RwLock, RwLockReadGuard, RwLockWriteGuard}, time::{Duration, Instant, SystemTime, UNIX_EPOCH}};
+use log::{error, info, warn};
 use sled;
 use lazy_static::lazy_static;
 
+use crate::data::UserData;
+
+/// Directory of the persistent copy of the KV store. When not set the store is only kept in memory.
+const STORE_PATH_ENV: &str = "PIPELESS_KV_STORE_PATH";
+/// The keys are distributed among the shards by hash, so hooks rarely wait for the same lock
+const NUM_SHARDS: usize = 32;
+/// Interval to remove the expired keys. Expired keys are never returned, even before being removed.
+const EXPIRATION_INTERVAL: Duration = Duration::from_secs(1);
+/// Maximum number of writes applied to the persistent store in a single batch
+const PERSIST_BATCH_SIZE: usize = 1024;
+
+/// Keys have the format 'namespace:key'. The keys set from the hooks use the pipeline id
+/// as namespace, so all the keys of a stream are removed at once when it ends.
 // We assume the type implementing StoreInterface can be send thread safely
-pub trait StoreInterface: Sync {
-    fn get(&self, key: &str) -> String;
-    fn set(&self, key: &str, value: &str);
+pub trait StoreInterface: Sync + Send {
+    /// Returns the value of a key. None when it does not exist or expired.
+    fn get_value(&self, key: &str) -> Option<UserData>;
+    /// Sets the value of a key. With a TTL, the key expires after it.
+    fn set_value(&self, key: &str, value: UserData, ttl: Option<Duration>);
+    fn delete(&self, key: &str);
+    /// Atomically adds amount to the integer value of a key and returns the new value.
+    /// A key that does not exist starts from 0.
+    fn incr(&self, key: &str, amount: i64) -> Result<i64, String>;
     fn clean(&self, prefix: &str); // clean all the keys that start with prefix
+
+    fn mget(&self, keys: &[String]) -> Vec<Option<UserData>> {
+        keys.iter().map(|key| self.get_value(key)).collect()
+    }
+    fn mset(&self, entries: Vec<(String, UserData)>, ttl: Option<Duration>) {
+        for (key, value) in entries {
+            self.set_value(&key, value, ttl);
+        }
+    }
+
+    /// Returns the value as a string. Empty when it does not exist or is not a scalar.
+    fn get(&self, key: &str) -> String {
+        self.get_value(key).map_or_else(String::new, |value| value_to_string(&value))
+    }
+    fn set(&self, key: &str, value: &str) {
+        self.set_value(key, UserData::String(value.to_string()), None);
+    }
 }
 
-struct LocalStore {
-    backend: sled::Db,
+fn value_to_string(value: &UserData) -> String {
+    match value {
+        UserData::Bool(b) => if *b { "True".to_string() } else { "False".to_string() },
+        UserData::Integer(i) => i.to_string(),
+        UserData::Integer64(i) => i.to_string(),
+        UserData::Float(f) => f.to_string(),
+        UserData::String(s) => s.clone(),
+        UserData::Bytes(b) => String::from_utf8_lossy(b).into_owned(),
+        _ => String::new(),
+    }
 }
-impl LocalStore {
-    fn new() -> Self {
-        let db_path = "/tmp/.pipeless_kv_store";
-        let db = sled::open(db_path)
-            .expect(&format!("Failed to open KV store. Ensure pipeless can write at {}", db_path));
-        Self { backend: db }
+
+/// Integer value of a key for increments. Strings are accepted because
+/// older versions stored every value as a string.
+fn integer_value(value: &UserData) -> Option<i64> {
+    match value {
+        UserData::Integer(i) => Some(*i as i64),
+        UserData::Integer64(i) => Some(*i),
+        UserData::String(s) => s.trim().parse().ok(),
+        _ => None,
     }
 }
-impl StoreInterface for LocalStore {
-    /// Insert a KV pair, logs an error if it fails, but do not stop the program.
-    /// Trying to get the key will return an empty string.
-    fn set(&self, key: &str, value: &str) {
-        if let Err(err) = self.backend.insert(key, value) {
-            error!("Error inserting key {} with value {} in local KV store. Error: {}", key, value, err);
+
+/// Splits a key into its namespace and the rest of the key
+fn split_key(key: &str) -> (&str, &str) {
+    key.split_once(':').unwrap_or(("", key))
+}
+
+fn shard_index(key: &str) -> usize {
+    let mut hasher = DefaultHasher::new();
+    key.hash(&mut hasher);
+    hasher.finish() as usize % NUM_SHARDS
+}
+
+fn unix_millis(time: SystemTime) -> u64 {
+    time.duration_since(UNIX_EPOCH).map_or(0, |duration| duration.as_millis() as u64)
+}
+
+struct Entry {
+    value: UserData,
+    expires_at: Option<Instant>,
+}
+impl Entry {
+    fn is_expired(&self, now: Instant) -> bool {
+        self.expires_at.map_or(false, |expires_at| expires_at <= now)
+    }
+}
+
+/// Keys of a namespace stored in a shard
+#[derive(Default)]
+struct Namespace {
+    entries: HashMap<String, Entry>,
+    expiring: usize, // Number of entries with TTL
+}
+impl Namespace {
+    fn insert(&mut self, key: String, entry: Entry) {
+        if entry.expires_at.is_some() {
+            self.expiring += 1;
+        }
+        if let Some(old) = self.entries.insert(key, entry) {
+            if old.expires_at.is_some() {
+                self.expiring -= 1;
+            }
         }
     }
 
-    /// Returns the value or an empty string
-    fn get(&self, key: &str) -> String {
-        match self.backend.get(key) {
-            Ok(v) => {
-                match v.as_deref() {
-                    Some(v) => std::str::from_utf8(v).unwrap().into(),
-                    None => String::from("")
-                }
+    fn remove(&mut self, key: &str) -> Option<Entry> {
+        let entry = self.entries.remove(key)?;
+        if entry.expires_at.is_some() {
+            self.expiring -= 1;
+        }
+        Some(entry)
+    }
+
+    /// Removes the expired entries and returns their keys
+    fn remove_expired(&mut self, now: Instant) -> Vec<String> {
+        if self.expiring == 0 {
+            return Vec::new();
+        }
+        let expired: Vec<String> = self.entries.iter()
+            .filter(|(_, entry)| entry.is_expired(now))
+            .map(|(key, _)| key.clone())
+            .collect();
+        for key in &expired {
+            self.remove(key);
+        }
+        expired
+    }
+}
+
+/// Namespaces of a shard. The keys of the entries are the full keys.
+type Shard = RwLock<HashMap<String, Namespace>>;
+
+fn namespace_mut<'a>(namespaces: &'a mut HashMap<String, Namespace>, name: &str) -> &'a mut Namespace {
+    if !namespaces.contains_key(name) {
+        namespaces.insert(name.to_string(), Namespace::default());
+    }
+    namespaces.get_mut(name).unwrap()
+}
+
+enum PersistOp {
+    Set(String, UserData, u64), // key, value, expiration in unix milliseconds (0 never expires)
+    Delete(String),
+    DeletePrefix(String),
+}
+
+/// Copies the writes to a sled database in the background. The hooks never wait for the disk.
+struct WriteBehind {
+    sender: Mutex<mpsc::Sender<PersistOp>>,
+}
+impl WriteBehind {
+    fn start(db: sled::Db) -> Self {
+        let (sender, receiver) = mpsc::channel();
+        let spawned = std::thread::Builder::new()
+            .name("kv-store-writer".to_string())
+            .spawn(move || run_writer(db, receiver));
+        if let Err(err) = spawned {
+            error!("Unable to start the KV store writer, the store will not be persisted: {}", err);
+        }
+        Self { sender: Mutex::new(sender) }
+    }
+
+    fn send(&self, op: PersistOp) {
+        let sender = self.sender.lock().unwrap_or_else(|err| err.into_inner());
+        if sender.send(op).is_err() {
+            warn!("The KV store writer stopped, the change will not be persisted");
+        }
+    }
+}
+
+fn apply_batch(db: &sled::Db, batch: sled::Batch) {
+    if let Err(err) = db.apply_batch(batch) {
+        error!("Error persisting the KV store. Error: {}", err);
+    }
+}
+
+fn run_writer(db: sled::Db, receiver: mpsc::Receiver<PersistOp>) {
+    while let Ok(op) = receiver.recv() {
+        // Group the pending writes in a single batch
+        let mut batch = sled::Batch::default();
+        let mut next = Some(op);
+        let mut count = 0;
+        while let Some(op) = next.take() {
+            match op {
+                PersistOp::Set(key, value, expires_at) => {
+                    let mut data = expires_at.to_le_bytes().to_vec();
+                    encode_value(&value, &mut data);
+                    batch.insert(key.as_bytes(), data);
+                },
+                PersistOp::Delete(key) => batch.remove(key.as_bytes()),
+                PersistOp::DeletePrefix(prefix) => {
+                    // The previous writes must be applied before removing the keys
+                    apply_batch(&db, std::mem::take(&mut batch));
+                    let mut removals = sled::Batch::default();
+                    for key in db.scan_prefix(&prefix).keys().filter_map(Result::ok) {
+                        removals.remove(key);
+                    }
+                    apply_batch(&db, removals);
+                },
+            }
+            count += 1;
+            if count < PERSIST_BATCH_SIZE {
+                next = receiver.try_recv().ok();
+            }
+        }
+        apply_batch(&db, batch);
+    }
+}
+
+/// In-memory store sharded by key. The keys of every namespace are grouped,
+/// so cleaning a pipeline drops its namespace from every shard without scanning keys.
+/// When PIPELESS_KV_STORE_PATH is set, the writes are also persisted to a sled database
+/// in the background and the store is loaded from it on start.
+struct MemoryStore {
+    shards: Arc<Vec<Shard>>,
+    persistence: Option<Arc<WriteBehind>>,
+}
+impl MemoryStore {
+    fn new() -> Self {
+        let shards: Arc<Vec<Shard>> = Arc::new((0..NUM_SHARDS).map(|_| RwLock::new(HashMap::new())).collect());
+        let persistence = match std::env::var(STORE_PATH_ENV) {
+            Ok(db_path) => {
+                let db = sled::open(&db_path)
+                    .expect(&format!("Failed to open KV store. Ensure pipeless can write at {}", db_path));
+                Self::load(&shards, &db);
+                Some(Arc::new(WriteBehind::start(db)))
             },
-            Err(err) => {
-                error!("Error getting value for key {} from local KV store. Error: {}", key, err);
-                String::from("")
+            Err(_) => None,
+        };
+
+        let expiration_shards = shards.clone();
+        let expiration_persistence = persistence.clone();
+        let spawned = std::thread::Builder::new()
+            .name("kv-store-expiration".to_string())
+            .spawn(move || loop {
+                std::thread::sleep(EXPIRATION_INTERVAL);
+                remove_expired(&expiration_shards, expiration_persistence.as_deref());
+            });
+        if let Err(err) = spawned {
+            warn!("Unable to start the KV store expiration. Expired keys will be removed with their pipeline: {}", err);
+        }
+
+        Self { shards, persistence }
+    }
+
+    /// Loads the persisted keys that did not expire
+    fn load(shards: &[Shard], db: &sled::Db) {
+        let now = Instant::now();
+        let now_millis = unix_millis(SystemTime::now());
+        let mut loaded = 0;
+        for item in db.iter() {
+            let (key, data) = match item {
+                Ok(item) => item,
+                Err(err) => {
+                    error!("Error loading the persisted KV store. Error: {}", err);
+                    break;
+                }
+            };
+            let (key, mut data) = match (std::str::from_utf8(&key), data.len() >= 8) {
+                (Ok(key), true) => (key, &data[..]),
+                _ => {
+                    warn!("Ignoring invalid entry of the persisted KV store");
+                    continue;
+                }
+            };
+            let expires_at = u64::from_le_bytes(take(&mut data, 8).unwrap().try_into().unwrap());
+            let expires_at = match expires_at {
+                0 => None,
+                expires_at if expires_at > now_millis => Some(now + Duration::from_millis(expires_at - now_millis)),
+                _ => continue,
+            };
+            let value = match decode_value(&mut data) {
+                Some(value) => value,
+                None => {
+                    warn!("Ignoring invalid value of the key {} of the persisted KV store", key);
+                    continue;
+                }
+            };
+            let mut namespaces = shards[shard_index(key)].write().unwrap_or_else(|err| err.into_inner());
+            namespace_mut(&mut namespaces, split_key(key).0).insert(key.to_string(), Entry { value, expires_at });
+            loaded += 1;
+        }
+        info!("Loaded {} keys from the persisted KV store", loaded);
+    }
+
+    fn read_shard(&self, key: &str) -> RwLockReadGuard<HashMap<String, Namespace>> {
+        self.shards[shard_index(key)].read().unwrap_or_else(|err| err.into_inner())
+    }
+
+    fn write_shard(&self, key: &str) -> RwLockWriteGuard<HashMap<String, Namespace>> {
+        self.shards[shard_index(key)].write().unwrap_or_else(|err| err.into_inner())
+    }
+
+    fn persist(&self, op: impl FnOnce() -> PersistOp) {
+        if let Some(persistence) = &self.persistence {
+            persistence.send(op());
+        }
+    }
+
+    fn insert(&self, namespaces: &mut HashMap<String, Namespace>, key: String, value: UserData, ttl: Option<Duration>) {
+        self.persist(|| PersistOp::Set(
+            key.clone(), value.clone(), ttl.map_or(0, |ttl| unix_millis(SystemTime::now() + ttl))
+        ));
+        let expires_at = ttl.map(|ttl| Instant::now() + ttl);
+        namespace_mut(namespaces, split_key(&key).0).insert(key, Entry { value, expires_at });
+    }
+}
+impl StoreInterface for MemoryStore {
+    fn get_value(&self, key: &str) -> Option<UserData> {
+        let namespaces = self.read_shard(key);
+        let entry = namespaces.get(split_key(key).0)?.entries.get(key)?;
+        if entry.is_expired(Instant::now()) {
+            return None;
+        }
+        Some(entry.value.clone())
+    }
+
+    fn set_value(&self, key: &str, value: UserData, ttl: Option<Duration>) {
+        let mut namespaces = self.write_shard(key);
+        self.insert(&mut namespaces, key.to_string(), value, ttl);
+    }
+
+    fn mset(&self, entries: Vec<(String, UserData)>, ttl: Option<Duration>) {
+        // Lock every shard once
+        let mut shard_entries: Vec<Vec<(String, UserData)>> = (0..NUM_SHARDS).map(|_| Vec::new()).collect();
+        for (key, value) in entries {
+            shard_entries[shard_index(&key)].push((key, value));
+        }
+        for (index, entries) in shard_entries.into_iter().enumerate() {
+            if entries.is_empty() {
+                continue;
+            }
+            let mut namespaces = self.shards[index].write().unwrap_or_else(|err| err.into_inner());
+            for (key, value) in entries {
+                self.insert(&mut namespaces, key, value, ttl);
             }
         }
     }
 
+    fn delete(&self, key: &str) {
+        let mut namespaces = self.write_shard(key);
+        if let Some(namespace) = namespaces.get_mut(split_key(key).0) {
+            if namespace.remove(key).is_some() {
+                self.persist(|| PersistOp::Delete(key.to_string()));
+            }
+        }
+    }
+
+    fn incr(&self, key: &str, amount: i64) -> Result<i64, String> {
+        let mut namespaces = self.write_shard(key);
+        let (current, ttl) = match namespaces.get(split_key(key).0).and_then(|namespace| namespace.entries.get(key)) {
+            Some(entry) if !entry.is_expired(Instant::now()) => {
+                let current = integer_value(&entry.value)
+                    .ok_or_else(|| format!("The value of the key {} is not an integer", key))?;
+                // The key keeps its expiration
+                (current, entry.expires_at.map(|expires_at| expires_at.saturating_duration_since(Instant::now())))
+            },
+            _ => (0, None),
+        };
+        let value = current.checked_add(amount)
+            .ok_or_else(|| format!("Incrementing the key {} overflows a 64 bits integer", key))?;
+        let data = match i32::try_from(value) {
+            Ok(value) => UserData::Integer(value),
+            Err(_) => UserData::Integer64(value),
+        };
+        self.insert(&mut namespaces, key.to_string(), data, ttl);
+        Ok(value)
+    }
+
     fn clean(&self, prefix: &str) {
-        let keys_to_remove: Vec<sled::IVec> = self.backend
-            .scan_prefix(prefix)
-            .keys()
-            .filter_map(Result::ok)
-            .collect();
+        for shard in self.shards.iter() {
+            let mut namespaces = shard.write().unwrap_or_else(|err| err.into_inner());
+            match prefix.split_once(':') {
+                Some((namespace, _)) => {
+                    if let Some(namespace) = namespaces.get_mut(namespace) {
+                        let keys: Vec<String> = namespace.entries.keys()
+                            .filter(|key| key.starts_with(prefix))
+                            .cloned()
+                            .collect();
+                        for key in keys {
+                            namespace.remove(&key);
+                        }
+                    }
+                },
+                None => {
+                    // Drop the whole namespaces without visiting their keys
+                    namespaces.retain(|namespace, _| namespace.is_empty() || !namespace.starts_with(prefix));
+                    // The keys without namespace are grouped under the empty one
+                    if let Some(namespace) = namespaces.get_mut("") {
+                        let keys: Vec<String> = namespace.entries.keys()
+                            .filter(|key| key.starts_with(prefix))
+                            .cloned()
+                            .collect();
+                        for key in keys {
+                            namespace.remove(&key);
+                        }
+                    }
+                },
+            }
+        }
+        self.persist(|| PersistOp::DeletePrefix(prefix.to_string()));
+    }
+}
 
-        for key in keys_to_remove {
-            if let Err(err) = self.backend.remove(&key) {
-                warn!("Failed to remove key from KV store. {}", err);
+fn remove_expired(shards: &[Shard], persistence: Option<&WriteBehind>) {
+    let now = Instant::now();
+    for shard in shards {
+        let mut namespaces = shard.write().unwrap_or_else(|err| err.into_inner());
+        for namespace in namespaces.values_mut() {
+            for key in namespace.remove_expired(now) {
+                if let Some(persistence) = persistence {
+                    persistence.send(PersistOp::Delete(key));
+                }
             }
         }
+        namespaces.retain(|_, namespace| !namespace.entries.is_empty());
+    }
+}
+
+/// Encodes a value for the persistent store.
+/// Every value starts with a tag byte, numbers are little endian and
+/// lengths are u32 except the array dimensions, which are u64.
+fn encode_value(value: &UserData, out: &mut Vec<u8>) {
+    fn encode_bytes(bytes: &[u8], out: &mut Vec<u8>) {
+        out.extend_from_slice(&(bytes.len() as u32).to_le_bytes());
+        out.extend_from_slice(bytes);
+    }
+    fn encode_shape(shape: &[usize], out: &mut Vec<u8>) {
+        out.extend_from_slice(&(shape.len() as u32).to_le_bytes());
+        for dim in shape {
+            out.extend_from_slice(&(*dim as u64).to_le_bytes());
+        }
+    }
+    match value {
+        UserData::Empty => out.push(0),
+        UserData::Bool(b) => out.extend_from_slice(&[1, *b as u8]),
+        UserData::Integer(i) => { out.push(2); out.extend_from_slice(&i.to_le_bytes()); },
+        UserData::Integer64(i) => { out.push(3); out.extend_from_slice(&i.to_le_bytes()); },
+        UserData::Float(f) => { out.push(4); out.extend_from_slice(&f.to_le_bytes()); },
+        UserData::String(s) => { out.push(5); encode_bytes(s.as_bytes(), out); },
+        UserData::Bytes(b) => { out.push(6); encode_bytes(b, out); },
+        UserData::Array(items) => {
+            out.push(7);
+            out.extend_from_slice(&(items.len() as u32).to_le_bytes());
+            for item in items {
+                encode_value(item, out);
+            }
+        },
+        UserData::Dictionary(dict) => {
+            out.push(8);
+            out.extend_from_slice(&(dict.len() as u32).to_le_bytes());
+            for (key, item) in dict {
+                encode_bytes(key.as_bytes(), out);
+                encode_value(item, out);
+            }
+        },
+        UserData::F32Array(arr) => {
+            out.push(9);
+            encode_shape(arr.shape(), out);
+            arr.iter().for_each(|x| out.extend_from_slice(&x.to_le_bytes()));
+        },
+        UserData::I32Array(arr) => {
+            out.push(10);
+            encode_shape(arr.shape(), out);
+            arr.iter().for_each(|x| out.extend_from_slice(&x.to_le_bytes()));
+        },
+        UserData::U8Array(arr) => {
+            out.push(11);
+            encode_shape(arr.shape(), out);
+            out.extend(arr.iter());
+        },
+        UserData::F64Array(arr) => {
+            out.push(12);
+            encode_shape(arr.shape(), out);
+            arr.iter().for_each(|x| out.extend_from_slice(&x.to_le_bytes()));
+        },
+        UserData::I64Array(arr) => {
+            out.push(13);
+            encode_shape(arr.shape(), out);
+            arr.iter().for_each(|x| out.extend_from_slice(&x.to_le_bytes()));
+        },
+        UserData::BoolArray(arr) => {
+            out.push(14);
+            encode_shape(arr.shape(), out);
+            out.extend(arr.iter().map(|x| *x as u8));
+        },
+    }
+}
+
+fn take<'a>(data: &mut &'a [u8], size: usize) -> Option<&'a [u8]> {
+    if data.len() < size {
+        return None;
     }
+    let (head, tail) = data.split_at(size);
+    *data = tail;
+    Some(head)
+}
+
+fn take_u32(data: &mut &[u8]) -> Option<u32> {
+    take(data, 4).map(|b| u32::from_le_bytes([b[0], b[1], b[2], b[3]]))
+}
+
+fn take_bytes<'a>(data: &mut &'a [u8]) -> Option<&'a [u8]> {
+    let len = take_u32(data)? as usize;
+    take(data, len)
+}
+
+fn decode_array<T>(data: &mut &[u8], item_size: usize, item: fn(&[u8]) -> T) -> Option<ndarray::ArrayD<T>> {
+    let ndim = take_u32(data)? as usize;
+    let shape = (0..ndim)
+        .map(|_| take(data, 8).map(|b| u64::from_le_bytes(b.try_into().unwrap()) as usize))
+        .collect::<Option<Vec<usize>>>()?;
+    let size = shape.iter().try_fold(item_size, |size, dim| size.checked_mul(*dim))?;
+    let items = take(data, size)?.chunks_exact(item_size).map(item).collect();
+    ndarray::ArrayD::from_shape_vec(shape, items).ok()
+}
+
+/// Decodes a value encoded by encode_value. None when the data is not valid.
+fn decode_value(data: &mut &[u8]) -> Option<UserData> {
+    let value = match take(data, 1)?[0] {
+        0 => UserData::Empty,
+        1 => UserData::Bool(take(data, 1)?[0] != 0),
+        2 => UserData::Integer(i32::from_le_bytes(take(data, 4)?.try_into().unwrap())),
+        3 => UserData::Integer64(i64::from_le_bytes(take(data, 8)?.try_into().unwrap())),
+        4 => UserData::Float(f64::from_le_bytes(take(data, 8)?.try_into().unwrap())),
+        5 => UserData::String(String::from_utf8(take_bytes(data)?.to_vec()).ok()?),
+        6 => UserData::Bytes(take_bytes(data)?.to_vec()),
+        7 => {
+            let len = take_u32(data)?;
+            UserData::Array((0..len).map(|_| decode_value(data)).collect::<Option<_>>()?)
+        },
+        8 => {
+            let len = take_u32(data)?;
+            UserData::Dictionary((0..len)
+                .map(|_| {
+                    let key = String::from_utf8(take_bytes(data)?.to_vec()).ok()?;
+                    Some((key, decode_value(data)?))
+                })
+                .collect::<Option<_>>()?)
+        },
+        9 => UserData::F32Array(decode_array(data, 4, |b| f32::from_le_bytes(b.try_into().unwrap()))?),
+        10 => UserData::I32Array(decode_array(data, 4, |b| i32::from_le_bytes(b.try_into().unwrap()))?),
+        11 => UserData::U8Array(decode_array(data, 1, |b| b[0])?),
+        12 => UserData::F64Array(decode_array(data, 8, |b| f64::from_le_bytes(b.try_into().unwrap()))?),
+        13 => UserData::I64Array(decode_array(data, 8, |b| i64::from_le_bytes(b.try_into().unwrap()))?),
+        14 => UserData::BoolArray(decode_array(data, 1, |b| b[0] != 0)?),
+        _ => return None,
+    };
+    Some(value)
 }
 
 // TODO: setup Redis or any other distributed solution.
@@ -68,12 +565,156 @@ impl DistributedStore {
     fn new() -> Self { unimplemented!() }
 }
 impl StoreInterface for DistributedStore {
-    fn get(&self, key: &str) -> String { unimplemented!() }
-    fn set(&self, key: &str, value: &str) { unimplemented!() }
+    fn get_value(&self, key: &str) -> Option<UserData> { unimplemented!() }
+    fn set_value(&self, key: &str, value: UserData, ttl: Option<Duration>) { unimplemented!() }
+    fn delete(&self, key: &str) { unimplemented!() }
+    fn incr(&self, key: &str, amount: i64) -> Result<i64, String> { unimplemented!() }
+    fn clean(&self, prefix: &str) { unimplemented!() }
 }
 */
 
 lazy_static! {
     // TODO: Add support for distributed store. Do not hardcode the local one
-    pub static ref KV_STORE: Box<dyn StoreInterface> = Box::new(LocalStore::new());
+    pub static ref KV_STORE: Box<dyn StoreInterface> = Box::new(MemoryStore::new());
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn memory_store() -> MemoryStore {
+        MemoryStore {
+            shards: Arc::new((0..NUM_SHARDS).map(|_| RwLock::new(HashMap::new())).collect()),
+            persistence: None,
+        }
+    }
+
+    fn all_variants() -> Vec<UserData> {
+        let shape = ndarray::IxDyn(&[2, 3]);
+        vec![
+            UserData::Empty,
+            UserData::Bool(true),
+            UserData::Integer(-7),
+            UserData::Integer64(i64::MIN),
+            UserData::Float(1.5),
+            UserData::String("pipeless ✓".to_string()),
+            UserData::Bytes(vec![0, 1, 255]),
+            UserData::Array(vec![UserData::Integer(1), UserData::String("a".to_string())]),
+            UserData::Dictionary([
+                ("a".to_string(), UserData::Float(-0.5)),
+                ("b".to_string(), UserData::Array(vec![])),
+            ].into_iter().collect()),
+            UserData::F32Array(ndarray::ArrayD::from_shape_fn(shape.clone(), |idx| idx[0] as f32 + 0.5)),
+            UserData::F64Array(ndarray::ArrayD::from_shape_fn(shape.clone(), |idx| idx[1] as f64 * 1e300)),
+            UserData::I32Array(ndarray::ArrayD::from_shape_fn(shape.clone(), |idx| -(idx[1] as i32))),
+            UserData::I64Array(ndarray::ArrayD::from_shape_fn(shape.clone(), |idx| i64::MAX - idx[1] as i64)),
+            UserData::U8Array(ndarray::ArrayD::from_shape_fn(shape.clone(), |idx| (idx[0] * 3 + idx[1]) as u8)),
+            UserData::BoolArray(ndarray::ArrayD::from_shape_fn(shape, |idx| idx[1] % 2 == 0)),
+        ]
+    }
+
+    #[test]
+    fn test_encode_decode_round_trip() {
+        for value in all_variants() {
+            let mut encoded = Vec::new();
+            encode_value(&value, &mut encoded);
+            let mut data = &encoded[..];
+            assert!(decode_value(&mut data) == Some(value.clone()));
+            assert!(data.is_empty());
+        }
+    }
+
+    #[test]
+    fn test_decode_rejects_truncated_values() {
+        for value in all_variants() {
+            let mut encoded = Vec::new();
+            encode_value(&value, &mut encoded);
+            for len in 0..encoded.len() {
+                let mut data = &encoded[..len];
+                assert!(decode_value(&mut data).is_none(), "accepted {} of {} bytes", len, encoded.len());
+            }
+        }
+        let mut data: &[u8] = &[255];
+        assert!(decode_value(&mut data).is_none());
+    }
+
+    #[test]
+    fn test_incr() {
+        let store = memory_store();
+        assert_eq!(store.incr("p:counter", 2), Ok(2));
+        assert_eq!(store.incr("p:counter", -5), Ok(-3));
+        // Integers that do not fit in 32 bits are kept as 64 bits
+        store.set_value("p:big", UserData::Integer(i32::MAX), None);
+        assert_eq!(store.incr("p:big", 1), Ok(i32::MAX as i64 + 1));
+        assert!(store.get_value("p:big") == Some(UserData::Integer64(i32::MAX as i64 + 1)));
+        // Values stored as strings by older versions
+        store.set("p:legacy", "41");
+        assert_eq!(store.incr("p:legacy", 1), Ok(42));
+
+        store.set("p:text", "abc");
+        assert!(store.incr("p:text", 1).is_err());
+    }
+
+    #[test]
+    fn test_incr_overflow() {
+        let store = memory_store();
+        store.set_value("p:max", UserData::Integer64(i64::MAX), None);
+        assert!(store.incr("p:max", 1).is_err());
+        // The value is not modified
+        assert!(store.get_value("p:max") == Some(UserData::Integer64(i64::MAX)));
+    }
+
+    #[test]
+    fn test_incr_keeps_ttl() {
+        let store = memory_store();
+        store.set_value("p:counter", UserData::Integer(1), Some(Duration::from_secs(60)));
+        assert_eq!(store.incr("p:counter", 1), Ok(2));
+        let namespaces = store.read_shard("p:counter");
+        let expires_at = namespaces["p"].entries["p:counter"].expires_at;
+        assert!(expires_at.map_or(false, |expires_at| expires_at > Instant::now() + Duration::from_secs(50)));
+    }
+
+    #[test]
+    fn test_expired_keys() {
+        let store = memory_store();
+        store.set_value("p:expired", UserData::Integer(5), Some(Duration::ZERO));
+        store.set_value("p:kept", UserData::Integer(1), None);
+        assert!(store.get_value("p:expired").is_none());
+        // An expired key starts from 0 and does not keep the expiration
+        assert_eq!(store.incr("p:expired", 1), Ok(1));
+        assert!(store.read_shard("p:expired")["p"].entries["p:expired"].expires_at.is_none());
+
+        store.set_value("q:expired", UserData::Integer(5), Some(Duration::ZERO));
+        remove_expired(&store.shards, None);
+        assert!(store.read_shard("q:expired").get("q").is_none());
+        assert!(store.get_value("p:kept") == Some(UserData::Integer(1)));
+    }
+
+    #[test]
+    fn test_clean_key_prefix() {
+        let store = memory_store();
+        for key in ["p1:a", "p1:ab", "p1:b", "p2:a"] {
+            store.set(key, "value");
+        }
+        store.clean("p1:a");
+        assert_eq!(store.get("p1:a"), "");
+        assert_eq!(store.get("p1:ab"), "");
+        assert_eq!(store.get("p1:b"), "value");
+        assert_eq!(store.get("p2:a"), "value");
+    }
+
+    #[test]
+    fn test_clean_namespace_prefix() {
+        let store = memory_store();
+        for key in ["p1:a", "p1:b", "p10:a", "p2:a", "p1-no-namespace", "other"] {
+            store.set(key, "value");
+        }
+        store.clean("p1");
+        assert_eq!(store.get("p1:a"), "");
+        assert_eq!(store.get("p1:b"), "");
+        assert_eq!(store.get("p10:a"), "");
+        assert_eq!(store.get("p1-no-namespace"), "");
+        assert_eq!(store.get("p2:a"), "value");
+        assert_eq!(store.get("other"), "value");
+    }
 }
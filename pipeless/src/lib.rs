@@ -21,3 +21,5 @@ pub mod stages;
 pub mod cli;
 pub mod kvs;
 pub mod event_exporters;
+pub mod metrics;
+pub mod scheduler;
@@ -18,12 +18,30 @@ enum AddCommand {
         /// Optional. URI where to send the output video. Use "screen" to show it directly on the device screen.
         #[arg(short, long)]
         output_uri: Option<String>,
-        /// Comma separated list of stages that will be executed for the frames of the new stream
+        /// Comma separated list of stages that will be executed for the frames of the new stream. Use '(stage_a | [key] stage_b/stage_c)' to run branches in parallel, optionally only when the user data key is set.
         #[arg(short, long)]
         frame_path: String,
         /// Optional. Restart policy for the stream. Either always, never, on_error or on_eos. 'Never' by default.
         #[arg(short, long)]
         restart_policy: Option<String>,
+        /// Optional. Max number of frames per second taken from the input. Exceeding frames are dropped before processing them.
+        #[arg(long)]
+        target_fps: Option<u32>,
+        /// Optional. Take only one of every N input frames.
+        #[arg(long)]
+        every_n_frames: Option<u64>,
+        /// Optional. Skip input frames when the stream buffer starts to fill up, before they are processed.
+        #[arg(long)]
+        adaptive_skip: bool,
+        /// Optional. What to do with the frames that can't be processed when the stream buffer is full. Either discard, pass_through or pass_through_annotated. 'discard' by default.
+        #[arg(long)]
+        overload_mode: Option<String>,
+        /// Optional. Weight of the stream when sharing the node processing capacity. A stream with priority 2 gets twice the frames processed than one with priority 1. 1 by default.
+        #[arg(long)]
+        priority: Option<u32>,
+        /// Optional. Max number of frames of the stream processed at the same time. Unbounded by default.
+        #[arg(long)]
+        max_in_flight: Option<usize>,
     }
 }
 
@@ -50,12 +68,30 @@ enum UpdateCommand {
         /// Optional. New URI where to send the output video. Use "screen" to show it directly on the device screen.
         #[arg(short, long)]
         output_uri: Option<String>,
-        /// Optional. New comma separated list of stages that will be executed for the frames of the new stream
+        /// Optional. New comma separated list of stages that will be executed for the frames of the new stream. Use '(stage_a | [key] stage_b/stage_c)' to run branches in parallel, optionally only when the user data key is set.
         #[arg(short, long)]
         frame_path: Option<String>,
         /// Optional. Restart policy for the stream. Either always, never, on_error or on_eos.
         #[arg(short, long)]
         restart_policy: Option<String>,
+        /// Optional. Max number of frames per second taken from the input. Exceeding frames are dropped before processing them.
+        #[arg(long)]
+        target_fps: Option<u32>,
+        /// Optional. Take only one of every N input frames.
+        #[arg(long)]
+        every_n_frames: Option<u64>,
+        /// Optional. Skip input frames when the stream buffer starts to fill up, before they are processed.
+        #[arg(long)]
+        adaptive_skip: Option<bool>,
+        /// Optional. What to do with the frames that can't be processed when the stream buffer is full. Either discard, pass_through or pass_through_annotated.
+        #[arg(long)]
+        overload_mode: Option<String>,
+        /// Optional. Weight of the stream when sharing the node processing capacity. A stream with priority 2 gets twice the frames processed than one with priority 1. 1 by default.
+        #[arg(long)]
+        priority: Option<u32>,
+        /// Optional. Max number of frames of the stream processed at the same time. Unbounded by default.
+        #[arg(long)]
+        max_in_flight: Option<usize>,
     }
 }
 
@@ -91,9 +127,24 @@ enum Commands {
         /// Optional. Enable event export via Redis
         #[clap(short, long)]
         export_events_redis: bool,
+        /// Optional. Append the exported events to the file, one JSON object per line
+        #[clap(long)]
+        export_events_file: Option<String>,
         /// Optional. Max buffer size for each stream, measured in number of frames. Serves as backpressure mechanism. When the buffer is full new frames are discarded until there is space again in the buffer.
         #[clap(short, long, default_value = "240")]
         stream_buffer_size: usize,
+        /// Optional. Number of Python worker processes to run each stateless Python hook. By default, hooks run on the embedded Python interpreter, which executes a single hook at a time.
+        #[clap(long, default_value = "0")]
+        python_workers: usize,
+        /// Optional. Max number of frames processed at the same time across all the streams. The frames are shared among the streams according to their priority. Twice the number of CPUs by default.
+        #[clap(long)]
+        max_in_flight_frames: Option<usize>,
+        /// Optional. Load each stage when the first stream that uses it is created instead of loading all the stages at start
+        #[clap(long)]
+        lazy_stages: bool,
+        /// Optional. Reload the stages when their files change, without restarting the streams
+        #[clap(long)]
+        watch: bool,
     },
     /// Add resources such as streams
     Add {
@@ -127,10 +178,10 @@ fn main() {
 
     match &cli.command {
         Some(Commands::Init { project_name , template}) => pipeless_ai::cli::init::init(&project_name, template),
-        Some(Commands::Start { project_dir , export_events_redis , stream_buffer_size}) => pipeless_ai::cli::start::start_pipeless_node(&project_dir, *export_events_redis, *stream_buffer_size),
+        Some(Commands::Start { project_dir , export_events_redis , export_events_file, stream_buffer_size, python_workers, max_in_flight_frames, lazy_stages, watch }) => pipeless_ai::cli::start::start_pipeless_node(&project_dir, *export_events_redis, export_events_file.as_deref(), *stream_buffer_size, *python_workers, *max_in_flight_frames, *lazy_stages, *watch),
         Some(Commands::Add { command }) => {
             match &command {
-                Some(AddCommand::Stream { input_uri, output_uri, frame_path , restart_policy}) => pipeless_ai::cli::streams::add(input_uri, output_uri, frame_path, restart_policy),
+                Some(AddCommand::Stream { input_uri, output_uri, frame_path , restart_policy, target_fps, every_n_frames, adaptive_skip, overload_mode, priority, max_in_flight }) => pipeless_ai::cli::streams::add(input_uri, output_uri, frame_path, restart_policy, target_fps, every_n_frames, *adaptive_skip, overload_mode, priority, max_in_flight),
                 None =>  println!("Use --help to see the complete list of available commands"),
             }
         },
@@ -142,7 +193,7 @@ fn main() {
         },
         Some(Commands::Update { command }) => {
             match &command {
-                Some(UpdateCommand::Stream { id, input_uri, output_uri, frame_path , restart_policy}) => pipeless_ai::cli::streams::update(id, input_uri, output_uri, frame_path, restart_policy),
+                Some(UpdateCommand::Stream { id, input_uri, output_uri, frame_path , restart_policy, target_fps, every_n_frames, adaptive_skip, overload_mode, priority, max_in_flight }) => pipeless_ai::cli::streams::update(id, input_uri, output_uri, frame_path, restart_policy, target_fps, every_n_frames, adaptive_skip, overload_mode, priority, max_in_flight),
                 None =>  println!("Use --help to see the complete list of available commands"),
             }
         },
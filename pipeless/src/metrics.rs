@@ -0,0 +1,527 @@
+use std::{collections::{HashMap, VecDeque}, fmt::Write, sync::{Arc, Mutex, RwLock, atomic::{AtomicBool, AtomicU64, Ordering}}, time::{Duration, Instant}};
+use lazy_static::lazy_static;
+use log::{info, warn};
+use serde_derive::Serialize;
+
+use crate as pipeless;
+
+/// Upper bounds, in seconds, of the latency histogram buckets
+const LATENCY_BUCKETS: [f64; 14] = [
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+];
+/// Upper bounds of the ratio histogram buckets
+const RATIO_BUCKETS: [f64; 10] = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0];
+/// Max decoded frames waiting to be converted whose decode instant is kept
+const MAX_PENDING_DECODED_FRAMES: usize = 64;
+
+/// Latency histogram with fixed buckets. Recording a value only takes two atomic additions,
+/// so it can be used on the path of every frame.
+#[derive(Default)]
+pub struct Histogram {
+    buckets: [AtomicU64; LATENCY_BUCKETS.len() + 1], // The last bucket counts the values over the highest bound
+    sum_us: AtomicU64,
+}
+impl Histogram {
+    pub fn observe(&self, value: Duration) {
+        let seconds = value.as_secs_f64();
+        let bucket = LATENCY_BUCKETS.iter()
+            .position(|bound| seconds <= *bound)
+            .unwrap_or(LATENCY_BUCKETS.len());
+        self.buckets[bucket].fetch_add(1, Ordering::Relaxed);
+        self.sum_us.fetch_add(value.as_micros() as u64, Ordering::Relaxed);
+    }
+
+    pub fn get_count(&self) -> u64 {
+        self.buckets.iter().map(|bucket| bucket.load(Ordering::Relaxed)).sum()
+    }
+
+    /// Adds the values recorded by other histogram
+    pub fn merge(&self, other: &Histogram) {
+        for (bucket, other_bucket) in self.buckets.iter().zip(other.buckets.iter()) {
+            bucket.fetch_add(other_bucket.load(Ordering::Relaxed), Ordering::Relaxed);
+        }
+        self.sum_us.fetch_add(other.sum_us.load(Ordering::Relaxed), Ordering::Relaxed);
+    }
+
+    /// Estimates the quantile (0-1), in seconds, interpolating linearly inside its bucket.
+    /// The values over the highest bound are reported as the highest bound.
+    pub fn quantile(&self, quantile: f64) -> Option<f64> {
+        let count = self.get_count();
+        if count == 0 {
+            return None;
+        }
+        let rank = quantile.clamp(0.0, 1.0) * count as f64;
+        let mut cumulative = 0;
+        let mut lower_bound = 0.0;
+        for (bound, bucket) in LATENCY_BUCKETS.iter().zip(self.buckets.iter()) {
+            let bucket_count = bucket.load(Ordering::Relaxed);
+            if bucket_count > 0 && (cumulative + bucket_count) as f64 >= rank {
+                let position = (rank - cumulative as f64) / bucket_count as f64;
+                return Some(lower_bound + (bound - lower_bound) * position);
+            }
+            cumulative += bucket_count;
+            lower_bound = *bound;
+        }
+        Some(lower_bound)
+    }
+
+    /// Writes the histogram series in the Prometheus text format
+    fn write_prometheus(&self, out: &mut String, name: &str, labels: &str) {
+        write_histogram(out, name, labels, &LATENCY_BUCKETS, &self.buckets, self.sum_us.load(Ordering::Relaxed) as f64 / 1_000_000.0);
+    }
+}
+
+/// Histogram of ratios between 0 and 1, like the fill ratio of the inference batches
+#[derive(Default)]
+pub struct RatioHistogram {
+    buckets: [AtomicU64; RATIO_BUCKETS.len()],
+    sum_ppm: AtomicU64, // Sum of the ratios in parts per million
+}
+impl RatioHistogram {
+    pub fn observe(&self, ratio: f64) {
+        let ratio = ratio.clamp(0.0, 1.0);
+        let bucket = RATIO_BUCKETS.iter()
+            .position(|bound| ratio <= *bound)
+            .unwrap_or(RATIO_BUCKETS.len() - 1);
+        self.buckets[bucket].fetch_add(1, Ordering::Relaxed);
+        self.sum_ppm.fetch_add((ratio * 1_000_000.0) as u64, Ordering::Relaxed);
+    }
+
+    pub fn get_count(&self) -> u64 {
+        self.buckets.iter().map(|bucket| bucket.load(Ordering::Relaxed)).sum()
+    }
+
+    fn write_prometheus(&self, out: &mut String, name: &str, labels: &str) {
+        write_histogram(out, name, labels, &RATIO_BUCKETS, &self.buckets, self.sum_ppm.load(Ordering::Relaxed) as f64 / 1_000_000.0);
+    }
+}
+
+/// Writes the series of a histogram in the Prometheus text format.
+/// The buckets after the bounds count the values over the highest bound.
+fn write_histogram(out: &mut String, name: &str, labels: &str, bounds: &[f64], buckets: &[AtomicU64], sum: f64) {
+    let mut cumulative = 0;
+    for (bound, bucket) in bounds.iter().zip(buckets.iter()) {
+        cumulative += bucket.load(Ordering::Relaxed);
+        let _ = writeln!(out, "{}_bucket{{{},le=\"{}\"}} {}", name, labels, bound, cumulative);
+    }
+    cumulative += buckets[bounds.len()..].iter().map(|bucket| bucket.load(Ordering::Relaxed)).sum::<u64>();
+    let _ = writeln!(out, "{}_bucket{{{},le=\"+Inf\"}} {}", name, labels, cumulative);
+    let _ = writeln!(out, "{}_sum{{{}}} {}", name, labels, sum);
+    let _ = writeln!(out, "{}_count{{{}}} {}", name, labels, cumulative);
+}
+
+/// Metrics of a stage for a stream
+#[derive(Default)]
+pub struct StageMetrics {
+    pre_process: Histogram,
+    process: Histogram,
+    post_process: Histogram,
+    python_gil_wait: Histogram, // Time the Python hooks waited for the GIL
+    python_exec: Histogram, // Time the Python hooks ran holding the GIL
+    inference: Histogram, // Time spent in the inference sessions, batches included
+    batch_wait: Histogram, // Time the frames waited for their inference batch to be dispatched
+    batch_fill_ratio: RatioHistogram, // Fill ratio of the inference batch of every frame
+    dropped_frames: AtomicU64, // Frames that a hook of the stage did not return
+}
+impl StageMetrics {
+    pub fn observe_hook(&self, hook_type: pipeless::stages::hook::HookType, duration: Duration) {
+        match hook_type {
+            pipeless::stages::hook::HookType::PreProcess => self.pre_process.observe(duration),
+            pipeless::stages::hook::HookType::Process => self.process.observe(duration),
+            pipeless::stages::hook::HookType::PostProcess => self.post_process.observe(duration),
+        }
+    }
+    pub fn observe_python_gil_wait(&self, duration: Duration) {
+        self.python_gil_wait.observe(duration);
+    }
+    pub fn observe_python_exec(&self, duration: Duration) {
+        self.python_exec.observe(duration);
+    }
+    pub fn observe_inference(&self, duration: Duration) {
+        self.inference.observe(duration);
+    }
+    pub fn observe_batch(&self, fill_ratio: f64, wait: Duration) {
+        self.batch_fill_ratio.observe(fill_ratio);
+        self.batch_wait.observe(wait);
+    }
+    pub fn inc_dropped_frames(&self) {
+        self.dropped_frames.fetch_add(1, Ordering::Relaxed);
+    }
+}
+
+/// Frame counters of a stream. Updated from the gst callbacks and the
+/// frame processing tasks, so they are atomic to avoid locking.
+#[derive(Default)]
+pub struct StreamMetrics {
+    decoded_frames: AtomicU64, // Frames produced by the input decoder
+    skipped_frames: AtomicU64, // Frames dropped by the input rate policy, before copying them
+    discarded_frames: AtomicU64, // Frames copied but discarded because the stream buffer was full
+    processed_frames: AtomicU64, // Frames that went through the whole frame path
+    passthrough_frames: AtomicU64, // Frames sent to the output without processing them because of overload
+    overloaded: AtomicBool, // Whether the last input frame could not enter the frame path
+    queued_frames: AtomicU64, // Frames waiting for the frame scheduler
+    in_flight_frames: AtomicU64, // Frames being processed
+    scheduled_frames: AtomicU64, // Frames that got a processing slot from the frame scheduler
+    scheduler_wait_us: AtomicU64, // Total time the scheduled frames waited for a slot
+    inference_cache_hits: AtomicU64, // Inferences avoided by the motion gate
+    inference_cache_misses: AtomicU64, // Frames that went through a motion gated model
+    late_output_frames: AtomicU64, // Frames dropped by the output because a later frame was already sent
+    output_errors: AtomicU64, // Frames that could not be pushed to the output
+    input_latency: Histogram, // From the decoded frame to the frame entering the stream buffer, color conversion included
+    queue_latency: Histogram, // Time the frames waited in the stream buffer
+    scheduler_wait: Histogram,
+    output_latency: Histogram, // Time to push a frame to the output
+    frame_latency: Histogram, // From the frame entering the stream buffer to the end of the frame path
+    passthrough_hold: Histogram, // Time the pass-through frames were held back before the output
+    decoded_instants: Mutex<VecDeque<(u64, Instant)>>, // Decode instant of the frames being converted, by pts
+    stages: RwLock<HashMap<String, Arc<StageMetrics>>>,
+}
+impl StreamMetrics {
+    pub fn inc_decoded_frames(&self) {
+        self.decoded_frames.fetch_add(1, Ordering::Relaxed);
+    }
+    pub fn inc_skipped_frames(&self) {
+        self.skipped_frames.fetch_add(1, Ordering::Relaxed);
+    }
+    pub fn inc_discarded_frames(&self) {
+        self.discarded_frames.fetch_add(1, Ordering::Relaxed);
+    }
+    pub fn inc_processed_frames(&self) {
+        self.processed_frames.fetch_add(1, Ordering::Relaxed);
+    }
+    pub fn inc_passthrough_frames(&self) {
+        self.passthrough_frames.fetch_add(1, Ordering::Relaxed);
+    }
+    pub fn set_overloaded(&self, overloaded: bool) {
+        self.overloaded.store(overloaded, Ordering::Relaxed);
+    }
+    pub fn inc_queued_frames(&self) {
+        self.queued_frames.fetch_add(1, Ordering::Relaxed);
+    }
+    pub fn dec_queued_frames(&self) {
+        self.queued_frames.fetch_sub(1, Ordering::Relaxed);
+    }
+    pub fn inc_in_flight_frames(&self) {
+        self.in_flight_frames.fetch_add(1, Ordering::Relaxed);
+    }
+    pub fn dec_in_flight_frames(&self) {
+        self.in_flight_frames.fetch_sub(1, Ordering::Relaxed);
+    }
+    pub fn inc_inference_cache_hits(&self) {
+        self.inference_cache_hits.fetch_add(1, Ordering::Relaxed);
+    }
+    pub fn inc_inference_cache_misses(&self) {
+        self.inference_cache_misses.fetch_add(1, Ordering::Relaxed);
+    }
+    pub fn inc_late_output_frames(&self) {
+        self.late_output_frames.fetch_add(1, Ordering::Relaxed);
+    }
+    pub fn inc_output_errors(&self) {
+        self.output_errors.fetch_add(1, Ordering::Relaxed);
+    }
+    /// Records the time a frame waited for a processing slot
+    pub fn add_scheduler_wait(&self, wait: Duration) {
+        self.scheduled_frames.fetch_add(1, Ordering::Relaxed);
+        self.scheduler_wait_us.fetch_add(wait.as_micros() as u64, Ordering::Relaxed);
+        self.scheduler_wait.observe(wait);
+    }
+    pub fn observe_queue_latency(&self, latency: Duration) {
+        self.queue_latency.observe(latency);
+    }
+    pub fn observe_output_latency(&self, latency: Duration) {
+        self.output_latency.observe(latency);
+    }
+    pub fn observe_frame_latency(&self, latency: Duration) {
+        self.frame_latency.observe(latency);
+    }
+    pub fn observe_passthrough_hold(&self, hold: Duration) {
+        self.passthrough_hold.observe(hold);
+    }
+    pub fn get_frame_latency(&self) -> &Histogram {
+        &self.frame_latency
+    }
+
+    /// Records the instant a decoded frame enters the input conversion
+    pub fn mark_decoded(&self, pts: u64) {
+        let mut decoded_instants = self.decoded_instants.lock().unwrap();
+        if decoded_instants.len() == MAX_PENDING_DECODED_FRAMES {
+            decoded_instants.pop_front();
+        }
+        decoded_instants.push_back((pts, Instant::now()));
+    }
+
+    /// Records the input latency of a converted frame. The instants of older frames
+    /// are discarded, they were dropped during the conversion.
+    pub fn observe_input_latency(&self, pts: u64) {
+        let decoded_instant = {
+            let mut decoded_instants = self.decoded_instants.lock().unwrap();
+            let mut decoded_instant = None;
+            while let Some((decoded_pts, instant)) = decoded_instants.front().copied() {
+                if decoded_pts > pts {
+                    break;
+                }
+                decoded_instants.pop_front();
+                if decoded_pts == pts {
+                    decoded_instant = Some(instant);
+                    break;
+                }
+            }
+            decoded_instant
+        };
+        if let Some(instant) = decoded_instant {
+            self.input_latency.observe(instant.elapsed());
+        }
+    }
+
+    /// Returns the metrics of a stage, creating them on the first frame that reaches it
+    pub fn get_stage_metrics(&self, stage_name: &str) -> Arc<StageMetrics> {
+        if let Some(stage_metrics) = self.stages.read().unwrap().get(stage_name) {
+            return stage_metrics.clone();
+        }
+        self.stages.write().unwrap()
+            .entry(stage_name.to_string())
+            .or_default()
+            .clone()
+    }
+
+    pub fn snapshot(&self) -> StreamMetricsSnapshot {
+        let scheduled_frames = self.scheduled_frames.load(Ordering::Relaxed);
+        let scheduler_wait_us = self.scheduler_wait_us.load(Ordering::Relaxed);
+        let inference_cache_hits = self.inference_cache_hits.load(Ordering::Relaxed);
+        let inference_cache_misses = self.inference_cache_misses.load(Ordering::Relaxed);
+        let inference_cache_lookups = inference_cache_hits + inference_cache_misses;
+        StreamMetricsSnapshot {
+            decoded_frames: self.decoded_frames.load(Ordering::Relaxed),
+            skipped_frames: self.skipped_frames.load(Ordering::Relaxed),
+            discarded_frames: self.discarded_frames.load(Ordering::Relaxed),
+            processed_frames: self.processed_frames.load(Ordering::Relaxed),
+            passthrough_frames: self.passthrough_frames.load(Ordering::Relaxed),
+            overloaded: self.overloaded.load(Ordering::Relaxed),
+            queued_frames: self.queued_frames.load(Ordering::Relaxed),
+            in_flight_frames: self.in_flight_frames.load(Ordering::Relaxed),
+            scheduled_frames,
+            avg_scheduler_wait_ms: if scheduled_frames > 0 {
+                scheduler_wait_us as f64 / scheduled_frames as f64 / 1000.0
+            } else { 0.0 },
+            inference_cache_hits,
+            inference_cache_misses,
+            inference_cache_hit_ratio: if inference_cache_lookups > 0 {
+                inference_cache_hits as f64 / inference_cache_lookups as f64
+            } else { 0.0 },
+            late_output_frames: self.late_output_frames.load(Ordering::Relaxed),
+            output_errors: self.output_errors.load(Ordering::Relaxed),
+        }
+    }
+}
+
+/// Point in time copy of the stream metrics
+#[derive(Clone, Debug, Serialize)]
+pub struct StreamMetricsSnapshot {
+    pub decoded_frames: u64,
+    pub skipped_frames: u64,
+    pub discarded_frames: u64,
+    pub processed_frames: u64,
+    pub passthrough_frames: u64,
+    pub overloaded: bool,
+    pub queued_frames: u64,
+    pub in_flight_frames: u64,
+    pub scheduled_frames: u64,
+    pub avg_scheduler_wait_ms: f64,
+    pub inference_cache_hits: u64,
+    pub inference_cache_misses: u64,
+    pub inference_cache_hit_ratio: f64,
+    pub late_output_frames: u64,
+    pub output_errors: u64,
+}
+
+lazy_static! {
+    // Metrics of the running streams indexed by pipeline id
+    static ref STREAMS_METRICS: RwLock<HashMap<uuid::Uuid, Arc<StreamMetrics>>> = RwLock::new(HashMap::new());
+}
+
+/// Creates the metrics of a new pipeline
+pub fn register_stream(pipeline_id: uuid::Uuid) -> Arc<StreamMetrics> {
+    let metrics = Arc::new(StreamMetrics::default());
+    match STREAMS_METRICS.write() {
+        Ok(mut streams_metrics) => { streams_metrics.insert(pipeline_id, metrics.clone()); },
+        Err(err) => warn!("Unable to register stream metrics: {}", err),
+    }
+    metrics
+}
+
+/// Returns the metrics of a running pipeline
+pub fn get_stream_metrics(pipeline_id: &uuid::Uuid) -> Option<Arc<StreamMetrics>> {
+    match STREAMS_METRICS.read() {
+        Ok(streams_metrics) => streams_metrics.get(pipeline_id).cloned(),
+        Err(err) => {
+            warn!("Unable to read stream metrics: {}", err);
+            None
+        }
+    }
+}
+
+/// Returns the metrics of a stage for a running pipeline
+pub fn get_stage_metrics(pipeline_id: &uuid::Uuid, stage_name: &str) -> Option<Arc<StageMetrics>> {
+    get_stream_metrics(pipeline_id).map(|metrics| metrics.get_stage_metrics(stage_name))
+}
+
+/// Removes the metrics of a pipeline, logging the final values
+pub fn unregister_stream(pipeline_id: uuid::Uuid) {
+    let removed = match STREAMS_METRICS.write() {
+        Ok(mut streams_metrics) => streams_metrics.remove(&pipeline_id),
+        Err(err) => {
+            warn!("Unable to unregister stream metrics: {}", err);
+            None
+        }
+    };
+    if let Some(metrics) = removed {
+        let snapshot = metrics.snapshot();
+        info!(
+            "Stream metrics for pipeline {}: decoded frames: {}, skipped frames: {}, discarded frames: {}, processed frames: {}, pass-through frames: {}",
+            pipeline_id, snapshot.decoded_frames, snapshot.skipped_frames,
+            snapshot.discarded_frames, snapshot.processed_frames, snapshot.passthrough_frames
+        );
+    }
+}
+
+/// Returns the current metrics of every running stream
+pub fn get_streams_metrics() -> HashMap<uuid::Uuid, StreamMetricsSnapshot> {
+    match STREAMS_METRICS.read() {
+        Ok(streams_metrics) => streams_metrics.iter()
+            .map(|(pipeline_id, metrics)| (*pipeline_id, metrics.snapshot()))
+            .collect(),
+        Err(err) => {
+            warn!("Unable to read stream metrics: {}", err);
+            HashMap::new()
+        }
+    }
+}
+
+/// Returns the metrics of every running stream in the Prometheus text format.
+/// The series are labeled by pipeline id and, for the stage metrics, by stage.
+pub fn render_prometheus() -> String {
+    let streams_metrics: Vec<(uuid::Uuid, Arc<StreamMetrics>)> = match STREAMS_METRICS.read() {
+        Ok(streams_metrics) => streams_metrics.iter()
+            .map(|(pipeline_id, metrics)| (*pipeline_id, metrics.clone()))
+            .collect(),
+        Err(err) => {
+            warn!("Unable to read stream metrics: {}", err);
+            vec![]
+        }
+    };
+
+    let mut out = String::new();
+    let mut write_family = |name: &str, kind: &str, help: &str, write_series: &dyn Fn(&mut String, &str, &StreamMetrics)| {
+        let _ = writeln!(out, "# HELP {} {}", name, help);
+        let _ = writeln!(out, "# TYPE {} {}", name, kind);
+        for (pipeline_id, metrics) in &streams_metrics {
+            let labels = format!("pipeline_id=\"{}\"", pipeline_id);
+            write_series(&mut out, &labels, metrics);
+        }
+    };
+    write_family("pipeless_decoded_frames_total", "counter", "Frames produced by the input decoder",
+        &|out, labels, metrics| write_value(out, "pipeless_decoded_frames_total", labels, metrics.decoded_frames.load(Ordering::Relaxed)));
+    write_family("pipeless_processed_frames_total", "counter", "Frames that went through the whole frame path",
+        &|out, labels, metrics| write_value(out, "pipeless_processed_frames_total", labels, metrics.processed_frames.load(Ordering::Relaxed)));
+    write_family("pipeless_passthrough_frames_total", "counter", "Frames sent to the output without processing because of overload",
+        &|out, labels, metrics| write_value(out, "pipeless_passthrough_frames_total", labels, metrics.passthrough_frames.load(Ordering::Relaxed)));
+    write_family("pipeless_dropped_frames_total", "counter", "Frames dropped by reason",
+        &|out, labels, metrics| {
+            let name = "pipeless_dropped_frames_total";
+            write_value(out, name, &format!("{},reason=\"rate_policy\"", labels), metrics.skipped_frames.load(Ordering::Relaxed));
+            write_value(out, name, &format!("{},reason=\"buffer_full\"", labels), metrics.discarded_frames.load(Ordering::Relaxed));
+            let stage_dropped_frames: u64 = metrics.stages.read().unwrap().values()
+                .map(|stage| stage.dropped_frames.load(Ordering::Relaxed))
+                .sum();
+            write_value(out, name, &format!("{},reason=\"stage\"", labels), stage_dropped_frames);
+            write_value(out, name, &format!("{},reason=\"late_output\"", labels), metrics.late_output_frames.load(Ordering::Relaxed));
+            write_value(out, name, &format!("{},reason=\"output_error\"", labels), metrics.output_errors.load(Ordering::Relaxed));
+        });
+    write_family("pipeless_stage_dropped_frames_total", "counter", "Frames dropped by a hook of the stage",
+        &|out, labels, metrics| {
+            for (stage_name, stage) in metrics.stages.read().unwrap().iter() {
+                write_value(out, "pipeless_stage_dropped_frames_total", &format!("{},stage=\"{}\"", labels, stage_name), stage.dropped_frames.load(Ordering::Relaxed));
+            }
+        });
+    write_family("pipeless_inference_cache_hits_total", "counter", "Inferences avoided by the motion gate",
+        &|out, labels, metrics| write_value(out, "pipeless_inference_cache_hits_total", labels, metrics.inference_cache_hits.load(Ordering::Relaxed)));
+    write_family("pipeless_inference_cache_misses_total", "counter", "Frames that went through a motion gated model",
+        &|out, labels, metrics| write_value(out, "pipeless_inference_cache_misses_total", labels, metrics.inference_cache_misses.load(Ordering::Relaxed)));
+    write_family("pipeless_queued_frames", "gauge", "Frames waiting for the frame scheduler",
+        &|out, labels, metrics| write_value(out, "pipeless_queued_frames", labels, metrics.queued_frames.load(Ordering::Relaxed)));
+    write_family("pipeless_in_flight_frames", "gauge", "Frames being processed",
+        &|out, labels, metrics| write_value(out, "pipeless_in_flight_frames", labels, metrics.in_flight_frames.load(Ordering::Relaxed)));
+    write_family("pipeless_overloaded", "gauge", "Whether the last input frame could not enter the frame path",
+        &|out, labels, metrics| write_value(out, "pipeless_overloaded", labels, metrics.overloaded.load(Ordering::Relaxed) as u64));
+
+    write_family("pipeless_input_latency_seconds", "histogram", "Time from the decoded frame to the frame entering the stream buffer",
+        &|out, labels, metrics| metrics.input_latency.write_prometheus(out, "pipeless_input_latency_seconds", labels));
+    write_family("pipeless_queue_latency_seconds", "histogram", "Time the frames waited in the stream buffer",
+        &|out, labels, metrics| metrics.queue_latency.write_prometheus(out, "pipeless_queue_latency_seconds", labels));
+    write_family("pipeless_scheduler_wait_seconds", "histogram", "Time the frames waited for a processing slot",
+        &|out, labels, metrics| metrics.scheduler_wait.write_prometheus(out, "pipeless_scheduler_wait_seconds", labels));
+    write_family("pipeless_frame_latency_seconds", "histogram", "Time from the frame entering the stream buffer to the end of the frame path",
+        &|out, labels, metrics| metrics.frame_latency.write_prometheus(out, "pipeless_frame_latency_seconds", labels));
+    write_family("pipeless_output_latency_seconds", "histogram", "Time to push a frame to the output",
+        &|out, labels, metrics| metrics.output_latency.write_prometheus(out, "pipeless_output_latency_seconds", labels));
+    write_family("pipeless_passthrough_hold_seconds", "histogram", "Time the pass-through frames were held back so the processed frames reach the output first",
+        &|out, labels, metrics| metrics.passthrough_hold.write_prometheus(out, "pipeless_passthrough_hold_seconds", labels));
+    write_family("pipeless_hook_duration_seconds", "histogram", "Execution time of the stage hooks",
+        &|out, labels, metrics| {
+            for (stage_name, stage) in metrics.stages.read().unwrap().iter() {
+                for (hook_type, histogram) in [("pre_process", &stage.pre_process), ("process", &stage.process), ("post_process", &stage.post_process)] {
+                    if histogram.get_count() > 0 {
+                        let labels = format!("{},stage=\"{}\",hook=\"{}\"", labels, stage_name, hook_type);
+                        histogram.write_prometheus(out, "pipeless_hook_duration_seconds", &labels);
+                    }
+                }
+            }
+        });
+    let stage_histogram = |name: &'static str, field: fn(&StageMetrics) -> &Histogram| {
+        move |out: &mut String, labels: &str, metrics: &StreamMetrics| {
+            for (stage_name, stage) in metrics.stages.read().unwrap().iter() {
+                let histogram = field(stage);
+                if histogram.get_count() > 0 {
+                    histogram.write_prometheus(out, name, &format!("{},stage=\"{}\"", labels, stage_name));
+                }
+            }
+        }
+    };
+    write_family("pipeless_python_gil_wait_seconds", "histogram", "Time the Python hooks waited for the GIL",
+        &stage_histogram("pipeless_python_gil_wait_seconds", |stage| &stage.python_gil_wait));
+    write_family("pipeless_python_exec_seconds", "histogram", "Time the Python hooks ran holding the GIL",
+        &stage_histogram("pipeless_python_exec_seconds", |stage| &stage.python_exec));
+    write_family("pipeless_inference_duration_seconds", "histogram", "Time spent in the inference sessions",
+        &stage_histogram("pipeless_inference_duration_seconds", |stage| &stage.inference));
+    write_family("pipeless_inference_batch_wait_seconds", "histogram", "Time the frames waited for their inference batch to be dispatched",
+        &stage_histogram("pipeless_inference_batch_wait_seconds", |stage| &stage.batch_wait));
+    write_family("pipeless_inference_batch_fill_ratio", "histogram", "Ratio of the inference batch slots filled, observed for every batched frame",
+        &|out, labels, metrics| {
+            for (stage_name, stage) in metrics.stages.read().unwrap().iter() {
+                if stage.batch_fill_ratio.get_count() > 0 {
+                    stage.batch_fill_ratio.write_prometheus(out, "pipeless_inference_batch_fill_ratio", &format!("{},stage=\"{}\"", labels, stage_name));
+                }
+            }
+        });
+
+    let exporter_stats = pipeless::event_exporters::get_exporter_stats();
+    let exporter_families: [(&str, &str, &str, fn(&pipeless::event_exporters::ExporterStats) -> u64); 3] = [
+        ("pipeless_exported_events_total", "counter", "Events published by the event exporter", |stats| stats.get_exported()),
+        ("pipeless_dropped_events_total", "counter", "Events dropped because the exporter queue was full or the sink failed", |stats| stats.get_dropped()),
+        ("pipeless_queued_events", "gauge", "Events waiting to be published by the event exporter", |stats| stats.get_queued()),
+    ];
+    for (name, kind, help, value) in exporter_families {
+        let _ = writeln!(out, "# HELP {} {}", name, help);
+        let _ = writeln!(out, "# TYPE {} {}", name, kind);
+        for (sink, stats) in &exporter_stats {
+            write_value(&mut out, name, &format!("sink=\"{}\"", sink), value(stats));
+        }
+    }
+
+    out
+}
+
+fn write_value(out: &mut String, name: &str, labels: &str, value: u64) {
+    let _ = writeln!(out, "{}{{{}}} {}", name, labels, value);
+}
@@ -1 +1,2 @@
-pub mod pipeline;
\ No newline at end of file
+pub mod pipeline;
+pub mod overlay;
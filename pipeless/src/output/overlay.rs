@@ -0,0 +1,68 @@
+use crate as pipeless;
+
+/// Max fraction of the frame pixels that can be modified by the stages for the changes to be
+/// considered annotations. Over it, the stages are transforming the whole image (ex: a blur)
+/// and redrawing the changes would freeze the pass-through frames.
+const MAX_ANNOTATED_FRACTION: f32 = 0.25;
+
+/// Pixels drawn by the stages on a processed frame (boxes, labels, etc).
+/// Used to redraw the last known annotations on the frames that are sent to
+/// the output without processing them.
+pub struct AnnotationsOverlay {
+    frame_len: usize,
+    // Position of the first byte of every modified pixel and its RGB value
+    pixels: Vec<(usize, [u8; 3])>,
+}
+impl AnnotationsOverlay {
+    /// Compares the modified and original pixels of a processed frame.
+    /// Returns None when the changes can't be considered annotations.
+    pub fn from_frame(frame: &pipeless::data::Frame) -> Option<Self> {
+        match frame {
+            pipeless::data::Frame::RgbFrame(rgb_frame) => {
+                let original = rgb_frame.get_original_pixels();
+                let original = original.as_slice()?;
+                let modified = rgb_frame.get_modified_pixels_view();
+                let modified = modified.as_slice()?;
+                let original_len = original.len();
+                if modified.len() != original_len {
+                    return None;
+                }
+
+                let max_pixels = ((original_len / 3) as f32 * MAX_ANNOTATED_FRACTION) as usize;
+                let mut pixels = Vec::new();
+                for (idx, (original_pixel, modified_pixel)) in original.chunks_exact(3).zip(modified.chunks_exact(3)).enumerate() {
+                    if original_pixel != modified_pixel {
+                        if pixels.len() >= max_pixels {
+                            return None;
+                        }
+                        pixels.push((idx * 3, [modified_pixel[0], modified_pixel[1], modified_pixel[2]]));
+                    }
+                }
+
+                Some(Self { frame_len: original_len, pixels })
+            }
+        }
+    }
+
+    /// Draws the annotations on the modified pixels of the frame
+    pub fn apply(&self, frame: &mut pipeless::data::Frame) {
+        if self.pixels.is_empty() {
+            // Avoid copying the frame pixels
+            return;
+        }
+        match frame {
+            pipeless::data::Frame::RgbFrame(rgb_frame) => {
+                let mut modified = rgb_frame.get_modified_pixels();
+                if let Some(modified) = modified.as_slice_mut() {
+                    // The frame size may change along the stream
+                    if modified.len() != self.frame_len {
+                        return;
+                    }
+                    for (offset, value) in &self.pixels {
+                        modified[*offset..*offset + 3].copy_from_slice(value);
+                    }
+                }
+            }
+        }
+    }
+}
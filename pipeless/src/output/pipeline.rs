@@ -1,5 +1,6 @@
 use std;
 use std::str::FromStr;
+use std::sync::atomic::{AtomicU64, Ordering};
 use glib::BoolError;
 use gstreamer as gst;
 use gst::prelude::*;
@@ -325,7 +326,7 @@ fn on_bus_message(
 fn create_gst_pipeline(
     output_stream_def: &StreamDef,
     caps: &str,
-) -> Result<(gst::Pipeline, gst::BufferPool), OutputPipelineError> {
+) -> Result<(gst::Pipeline, gst::BufferPool, usize), OutputPipelineError> {
     let pipeline = gst::Pipeline::new();
     let input_stream_caps = gst::Caps::from_str(caps)
         .map_err(|_| { OutputPipelineError::new(&format!("Unable to create caps from provide string {}", caps)) })?;
@@ -389,7 +390,19 @@ fn create_gst_pipeline(
     bufferpool.set_config(bufferpool_config).map_err(|_| { OutputPipelineError::new("Unable to set bufferpool config") })?;
 	bufferpool.set_active(true).map_err(|_| { OutputPipelineError::new("Could not activate buffer pool") })?;
 
-    Ok((pipeline, bufferpool))
+    Ok((pipeline, bufferpool, frame_size as usize))
+}
+
+fn on_frame_size_changed(
+    pipeless_bus_sender: &tokio::sync::mpsc::Sender<pipeless::events::Event>
+) {
+    warn!("
+        The frame produced does not match the output buffer size.
+        This may happen if your input stream changes the frame size in the input capabilitites.
+        Stopping pipeline. If the pipeline is set to automatically restart it will be recreated with the new capabilities.
+    ");
+    // If the pipeline is set to restart automatically, after the error, a new one will be created
+    pipeless::events::publish_output_stream_error_event_sync(pipeless_bus_sender, "The size of the input frame has changed.");
 }
 
 pub struct Pipeline {
@@ -399,20 +412,29 @@ pub struct Pipeline {
     gst_pipeline: gst::Pipeline,
     stream: pipeless::output::pipeline::StreamDef,
     buffer_pool: gst::BufferPool, // Allows to send buffers without constantly allocate new ones
+    frame_size: usize, // Size in bytes of the frames expected by the output caps
+    // When frames are sent to the output without processing them, the processed frames
+    // may arrive after newer ones. Those late frames are dropped to keep the timestamps in order.
+    drop_late_frames: bool,
+    last_pts: AtomicU64, // Nanoseconds + 1 of the last pushed frame. 0 when no frame was pushed.
 }
 impl Pipeline {
     pub fn new(
         id: uuid::Uuid,
         stream: pipeless::output::pipeline::StreamDef,
         caps: &str,
+        drop_late_frames: bool,
         pipeless_bus_sender: &tokio::sync::mpsc::Sender<pipeless::events::Event>,
     ) -> Result<Self, OutputPipelineError> {
-        let (gst_pipeline, buffer_pool) = create_gst_pipeline(&stream, caps)?;
+        let (gst_pipeline, buffer_pool, frame_size) = create_gst_pipeline(&stream, caps)?;
         let pipeline = Pipeline {
             id,
             gst_pipeline,
             stream,
             buffer_pool,
+            frame_size,
+            drop_late_frames,
+            last_pts: AtomicU64::new(0),
         };
         let bus = pipeline.gst_pipeline.bus()
             .ok_or_else(|| { OutputPipelineError::new("Unable to get output gst pipeline bus") })?;
@@ -461,63 +483,91 @@ impl Pipeline {
         pipeless_bus_sender: &tokio::sync::mpsc::Sender<pipeless::events::Event>
     ) -> Result<(), OutputPipelineError>{
         match frame {
-            pipeless::data::Frame::RgbFrame(mut rgb_frame) => {
-                let modified_pixels = rgb_frame.get_modified_pixels();
-                let out_frame_data = modified_pixels.as_slice()
-                    .ok_or_else(|| { OutputPipelineError::new("Unable to get bytes data from RGB frame. Is your output image of the same shape as the input?") })?;
+            pipeless::data::Frame::RgbFrame(rgb_frame) => {
+                let copy_timestamps =
+                    self.stream.get_video().get_protocol() != "screen";
+                if copy_timestamps && self.drop_late_frames {
+                    let pts = rgb_frame.get_pts().nseconds();
+                    let previous_pts = self.last_pts.fetch_max(pts + 1, Ordering::Relaxed);
+                    if previous_pts > pts {
+                        debug!("Dropping late frame from the output");
+                        if let Some(metrics) = pipeless::metrics::get_stream_metrics(&self.id) {
+                            metrics.inc_late_output_frames();
+                        }
+                        return Ok(());
+                    }
+                }
 
                 let appsrc = self.gst_pipeline.by_name("appsrc")
                     .ok_or_else(|| { OutputPipelineError::new("Unable to get pipeline appsrc element") })?
                     .dynamic_cast::<gst_app::AppSrc>()
                     .map_err(|_| { OutputPipelineError::new("Unable to cast element to AppSource") })?;
-                let copy_timestamps =
-                    self.stream.get_video().get_protocol() != "screen";
-
-                // TODO: something we can do instead of having a buffer pool is to re-use the input gst buffer by storing it into the RgbFrame
-                let mut gst_buffer = self.buffer_pool.acquire_buffer(None)
-                    .map_err(|_| { OutputPipelineError::new("Unable to acquire buffer from pool") })?;
-
-                let gst_buffer_mut = gst_buffer.get_mut()
-                    .ok_or_else(|| { OutputPipelineError::new("Unable to get mutable buffer") })?;
-
-                // TODO: profile. Could this be faster by copying manually with rayon?
-                // let data_slice = buffer_map.as_mut_slice();
-                //// Use Rayon to assign data elements in parallel
-                // data_slice.par_iter_mut().for_each(|byte| {
-                //     *byte = (*byte + 1) % 256;
-                // });
-                if out_frame_data.len() > gst_buffer_mut.size() {
-                    warn!("
-                        The frame produced is bigger than the buffer.
-                        This may happen if your input stream changes the frame size in the input capabilitites.
-                        Stopping pipeline. If the pipeline is set to automatically restart it will be recreated with the new capabilities.
-                    ");
-                    // If the pipeline is set to restart automatically, after the error, a new one will be created
-                    pipeless::events::publish_output_stream_error_event_sync(pipeless_bus_sender, "The size of the input frame has changed.");
-                } else {
-                    gst_buffer_mut.copy_from_slice(0, out_frame_data)
-                        .map_err(|_| { OutputPipelineError::new("Unable to copy slice into buffer") })?;
-
-                    if copy_timestamps {
-                        let pts = rgb_frame.get_pts();
-                        let dts = rgb_frame.get_dts();
-                        let duration = rgb_frame.get_duration();
-                        gst_buffer_mut.set_pts(pts);
-                        gst_buffer_mut.set_dts(dts);
-                        gst_buffer_mut.set_duration(duration);
-                    }
 
+                let pts = rgb_frame.get_pts();
+                let dts = rgb_frame.get_dts();
+                let duration = rgb_frame.get_duration();
+                let gst_buffer = match rgb_frame.into_modified_pixels() {
+                    pipeless::data::Pixels::Buffer(buffer_pixels) => {
+                        // The frame was not modified. Re-use the input buffer instead of copying the frame.
+                        let mut gst_buffer = buffer_pixels.into_buffer();
+                        if gst_buffer.size() != self.frame_size {
+                            on_frame_size_changed(pipeless_bus_sender);
+                            return Ok(());
+                        }
+                        // Only copies the buffer metadata when the buffer is still referenced somewhere else
+                        let gst_buffer_mut = gst_buffer.make_mut();
+                        if copy_timestamps {
+                            gst_buffer_mut.set_pts(pts);
+                            gst_buffer_mut.set_dts(dts);
+                            gst_buffer_mut.set_duration(duration);
+                        } else {
+                            gst_buffer_mut.set_pts(gst::ClockTime::NONE);
+                            gst_buffer_mut.set_dts(gst::ClockTime::NONE);
+                            gst_buffer_mut.set_duration(gst::ClockTime::NONE);
+                        }
+                        gst_buffer
+                    },
+                    pipeless::data::Pixels::Owned(modified_pixels) => {
+                        let out_frame_data = modified_pixels.as_slice()
+                            .ok_or_else(|| { OutputPipelineError::new("Unable to get bytes data from RGB frame. Is your output image of the same shape as the input?") })?;
+
+                        let mut gst_buffer = self.buffer_pool.acquire_buffer(None)
+                            .map_err(|_| { OutputPipelineError::new("Unable to acquire buffer from pool") })?;
+
+                        let gst_buffer_mut = gst_buffer.get_mut()
+                            .ok_or_else(|| { OutputPipelineError::new("Unable to get mutable buffer") })?;
+
+                        // TODO: profile. Could this be faster by copying manually with rayon?
+                        // let data_slice = buffer_map.as_mut_slice();
+                        //// Use Rayon to assign data elements in parallel
+                        // data_slice.par_iter_mut().for_each(|byte| {
+                        //     *byte = (*byte + 1) % 256;
+                        // });
+                        if out_frame_data.len() > gst_buffer_mut.size() {
+                            on_frame_size_changed(pipeless_bus_sender);
+                            return Ok(());
+                        }
+                        gst_buffer_mut.copy_from_slice(0, out_frame_data)
+                            .map_err(|_| { OutputPipelineError::new("Unable to copy slice into buffer") })?;
 
-                    if let Err(err) = appsrc.push_buffer(gst_buffer) {
-                        match err {
-                            gst::FlowError::Eos => {
-                                // Do not log error or warn because confuses users
-                                debug!("Unable to send frame, output pipeline is EOS.");
-                                return Ok(());
-                            }
-                            _ => {
-                                return Err(OutputPipelineError::new(&format!("Failed to send the output buffer: {}", err)));
-                            }
+                        if copy_timestamps {
+                            gst_buffer_mut.set_pts(pts);
+                            gst_buffer_mut.set_dts(dts);
+                            gst_buffer_mut.set_duration(duration);
+                        }
+                        gst_buffer
+                    },
+                };
+
+                if let Err(err) = appsrc.push_buffer(gst_buffer) {
+                    match err {
+                        gst::FlowError::Eos => {
+                            // Do not log error or warn because confuses users
+                            debug!("Unable to send frame, output pipeline is EOS.");
+                            return Ok(());
+                        }
+                        _ => {
+                            return Err(OutputPipelineError::new(&format!("Failed to send the output buffer: {}", err)));
                         }
                     }
                 }
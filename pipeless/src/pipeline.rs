@@ -2,10 +2,69 @@ use uuid;
 use tokio;
 use tokio::sync::RwLock;
 use std::{fmt, sync::Arc};
-use log::{info, error, warn};
+use log::{debug, info, error, warn};
 
 use crate as pipeless;
 
+/// Max number of frames waiting to be sent to the output without processing
+const PASSTHROUGH_BUFFER_SIZE: usize = 64;
+/// Max time a pass-through frame is held back waiting for the processed frames
+const MAX_PASSTHROUGH_HOLD: std::time::Duration = std::time::Duration::from_secs(1);
+
+/// Frames of a stream that entered the frame path and did not finish it yet, by pts.
+/// The pass-through frames wait for the processed frames before them, otherwise
+/// the output would drop those processed frames as late.
+#[derive(Default)]
+pub struct PendingFrames {
+    pts: std::sync::Mutex<std::collections::BTreeMap<u64, usize>>, // Number of pending frames by pts
+    finished: tokio::sync::Notify,
+}
+impl PendingFrames {
+    pub fn add(&self, pts: u64) {
+        *self.pts.lock().unwrap().entry(pts).or_insert(0) += 1;
+    }
+
+    pub fn remove(&self, pts: u64) {
+        {
+            let mut pending = self.pts.lock().unwrap();
+            if let Some(count) = pending.get_mut(&pts) {
+                *count -= 1;
+                if *count == 0 {
+                    pending.remove(&pts);
+                }
+            }
+        }
+        self.finished.notify_waiters();
+    }
+
+    fn has_before(&self, pts: u64) -> bool {
+        self.pts.lock().unwrap().range(..pts).next().is_some()
+    }
+
+    /// Waits until every frame with a lower pts finished the frame path
+    async fn wait_before(&self, pts: u64) {
+        loop {
+            // Created before the check so a frame finishing in between is not missed
+            let finished = self.finished.notified();
+            if !self.has_before(pts) {
+                return;
+            }
+            finished.await;
+        }
+    }
+}
+
+/// Removes a frame from the pending frames when dropped, however its processing ends
+struct PendingFrameGuard {
+    pending_frames: Arc<PendingFrames>,
+    pts: u64,
+}
+impl Drop for PendingFrameGuard {
+    fn drop(&mut self) {
+        self.pending_frames.remove(self.pts);
+    }
+}
+
 #[derive(Debug)]
 pub struct PipelineError {
     msg: String
@@ -60,6 +119,12 @@ struct Pipeline {
     input_pipeline: pipeless::input::pipeline::Pipeline,
     output_pipeline: Option<pipeless::output::pipeline::Pipeline>,
     frames_path: pipeless::stages::path::FramePath,
+    metrics: Arc<pipeless::metrics::StreamMetrics>,
+    overload_mode: pipeless::config::streams::OverloadMode,
+    // Only with the pass-through overload modes
+    pending_frames: Option<Arc<PendingFrames>>,
+    // Annotations of the last processed frame. Only used with the pass-through annotated overload mode
+    annotations_overlay: std::sync::Mutex<Option<pipeless::output::overlay::AnnotationsOverlay>>,
 }
 impl Pipeline {
     fn new(
@@ -67,22 +132,36 @@ impl Pipeline {
         input_uri: String,
         output_uri: Option<String>,
         frames_path: pipeless::stages::path::FramePath,
+        input_rate_policy: pipeless::config::streams::InputRatePolicy,
+        overload_mode: pipeless::config::streams::OverloadMode,
+        passthrough_sender: Option<tokio::sync::mpsc::Sender<pipeless::data::Frame>>,
     ) -> Result<Self, PipelineError> {
         let pipeline_id = uuid::Uuid::new_v4();
         let input_stream_def =
-            pipeless::input::pipeline::StreamDef::new(input_uri.clone())?;
-        let input_pipeline = pipeless::input::pipeline::Pipeline::new(
-            pipeline_id,
-            input_stream_def.clone(),
-            pipeless_bus_sender,
-        )?;
-
+            pipeless::input::pipeline::StreamDef::new(input_uri.clone(), input_rate_policy)?;
+        // Validate the output before starting the input pipeline, so nothing is left running on error
         let mut output_stream_def = None;
         if let Some(uri) = output_uri {
             if !uri.is_empty() { // Prevent segfault when the output_uri is provided as empty string
                 output_stream_def = Some(pipeless::output::pipeline::StreamDef::new(uri)?);
             }
         }
+        let pending_frames = passthrough_sender.as_ref().map(|_| Arc::new(PendingFrames::default()));
+        let metrics = pipeless::metrics::register_stream(pipeline_id);
+        let input_pipeline = match pipeless::input::pipeline::Pipeline::new(
+            pipeline_id,
+            input_stream_def.clone(),
+            &metrics,
+            passthrough_sender,
+            pending_frames.clone(),
+            pipeless_bus_sender,
+        ) {
+            Ok(input_pipeline) => input_pipeline,
+            Err(err) => {
+                pipeless::metrics::unregister_stream(pipeline_id);
+                return Err(err.into());
+            }
+        };
 
         Ok(Pipeline {
             id: pipeline_id,
@@ -92,6 +171,10 @@ impl Pipeline {
             // The output pipeline can't be created until we have the input caps
             output_pipeline: None,
             frames_path,
+            metrics,
+            overload_mode,
+            pending_frames,
+            annotations_overlay: std::sync::Mutex::new(None),
         })
     }
 
@@ -109,6 +192,7 @@ impl Pipeline {
                     self.id,
                     stream_def.clone(),
                     &input_caps,
+                    self.overload_mode != pipeless::config::streams::OverloadMode::Discard,
                     pipeless_bus_sender
                 )?;
             self.output_pipeline = Some(output_pipeline);
@@ -139,6 +223,37 @@ impl Pipeline {
     pub fn get_frames_path(&self) -> pipeless::stages::path::FramePath {
         self.frames_path.clone()
     }
+
+    pub fn get_metrics(&self) -> Arc<pipeless::metrics::StreamMetrics> {
+        self.metrics.clone()
+    }
+
+    /// Stores the annotations of a processed frame to redraw them on pass-through frames
+    fn update_annotations(&self, frame: &pipeless::data::Frame) {
+        if self.overload_mode != pipeless::config::streams::OverloadMode::PassThroughAnnotated {
+            return;
+        }
+        let overlay = pipeless::output::overlay::AnnotationsOverlay::from_frame(frame);
+        match self.annotations_overlay.lock() {
+            Ok(mut annotations_overlay) => *annotations_overlay = overlay,
+            Err(err) => warn!("Unable to update the annotations overlay: {}", err),
+        }
+    }
+
+    /// Draws the last known annotations on a pass-through frame
+    fn redraw_annotations(&self, frame: &mut pipeless::data::Frame) {
+        if self.overload_mode != pipeless::config::streams::OverloadMode::PassThroughAnnotated {
+            return;
+        }
+        match self.annotations_overlay.lock() {
+            Ok(annotations_overlay) => {
+                if let Some(overlay) = annotations_overlay.as_ref() {
+                    overlay.apply(frame);
+                }
+            },
+            Err(err) => warn!("Unable to redraw the annotations overlay: {}", err),
+        }
+    }
 }
 
 // TODO: the pipeline manager should distribute the workload
@@ -149,24 +264,47 @@ pub struct Manager {
     pipeline: Arc<RwLock<pipeless::pipeline::Pipeline>>,
     // TODO: we could change this by a callback and avoid using references to the dispatcher here
     dispatcher_sender: tokio::sync::mpsc::UnboundedSender<pipeless::dispatcher::DispatcherEvent>,
+    // Receives the frames that must be sent to the output without processing them. Taken on start.
+    passthrough_receiver: std::sync::Mutex<Option<tokio::sync::mpsc::Receiver<pipeless::data::Frame>>>,
+    scheduling_policy: pipeless::config::streams::SchedulingPolicy,
+    // Set on start. Used to remove the stream from the scheduler on stop.
+    frame_scheduler: std::sync::Mutex<Option<Arc<pipeless::scheduler::FrameScheduler>>>,
 }
 impl Manager {
     pub fn new(
         input_video_uri: String,
         output_video_uri: Option<String>,
         frames_path: pipeless::stages::path::FramePath,
+        input_rate_policy: pipeless::config::streams::InputRatePolicy,
+        overload_mode: pipeless::config::streams::OverloadMode,
+        scheduling_policy: pipeless::config::streams::SchedulingPolicy,
         // The bus needs to be created before the pipeline
         pipeless_bus_sender: &tokio::sync::mpsc::Sender<pipeless::events::Event>,
         dispatcher_sender: tokio::sync::mpsc::UnboundedSender<pipeless::dispatcher::DispatcherEvent>,
     ) -> Result<Self, PipelineError> {
+        let (passthrough_sender, passthrough_receiver) = match overload_mode {
+            pipeless::config::streams::OverloadMode::Discard => (None, None),
+            _ => {
+                let (sender, receiver) = tokio::sync::mpsc::channel::<pipeless::data::Frame>(PASSTHROUGH_BUFFER_SIZE);
+                (Some(sender), Some(receiver))
+            }
+        };
         let pipeline = Arc::new(RwLock::new(pipeless::pipeline::Pipeline::new(
             &pipeless_bus_sender,
             input_video_uri,
             output_video_uri,
             frames_path,
+            input_rate_policy,
+            overload_mode,
+            passthrough_sender,
         )?));
 
-        Ok(Self { pipeline, dispatcher_sender })
+        Ok(Self {
+            pipeline, dispatcher_sender,
+            passthrough_receiver: std::sync::Mutex::new(passthrough_receiver),
+            scheduling_policy,
+            frame_scheduler: std::sync::Mutex::new(None),
+        })
     }
 
     // Start takes ownership of self because we have to access the bus,
@@ -175,11 +313,64 @@ impl Manager {
     pub fn start(
         &self,
         event_bus: pipeless::events::Bus,
-        frame_path_executor_arc: Arc<RwLock<pipeless::stages::path::FramePathExecutor>>
+        frame_path_executor_arc: Arc<RwLock<pipeless::stages::path::FramePathExecutor>>,
+        frame_scheduler: Arc<pipeless::scheduler::FrameScheduler>,
     ) {
         let rw_pipeline = self.pipeline.clone();
         let dispatcher_sender = self.dispatcher_sender.clone();
         let frame_path_executor_arc = frame_path_executor_arc.clone();
+
+        let passthrough_receiver = match self.passthrough_receiver.lock() {
+            Ok(mut receiver) => receiver.take(),
+            Err(err) => {
+                error!("Unable to get the pass-through receiver: {}", err);
+                None
+            }
+        };
+        let scheduling_policy = self.scheduling_policy;
+        match self.frame_scheduler.lock() {
+            Ok(mut scheduler) => *scheduler = Some(frame_scheduler.clone()),
+            Err(err) => error!("Unable to store the frame scheduler: {}", err),
+        }
+
+        if let Some(mut passthrough_receiver) = passthrough_receiver {
+            // Send the frames that could not be processed directly to the output.
+            // Uses a weak reference because the pipeline owns the sender. The loop ends when the pipeline is dropped.
+            let weak_pipeline = Arc::downgrade(&self.pipeline);
+            let pipeless_bus_sender = event_bus.get_sender();
+            tokio::spawn(async move {
+                let (metrics, pending_frames) = match weak_pipeline.upgrade() {
+                    Some(pipeline) => {
+                        let read_guard = pipeline.read().await;
+                        (read_guard.get_metrics(), read_guard.pending_frames.clone())
+                    },
+                    None => return,
+                };
+                while let Some(mut frame) = passthrough_receiver.recv().await {
+                    // The output drops the frames older than the last one pushed. Hold the pass-through frame
+                    // back until the processed frames before it reach the output, so they are not dropped as late.
+                    let hold_start = std::time::Instant::now();
+                    if let Some(pending_frames) = &pending_frames {
+                        let pts = frame.get_pts().nseconds();
+                        if tokio::time::timeout(MAX_PASSTHROUGH_HOLD, pending_frames.wait_before(pts)).await.is_err() {
+                            debug!("Sending pass-through frame before the processed frames that precede it");
+                        }
+                    }
+                    metrics.observe_passthrough_hold(hold_start.elapsed());
+                    let rw_pipeline = match weak_pipeline.upgrade() {
+                        Some(pipeline) => pipeline,
+                        None => break,
+                    };
+                    let read_guard = rw_pipeline.read().await;
+                    if let Some(pipe) = &read_guard.output_pipeline {
+                        read_guard.redraw_annotations(&mut frame);
+                        if let Err(err) = pipe.on_new_frame(frame, &pipeless_bus_sender) {
+                            error!("{}", err);
+                        }
+                    }
+                }
+            });
+        }
         // Leave the pipeline manager running as a tokio task
         tokio::spawn(async move {
             // Process events on the pipeline concurrently. So frames are processed even
@@ -188,35 +379,65 @@ impl Manager {
             let rw_pipeline = rw_pipeline.clone();
             let dispatcher_sender = dispatcher_sender.clone();
             let pipeless_bus_sender = event_bus.get_sender();
-            let concurrent_limit = num_cpus::get() * 2; // NOTE: Making benchmarks we found this is a good value
+            let pipeline_id;
+            {
+                let read_guard = rw_pipeline.read().await;
+                pipeline_id = read_guard.id;
+                frame_scheduler.register_stream(&pipeline_id, scheduling_policy, read_guard.get_metrics());
+            }
+            // The frame scheduler limits the frames processed at the same time across all the streams.
+            // The events over that limit wait for their turn in the scheduler.
+            let concurrent_limit = frame_scheduler.get_max_in_flight();
             let frame_path_executor_arc = frame_path_executor_arc.clone();
+            let loop_frame_scheduler = frame_scheduler.clone();
             event_bus.process_events(concurrent_limit,
                 move |event, end_signal| {
                     let rw_pipeline = rw_pipeline.clone();
                     let dispatcher_sender = dispatcher_sender.clone();
                     let pipeless_bus_sender = pipeless_bus_sender.clone();
                     let frame_path_executor_arc = frame_path_executor_arc.clone();
+                    let frame_scheduler = loop_frame_scheduler.clone();
                     async move {
                         match event {
                             pipeless::events::Event::FrameChangeEvent(e) => {
                                 let frame = e.into_frame();
                                 let frame_path;
+                                let metrics;
+                                let _pending_frame;
                                 {
                                     let read_guard = rw_pipeline.read().await;
                                     frame_path = read_guard.get_frames_path();
+                                    metrics = read_guard.get_metrics();
+                                    // The input added the frame to the pending frames when publishing it.
+                                    // Removed once the frame is sent to the output or dropped.
+                                    _pending_frame = read_guard.pending_frames.clone().map(|pending_frames| PendingFrameGuard {
+                                        pending_frames, pts: frame.get_pts().nseconds(),
+                                    });
                                 }
+                                let input_ts = frame.get_input_ts();
+                                let now = std::time::SystemTime::now().duration_since(std::time::UNIX_EPOCH).unwrap().as_secs_f64();
+                                metrics.observe_queue_latency(std::time::Duration::from_secs_f64((now - input_ts).max(0.0)));
                                 let out_frame_opt;
                                 {
+                                    let _permit = frame_scheduler.acquire(&pipeline_id).await;
                                     let frame_path_executor = frame_path_executor_arc.read().await;
                                     out_frame_opt = frame_path_executor.execute_path(frame, frame_path).await;
                                 }
 
                                 if let Some(out_frame) = out_frame_opt {
+                                    metrics.inc_processed_frames();
+                                    let now = std::time::SystemTime::now().duration_since(std::time::UNIX_EPOCH).unwrap().as_secs_f64();
+                                    metrics.observe_frame_latency(std::time::Duration::from_secs_f64((now - input_ts).max(0.0)));
                                     let read_guard = rw_pipeline.read().await;
+                                    read_guard.update_annotations(&out_frame);
                                     match &read_guard.output_pipeline {
                                         Some(pipe) => {
+                                            let output_start = std::time::Instant::now();
                                             if let Err(err) = pipe.on_new_frame(out_frame, &pipeless_bus_sender) {
+                                                metrics.inc_output_errors();
                                                 error!("{}", err);
+                                            } else {
+                                                metrics.observe_output_latency(output_start.elapsed());
                                             }
                                         }
                                         None => {}
@@ -346,6 +567,8 @@ impl Manager {
                     }
                 }
             ).await;
+
+            frame_scheduler.unregister_stream(&pipeline_id);
         });
     }
 
@@ -355,6 +578,15 @@ impl Manager {
         let read_guard = self.pipeline.read().await;
         let pipeline_id = read_guard.id;
         read_guard.close();
+        pipeless::metrics::unregister_stream(pipeline_id);
+        match self.frame_scheduler.lock() {
+            Ok(scheduler) => {
+                if let Some(scheduler) = scheduler.as_ref() {
+                    scheduler.unregister_stream(&pipeline_id);
+                }
+            },
+            Err(err) => warn!("Unable to remove the stream from the frame scheduler: {}", err),
+        }
         pipeline_id
     }
 
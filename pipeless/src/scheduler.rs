@@ -0,0 +1,309 @@
+use std::{collections::{HashMap, VecDeque}, sync::{Arc, Mutex}, time::Instant};
+use log::{debug, warn};
+use tokio::sync::oneshot;
+use uuid::Uuid;
+
+use crate as pipeless;
+
+/// Frame waiting for a processing slot
+struct QueuedFrame {
+    start_tag: f64, // Virtual time at which the frame becomes eligible
+    queued_at: Instant,
+    sender: oneshot::Sender<FramePermit>,
+}
+
+struct StreamQueue {
+    priority: u32,
+    max_in_flight: Option<usize>,
+    in_flight: usize,
+    last_finish_tag: f64, // Virtual finish time of the last frame queued for the stream
+    frames: VecDeque<QueuedFrame>,
+    metrics: Option<Arc<pipeless::metrics::StreamMetrics>>,
+    // The stream ended. The queue is removed once its frames finish.
+    unregistered: bool,
+}
+impl StreamQueue {
+    fn new(policy: pipeless::config::streams::SchedulingPolicy, metrics: Option<Arc<pipeless::metrics::StreamMetrics>>) -> Self {
+        Self {
+            priority: policy.get_priority(),
+            max_in_flight: policy.get_max_in_flight(),
+            in_flight: 0,
+            last_finish_tag: 0.0,
+            frames: VecDeque::new(),
+            metrics,
+            unregistered: false,
+        }
+    }
+
+    fn is_idle(&self) -> bool {
+        self.in_flight == 0 && self.frames.is_empty()
+    }
+
+    fn can_run(&self) -> bool {
+        !self.frames.is_empty() && self.max_in_flight.map_or(true, |max| self.in_flight < max)
+    }
+}
+
+struct SchedulerState {
+    in_flight: usize,
+    virtual_time: f64,
+    streams: HashMap<Uuid, StreamQueue>,
+}
+
+/// Owns the in-flight frame budget of the node and shares it among the running streams.
+/// Uses start-time fair queuing: every queued frame gets a virtual start tag and the
+/// frame with the lowest tag among the streams that are below their max in flight runs next.
+/// Each frame advances the tags of its stream by 1 / priority, so streams share the
+/// processing slots proportionally to their priority and an idle stream does not
+/// accumulate credit to starve the others when it becomes active.
+pub struct FrameScheduler {
+    max_in_flight: usize,
+    state: Mutex<SchedulerState>,
+}
+impl FrameScheduler {
+    pub fn new(max_in_flight: usize) -> Self {
+        Self {
+            max_in_flight: max_in_flight.max(1),
+            state: Mutex::new(SchedulerState {
+                in_flight: 0,
+                virtual_time: 0.0,
+                streams: HashMap::new(),
+            }),
+        }
+    }
+
+    pub fn get_max_in_flight(&self) -> usize {
+        self.max_in_flight
+    }
+
+    /// Adds a stream to the scheduler or updates its policy when it already exists
+    pub fn register_stream(
+        &self,
+        pipeline_id: &Uuid,
+        policy: pipeless::config::streams::SchedulingPolicy,
+        metrics: Arc<pipeless::metrics::StreamMetrics>,
+    ) {
+        let mut state = self.state.lock().unwrap();
+        let queue = state.streams.entry(*pipeline_id)
+            .or_insert_with(|| StreamQueue::new(policy, None));
+        queue.priority = policy.get_priority();
+        queue.max_in_flight = policy.get_max_in_flight();
+        queue.metrics = Some(metrics);
+        queue.unregistered = false;
+    }
+
+    /// Removes a stream from the scheduler. When the stream still has frames,
+    /// the removal is deferred until they finish.
+    pub fn unregister_stream(&self, pipeline_id: &Uuid) {
+        let mut state = self.state.lock().unwrap();
+        let remove = match state.streams.get_mut(pipeline_id) {
+            Some(queue) => {
+                queue.unregistered = true;
+                queue.is_idle()
+            },
+            None => false,
+        };
+        if remove {
+            state.streams.remove(pipeline_id);
+        }
+    }
+
+    /// Waits for a processing slot for a frame of the stream.
+    /// The slot is released when the returned permit is dropped.
+    pub async fn acquire(self: &Arc<Self>, pipeline_id: &Uuid) -> FramePermit {
+        let receiver = {
+            let mut state = self.state.lock().unwrap();
+            let virtual_time = state.virtual_time;
+            let queue = state.streams.entry(*pipeline_id).or_insert_with(|| {
+                debug!("Scheduling frames of unregistered pipeline {} with the default policy", pipeline_id);
+                let mut queue = StreamQueue::new(Default::default(), None);
+                queue.unregistered = true;
+                queue
+            });
+            let start_tag = virtual_time.max(queue.last_finish_tag);
+            queue.last_finish_tag = start_tag + 1.0 / queue.priority as f64;
+            let (sender, receiver) = oneshot::channel();
+            queue.frames.push_back(QueuedFrame { start_tag, queued_at: Instant::now(), sender });
+            if let Some(metrics) = &queue.metrics {
+                metrics.inc_queued_frames();
+            }
+            self.dispatch(&mut state);
+            receiver
+        };
+
+        match receiver.await {
+            Ok(permit) => permit,
+            Err(_) => {
+                // The scheduler never drops a queued frame without sending it a permit
+                warn!("Frame of pipeline {} lost its place in the scheduler queue, running it unscheduled", pipeline_id);
+                FramePermit { scheduler: None, pipeline_id: *pipeline_id }
+            }
+        }
+    }
+
+    /// Gives the free processing slots to the queued frames with the lowest start tags
+    fn dispatch(self: &Arc<Self>, state: &mut SchedulerState) {
+        while state.in_flight < self.max_in_flight {
+            let next_stream = state.streams.iter()
+                .filter(|(_, queue)| queue.can_run())
+                .min_by(|(_, a), (_, b)| a.frames[0].start_tag.total_cmp(&b.frames[0].start_tag))
+                .map(|(pipeline_id, _)| *pipeline_id);
+            let pipeline_id = match next_stream {
+                Some(pipeline_id) => pipeline_id,
+                None => break,
+            };
+
+            let queue = state.streams.get_mut(&pipeline_id).unwrap();
+            let frame = queue.frames.pop_front().unwrap();
+            if let Some(metrics) = &queue.metrics {
+                metrics.dec_queued_frames();
+            }
+            let permit = FramePermit { scheduler: Some(self.clone()), pipeline_id };
+            match frame.sender.send(permit) {
+                Ok(()) => {
+                    queue.in_flight += 1;
+                    if let Some(metrics) = &queue.metrics {
+                        metrics.inc_in_flight_frames();
+                        metrics.add_scheduler_wait(frame.queued_at.elapsed());
+                    }
+                    state.in_flight += 1;
+                    state.virtual_time = frame.start_tag;
+                },
+                Err(permit) => {
+                    // The frame stopped waiting. The slot was not taken.
+                    permit.disarm();
+                },
+            }
+        }
+
+        if state.in_flight == 0 && state.streams.values().all(|queue| queue.frames.is_empty()) {
+            // Nothing to schedule, restart the virtual clock to keep the tags small
+            state.virtual_time = 0.0;
+            for queue in state.streams.values_mut() {
+                queue.last_finish_tag = 0.0;
+            }
+        }
+    }
+
+    fn release(self: &Arc<Self>, pipeline_id: &Uuid) {
+        let mut state = self.state.lock().unwrap();
+        state.in_flight = state.in_flight.saturating_sub(1);
+        let remove = match state.streams.get_mut(pipeline_id) {
+            Some(queue) => {
+                queue.in_flight = queue.in_flight.saturating_sub(1);
+                if let Some(metrics) = &queue.metrics {
+                    metrics.dec_in_flight_frames();
+                }
+                queue.unregistered && queue.is_idle()
+            },
+            None => false,
+        };
+        if remove {
+            state.streams.remove(pipeline_id);
+        }
+        self.dispatch(&mut state);
+    }
+}
+
+/// Processing slot of a frame. Releases the slot when dropped.
+pub struct FramePermit {
+    scheduler: Option<Arc<FrameScheduler>>,
+    pipeline_id: Uuid,
+}
+impl FramePermit {
+    /// Drops the permit without releasing the slot, for permits that were never taken
+    fn disarm(mut self) {
+        self.scheduler = None;
+    }
+}
+impl Drop for FramePermit {
+    fn drop(&mut self) {
+        if let Some(scheduler) = self.scheduler.take() {
+            scheduler.release(&self.pipeline_id);
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::time::Duration;
+
+    const WAIT: Duration = Duration::from_millis(50);
+
+    fn register(scheduler: &FrameScheduler, priority: u32, max_in_flight: Option<usize>) -> Uuid {
+        let pipeline_id = Uuid::new_v4();
+        let policy = pipeless::config::streams::SchedulingPolicy::new(Some(priority), max_in_flight);
+        scheduler.register_stream(&pipeline_id, policy, Arc::new(pipeless::metrics::StreamMetrics::default()));
+        pipeline_id
+    }
+
+    #[tokio::test]
+    async fn test_weighted_share() {
+        let scheduler = Arc::new(FrameScheduler::new(1));
+        let high = register(&scheduler, 2, None);
+        let low = register(&scheduler, 1, None);
+        // Hold the only slot so the frames of both streams queue up
+        let blocker = scheduler.acquire(&Uuid::new_v4()).await;
+
+        let order = Arc::new(Mutex::new(vec![]));
+        let mut tasks = vec![];
+        for _ in 0..12 {
+            for pipeline_id in [high, low] {
+                let scheduler = scheduler.clone();
+                let order = order.clone();
+                tasks.push(tokio::spawn(async move {
+                    let _permit = scheduler.acquire(&pipeline_id).await;
+                    order.lock().unwrap().push(pipeline_id);
+                }));
+                tokio::task::yield_now().await;
+            }
+        }
+        drop(blocker);
+        for task in tasks {
+            task.await.unwrap();
+        }
+
+        // While both streams have frames, the stream with priority 2 gets twice the slots
+        let order = order.lock().unwrap();
+        let high_count = order[..12].iter().filter(|pipeline_id| **pipeline_id == high).count();
+        assert_eq!(high_count, 8);
+        assert_eq!(order.len(), 24);
+    }
+
+    #[tokio::test]
+    async fn test_stream_max_in_flight() {
+        let scheduler = Arc::new(FrameScheduler::new(4));
+        let capped = register(&scheduler, 1, Some(1));
+        let other = register(&scheduler, 1, None);
+
+        let permit = scheduler.acquire(&capped).await;
+        // The node has free slots, but the stream is at its limit
+        assert!(tokio::time::timeout(WAIT, scheduler.acquire(&capped)).await.is_err());
+        assert!(tokio::time::timeout(WAIT, scheduler.acquire(&other)).await.is_ok());
+
+        drop(permit);
+        // The frame that stopped waiting does not keep the slot
+        assert!(tokio::time::timeout(WAIT, scheduler.acquire(&capped)).await.is_ok());
+    }
+
+    #[tokio::test]
+    async fn test_dropped_permit_releases_slot() {
+        let scheduler = Arc::new(FrameScheduler::new(1));
+        let first = register(&scheduler, 1, None);
+        let second = register(&scheduler, 1, None);
+
+        let permit = scheduler.acquire(&first).await;
+        let waiting = tokio::spawn({
+            let scheduler = scheduler.clone();
+            async move { scheduler.acquire(&second).await.pipeline_id }
+        });
+        tokio::task::yield_now().await;
+        assert!(!waiting.is_finished());
+
+        drop(permit);
+        let pipeline_id = tokio::time::timeout(WAIT, waiting).await.unwrap().unwrap();
+        assert_eq!(pipeline_id, second);
+        assert_eq!(scheduler.state.lock().unwrap().in_flight, 0);
+    }
+}
@@ -1,9 +1,10 @@
 use std::{collections::HashMap, fmt, sync::Arc};
 use log::error;
-use tokio::sync::{Mutex, RwLock};
+use tokio::sync::Mutex;
 use uuid::Uuid;
 
 use crate as pipeless;
+use super::sequencer::FrameSequencer;
 
 #[derive(Clone,Copy,PartialEq)]
 pub enum HookType {
@@ -43,35 +44,49 @@ impl StatelessHook {
         self.h_body.clone()
     }
 }
+/// Creates the body of a stateful hook for a stream
+pub type StatefulHookFactory = dyn Fn(&Uuid) -> Arc<Mutex<dyn HookTrait>> + Send + Sync;
+
+/// The state of a stateful hook can be shared by all the streams or kept per stream.
+/// When kept per stream, the hooks of different streams run in parallel.
+#[derive(Clone)]
+enum StatefulBody {
+    Shared(Arc<Mutex<dyn HookTrait>>),
+    PerStream {
+        factory: Arc<StatefulHookFactory>,
+        bodies: Arc<std::sync::Mutex<HashMap<Uuid, Arc<Mutex<dyn HookTrait>>>>>,
+    },
+}
+
 #[derive(Clone)]
 pub struct StatefulHook {
     h_type: HookType,
-    h_body: Arc<Mutex<dyn HookTrait>>,
+    h_body: StatefulBody,
     // Stateful hooks would not necesarily require to process sequentially, however, in almost all cases preserving a state in CV are related to sorted processing, such as tracking.
-    // Maps the stream uuid to the last frame processed for the stream. Used for stateful sequential sorted processing.
-    last_frame_map: Arc<RwLock<HashMap<Uuid, u64>>>,
+    // Orders the frames of each stream.
+    sequencer: Arc<FrameSequencer>,
 }
 impl StatefulHook {
     fn get_hook_type(&self) -> HookType {
         self.h_type
     }
-    fn get_hook_body(&self) -> Arc<Mutex<dyn HookTrait>> {
-        self.h_body.clone()
-    }
-    async fn last_processed_frame_number(&self, pipeline_id: &Uuid) -> u64 {
-        let read_guard = self.last_frame_map.read().await;
-        match read_guard.get(pipeline_id) {
-            Some(n) => *n,
-            None => 0,
+    /// Creates the stream body the first time it is used, which may block
+    fn get_hook_body(&self, pipeline_id: &Uuid) -> Arc<Mutex<dyn HookTrait>> {
+        match &self.h_body {
+            StatefulBody::Shared(body) => body.clone(),
+            StatefulBody::PerStream { factory, bodies } => {
+                let mut bodies = bodies.lock().unwrap();
+                bodies.entry(*pipeline_id)
+                    .or_insert_with(|| factory(pipeline_id))
+                    .clone()
+            }
         }
     }
-    async fn increment_last_processed(&self, pipeline_id: &Uuid) {
-        let mut write_guard = self.last_frame_map.write().await;
-        let last = match write_guard.get(pipeline_id) {
-            Some(n) => *n,
-            None => 0,
-        };
-        write_guard.insert(*pipeline_id, last + 1);
+    fn forget_stream(&self, pipeline_id: &Uuid) {
+        self.sequencer.forget(pipeline_id);
+        if let StatefulBody::PerStream { bodies, .. } = &self.h_body {
+            bodies.lock().unwrap().remove(pipeline_id);
+        }
     }
 }
 
@@ -103,8 +118,20 @@ impl Hook {
     pub fn new_stateful(hook_type: HookType, hook_body: Arc<Mutex<dyn HookTrait>>) -> Self {
         let hook = StatefulHook {
             h_type: hook_type,
-            h_body: hook_body,
-            last_frame_map: Arc::new(RwLock::new(HashMap::new())),
+            h_body: StatefulBody::Shared(hook_body),
+            sequencer: Arc::new(FrameSequencer::new()),
+        };
+        Self::StatefulHook(hook)
+    }
+    /// Stateful hook that keeps a different state for each stream, created by the factory
+    pub fn new_stateful_per_stream(hook_type: HookType, factory: Arc<StatefulHookFactory>) -> Self {
+        let hook = StatefulHook {
+            h_type: hook_type,
+            h_body: StatefulBody::PerStream {
+                factory,
+                bodies: Arc::new(std::sync::Mutex::new(HashMap::new())),
+            },
+            sequencer: Arc::new(FrameSequencer::new()),
         };
         Self::StatefulHook(hook)
     }
@@ -142,32 +169,26 @@ impl Hook {
                 }
             },
             Hook::StatefulHook(hook) => {
-                let frame_pipeline_id = frame.get_pipeline_id().clone();
+                let pipeline_id = *frame.get_pipeline_id();
+                let frame_number = *frame.get_frame_number();
                 // Wait until it's this frame's turn to be processed
-                {
-                    let prev_frame_number = frame.get_frame_number() - 1;
-                    let mut last_processed = hook.last_processed_frame_number(&frame_pipeline_id).await;
-                    while last_processed != prev_frame_number {
-                        last_processed = hook.last_processed_frame_number(&frame_pipeline_id).await;
-                        tokio::task::yield_now().await;
-                    }
-                }
+                let in_sequence = hook.sequencer.wait_turn(&pipeline_id, frame_number).await;
 
-                // NOTE: the following is sub-optimal. We can't use rayon with async code and
-                // for stateful hooks we need to lock the mutex before running.
+                // We can't use rayon with async code and for stateful hooks we need to lock the hook before running.
                 let worker_res = tokio::task::spawn_blocking({
                     let stage_context = stage_context.clone();
                     let hook = hook.clone();
-                    move || async move{
-                        let h_body = hook.get_hook_body();
-                        let locked_hook = h_body.lock().await;
-                        let res = locked_hook.exec_hook(frame, &stage_context);
-                        hook.increment_last_processed(&frame_pipeline_id).await;
-                        res
+                    move || {
+                        let h_body = hook.get_hook_body(&pipeline_id);
+                        let locked_hook = h_body.blocking_lock();
+                        locked_hook.exec_hook(frame, &stage_context)
                     }
                 }).await;
+                if in_sequence {
+                    hook.sequencer.finish(&pipeline_id, frame_number);
+                }
                 match worker_res {
-                    Ok(f) => f.await,
+                    Ok(f) => f,
                     Err(err) => {
                         error!("Error getting result from the tokio worker: {}", err);
                         None
@@ -177,6 +198,28 @@ impl Hook {
         }
     }
 
+    /// Notifies the hook that a frame will not arrive, so stateful hooks do not wait for it
+    pub fn skip_frame(&self, pipeline_id: &Uuid, frame_number: u64) {
+        if let Hook::StatefulHook(hook) = self {
+            hook.sequencer.skip(pipeline_id, frame_number);
+        }
+    }
+
+    /// Makes stateful hooks order the streams from the first frame they receive,
+    /// because the previous frames were processed by a previous version of the hook
+    pub fn resume_streams(&self) {
+        if let Hook::StatefulHook(hook) = self {
+            hook.sequencer.resume_streams();
+        }
+    }
+
+    /// Releases the data kept by the hook for a stream that ended
+    pub fn forget_stream(&self, pipeline_id: &Uuid) {
+        if let Hook::StatefulHook(hook) = self {
+            hook.forget_stream(pipeline_id);
+        }
+    }
+
     pub fn get_hook_type(&self) -> HookType {
         match self {
             Hook::StatelessHook(hook) => {
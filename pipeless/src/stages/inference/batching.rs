@@ -0,0 +1,193 @@
+use std::sync::{Condvar, Mutex, mpsc, atomic::{AtomicU64, Ordering}};
+use std::time::{Duration, Instant};
+use log::{error, info};
+
+use crate as pipeless;
+
+// Number of batches between every stats report
+const STATS_REPORT_INTERVAL: u64 = 1000;
+
+/// Batching configuration of an inference stage. Provided in the stage
+/// process.json via 'max_batch_size' and 'max_batch_wait_ms'
+#[derive(Clone, Copy)]
+pub struct BatchingParams {
+    max_batch_size: usize,
+    max_batch_wait: Duration,
+}
+impl BatchingParams {
+    pub fn new(max_batch_size: usize, max_batch_wait_ms: u64) -> Self {
+        Self {
+            max_batch_size,
+            max_batch_wait: Duration::from_millis(max_batch_wait_ms),
+        }
+    }
+
+    /// Batching is opt-in. It is enabled only when 'max_batch_size' is bigger than 1
+    pub fn from_raw_data(data: &serde_json::Value) -> Option<Self> {
+        let max_batch_size = data["max_batch_size"].as_u64().unwrap_or(1) as usize;
+        if max_batch_size < 2 {
+            return None;
+        }
+        let max_batch_wait_ms = data["max_batch_wait_ms"].as_u64().unwrap_or(5);
+        Some(Self::new(max_batch_size, max_batch_wait_ms))
+    }
+
+    pub fn get_max_batch_size(&self) -> usize {
+        self.max_batch_size
+    }
+}
+
+struct BatchRequest {
+    frame: pipeless::data::Frame,
+    enqueued_at: Instant,
+    result_sender: mpsc::SyncSender<pipeless::data::Frame>,
+}
+
+struct BatcherState {
+    pending: Vec<BatchRequest>,
+    // Whether a thread is currently collecting and running a batch
+    leader_active: bool,
+}
+
+/// Counters to evaluate the batching efficiency
+#[derive(Default)]
+pub struct BatchingStats {
+    batches: AtomicU64,
+    frames: AtomicU64,
+    // Accumulated time the frames waited for the batch to be dispatched
+    wait_us: AtomicU64,
+}
+impl BatchingStats {
+    /// Average ratio of the batch slots that were filled
+    pub fn fill_ratio(&self, max_batch_size: usize) -> f64 {
+        let batches = self.batches.load(Ordering::Relaxed);
+        if batches == 0 { return 0.0; }
+        self.frames.load(Ordering::Relaxed) as f64 / (batches * max_batch_size as u64) as f64
+    }
+
+    /// Average latency added to every frame by waiting for the batch, in milliseconds
+    pub fn avg_wait_ms(&self) -> f64 {
+        let frames = self.frames.load(Ordering::Relaxed);
+        if frames == 0 { return 0.0; }
+        self.wait_us.load(Ordering::Relaxed) as f64 / frames as f64 / 1000.0
+    }
+}
+
+/// Groups the frames that arrive concurrently to the same inference hook
+/// (from any stream) into a single batched inference.
+/// The frames are processed by the hook workers, which block until their
+/// frame has been processed. The first waiting worker becomes the leader:
+/// it waits until the batch is full or until the oldest frame reached
+/// the max wait time, runs the batch and sends the results back.
+/// Note the batch size is also bounded by the number of hook workers.
+pub struct InferenceBatcher {
+    params: BatchingParams,
+    state: Mutex<BatcherState>,
+    // Notified when a new frame is queued
+    arrivals: Condvar,
+    // Notified when a batch finished
+    completions: Condvar,
+    stats: BatchingStats,
+    stage_name: String,
+}
+impl InferenceBatcher {
+    pub fn new(params: BatchingParams, stage_name: &str) -> Self {
+        Self {
+            params,
+            stage_name: stage_name.to_string(),
+            state: Mutex::new(BatcherState { pending: Vec::new(), leader_active: false }),
+            arrivals: Condvar::new(),
+            completions: Condvar::new(),
+            stats: BatchingStats::default(),
+        }
+    }
+
+    pub fn get_stats(&self) -> &BatchingStats {
+        &self.stats
+    }
+
+    /// Queues the frame for the next batch and waits until it is processed.
+    /// 'run_batch' must return the frames in the same order it receives them.
+    pub fn submit<F>(&self, frame: pipeless::data::Frame, run_batch: F) -> Option<pipeless::data::Frame>
+    where
+        F: Fn(Vec<pipeless::data::Frame>) -> Vec<pipeless::data::Frame>,
+    {
+        let (result_sender, result_receiver) = mpsc::sync_channel(1);
+        let mut state = self.state.lock().unwrap();
+        state.pending.push(BatchRequest { frame, enqueued_at: Instant::now(), result_sender });
+        self.arrivals.notify_one();
+
+        loop {
+            match result_receiver.try_recv() {
+                Ok(out_frame) => return Some(out_frame),
+                // The batch containing the frame failed
+                Err(mpsc::TryRecvError::Disconnected) => return None,
+                Err(mpsc::TryRecvError::Empty) => {},
+            }
+
+            if !state.leader_active && !state.pending.is_empty() {
+                state.leader_active = true;
+                // Wait until the batch is full or the oldest frame reached the max wait time
+                let deadline = state.pending[0].enqueued_at + self.params.max_batch_wait;
+                while state.pending.len() < self.params.max_batch_size {
+                    let now = Instant::now();
+                    if now >= deadline { break; }
+                    state = self.arrivals.wait_timeout(state, deadline - now).unwrap().0;
+                }
+                let batch_len = state.pending.len().min(self.params.max_batch_size);
+                let batch: Vec<BatchRequest> = state.pending.drain(..batch_len).collect();
+                drop(state);
+
+                self.run(batch, &run_batch);
+
+                state = self.state.lock().unwrap();
+                state.leader_active = false;
+                self.completions.notify_all();
+                continue;
+            }
+
+            state = self.completions.wait(state).unwrap();
+        }
+    }
+
+    fn run<F>(&self, batch: Vec<BatchRequest>, run_batch: &F)
+    where
+        F: Fn(Vec<pipeless::data::Frame>) -> Vec<pipeless::data::Frame>,
+    {
+        let dispatched_at = Instant::now();
+        let mut frames = Vec::with_capacity(batch.len());
+        let mut senders = Vec::with_capacity(batch.len());
+        let mut wait_us = 0;
+        let fill_ratio = batch.len() as f64 / self.params.max_batch_size as f64;
+        for request in batch {
+            let wait = dispatched_at.duration_since(request.enqueued_at);
+            wait_us += wait.as_micros() as u64;
+            if let Some(stage_metrics) = pipeless::metrics::get_stage_metrics(request.frame.get_pipeline_id(), &self.stage_name) {
+                stage_metrics.observe_batch(fill_ratio, wait);
+            }
+            frames.push(request.frame);
+            senders.push(request.result_sender);
+        }
+
+        let batch_len = frames.len() as u64;
+        let out_frames = run_batch(frames);
+        if out_frames.len() != senders.len() {
+            error!("The batched inference returned {} frames for a batch of {}. Discarding the batch", out_frames.len(), senders.len());
+        } else {
+            for (out_frame, sender) in out_frames.into_iter().zip(senders) {
+                // The channel has capacity for the result, so this never blocks
+                let _ = sender.send(out_frame);
+            }
+        }
+
+        self.stats.frames.fetch_add(batch_len, Ordering::Relaxed);
+        self.stats.wait_us.fetch_add(wait_us, Ordering::Relaxed);
+        let batches = self.stats.batches.fetch_add(1, Ordering::Relaxed) + 1;
+        if batches % STATS_REPORT_INTERVAL == 0 {
+            info!(
+                "Inference batching: {} batches, fill ratio: {:.2}, average added latency: {:.2} ms",
+                batches, self.stats.fill_ratio(self.params.max_batch_size), self.stats.avg_wait_ms()
+            );
+        }
+    }
+}
@@ -1,26 +1,45 @@
 use crate as pipeless;
 
+use std::time::{Duration, Instant};
 use crate::stages::hook::HookTrait;
-use super::{runtime::InferenceRuntime, session::{InferenceSession, SessionParams}};
+use log::warn;
+
+use super::{batching::{BatchingParams, InferenceBatcher}, motion::{GateDecision, MotionGate}, postprocessing::PostProcessParams, preprocessing::PreProcessParams, runtime::InferenceRuntime, session::{InferenceSession, SessionParams}};
 
 /// Inference hooks maintain the inference session.
 /// When created as stateless hooks, the inference session will be duplicated to every worker
 /// When using a model that maintains internal state a stateful hook should be used.
-/// Since the hook is associated to a stage, the inference session will last as long as the stage
-/// To use different sessions per stream, the stage should be duplicated. Creating a symlink
-/// in the project folder is enough to split the inference session.
+/// Stages with the same model and inference params share the inference session, which lasts
+/// as long as any of those stages. To use different sessions per stream, the stage should be
+/// duplicated with 'shared_session: false' in the 'inference_params'.
+/// When batching is enabled, the frames that arrive concurrently to the hook, from any stream,
+/// are grouped into a single inference.
+/// When a pre-processing is defined, the inference input is created natively from the original frame.
+/// When a post-processing is defined, the raw inference output is decoded natively.
+/// When a motion gate is defined, frames without changes since the last inferred frame
+/// of the stream reuse its inference output.
 pub struct InferenceHook {
     session: InferenceSession,
+    batcher: Option<InferenceBatcher>,
+    pre_process: Option<PreProcessParams>,
+    post_process: Option<PostProcessParams>,
+    motion_gate: Option<MotionGate>,
+    stage_name: String,
 }
 impl InferenceHook {
     pub fn new(
+        stage_name: &str,
         runtime: &InferenceRuntime,
         session_params: SessionParams,
-        model_uri: &str
+        model_uri: &str,
+        batching_params: Option<BatchingParams>,
+        pre_process: Option<PreProcessParams>,
+        post_process: Option<PostProcessParams>,
+        motion_gate: Option<MotionGate>,
     ) -> Self {
         let session = match runtime {
             InferenceRuntime::Onnx =>  {
-                let onnx_session_result = pipeless::stages::inference::onnx::OnnxSession::new(model_uri, session_params);
+                let onnx_session_result = pipeless::stages::inference::registry::get_onnx_session(model_uri, session_params);
                 match onnx_session_result {
                     Ok(onnx_session) => pipeless::stages::inference::session::InferenceSession::Onnx(onnx_session),
                     Err(err) => panic!("{}", err)
@@ -31,16 +50,84 @@ impl InferenceHook {
             ),
         };
 
-        Self { session }
+        // Without an explicit dtype, the pre-processing creates the input in the type expected by the model
+        let mut pre_process = pre_process;
+        if let Some(pre_process) = pre_process.as_mut() {
+            pre_process.set_default_dtype(session.get_input_type());
+        }
+
+        let batcher = match batching_params {
+            Some(params) if session.supports_batching() => {
+                log::info!("\t\tBatching enabled with a max batch size of {}", params.get_max_batch_size());
+                Some(InferenceBatcher::new(params, stage_name))
+            },
+            Some(_) => {
+                warn!("Batching disabled. The model input does not have a dynamic batch axis");
+                None
+            },
+            None => None,
+        };
+
+        Self { session, batcher, pre_process, post_process, motion_gate, stage_name: stage_name.to_string() }
+    }
+
+    fn observe_inference(&self, frame: &crate::data::Frame, inference_time: Duration) {
+        if let Some(stage_metrics) = pipeless::metrics::get_stage_metrics(frame.get_pipeline_id(), &self.stage_name) {
+            stage_metrics.observe_inference(inference_time);
+        }
     }
 }
 impl HookTrait for InferenceHook {
     fn exec_hook(
         &self,
-        frame: crate::data::Frame,
+        mut frame: crate::data::Frame,
         _: &crate::stages::stage::Context
     ) -> Option<crate::data::Frame> {
-       let out_frame = self.session.infer(frame);
-       Some(out_frame)
+        let mut signature = None;
+        if let Some(motion_gate) = &self.motion_gate {
+            match motion_gate.check(&mut frame) {
+                GateDecision::Reused => return Some(frame),
+                GateDecision::Infer(frame_signature) => signature = Some(frame_signature),
+            }
+        }
+
+        if let Some(pre_process) = &self.pre_process {
+            pre_process.run(&mut frame);
+        }
+
+        let out_frame = match &self.batcher {
+            Some(batcher) => batcher.submit(frame, |frames| {
+                let start = Instant::now();
+                let out_frames = self.session.infer_batch(frames);
+                // Every frame of the batch waited for the whole batch
+                let inference_time = start.elapsed();
+                for out_frame in &out_frames {
+                    self.observe_inference(out_frame, inference_time);
+                }
+                out_frames
+            }),
+            None => {
+                let start = Instant::now();
+                let out_frame = self.session.infer(frame);
+                self.observe_inference(&out_frame, start.elapsed());
+                Some(out_frame)
+            }
+        };
+
+        let out_frame = match (out_frame, &self.post_process) {
+            (Some(mut out_frame), Some(post_process)) => {
+                post_process.run(&mut out_frame);
+                Some(out_frame)
+            },
+            (out_frame, _) => out_frame,
+        };
+
+        if let (Some(motion_gate), Some(out_frame), Some(signature)) = (&self.motion_gate, &out_frame, signature) {
+            // A failed inference leaves the default output. Keep reusing the previous one instead.
+            if matches!(out_frame.get_inference_output(), pipeless::data::InferenceOutput::OnnxInferenceOutput(_)) {
+                motion_gate.store(out_frame, signature);
+            }
+        }
+        out_frame
     }
 }
\ No newline at end of file
@@ -1,6 +1,11 @@
 pub mod hook;
 pub mod runtime;
 pub mod session;
+pub mod registry;
 pub mod util;
 pub mod onnx;
 pub mod openvino;
+pub mod batching;
+pub mod preprocessing;
+pub mod postprocessing;
+pub mod motion;
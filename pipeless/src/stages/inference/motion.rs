@@ -0,0 +1,216 @@
+use std::{collections::HashMap, sync::Mutex};
+use lazy_static::lazy_static;
+use log::warn;
+
+use crate as pipeless;
+
+/// Number of pixels sampled per cell side when computing the frame signature
+const CELL_SAMPLES: usize = 4;
+
+/// Native change detector in front of an inference hook, defined by the 'motion_gate'
+/// field of the stage process.json.
+/// The frame is reduced to a grid of average luma values (the signature) and compared
+/// with the signature of the last frame of the stream that went through the model.
+/// When the fraction of changed cells is under the threshold, the model does not run
+/// and the frame gets the cached inference output of that frame.
+/// Example:
+///    "motion_gate": {
+///        "grid_size": 32,
+///        "cell_threshold": 12,
+///        "change_threshold": 0.01,
+///        "max_reuse": 30
+///    }
+/// 'cell_threshold' is the luma difference (0-255) over which a cell is considered changed
+/// and 'max_reuse' forces an inference after that number of consecutive reuses.
+pub struct MotionGateParams {
+    grid_size: usize,
+    cell_threshold: f32,
+    change_threshold: f32,
+    max_reuse: u64,
+}
+impl MotionGateParams {
+    /// Returns None when the motion gate is not defined
+    pub fn from_raw_data(data: &serde_json::Value) -> Result<Option<Self>, String> {
+        if data.is_null() {
+            return Ok(None);
+        }
+        if !data.is_object() {
+            return Err("The 'motion_gate' field must be an object".to_string());
+        }
+
+        let grid_size = data["grid_size"].as_u64().unwrap_or(32) as usize;
+        if grid_size == 0 {
+            return Err("'grid_size' must be a positive integer".to_string());
+        }
+        let cell_threshold = data["cell_threshold"].as_f64().unwrap_or(12.0) as f32;
+        let change_threshold = data["change_threshold"].as_f64().unwrap_or(0.01) as f32;
+        if !(0.0..=1.0).contains(&change_threshold) {
+            return Err("'change_threshold' must be a number between 0 and 1".to_string());
+        }
+        let max_reuse = data["max_reuse"].as_u64().unwrap_or(30);
+
+        Ok(Some(Self { grid_size, cell_threshold, change_threshold, max_reuse }))
+    }
+}
+
+/// Last inferred frame of a stream for an inference stage
+struct CacheEntry {
+    frame_number: u64,
+    signature: Vec<f32>,
+    inference_output: pipeless::data::InferenceOutput,
+    letterbox: Option<pipeless::data::Letterbox>,
+    reuses: u64, // Consecutive frames that reused the output
+}
+
+/// Cached inference outputs indexed by pipeline id and stage
+pub struct InferenceCache {
+    entries: Mutex<HashMap<(uuid::Uuid, String), CacheEntry>>,
+}
+impl InferenceCache {
+    fn new() -> Self {
+        Self { entries: Mutex::new(HashMap::new()) }
+    }
+
+    /// Removes the cached outputs of a pipeline
+    pub fn clean(&self, pipeline_id: &uuid::Uuid) {
+        match self.entries.lock() {
+            Ok(mut entries) => entries.retain(|(entry_pipeline_id, _), _| entry_pipeline_id != pipeline_id),
+            Err(err) => warn!("Unable to clean the inference cache: {}", err),
+        }
+    }
+
+    /// Removes the cached outputs of a stage, for example, after loading a new version of it
+    pub fn clean_stage(&self, stage_name: &str) {
+        match self.entries.lock() {
+            Ok(mut entries) => entries.retain(|(_, entry_stage_name), _| entry_stage_name != stage_name),
+            Err(err) => warn!("Unable to clean the inference cache: {}", err),
+        }
+    }
+}
+
+lazy_static! {
+    pub static ref INFERENCE_CACHE: InferenceCache = InferenceCache::new();
+}
+
+/// Result of checking a frame against the motion gate
+pub enum GateDecision {
+    /// The frame got the cached inference output
+    Reused,
+    /// The scene changed. The signature must be stored with the new inference output.
+    Infer(Vec<f32>),
+}
+
+pub struct MotionGate {
+    params: MotionGateParams,
+    stage_name: String,
+}
+impl MotionGate {
+    pub fn new(params: MotionGateParams, stage_name: &str) -> Self {
+        Self { params, stage_name: stage_name.to_string() }
+    }
+
+    /// Sets the cached inference output on the frame when the scene did not change
+    /// since the last inferred frame of the stream
+    pub fn check(&self, frame: &mut pipeless::data::Frame) -> GateDecision {
+        let pipeline_id = *frame.get_pipeline_id();
+        let signature = compute_signature(frame.get_original_pixels(), self.params.grid_size);
+        let metrics = pipeless::metrics::get_stream_metrics(&pipeline_id);
+
+        let cached = match INFERENCE_CACHE.entries.lock() {
+            Ok(mut entries) => {
+                match entries.get_mut(&(pipeline_id, self.stage_name.clone())) {
+                    Some(entry) if entry.reuses < self.params.max_reuse
+                        && changed_fraction(&entry.signature, &signature, self.params.cell_threshold) <= self.params.change_threshold =>
+                    {
+                        entry.reuses += 1;
+                        Some((entry.inference_output.clone(), entry.letterbox))
+                    },
+                    _ => None,
+                }
+            },
+            Err(err) => {
+                warn!("Unable to read the inference cache: {}", err);
+                None
+            }
+        };
+
+        match cached {
+            Some((inference_output, letterbox)) => {
+                frame.set_inference_output(inference_output);
+                frame.set_letterbox(letterbox);
+                if let Some(metrics) = metrics {
+                    metrics.inc_inference_cache_hits();
+                }
+                GateDecision::Reused
+            },
+            None => {
+                if let Some(metrics) = metrics {
+                    metrics.inc_inference_cache_misses();
+                }
+                GateDecision::Infer(signature)
+            }
+        }
+    }
+
+    /// Caches the inference output of a frame that went through the model
+    pub fn store(&self, frame: &pipeless::data::Frame, signature: Vec<f32>) {
+        let frame_number = *frame.get_frame_number();
+        let key = (*frame.get_pipeline_id(), self.stage_name.clone());
+        match INFERENCE_CACHE.entries.lock() {
+            Ok(mut entries) => {
+                if entries.get(&key).map_or(false, |entry| entry.frame_number > frame_number) {
+                    // A later frame of the stream was already inferred
+                    return;
+                }
+                entries.insert(key, CacheEntry {
+                    frame_number,
+                    signature,
+                    inference_output: frame.get_inference_output().clone(),
+                    letterbox: frame.get_letterbox().copied(),
+                    reuses: 0,
+                });
+            },
+            Err(err) => warn!("Unable to update the inference cache: {}", err),
+        }
+    }
+}
+
+/// Average luma of every cell of a grid_size x grid_size grid over the frame,
+/// sampling CELL_SAMPLES x CELL_SAMPLES pixels per cell
+fn compute_signature(pixels: ndarray::ArrayView3<u8>, grid_size: usize) -> Vec<f32> {
+    let (height, width, channels) = pixels.dim();
+    let mut signature = vec![0.0; grid_size * grid_size];
+    if height == 0 || width == 0 || channels < 3 {
+        return signature;
+    }
+    let samples = (CELL_SAMPLES * CELL_SAMPLES) as f32;
+    for cell_y in 0..grid_size {
+        for cell_x in 0..grid_size {
+            let mut sum = 0.0;
+            for sample_y in 0..CELL_SAMPLES {
+                let y = ((cell_y * CELL_SAMPLES + sample_y) * 2 + 1) * height / (grid_size * CELL_SAMPLES * 2);
+                for sample_x in 0..CELL_SAMPLES {
+                    let x = ((cell_x * CELL_SAMPLES + sample_x) * 2 + 1) * width / (grid_size * CELL_SAMPLES * 2);
+                    let r = pixels[[y, x, 0]] as f32;
+                    let g = pixels[[y, x, 1]] as f32;
+                    let b = pixels[[y, x, 2]] as f32;
+                    sum += 0.299 * r + 0.587 * g + 0.114 * b;
+                }
+            }
+            signature[cell_y * grid_size + cell_x] = sum / samples;
+        }
+    }
+    signature
+}
+
+/// Fraction of the cells whose luma changed more than the threshold
+fn changed_fraction(a: &[f32], b: &[f32], cell_threshold: f32) -> f32 {
+    if a.len() != b.len() || a.is_empty() {
+        // The frame size or the grid changed
+        return 1.0;
+    }
+    let changed = a.iter().zip(b.iter())
+        .filter(|(a, b)| (*a - *b).abs() > cell_threshold)
+        .count();
+    changed as f32 / a.len() as f32
+}
@@ -1,10 +1,13 @@
-use std::collections::HashMap;
+use std::{collections::HashMap, sync::Mutex};
 
-use log::{error, warn};
+use log::{error, info, warn};
 use ort;
 
 use crate as pipeless;
 
+// Max number of batch input buffers kept for re-use per session
+const MAX_POOLED_INPUT_BUFFERS: usize = 4;
+
 pub type OnnxInferenceOutput = HashMap<String, ndarray::ArrayBase<ndarray::OwnedRepr<f32>, ndarray::Dim<ndarray::IxDynImpl>>>;
 
 pub struct OnnxSessionParams {
@@ -14,6 +17,7 @@ pub struct OnnxSessionParams {
     inter_threads: Option<i16>, // If execution mode is Parallel (and nodes can be run in parallel), this sets the maximum number of threads to use to run them in parallel.
     intra_threads: Option<i16>, // Number of threads to parallelize the execution within nodes
     custom_op_lib_path: Option<String>, // Path to a custom op library
+    shared: bool, // Whether the session can be shared with other stages using the same model and options
     /*ir_version: Option<u32>,
     opset_version: Option<u32>,
     image_shape_format: Option<Vec<String>>,
@@ -27,6 +31,7 @@ impl OnnxSessionParams {
         execution_provider: &str, execution_mode: Option<&str>,
         inter_threads: Option<i16>, intra_threads: Option<i16>,
         custom_op_lib_path: Option<&str>,
+        shared: bool,
     ) -> Self {
         Self {
             stage_name: stage_name.to_string(),
@@ -34,11 +39,37 @@ impl OnnxSessionParams {
             execution_mode: execution_mode.map(|m| m.to_string()),
             inter_threads, intra_threads,
             custom_op_lib_path: custom_op_lib_path.map(|p| p.to_string()),
+            shared,
         }
     }
+
+    pub fn is_shared(&self) -> bool {
+        self.shared
+    }
+
+    pub fn get_stage_name(&self) -> &str {
+        &self.stage_name
+    }
+
+    /// Identifies the options that produce a different session for the same model
+    pub fn get_cache_key(&self) -> String {
+        format!(
+            "{}|{:?}|{:?}|{:?}|{:?}",
+            self.execution_provider.to_lowercase(),
+            self.execution_mode.as_ref().map(|mode| mode.to_lowercase()),
+            self.inter_threads, self.intra_threads,
+            self.custom_op_lib_path,
+        )
+    }
 }
 pub struct OnnxSession {
     session: ort::Session,
+    // Element type of every model input, None for the types not supported by the frames
+    input_types: Vec<Option<pipeless::data::TensorType>>,
+    // Whether the first axis of the model input accepts any batch size
+    dynamic_batch: bool,
+    // Re-usable buffers for the batched inputs. Grows lazily with the batch shapes used
+    input_buffers_pool: Mutex<Vec<pipeless::data::Tensor>>,
 }
 impl OnnxSession {
     pub fn new(model_uri: &str, params: super::session::SessionParams) -> Result<Self, String> {
@@ -57,160 +88,433 @@ impl OnnxSession {
                 }
             };
 
-            let model_file_path = super::util::get_model_path(model_uri, "main")?;
-            let environment = ort::Environment::builder()
-                .with_log_level(ort::LoggingLevel::Warning)
-                .with_name(onnx_params.stage_name)
-                .with_execution_providers([execution_provider])
-                .build().unwrap()
-                .into_arc();
-
-            let mut session_builder = ort::SessionBuilder::new(&environment).unwrap();
-            // Allow all optimizations by default (Level 3 is the highest)
-            // TODO: make optimization level configurable
-            session_builder = session_builder.with_optimization_level(ort::GraphOptimizationLevel::Level3).unwrap();
-            if let Some(intra_threads) = onnx_params.intra_threads {
-                session_builder = session_builder.with_intra_threads(intra_threads).unwrap();
-            }
-            if let Some(mode) = onnx_params.execution_mode {
-                match mode.as_str() {
-                    "parallel" | "Parallel" | "PARALLEL" => {
-                        session_builder = session_builder.with_parallel_execution(true).unwrap();
-                        if let Some(inter_threads) = onnx_params.inter_threads {
-                            session_builder = session_builder.with_inter_threads(inter_threads).unwrap();
+            let model_file_path = super::util::get_model_path(model_uri, &onnx_params.stage_name)?;
+            let environment = super::registry::get_onnx_environment()?;
+
+            let build_session = |model_path: &str, optimization_level: ort::GraphOptimizationLevel, optimized_model_path: Option<&std::path::Path>| -> Result<ort::Session, String> {
+                let mut session_builder = ort::SessionBuilder::new(&environment)
+                    .and_then(|builder| builder.with_execution_providers([execution_provider.clone()]))
+                    .and_then(|builder| builder.with_optimization_level(optimization_level))
+                    .map_err(|err| format!("Unable to create the ONNX session builder: {}", err))?;
+                if let Some(path) = optimized_model_path {
+                    session_builder = session_builder.with_optimized_model_path(path)
+                        .map_err(|err| format!("Unable to set the optimized model path: {}", err))?;
+                }
+                if onnx_params.intra_threads.is_none() && onnx_params.inter_threads.is_none() {
+                    // Run on the thread pool shared by all the sessions
+                    session_builder = session_builder.with_disable_per_session_threads().unwrap();
+                }
+                if let Some(intra_threads) = onnx_params.intra_threads {
+                    session_builder = session_builder.with_intra_threads(intra_threads).unwrap();
+                }
+                if let Some(mode) = &onnx_params.execution_mode {
+                    match mode.as_str() {
+                        "parallel" | "Parallel" | "PARALLEL" => {
+                            session_builder = session_builder.with_parallel_execution(true).unwrap();
+                            if let Some(inter_threads) = onnx_params.inter_threads {
+                                session_builder = session_builder.with_inter_threads(inter_threads).unwrap();
+                            }
+                        },
+                        "sequential" | "Sequential" | "SEQUENTIAL" => {
+                            session_builder = session_builder.with_parallel_execution(false).unwrap();
+                        },
+                        mode => {
+                            return Err(format!("Unrecognized execution mode: {}", mode));
                         }
-                    },
-                    "sequential" | "Sequential" | "SEQUENTIAL" => {
-                        session_builder = session_builder.with_parallel_execution(false).unwrap();
-                    },
-                    mode => {
-                        return Err(format!("Unrecognized execution mode: {}", mode));
                     }
                 }
-            }
 
-            if let Some(lib_path) = onnx_params.custom_op_lib_path {
-                log::info!("Loading custom operations lib from: {}", lib_path);
-                session_builder = session_builder.with_custom_op_lib(&lib_path).unwrap();
-            }
+                if let Some(lib_path) = &onnx_params.custom_op_lib_path {
+                    log::info!("Loading custom operations lib from: {}", lib_path);
+                    session_builder = session_builder.with_custom_op_lib(lib_path).unwrap();
+                }
 
-            let session = session_builder.with_model_from_file(model_file_path).unwrap();
+                session_builder.with_model_from_file(model_path)
+                    .map_err(|err| format!("Unable to load the model {}: {}", model_path, err))
+            };
 
-            // Run a first test inference that usually takes more time.
-            // This avoids to add an initial delay to the stream when it arrives, making the session ready
+            // The graph optimizations of the model are cached on disk, so they run only the first time.
+            // Providers that compile the graph (TensorRT, OpenVINO, CoreML) can't serialize the optimized model.
+            let cacheable = matches!(onnx_params.execution_provider.to_lowercase().as_str(), "cpu" | "cuda");
+            let optimized_model_path = if cacheable {
+                super::registry::get_optimized_model_path(&model_file_path, &onnx_params.get_cache_key())
+            } else {
+                None
+            };
+            let session = match optimized_model_path {
+                Some(path) if path.exists() => {
+                    match build_session(&path.to_string_lossy(), ort::GraphOptimizationLevel::Disable, None) {
+                        Ok(session) => {
+                            info!("\t\tLoaded the optimized model from the cache: {}", path.display());
+                            session
+                        },
+                        Err(err) => {
+                            warn!("Invalid optimized model in the cache, optimizing the model again. {}", err);
+                            let _ = std::fs::remove_file(&path);
+                            build_session(&model_file_path, ort::GraphOptimizationLevel::Level3, None)?
+                        }
+                    }
+                },
+                Some(path) => {
+                    // Written to a temporary file first, so a partial write is never loaded
+                    let tmp_path = path.with_extension(format!("{}.tmp", uuid::Uuid::new_v4()));
+                    let session = build_session(&model_file_path, ort::GraphOptimizationLevel::Level3, Some(&tmp_path))?;
+                    if let Err(err) = std::fs::rename(&tmp_path, &path) {
+                        warn!("Unable to store the optimized model in the cache: {}", err);
+                        let _ = std::fs::remove_file(&tmp_path);
+                    }
+                    session
+                },
+                None => build_session(&model_file_path, ort::GraphOptimizationLevel::Level3, None)?,
+            };
+
+            let input_types: Vec<Option<pipeless::data::TensorType>> = session.inputs.iter()
+                .map(|input| {
+                    let input_type = to_tensor_type(input.input_type);
+                    if input_type.is_none() {
+                        warn!("Unsupported type {:?} of the model input '{}'", input.input_type, input.name);
+                    }
+                    input_type
+                })
+                .collect();
             let input0_shape: Vec<Option<usize>> = session.inputs[0].dimensions().map(|x| x).collect();
-            if input0_shape.len() > 2 {
-                // Assuming the conventional input format: batch, channels, height, witdh
-                let batch_shift = if input0_shape.len() > 3 { 1 } else { 0 };
-                let width = input0_shape[2 + batch_shift];
-                let height = input0_shape[1 + batch_shift];
-                let channels = input0_shape[0 + batch_shift];
-                if let (Some(width), Some(height), Some(channels)) = (width, height, channels) {
-                    let test_image = ndarray::Array3::<u8>::zeros((channels, height, width)).into_dyn();
-                    let cow_array = ndarray::CowArray::from(test_image);
-                    let ort_input_value = ort::Value::from_array(
-                        session.allocator(),
-                        &cow_array
-                    ).unwrap();
-                    let _ = session.run(vec![ort_input_value]);
-                } else {
+            let dynamic_batch = input0_shape.len() > 3 && input0_shape[0].is_none();
+
+            let onnx_session = Self { session, input_types, dynamic_batch, input_buffers_pool: Mutex::new(Vec::new()) };
+            onnx_session.warm_up();
+
+            Ok(onnx_session)
+        } else {
+            let err = "Wrong parameters provided to ONNX session";
+            Err(err.to_owned())
+        }
+    }
+}
+
+fn to_tensor_type(element_type: ort::tensor::TensorElementDataType) -> Option<pipeless::data::TensorType> {
+    match element_type {
+        ort::tensor::TensorElementDataType::Uint8 => Some(pipeless::data::TensorType::U8),
+        ort::tensor::TensorElementDataType::Int8 => Some(pipeless::data::TensorType::I8),
+        ort::tensor::TensorElementDataType::Float16 => Some(pipeless::data::TensorType::F16),
+        ort::tensor::TensorElementDataType::Float32 => Some(pipeless::data::TensorType::F32),
+        ort::tensor::TensorElementDataType::Int64 => Some(pipeless::data::TensorType::I64),
+        _ => None,
+    }
+}
+
+/// Tensor borrowed to create an input value of the session
+enum CowTensor<'a> {
+    U8(ndarray::CowArray<'a, u8, ndarray::IxDyn>),
+    I8(ndarray::CowArray<'a, i8, ndarray::IxDyn>),
+    F16(ndarray::CowArray<'a, half::f16, ndarray::IxDyn>),
+    F32(ndarray::CowArray<'a, f32, ndarray::IxDyn>),
+    I64(ndarray::CowArray<'a, i64, ndarray::IxDyn>),
+}
+impl<'a> CowTensor<'a> {
+    /// Borrows the tensor adding the batch axis when required
+    fn new(tensor: &'a pipeless::data::Tensor, add_batch_axis: bool) -> Self {
+        fn cow<T>(array: &ndarray::ArrayD<T>, add_batch_axis: bool) -> ndarray::CowArray<T, ndarray::IxDyn> {
+            let view = array.view();
+            let view = if add_batch_axis { view.insert_axis(ndarray::Axis(0)) } else { view };
+            ndarray::CowArray::from(view)
+        }
+        match tensor {
+            pipeless::data::Tensor::U8(t) => CowTensor::U8(cow(t, add_batch_axis)),
+            pipeless::data::Tensor::I8(t) => CowTensor::I8(cow(t, add_batch_axis)),
+            pipeless::data::Tensor::F16(t) => CowTensor::F16(cow(t, add_batch_axis)),
+            pipeless::data::Tensor::F32(t) => CowTensor::F32(cow(t, add_batch_axis)),
+            pipeless::data::Tensor::I64(t) => CowTensor::I64(cow(t, add_batch_axis)),
+        }
+    }
+
+    fn to_value(&self, allocator: *mut ort::sys::OrtAllocator) -> ort::OrtResult<ort::Value> {
+        match self {
+            CowTensor::U8(array) => ort::Value::from_array(allocator, array),
+            CowTensor::I8(array) => ort::Value::from_array(allocator, array),
+            CowTensor::F16(array) => ort::Value::from_array(allocator, array),
+            CowTensor::F32(array) => ort::Value::from_array(allocator, array),
+            CowTensor::I64(array) => ort::Value::from_array(allocator, array),
+        }
+    }
+}
+
+/// Copies the input of a frame into its position of a batch buffer of the same type
+/// Copies the input of a frame into the batch buffer. When the input includes
+/// the batch axis (of size 1) it is removed before copying.
+fn assign_batch_item(buffer: &mut pipeless::data::Tensor, idx: usize, input: &pipeless::data::Tensor, has_batch_axis: bool) {
+    fn item<T>(input: &ndarray::ArrayD<T>, has_batch_axis: bool) -> ndarray::ArrayViewD<T> {
+        if has_batch_axis { input.index_axis(ndarray::Axis(0), 0) } else { input.view() }
+    }
+    match (buffer, input) {
+        (pipeless::data::Tensor::U8(b), pipeless::data::Tensor::U8(i)) => b.index_axis_mut(ndarray::Axis(0), idx).assign(&item(i, has_batch_axis)),
+        (pipeless::data::Tensor::I8(b), pipeless::data::Tensor::I8(i)) => b.index_axis_mut(ndarray::Axis(0), idx).assign(&item(i, has_batch_axis)),
+        (pipeless::data::Tensor::F16(b), pipeless::data::Tensor::F16(i)) => b.index_axis_mut(ndarray::Axis(0), idx).assign(&item(i, has_batch_axis)),
+        (pipeless::data::Tensor::F32(b), pipeless::data::Tensor::F32(i)) => b.index_axis_mut(ndarray::Axis(0), idx).assign(&item(i, has_batch_axis)),
+        (pipeless::data::Tensor::I64(b), pipeless::data::Tensor::I64(i)) => b.index_axis_mut(ndarray::Axis(0), idx).assign(&item(i, has_batch_axis)),
+        _ => warn!("The batch input buffer type does not match the frame input type"),
+    }
+}
+
+/// Copies an output tensor into an f32 array in a single pass, whatever the numeric type returned by the model
+fn extract_output(output_value: &ort::Value) -> Result<ndarray::ArrayD<f32>, String> {
+    if let Ok(output) = output_value.try_extract::<f32>() {
+        return Ok(output.view().to_owned());
+    }
+    // Sometimes the models do not return floats
+    if let Ok(output) = output_value.try_extract::<i64>() {
+        return Ok(output.view().mapv(|v| v as f32));
+    }
+    if let Ok(output) = output_value.try_extract::<i32>() {
+        return Ok(output.view().mapv(|v| v as f32));
+    }
+    // Half precision and quantized models
+    if let Ok(output) = output_value.try_extract::<half::f16>() {
+        return Ok(output.view().mapv(|v| v.to_f32()));
+    }
+    if let Ok(output) = output_value.try_extract::<u8>() {
+        return Ok(output.view().mapv(|v| v as f32));
+    }
+    match output_value.try_extract::<i8>() {
+        Ok(output) => Ok(output.view().mapv(|v| v as f32)),
+        Err(err) => Err(err.to_string()),
+    }
+}
+
+impl OnnxSession {
+    /// Runs a first test inference, that usually takes more time, with zeroed inputs.
+    /// This avoids to add an initial delay to the stream when it arrives, making the session ready
+    fn warm_up(&self) {
+        let mut inputs = Vec::with_capacity(self.session.inputs.len());
+        for (input, input_type) in self.session.inputs.iter().zip(&self.input_types) {
+            let dimensions: Vec<Option<usize>> = input.dimensions().collect();
+            // The dynamic batch axis is tested with a single item
+            let shape: Option<Vec<usize>> = dimensions.iter().enumerate()
+                .map(|(idx, dim)| if idx == 0 && dimensions.len() > 3 { Some(dim.unwrap_or(1)) } else { *dim })
+                .collect();
+            match (shape, input_type) {
+                (Some(shape), Some(input_type)) => {
+                    inputs.push((input.name.clone(), pipeless::data::Tensor::zeros(*input_type, &shape)));
+                },
+                _ => {
                     warn!(
-                        "Could not run an inference test because the model input shape was not properly recognized. Obtained: width: {:?}, height: {:?}, channels: {:?}",
-                        width.map(|num| num.to_string()).unwrap_or_else(|| "None".to_string()), // Print the number on the option or "None"
-                        height.map(|num| num.to_string()).unwrap_or_else(|| "None".to_string()),
-                        channels.map(|num| num.to_string()).unwrap_or_else(|| "None".to_string())
+                        "Could not run an inference test because the shape or type of the model input '{}' was not properly recognized. Obtained: {:?} {:?}",
+                        input.name, dimensions, input.input_type
                     );
+                    return;
                 }
-            } else {
-                warn!("Could not run an inference test because the model input shape does not contain all the image dimensions");
             }
+        }
+        let inputs = inputs.iter().map(|(name, tensor)| (name.as_str(), CowTensor::new(tensor, false))).collect();
+        if let Err(err) = self.run(inputs) {
+            warn!("The inference test failed: {}", err);
+        }
+    }
 
-            Ok(Self { session })
-        } else {
-            let err = "Wrong parameters provided to ONNX session";
-            Err(err.to_owned())
+    /// Takes a buffer of the provided type and shape from the pool. Allocates a new one when there is none
+    fn acquire_input_buffer(&self, dtype: pipeless::data::TensorType, shape: &[usize]) -> pipeless::data::Tensor {
+        let mut pool = self.input_buffers_pool.lock().unwrap();
+        match pool.iter().position(|buffer| buffer.get_type() == dtype && buffer.shape() == shape) {
+            Some(idx) => pool.swap_remove(idx),
+            None => pipeless::data::Tensor::zeros(dtype, shape),
+        }
+    }
+
+    /// Returns a buffer to the pool so the next inference can re-use it
+    fn release_input_buffer(&self, buffer: pipeless::data::Tensor) {
+        let mut pool = self.input_buffers_pool.lock().unwrap();
+        if pool.len() < MAX_POOLED_INPUT_BUFFERS {
+            pool.push(buffer);
+        }
+    }
+
+    /// Converts the inference input of a frame to the types of the model inputs.
+    /// The returned tensors are borrowed from the frame when the types match.
+    fn prepare_inputs<'a>(
+        &self, inference_input: &'a pipeless::data::InferenceInput
+    ) -> Result<Vec<(&str, std::borrow::Cow<'a, pipeless::data::Tensor>)>, String> {
+        let tensors: Vec<(&str, &pipeless::data::Tensor)> = match inference_input {
+            pipeless::data::InferenceInput::Default(tensor) => vec![(self.session.inputs[0].name.as_str(), tensor)],
+            pipeless::data::InferenceInput::Named(tensors) => {
+                let mut model_tensors = Vec::with_capacity(self.session.inputs.len());
+                for input in &self.session.inputs {
+                    match tensors.get(&input.name) {
+                        Some(tensor) => model_tensors.push((input.name.as_str(), tensor)),
+                        None => return Err(format!("Missing inference input '{}'", input.name)),
+                    }
+                }
+                model_tensors
+            },
+        };
+        Ok(tensors.into_iter().map(|(name, tensor)| {
+            let input_type = self.session.inputs.iter().position(|input| input.name == name)
+                .and_then(|idx| self.input_types[idx]);
+            match input_type {
+                Some(input_type) if input_type != tensor.get_type() => {
+                    (name, std::borrow::Cow::Owned(tensor.to_type(input_type)))
+                },
+                _ => (name, std::borrow::Cow::Borrowed(tensor)),
+            }
+        }).collect())
+    }
+
+    /// Runs the model over the provided inputs, which must already contain the batch axis
+    fn run(&self, inputs: Vec<(&str, CowTensor)>) -> Result<OnnxInferenceOutput, String> {
+        // Use IO bindings for faster data movement between devices
+        let mut io_bindings = self.session.bind().unwrap();
+        for (name, input) in &inputs {
+            let ort_input_value = input.to_value(self.session.allocator())
+                .map_err(|err| format!("There was an error creating the input tensor '{}': {}", name, err))?;
+            io_bindings.bind_input(*name, ort_input_value)
+                .map_err(|err| format!("There was an error binding the input tensor '{}': {}", name, err))?;
         }
+
+        for output in &self.session.outputs {
+            let output_mem_info = ort::MemoryInfo::new(
+                ort::AllocationDevice::CPU, 0, ort::AllocatorType::Device, ort::MemType::Default
+            ).unwrap();
+            let _ = io_bindings.bind_output(output.name.as_str(), output_mem_info).unwrap();
+        }
+        self.session.run_with_binding(&io_bindings)
+            .map_err(|err| format!("There was an error running inference: {}", err))?;
+
+        let outputs = io_bindings.outputs().unwrap();
+        let mut inference_output = OnnxInferenceOutput::new();
+        for (output_name, output_value) in outputs {
+            match extract_output(&output_value) {
+                Ok(output_ndarray) => { inference_output.insert(output_name, output_ndarray); },
+                Err(err) => warn!("Error extracting inference results: {}", err),
+            }
+        }
+
+        Ok(inference_output)
     }
 }
 
 impl super::session::SessionTrait for OnnxSession {
     fn infer(&self, mut frame: pipeless::data::Frame) -> pipeless::data::Frame {
-        // TODO: automatically resize and traspose the input image to the expected by the model
+        // The input image can be resized and transposed natively by defining 'pre_process' in the process.json
+        // The inputs are converted when their types do not match the model input types
 
-        // FIXME: we are forcing users to provide float32 arrays which will produce the inference to fail if the model expects uint values.
+        let inference_result = {
+            let input_data = frame.get_inference_input();
+            if input_data.is_empty() {
+                warn!("No inference input data was provided. Did you forget to add it at your pre-process hook?");
+                return frame;
+            }
 
-        let input_data = frame.get_inference_input().to_owned();
-        if input_data.len() == 0 {
-            warn!("No inference input data was provided. Did you forget to add it at your pre-process hook?");
-            return frame;
+            match self.prepare_inputs(input_data) {
+                Ok(tensors) => {
+                    let inputs = tensors.iter()
+                        .map(|(name, tensor)| {
+                            // Batch with batch size 1 when the input does not include the batch axis
+                            let add_batch_axis = self.session.inputs.iter()
+                                .find(|input| input.name == *name)
+                                .map_or(false, |input| input.dimensions().count() == tensor.shape().len() + 1);
+                            (*name, CowTensor::new(tensor, add_batch_axis))
+                        })
+                        .collect();
+                    self.run(inputs)
+                },
+                Err(err) => Err(err),
+            }
+        };
+        match inference_result {
+            Ok(frame_inference_output) => {
+                frame.set_inference_output(pipeless::data::InferenceOutput::OnnxInferenceOutput(frame_inference_output));
+            },
+            Err(err) => error!("{}", err)
         }
 
-        let input_vec = input_data.view().insert_axis(ndarray::Axis(0)).into_dyn(); // Batch image with batch size 1
-        let cow_array = ndarray::CowArray::from(input_vec);
-        let ort_input_value_result = ort::Value::from_array(
-            self.session.allocator(),
-            &cow_array
-        );
-        match ort_input_value_result {
-            Ok(ort_input_value) => {
-                // Use IO bindings for faster data movement between devices
-                let mut io_bindings = self.session.bind().unwrap();
-                // TODO: support more than one model input
-                let _ = io_bindings.bind_input(self.session.inputs[0].name.as_str(), ort_input_value).unwrap();
-
-                for output in &self.session.outputs {
-                    let output_mem_info = ort::MemoryInfo::new(
-                        ort::AllocationDevice::CPU, 0, ort::AllocatorType::Device, ort::MemType::Default
-                    ).unwrap();
-                    let _ = io_bindings.bind_output(output.name.as_str(), output_mem_info).unwrap();
-                }
-                match self.session.run_with_binding(&io_bindings) {
-                    Ok(()) => {
-                        let outputs = io_bindings.outputs().unwrap();
-                        let mut frame_inference_output = OnnxInferenceOutput::new();
-                        for (output_name, output_value) in outputs {
-                            // FIXME: the extract code is very unelegant. The extract can return several different numric types depending on the model used
-                            //        and there is not a number wrapper that we can apply, so we have to check type by type
-                            match output_value.try_extract() {
-                                Ok(output) => {
-                                    //let output = output.view().map(|v: &_| v.into());
-                                    // FIXME: we can use an arrayview for the inference output instead of owned array base to avoid copying here.
-                                    let output_ndarray = output.view().to_owned();
-                                    frame_inference_output.insert(output_name, output_ndarray);
-                                },
-                                Err(_err) => {
-                                    // Try to convert from i64 since sometimes the models do not return floats
-                                    match output_value.try_extract() {
-                                        Ok(output) => {
-                                            // FIXME: this copies the array twice, first to_owned and then the mapv
-                                            let output_ndarray: ndarray::ArrayBase<ndarray::OwnedRepr<i64>, _> = output.view().to_owned();
-                                            let float_output = output_ndarray.mapv(|v| v as f32);
-                                            frame_inference_output.insert(output_name, float_output);
-                                        }
-                                        Err(_err) => {
-                                            // Try to convert from i64 since sometimes the models do not return floats
-                                            match output_value.try_extract() {
-                                                Ok(output) => {
-                                                    // FIXME: this copies the array twice, first to_owned and then the mapv
-                                                    let output_ndarray: ndarray::ArrayBase<ndarray::OwnedRepr<i32>, _> = output.view().to_owned();
-                                                    let float_output = output_ndarray.mapv(|v| v as f32);
-                                                    frame_inference_output.insert(output_name, float_output);
-                                                }
-                                                Err(err) => warn!("Error extracting inference results: {}", err.to_string()),
-                                            }
-                                        },
-                                    }
-                                }
-                            }
+       frame
+    }
+
+    fn infer_batch(&self, frames: Vec<pipeless::data::Frame>) -> Vec<pipeless::data::Frame> {
+        let batch_size = frames.len();
+        let batched_input = {
+            // Only the frames with a single input tensor are stacked
+            let inputs: Vec<Option<&pipeless::data::Tensor>> = frames.iter()
+                .map(|frame| match frame.get_inference_input() {
+                    pipeless::data::InferenceInput::Default(tensor) => Some(tensor),
+                    pipeless::data::InferenceInput::Named(_) => None,
+                })
+                .collect();
+            let first = inputs[0];
+            let stackable = inputs.iter().all(|input| match (input, first) {
+                (Some(input), Some(first)) => input.len() > 0
+                    && input.get_type() == first.get_type()
+                    && input.shape() == first.shape(),
+                _ => false,
+            });
+            // Like when running a single frame, the inputs may already include the batch axis
+            let model_rank = self.session.inputs[0].dimensions().count();
+            let has_batch_axis = first.map_or(false, |first| first.shape().len() == model_rank);
+            match first {
+                // An input that includes the batch axis can only be stacked when it holds a single item
+                Some(first) if has_batch_axis && first.shape().first() != Some(&1) => None,
+                Some(first) if batch_size > 1 && stackable => {
+                    // Stack the inputs into a pooled buffer to avoid allocating a new one on every batch
+                    let item_shape = if has_batch_axis { &first.shape()[1..] } else { first.shape() };
+                    let mut batch_shape = vec![batch_size];
+                    batch_shape.extend_from_slice(item_shape);
+                    let mut buffer = self.acquire_input_buffer(first.get_type(), &batch_shape);
+                    for (idx, input) in inputs.iter().enumerate() {
+                        if let Some(input) = input {
+                            assign_batch_item(&mut buffer, idx, input, has_batch_axis);
+                        }
+                    }
+                    Some(buffer)
+                },
+                _ => None,
+            }
+        };
+        let batched_input = match batched_input {
+            Some(input) => input,
+            None => {
+                // The frames can't be stacked, run them one by one
+                return frames.into_iter().map(|frame| self.infer(frame)).collect();
+            }
+        };
+
+        let mut frames = frames;
+        let batch_result = {
+            let batched_input = pipeless::data::InferenceInput::Default(batched_input);
+            let result = self.prepare_inputs(&batched_input).and_then(|tensors| {
+                let inputs = tensors.iter().map(|(name, tensor)| (*name, CowTensor::new(tensor, false))).collect();
+                self.run(inputs)
+            });
+            if let pipeless::data::InferenceInput::Default(buffer) = batched_input {
+                self.release_input_buffer(buffer);
+            }
+            result
+        };
+        match batch_result {
+            Ok(outputs) => {
+                // Scatter the batch outputs. Every frame keeps a batch axis of size 1, like when running without batching
+                for (idx, frame) in frames.iter_mut().enumerate() {
+                    let mut frame_inference_output = OnnxInferenceOutput::new();
+                    for (output_name, output) in &outputs {
+                        if output.shape().first() == Some(&batch_size) {
+                            let frame_slice = output.slice_axis(ndarray::Axis(0), ndarray::Slice::from(idx..idx + 1));
+                            frame_inference_output.insert(output_name.clone(), frame_slice.to_owned());
+                        } else {
+                            // Outputs without the batch axis are shared by all the frames
+                            frame_inference_output.insert(output_name.clone(), output.clone());
                         }
-                        frame.set_inference_output(pipeless::data::InferenceOutput::OnnxInferenceOutput(frame_inference_output));
-                    },
-                    Err(err) => error!("There was an error running inference: {}", err)
+                    }
+                    frame.set_inference_output(pipeless::data::InferenceOutput::OnnxInferenceOutput(frame_inference_output));
                 }
             },
-            Err(err) => error!("There was an error creating the input tensor: {}", err)
+            Err(err) => error!("{}", err)
         }
 
-       frame
+        frames
+    }
+
+    fn supports_batching(&self) -> bool {
+        self.dynamic_batch
+    }
+
+    fn get_input_type(&self) -> Option<pipeless::data::TensorType> {
+        self.input_types.first().copied().flatten()
     }
 }
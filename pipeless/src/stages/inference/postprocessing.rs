@@ -0,0 +1,350 @@
+use log::warn;
+
+use crate as pipeless;
+
+/// Name of the inference output that contains the decoded detections
+pub const DETECTIONS_OUTPUT_NAME: &str = "detections";
+/// Max number of candidates sorted by score that are considered for the NMS
+const MAX_NMS_CANDIDATES: usize = 30000;
+
+#[derive(Clone, Copy, PartialEq)]
+pub enum BoxFormat {
+    CenterXywh, // center x, center y, width, height
+    Xyxy, // x1, y1, x2, y2
+}
+impl BoxFormat {
+    pub fn from_str(format_str: &str) -> Option<Self> {
+        match format_str {
+            "xywh" | "cxcywh" => Some(BoxFormat::CenterXywh),
+            "xyxy" => Some(BoxFormat::Xyxy),
+            _ => None,
+        }
+    }
+}
+
+#[derive(Clone, Copy)]
+struct Detection {
+    x1: f32,
+    y1: f32,
+    x2: f32,
+    y2: f32,
+    score: f32,
+    class_id: usize,
+}
+impl Detection {
+    fn area(&self) -> f32 {
+        (self.x2 - self.x1) * (self.y2 - self.y1)
+    }
+    fn iou(&self, other: &Detection) -> f32 {
+        let inter_w = (self.x2.min(other.x2) - self.x1.max(other.x1)).max(0.0);
+        let inter_h = (self.y2.min(other.y2) - self.y1.max(other.y1)).max(0.0);
+        let intersection = inter_w * inter_h;
+        let union = self.area() + other.area() - intersection;
+        if union <= 0.0 { 0.0 } else { intersection / union }
+    }
+}
+
+/// Native decoding of the inference output, defined by the 'post_process' field of the stage process.json.
+/// Decodes the raw output of YOLO-like detection models: confidence thresholding, letterbox un-scaling,
+/// clipping to the frame and non-maximum suppression.
+/// The result replaces the raw output in the inference output with a 'detections' array
+/// of shape (N, 6), where every row is (x1, y1, x2, y2, score, class) in original frame coordinates.
+/// Example:
+///    "post_process": {
+///        "decoder": "yolo",
+///        "output": "output0",
+///        "confidence_threshold": 0.45, "iou_threshold": 0.5,
+///        "num_classes": 80, "box_format": "xywh"
+///    }
+/// Both (1, 4 + classes, candidates) and (1, candidates, 4 + classes) output layouts are supported.
+/// Set "objectness": true for models that provide an objectness score before the class scores.
+pub struct PostProcessParams {
+    output_name: Option<String>, // Defaults to the first output
+    confidence_threshold: f32,
+    iou_threshold: f32,
+    num_classes: Option<usize>, // When not provided it is deduced from the output shape
+    box_format: BoxFormat,
+    objectness: bool,
+    class_agnostic: bool,
+    max_detections: usize,
+}
+impl PostProcessParams {
+    /// Returns None when the post-processing is not defined
+    pub fn from_raw_data(data: &serde_json::Value) -> Result<Option<Self>, String> {
+        if data.is_null() {
+            return Ok(None);
+        }
+        if !data.is_object() {
+            return Err("The 'post_process' field must be an object".to_string());
+        }
+
+        match data["decoder"].as_str() {
+            Some("yolo") => {},
+            Some(other) => return Err(format!("Unsupported post-processing decoder '{}'. Currently supported: yolo", other)),
+            None => return Err("The 'post_process' field requires 'decoder' as a string".to_string()),
+        }
+        let output_name = data["output"].as_str().map(|s| s.to_string());
+        let confidence_threshold = data["confidence_threshold"].as_f64().unwrap_or(0.25) as f32;
+        let iou_threshold = data["iou_threshold"].as_f64().unwrap_or(0.45) as f32;
+        let num_classes = match &data["num_classes"] {
+            serde_json::Value::Null => None,
+            value => match value.as_u64() {
+                Some(n) if n > 0 => Some(n as usize),
+                _ => return Err("'num_classes' must be a positive integer".to_string()),
+            },
+        };
+        let box_format = match data["box_format"].as_str() {
+            Some(format_str) => BoxFormat::from_str(format_str)
+                .ok_or_else(|| format!("Unsupported box format '{}'. Use 'xywh' or 'xyxy'", format_str))?,
+            None => BoxFormat::CenterXywh,
+        };
+        let objectness = data["objectness"].as_bool().unwrap_or(false);
+        let class_agnostic = data["class_agnostic"].as_bool().unwrap_or(false);
+        let max_detections = data["max_detections"].as_u64().unwrap_or(300) as usize;
+
+        Ok(Some(Self {
+            output_name, confidence_threshold, iou_threshold,
+            num_classes, box_format, objectness, class_agnostic, max_detections,
+        }))
+    }
+
+    /// Replaces the raw model output of the frame by the decoded detections
+    pub fn run(&self, frame: &mut pipeless::data::Frame) {
+        let frame_width = frame.get_width() as f32;
+        let frame_height = frame.get_height() as f32;
+        let letterbox = frame.get_letterbox().copied();
+
+        match frame.take_inference_output() {
+            pipeless::data::InferenceOutput::OnnxInferenceOutput(mut outputs) => {
+                let output_name = match &self.output_name {
+                    Some(name) => Some(name.clone()),
+                    // The outputs are a map, so pick the lowest name to be deterministic (ex: output0)
+                    None => outputs.keys().min().cloned(),
+                };
+                if let Some(output_name) = output_name {
+                    match outputs.remove(&output_name) {
+                        Some(raw_output) => {
+                            match self.decode(raw_output.view(), letterbox, frame_width, frame_height) {
+                                Ok(detections) => { outputs.insert(DETECTIONS_OUTPUT_NAME.to_string(), detections); },
+                                Err(err) => {
+                                    warn!("Unable to decode the inference output '{}': {}", output_name, err);
+                                    outputs.insert(output_name, raw_output);
+                                }
+                            }
+                        },
+                        None => warn!("The inference output '{}' to decode does not exist", output_name),
+                    }
+                }
+                frame.set_inference_output(pipeless::data::InferenceOutput::OnnxInferenceOutput(outputs));
+            },
+            pipeless::data::InferenceOutput::Default(raw_output) => {
+                if raw_output.len() == 0 {
+                    // No inference was executed
+                    frame.set_inference_output(pipeless::data::InferenceOutput::Default(raw_output));
+                    return;
+                }
+                match self.decode(raw_output.view(), letterbox, frame_width, frame_height) {
+                    Ok(detections) => frame.set_inference_output(pipeless::data::InferenceOutput::Default(detections)),
+                    Err(err) => {
+                        warn!("Unable to decode the inference output: {}", err);
+                        frame.set_inference_output(pipeless::data::InferenceOutput::Default(raw_output));
+                    }
+                }
+            },
+        }
+    }
+
+    fn decode(
+        &self,
+        raw_output: ndarray::ArrayViewD<f32>,
+        letterbox: Option<pipeless::data::Letterbox>,
+        frame_width: f32, frame_height: f32,
+    ) -> Result<ndarray::ArrayD<f32>, String> {
+        let raw_shape = raw_output.shape().to_vec();
+        // Remove the batch axis
+        let output = match raw_output.ndim() {
+            3 if raw_shape[0] == 1 => raw_output.index_axis_move(ndarray::Axis(0), 0),
+            2 => raw_output,
+            _ => return Err(format!("Unexpected output shape {:?}. Expected (1, attributes, candidates) or (1, candidates, attributes)", raw_shape)),
+        };
+        let output = output.into_dimensionality::<ndarray::Ix2>().map_err(|err| err.to_string())?;
+
+        // Number of values before the class scores
+        let box_attributes = if self.objectness { 5 } else { 4 };
+        let (rows, cols) = output.dim();
+        let attributes_first = match self.num_classes {
+            Some(num_classes) if rows == num_classes + box_attributes => true,
+            Some(num_classes) if cols == num_classes + box_attributes => false,
+            Some(num_classes) => return Err(format!("The output shape {:?} does not match {} classes", raw_shape, num_classes)),
+            // There are always more candidates than attributes
+            None => rows < cols,
+        };
+        // Work on a (attributes, candidates) view so the class scores of every candidate are read row by row
+        let attributes = if attributes_first { output } else { output.reversed_axes() };
+        let (num_attributes, num_candidates) = attributes.dim();
+        if num_attributes <= box_attributes {
+            return Err(format!("The output shape {:?} does not contain class scores", raw_shape));
+        }
+
+        let mut best_scores = vec![f32::NEG_INFINITY; num_candidates];
+        let mut best_classes = vec![0usize; num_candidates];
+        for (class_id, class_scores) in attributes.rows().into_iter().skip(box_attributes).enumerate() {
+            // NaN scores never win the comparison, so they are discarded
+            for ((best_score, best_class), score) in best_scores.iter_mut().zip(best_classes.iter_mut()).zip(class_scores.iter()) {
+                if *score > *best_score {
+                    *best_score = *score;
+                    *best_class = class_id;
+                }
+            }
+        }
+
+        let mut candidates: Vec<Detection> = Vec::new();
+        for idx in 0..num_candidates {
+            let mut score = best_scores[idx];
+            if self.objectness {
+                score *= attributes[[4, idx]];
+            }
+            if !(score >= self.confidence_threshold) {
+                continue;
+            }
+
+            let (a, b, c, d) = (attributes[[0, idx]], attributes[[1, idx]], attributes[[2, idx]], attributes[[3, idx]]);
+            let (mut x1, mut y1, mut x2, mut y2) = match self.box_format {
+                BoxFormat::CenterXywh => (a - c / 2.0, b - d / 2.0, a + c / 2.0, b + d / 2.0),
+                BoxFormat::Xyxy => (a, b, c, d),
+            };
+            if let Some(letterbox) = &letterbox {
+                x1 = (x1 - letterbox.get_pad_x()) / letterbox.get_scale_x();
+                x2 = (x2 - letterbox.get_pad_x()) / letterbox.get_scale_x();
+                y1 = (y1 - letterbox.get_pad_y()) / letterbox.get_scale_y();
+                y2 = (y2 - letterbox.get_pad_y()) / letterbox.get_scale_y();
+            }
+            let detection = Detection {
+                x1: x1.clamp(0.0, frame_width),
+                y1: y1.clamp(0.0, frame_height),
+                x2: x2.clamp(0.0, frame_width),
+                y2: y2.clamp(0.0, frame_height),
+                score, class_id: best_classes[idx],
+            };
+            if detection.x2 > detection.x1 && detection.y2 > detection.y1 {
+                candidates.push(detection);
+            }
+        }
+
+        candidates.sort_unstable_by(|a, b| b.score.partial_cmp(&a.score).unwrap_or(std::cmp::Ordering::Equal));
+        candidates.truncate(MAX_NMS_CANDIDATES);
+        let detections = self.non_max_suppression(&candidates);
+
+        let mut values = Vec::with_capacity(detections.len() * 6);
+        for detection in &detections {
+            values.extend_from_slice(&[
+                detection.x1, detection.y1, detection.x2, detection.y2,
+                detection.score, detection.class_id as f32,
+            ]);
+        }
+        ndarray::Array2::from_shape_vec((detections.len(), 6), values)
+            .map(|arr| arr.into_dyn())
+            .map_err(|err| err.to_string())
+    }
+
+    /// Greedy NMS over candidates sorted by descending score
+    fn non_max_suppression(&self, candidates: &[Detection]) -> Vec<Detection> {
+        let mut kept: Vec<Detection> = Vec::new();
+        let mut suppressed = vec![false; candidates.len()];
+        for i in 0..candidates.len() {
+            if suppressed[i] {
+                continue;
+            }
+            kept.push(candidates[i]);
+            if kept.len() >= self.max_detections {
+                break;
+            }
+            for j in (i + 1)..candidates.len() {
+                if suppressed[j] {
+                    continue;
+                }
+                if !self.class_agnostic && candidates[i].class_id != candidates[j].class_id {
+                    continue;
+                }
+                if candidates[i].iou(&candidates[j]) > self.iou_threshold {
+                    suppressed[j] = true;
+                }
+            }
+        }
+        kept
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn params(data: serde_json::Value) -> PostProcessParams {
+        PostProcessParams::from_raw_data(&data).unwrap().unwrap()
+    }
+
+    fn assert_row(detections: &ndarray::ArrayD<f32>, row: usize, expected: [f32; 6]) {
+        for (value, expected) in detections.index_axis(ndarray::Axis(0), row).iter().zip(expected) {
+            assert!((value - expected).abs() < 1e-4, "row {}: {:?} != {:?}", row, detections.index_axis(ndarray::Axis(0), row), expected);
+        }
+    }
+
+    /// (1, 4 + 2 classes, 4 candidates) output with center xywh boxes
+    fn two_class_output() -> ndarray::ArrayD<f32> {
+        let candidates = [
+            [100.0, 100.0, 50.0, 50.0, 0.9, 0.0],
+            [102.0, 102.0, 50.0, 50.0, 0.8, 0.0], // Overlaps the first one, same class
+            [101.0, 101.0, 50.0, 50.0, 0.0, 0.7], // Overlaps the first one, other class
+            [300.0, 300.0, 20.0, 20.0, 0.1, 0.2], // Under the confidence threshold
+        ];
+        ndarray::Array2::from_shape_fn((6, 4), |(attribute, candidate)| candidates[candidate][attribute])
+            .insert_axis(ndarray::Axis(0))
+            .into_dyn()
+    }
+
+    #[test]
+    fn test_nms_suppresses_overlapping_boxes_of_the_same_class() {
+        let params = params(serde_json::json!({ "decoder": "yolo", "num_classes": 2 }));
+        let detections = params.decode(two_class_output().view(), None, 640.0, 640.0).unwrap();
+        assert_eq!(detections.shape(), &[2, 6]);
+        assert_row(&detections, 0, [75.0, 75.0, 125.0, 125.0, 0.9, 0.0]);
+        assert_row(&detections, 1, [76.0, 76.0, 126.0, 126.0, 0.7, 1.0]);
+    }
+
+    #[test]
+    fn test_class_agnostic_nms() {
+        let params = params(serde_json::json!({ "decoder": "yolo", "num_classes": 2, "class_agnostic": true }));
+        let detections = params.decode(two_class_output().view(), None, 640.0, 640.0).unwrap();
+        assert_eq!(detections.shape(), &[1, 6]);
+        assert_row(&detections, 0, [75.0, 75.0, 125.0, 125.0, 0.9, 0.0]);
+    }
+
+    #[test]
+    fn test_max_detections() {
+        let params = params(serde_json::json!({ "decoder": "yolo", "num_classes": 2, "max_detections": 1 }));
+        let detections = params.decode(two_class_output().view(), None, 640.0, 640.0).unwrap();
+        assert_eq!(detections.shape(), &[1, 6]);
+    }
+
+    #[test]
+    fn test_letterbox_unscaling() {
+        // A 1280x960 frame resized to 640x480 and padded to 640x640
+        let letterbox = pipeless::data::Letterbox::new(0.5, 0.5, 0.0, 80.0);
+        // (1, 2 candidates, 4 + 1 class) output with xyxy boxes
+        let output: ndarray::ArrayD<f32> = ndarray::arr3(&[[
+            [100.0, 180.0, 300.0, 380.0, 0.9],
+            [600.0, 500.0, 700.0, 600.0, 0.8], // Goes beyond the frame once un-scaled
+        ]]).into_dyn();
+        let params = params(serde_json::json!({ "decoder": "yolo", "num_classes": 1, "box_format": "xyxy" }));
+        let detections = params.decode(output.view(), Some(letterbox), 1280.0, 960.0).unwrap();
+        assert_eq!(detections.shape(), &[2, 6]);
+        assert_row(&detections, 0, [200.0, 200.0, 600.0, 600.0, 0.9, 0.0]);
+        assert_row(&detections, 1, [1200.0, 840.0, 1280.0, 960.0, 0.8, 0.0]);
+    }
+
+    #[test]
+    fn test_unexpected_output_shape() {
+        let params = params(serde_json::json!({ "decoder": "yolo", "num_classes": 3 }));
+        assert!(params.decode(two_class_output().view(), None, 640.0, 640.0).is_err());
+    }
+}
@@ -0,0 +1,240 @@
+use log::warn;
+
+use crate as pipeless;
+
+#[derive(Clone, Copy, PartialEq)]
+pub enum Layout {
+    Chw,
+    Hwc,
+}
+impl Layout {
+    pub fn from_str(layout_str: &str) -> Option<Self> {
+        match layout_str {
+            "CHW" | "chw" | "NCHW" | "nchw" => Some(Layout::Chw),
+            "HWC" | "hwc" | "NHWC" | "nhwc" => Some(Layout::Hwc),
+            _ => None,
+        }
+    }
+}
+
+/// Native pre-processing of the inference input, defined by the 'pre_process' field of the stage process.json.
+/// Resizes the original frame (keeping the aspect ratio with letterbox padding when enabled),
+/// normalizes it and changes the layout in a single pass, writing directly into the inference input.
+/// Avoids the need of a pre-process hook for standard models.
+/// Example:
+///    "pre_process": {
+///        "width": 640, "height": 640,
+///        "letterbox": true, "pad_value": 114,
+///        "scale": 0.00392156862745098, "mean": [0, 0, 0], "std": [1, 1, 1],
+///        "layout": "CHW", "dtype": "float32"
+///    }
+/// Every output value is calculated as: (pixel * scale - mean) / std
+/// 'dtype' can be float32, float16, uint8, int8 or int64. When omitted, the type of the model
+/// input is used, so uint8 models get the resized pixels without normalization nor conversions.
+pub struct PreProcessParams {
+    width: usize,
+    height: usize,
+    letterbox: bool,
+    pad_value: f32, // Pixel value (0-255) used for the padding, before normalization
+    // Per channel affine transformation equivalent to (pixel * scale - mean) / std
+    multiplier: [f32; 3],
+    offset: [f32; 3],
+    layout: Layout,
+    dtype: Option<pipeless::data::TensorType>, // None until known from the model input
+}
+impl PreProcessParams {
+    /// Returns None when the pre-processing is not defined
+    pub fn from_raw_data(data: &serde_json::Value) -> Result<Option<Self>, String> {
+        if data.is_null() {
+            return Ok(None);
+        }
+        if !data.is_object() {
+            return Err("The 'pre_process' field must be an object".to_string());
+        }
+
+        let width = data["width"].as_u64()
+            .ok_or_else(|| "The 'pre_process' field requires 'width' as an integer".to_string())? as usize;
+        let height = data["height"].as_u64()
+            .ok_or_else(|| "The 'pre_process' field requires 'height' as an integer".to_string())? as usize;
+        let letterbox = data["letterbox"].as_bool().unwrap_or(true);
+        let pad_value = data["pad_value"].as_f64().unwrap_or(0.0) as f32;
+        let scale = data["scale"].as_f64().unwrap_or(1.0) as f32;
+        let mean = parse_channel_values(&data["mean"], 0.0)
+            .ok_or_else(|| "'mean' must be an array of 3 numbers".to_string())?;
+        let std = parse_channel_values(&data["std"], 1.0)
+            .ok_or_else(|| "'std' must be an array of 3 numbers".to_string())?;
+        if std.iter().any(|s| *s == 0.0) {
+            return Err("'std' values can't be 0".to_string());
+        }
+        let layout = match data["layout"].as_str() {
+            Some(layout_str) => Layout::from_str(layout_str)
+                .ok_or_else(|| format!("Unsupported layout '{}'. Use 'CHW' or 'HWC'", layout_str))?,
+            None => Layout::Chw,
+        };
+        let dtype = match data["dtype"].as_str() {
+            Some(dtype_str) => Some(pipeless::data::TensorType::from_str(dtype_str)
+                .ok_or_else(|| format!("Unsupported pre-processing dtype '{}'. Use float32, float16, uint8, int8 or int64", dtype_str))?),
+            None => None,
+        };
+
+        let mut multiplier = [0.0; 3];
+        let mut offset = [0.0; 3];
+        for c in 0..3 {
+            multiplier[c] = scale / std[c];
+            offset[c] = -mean[c] / std[c];
+        }
+
+        Ok(Some(Self { width, height, letterbox, pad_value, multiplier, offset, layout, dtype }))
+    }
+
+    /// Sets the type of the model input when the dtype was not provided
+    pub fn set_default_dtype(&mut self, dtype: Option<pipeless::data::TensorType>) {
+        if self.dtype.is_none() {
+            self.dtype = dtype;
+        }
+    }
+
+    /// Creates the inference input of the frame from its original pixels
+    pub fn run(&self, frame: &mut pipeless::data::Frame) {
+        let result = {
+            let original = frame.get_original_pixels();
+            // The values are written directly in the final type
+            match self.dtype.unwrap_or(pipeless::data::TensorType::F32) {
+                pipeless::data::TensorType::U8 => self.process(original, |v| v.round().clamp(0.0, 255.0) as u8)
+                    .map(|(out, letterbox)| (pipeless::data::Tensor::U8(out), letterbox)),
+                pipeless::data::TensorType::I8 => self.process(original, |v| v.round().clamp(-128.0, 127.0) as i8)
+                    .map(|(out, letterbox)| (pipeless::data::Tensor::I8(out), letterbox)),
+                pipeless::data::TensorType::F16 => self.process(original, half::f16::from_f32)
+                    .map(|(out, letterbox)| (pipeless::data::Tensor::F16(out), letterbox)),
+                pipeless::data::TensorType::F32 => self.process(original, |v| v)
+                    .map(|(out, letterbox)| (pipeless::data::Tensor::F32(out), letterbox)),
+                pipeless::data::TensorType::I64 => self.process(original, |v| v.round() as i64)
+                    .map(|(out, letterbox)| (pipeless::data::Tensor::I64(out), letterbox)),
+            }
+        };
+        match result {
+            Some((inference_input, letterbox)) => {
+                frame.set_inference_input(pipeless::data::InferenceInput::Default(inference_input));
+                frame.set_letterbox(Some(letterbox));
+            },
+            None => warn!("Unable to pre-process the frame. Only RGB frames are supported"),
+        }
+    }
+
+    fn process<T: Copy>(
+        &self,
+        image: ndarray::ArrayView3<u8>,
+        convert: impl Fn(f32) -> T,
+    ) -> Option<(ndarray::ArrayD<T>, pipeless::data::Letterbox)> {
+        let (src_height, src_width, channels) = image.dim();
+        if channels != 3 || src_height == 0 || src_width == 0 {
+            return None;
+        }
+
+        let (resized_width, resized_height) = if self.letterbox {
+            let ratio = (self.width as f32 / src_width as f32).min(self.height as f32 / src_height as f32);
+            (
+                ((src_width as f32 * ratio).round() as usize).clamp(1, self.width),
+                ((src_height as f32 * ratio).round() as usize).clamp(1, self.height),
+            )
+        } else {
+            (self.width, self.height)
+        };
+        let pad_x = (self.width - resized_width) / 2;
+        let pad_y = (self.height - resized_height) / 2;
+        let scale_x = resized_width as f32 / src_width as f32;
+        let scale_y = resized_height as f32 / src_height as f32;
+
+        // The frames are usually contiguous, so this does not copy
+        let image = image.as_standard_layout();
+        let src = image.as_slice()?;
+
+        let out_shape = match self.layout {
+            Layout::Chw => [3, self.height, self.width],
+            Layout::Hwc => [self.height, self.width, 3],
+        };
+        let pad = [
+            convert(self.pad_value * self.multiplier[0] + self.offset[0]),
+            convert(self.pad_value * self.multiplier[1] + self.offset[1]),
+            convert(self.pad_value * self.multiplier[2] + self.offset[2]),
+        ];
+        let mut out = ndarray::Array3::<T>::from_elem(out_shape, pad[0]);
+        let plane_size = self.height * self.width;
+        // Position of a value in the output buffer
+        let out_idx = |c: usize, y: usize, x: usize| -> usize {
+            match self.layout {
+                Layout::Chw => c * plane_size + y * self.width + x,
+                Layout::Hwc => (y * self.width + x) * 3 + c,
+            }
+        };
+
+        // Bilinear interpolation taps, calculated once per column and row
+        let x_taps = interpolation_taps(src_width, resized_width, scale_x);
+        let y_taps = interpolation_taps(src_height, resized_height, scale_y);
+
+        {
+            let dst = out.as_slice_mut()?;
+            if resized_width != self.width || resized_height != self.height {
+                match self.layout {
+                    Layout::Chw => {
+                        for c in 0..3 {
+                            dst[c * plane_size..(c + 1) * plane_size].fill(pad[c]);
+                        }
+                    },
+                    Layout::Hwc => {
+                        for pixel in dst.chunks_exact_mut(3) {
+                            pixel.copy_from_slice(&pad);
+                        }
+                    },
+                }
+            }
+
+            let src_row_len = src_width * 3;
+            for (oy, &(y0, y1, wy)) in y_taps.iter().enumerate() {
+                let row0 = &src[y0 * src_row_len..(y0 + 1) * src_row_len];
+                let row1 = &src[y1 * src_row_len..(y1 + 1) * src_row_len];
+                for (ox, &(x0, x1, wx)) in x_taps.iter().enumerate() {
+                    for c in 0..3 {
+                        let p00 = row0[x0 * 3 + c] as f32;
+                        let p01 = row0[x1 * 3 + c] as f32;
+                        let p10 = row1[x0 * 3 + c] as f32;
+                        let p11 = row1[x1 * 3 + c] as f32;
+                        let top = p00 + (p01 - p00) * wx;
+                        let bottom = p10 + (p11 - p10) * wx;
+                        let value = top + (bottom - top) * wy;
+                        dst[out_idx(c, pad_y + oy, pad_x + ox)] = convert(value * self.multiplier[c] + self.offset[c]);
+                    }
+                }
+            }
+        }
+
+        let letterbox = pipeless::data::Letterbox::new(scale_x, scale_y, pad_x as f32, pad_y as f32);
+        Some((out.into_dyn(), letterbox))
+    }
+}
+
+fn parse_channel_values(data: &serde_json::Value, default: f32) -> Option<[f32; 3]> {
+    if data.is_null() {
+        return Some([default; 3]);
+    }
+    let values = data.as_array()?;
+    if values.len() != 3 {
+        return None;
+    }
+    let mut out = [default; 3];
+    for (idx, value) in values.iter().enumerate() {
+        out[idx] = value.as_f64()? as f32;
+    }
+    Some(out)
+}
+
+/// For every destination position returns the two source positions to interpolate and the weight of the second one
+fn interpolation_taps(src_len: usize, dst_len: usize, scale: f32) -> Vec<(usize, usize, f32)> {
+    (0..dst_len).map(|dst_pos| {
+        // Align pixel centers
+        let src_pos = ((dst_pos as f32 + 0.5) / scale - 0.5).max(0.0);
+        let pos0 = (src_pos.floor() as usize).min(src_len - 1);
+        let pos1 = (pos0 + 1).min(src_len - 1);
+        (pos0, pos1, src_pos - pos0 as f32)
+    }).collect()
+}
@@ -0,0 +1,106 @@
+use std::{collections::HashMap, fs, path::PathBuf, sync::{Arc, Mutex, Weak}};
+use lazy_static::lazy_static;
+use log::{info, warn};
+
+use crate as pipeless;
+
+/// Directory where the optimized models are cached. Defaults to ~/.cache/pipeless/models
+const MODEL_CACHE_DIR_ENV: &str = "PIPELESS_MODEL_CACHE_DIR";
+
+lazy_static! {
+    /// ONNX Runtime environment shared by all the sessions of the node.
+    /// The sessions that do not configure their own threads run on its global thread pool.
+    static ref ONNX_ENVIRONMENT: Result<Arc<ort::Environment>, String> = ort::Environment::builder()
+        .with_name("pipeless")
+        .with_log_level(ort::LoggingLevel::Warning)
+        .with_global_thread_pool(Default::default())
+        .build()
+        .map(|environment| environment.into_arc())
+        .map_err(|err| format!("Unable to create the ONNX Runtime environment: {}", err));
+    /// Sessions by model and options. Every slot is locked while its session is created,
+    /// so stages loaded concurrently with the same model wait for a single session.
+    static ref ONNX_SESSIONS: Mutex<HashMap<String, Arc<Mutex<Weak<pipeless::stages::inference::onnx::OnnxSession>>>>> = Mutex::new(HashMap::new());
+}
+
+pub fn get_onnx_environment() -> Result<Arc<ort::Environment>, String> {
+    ONNX_ENVIRONMENT.clone()
+}
+
+/// Returns the session of the model, creating it when no other stage uses the same
+/// model with the same options. The session is released when the last stage using it is dropped.
+/// Sessions are keyed by the content of the model file, so a model replaced at the same URI,
+/// for example when reloading a stage, gets a new session.
+/// Stages can opt out of sharing with 'shared_session: false' in the 'inference_params',
+/// for example, for models that keep internal state.
+pub fn get_onnx_session(
+    model_uri: &str,
+    params: pipeless::stages::inference::session::SessionParams,
+) -> Result<Arc<pipeless::stages::inference::onnx::OnnxSession>, String> {
+    let (key, model_file_path) = match &params {
+        pipeless::stages::inference::session::SessionParams::Onnx(onnx_params) if onnx_params.is_shared() => {
+            let model_file_path = pipeless::stages::inference::util::get_model_path(model_uri, onnx_params.get_stage_name())?;
+            let model_hash = hash_model_file(&model_file_path)?;
+            (format!("{:016x}|{}", model_hash, onnx_params.get_cache_key()), model_file_path)
+        },
+        _ => return pipeless::stages::inference::onnx::OnnxSession::new(model_uri, params).map(Arc::new),
+    };
+
+    let slot = {
+        let mut sessions = ONNX_SESSIONS.lock().unwrap();
+        // Remove the slots of released sessions
+        sessions.retain(|_, slot| slot.try_lock().map_or(true, |session| session.strong_count() > 0));
+        sessions.entry(key).or_default().clone()
+    };
+    let mut slot = slot.lock().unwrap();
+    if let Some(session) = slot.upgrade() {
+        info!("\t\tSharing the inference session of the model {}", model_uri);
+        return Ok(session);
+    }
+    // The model was already fetched to compute its hash
+    let session = Arc::new(pipeless::stages::inference::onnx::OnnxSession::new(&format!("file://{}", model_file_path), params)?);
+    *slot = Arc::downgrade(&session);
+    Ok(session)
+}
+
+fn model_cache_dir() -> Option<PathBuf> {
+    let dir = match std::env::var(MODEL_CACHE_DIR_ENV) {
+        Ok(dir) => PathBuf::from(dir),
+        Err(_) => PathBuf::from(std::env::var("HOME").ok()?).join(".cache").join("pipeless").join("models"),
+    };
+    match fs::create_dir_all(&dir) {
+        Ok(()) => Some(dir),
+        Err(err) => {
+            warn!("Unable to create the model cache directory {}: {}", dir.display(), err);
+            None
+        }
+    }
+}
+
+/// 64-bit FNV-1a. Stable across builds, unlike the std hasher, so the cache survives upgrades.
+fn fnv1a(hash: u64, data: &[u8]) -> u64 {
+    data.iter().fold(hash, |hash, byte| (hash ^ *byte as u64).wrapping_mul(0x100000001b3))
+}
+
+/// Hash of the content of a model file
+fn hash_model_file(model_file_path: &str) -> Result<u64, String> {
+    let model = fs::read(model_file_path)
+        .map_err(|err| format!("Unable to read the model {}: {}", model_file_path, err))?;
+    Ok(fnv1a(0xcbf29ce484222325, &model))
+}
+
+/// Path of the optimized version of a model in the cache, keyed by the hash of the model file
+/// and the session options that affect the optimization.
+/// None when the cache can't be used.
+pub fn get_optimized_model_path(model_file_path: &str, options_key: &str) -> Option<PathBuf> {
+    let mut hash = match hash_model_file(model_file_path) {
+        Ok(hash) => hash,
+        Err(err) => {
+            warn!("Unable to look up the model in the model cache. {}", err);
+            return None;
+        }
+    };
+    hash = fnv1a(hash, options_key.as_bytes());
+    // The optimizations change between versions of the runtime
+    hash = fnv1a(hash, env!("CARGO_PKG_VERSION").as_bytes());
+    Some(model_cache_dir()?.join(format!("{:016x}.onnx", hash)))
+}
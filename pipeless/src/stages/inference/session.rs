@@ -1,3 +1,4 @@
+use std::sync::Arc;
 use log::warn;
 
 use crate as pipeless;
@@ -9,10 +10,22 @@ use super::{
 
 pub trait SessionTrait {
     fn infer(&self, frame: pipeless::data::Frame) -> pipeless::data::Frame;
+    /// Runs the inference for several frames at once. Returns the frames in the same order.
+    fn infer_batch(&self, frames: Vec<pipeless::data::Frame>) -> Vec<pipeless::data::Frame> {
+        frames.into_iter().map(|frame| self.infer(frame)).collect()
+    }
+    /// Whether the session model accepts inputs with a batch size bigger than 1
+    fn supports_batching(&self) -> bool {
+        false
+    }
+    /// Element type of the first model input. None when unknown.
+    fn get_input_type(&self) -> Option<pipeless::data::TensorType> {
+        None
+    }
 }
 
 pub enum InferenceSession {
-    Onnx(OnnxSession),
+    Onnx(Arc<OnnxSession>), // Can be shared by several stages
     Openvino(OpenvinoSession)
 }
 impl InferenceSession {
@@ -22,6 +35,24 @@ impl InferenceSession {
             InferenceSession::Openvino(_) => unimplemented!(),
         }
     }
+    pub fn infer_batch(&self, frames: Vec<pipeless::data::Frame>) -> Vec<pipeless::data::Frame> {
+        match self {
+            InferenceSession::Onnx(onnx_session) => onnx_session.infer_batch(frames),
+            InferenceSession::Openvino(_) => unimplemented!(),
+        }
+    }
+    pub fn supports_batching(&self) -> bool {
+        match self {
+            InferenceSession::Onnx(onnx_session) => onnx_session.supports_batching(),
+            InferenceSession::Openvino(_) => false,
+        }
+    }
+    pub fn get_input_type(&self) -> Option<pipeless::data::TensorType> {
+        match self {
+            InferenceSession::Onnx(onnx_session) => onnx_session.get_input_type(),
+            InferenceSession::Openvino(_) => None,
+        }
+    }
 }
 
 pub enum SessionParams {
@@ -43,6 +74,7 @@ impl SessionParams {
                 }
                 let intra_threads = data["intra_threads"].as_i64();
                 let custom_op_lib_path = data["custom_op_lib_path"].as_str();
+                let shared = data["shared_session"].as_bool().unwrap_or(true);
                 SessionParams::Onnx(
                     OnnxSessionParams::new(
                         stage_name,
@@ -50,6 +82,7 @@ impl SessionParams {
                         inter_threads.map(|t| t as i16),
                         intra_threads.map(|t| t as i16),
                         custom_op_lib_path,
+                        shared,
                 ))
             },
             super::runtime::InferenceRuntime::Openvino => unimplemented!(),
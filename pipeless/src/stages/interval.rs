@@ -0,0 +1,349 @@
+use std::{collections::HashMap, sync::Mutex};
+use log::warn;
+
+use crate as pipeless;
+
+/// Min IoU between a detection of the last run and one of the previous run to consider them the same object
+const MIN_MATCH_IOU: f32 = 0.3;
+
+/// How the outputs of a stage are propagated to the frames for which the stage does not run
+#[derive(Clone, Copy, PartialEq)]
+pub enum Propagation {
+    Hold, // Copy the outputs of the last run
+    Linear, // Move the detections of the last run with the velocity observed between the last two runs
+}
+impl Propagation {
+    pub fn from_str(propagation_str: &str) -> Option<Self> {
+        match propagation_str {
+            "hold" => Some(Propagation::Hold),
+            "linear" => Some(Propagation::Linear),
+            _ => None,
+        }
+    }
+}
+
+/// Execution interval of a stage, defined in the stage.json file of the stage.
+/// The stage runs only for some frames of each stream and the frames in between get the
+/// inference output and user data that the stage produced on its last run.
+/// Example:
+///    {
+///        "every_n_frames": 5,
+///        "max_fps": 6,
+///        "propagation": "linear"
+///    }
+/// When both limits are provided the stage runs when both allow it.
+/// With 'linear' propagation the decoded detections (see post_process) are moved
+/// according to their velocity between the last two runs.
+pub struct IntervalParams {
+    every_n_frames: Option<u64>,
+    max_fps: Option<f64>,
+    propagation: Propagation,
+}
+impl IntervalParams {
+    /// Returns None when the stage must run on every frame
+    pub fn from_raw_data(data: &serde_json::Value) -> Result<Option<Self>, String> {
+        if !data.is_object() {
+            return Err("The stage definition must be an object".to_string());
+        }
+        let every_n_frames = match &data["every_n_frames"] {
+            serde_json::Value::Null => None,
+            value => match value.as_u64() {
+                // 1 means every frame
+                Some(n) if n > 0 => if n > 1 { Some(n) } else { None },
+                _ => return Err("'every_n_frames' must be a positive integer".to_string()),
+            },
+        };
+        let max_fps = match &data["max_fps"] {
+            serde_json::Value::Null => None,
+            value => match value.as_f64() {
+                Some(fps) if fps > 0.0 => Some(fps),
+                _ => return Err("'max_fps' must be a positive number".to_string()),
+            },
+        };
+        let propagation = match data["propagation"].as_str() {
+            Some(propagation_str) => Propagation::from_str(propagation_str)
+                .ok_or_else(|| format!("Unsupported propagation '{}'. Use 'hold' or 'linear'", propagation_str))?,
+            None => Propagation::Hold,
+        };
+
+        if every_n_frames.is_none() && max_fps.is_none() {
+            return Ok(None);
+        }
+        Ok(Some(Self { every_n_frames, max_fps, propagation }))
+    }
+}
+
+/// Changes of the user data made by a stage run
+#[derive(Clone)]
+enum UserDataChanges {
+    Unchanged,
+    Replaced(pipeless::data::UserData), // The stage produced a value that is not a dictionary, or its input was not one
+    Entries {
+        set: pipeless::data::UserDataDictionary,
+        removed: Vec<String>,
+    },
+}
+impl UserDataChanges {
+    fn diff(input: &pipeless::data::UserData, output: &pipeless::data::UserData) -> Self {
+        if input == output {
+            return UserDataChanges::Unchanged;
+        }
+        match (input, output) {
+            (pipeless::data::UserData::Dictionary(input), pipeless::data::UserData::Dictionary(output)) => {
+                UserDataChanges::Entries {
+                    set: output.iter()
+                        .filter(|(key, value)| input.get(*key) != Some(*value))
+                        .map(|(key, value)| (key.clone(), value.clone()))
+                        .collect(),
+                    removed: input.keys().filter(|key| !output.contains_key(*key)).cloned().collect(),
+                }
+            },
+            (pipeless::data::UserData::Empty, pipeless::data::UserData::Dictionary(output)) => {
+                UserDataChanges::Entries { set: output.clone(), removed: vec![] }
+            },
+            _ => UserDataChanges::Replaced(output.clone()),
+        }
+    }
+
+    /// Applies the changes over the user data of the frame, keeping the values the stage did not change
+    fn apply(self, user_data: &mut pipeless::data::UserData) {
+        match self {
+            UserDataChanges::Unchanged => {},
+            UserDataChanges::Replaced(value) => *user_data = value,
+            UserDataChanges::Entries { set, removed } => {
+                match user_data {
+                    pipeless::data::UserData::Dictionary(entries) => {
+                        for key in &removed {
+                            entries.shift_remove(key);
+                        }
+                        entries.extend(set);
+                    },
+                    _ => *user_data = pipeless::data::UserData::Dictionary(set),
+                }
+            },
+        }
+    }
+}
+
+/// Outputs of a stage run
+struct StageRun {
+    frame_number: u64,
+    inference_output: pipeless::data::InferenceOutput,
+    user_data_changes: UserDataChanges,
+}
+
+#[derive(Default)]
+struct StreamInterval {
+    next_frame_number: u64, // First frame number for which the stage can run again
+    next_pts: u64, // First timestamp (ns) for which the stage can run again
+    last_run: Option<StageRun>,
+    previous_run: Option<StageRun>,
+}
+
+/// Decides, per stream, which frames go through the stage and carries the outputs
+/// of the last run forward to the rest.
+/// Frames are processed concurrently, so a frame skipped while the run that precedes it is
+/// still in progress gets the outputs of the run before.
+pub struct StageInterval {
+    params: IntervalParams,
+    streams: Mutex<HashMap<uuid::Uuid, StreamInterval>>,
+}
+impl StageInterval {
+    pub fn new(params: IntervalParams) -> Self {
+        Self { params, streams: Mutex::new(HashMap::new()) }
+    }
+
+    /// Returns whether the stage has to run for the frame, reserving the run when it does
+    pub fn should_run(&self, frame: &pipeless::data::Frame) -> bool {
+        let frame_number = *frame.get_frame_number();
+        let pts = frame.get_pts().nseconds();
+        let mut streams = self.streams.lock().unwrap();
+        let stream = streams.entry(*frame.get_pipeline_id()).or_default();
+
+        if frame_number < stream.next_frame_number || pts < stream.next_pts {
+            return false;
+        }
+
+        if let Some(n) = self.params.every_n_frames {
+            stream.next_frame_number = frame_number + n;
+        }
+        if let Some(fps) = self.params.max_fps {
+            stream.next_pts = pts + (1_000_000_000.0 / fps) as u64;
+        }
+        true
+    }
+
+    /// Keeps the outputs of a frame for which the stage ran.
+    /// Only the user data that the stage changed from its input is kept.
+    pub fn store_outputs(&self, frame: &pipeless::data::Frame, input_user_data: &pipeless::data::UserData) {
+        let frame_number = *frame.get_frame_number();
+        let mut streams = self.streams.lock().unwrap();
+        let stream = streams.entry(*frame.get_pipeline_id()).or_default();
+        if stream.last_run.as_ref().map_or(false, |run| run.frame_number >= frame_number) {
+            // A later run already finished
+            return;
+        }
+        let run = StageRun {
+            frame_number,
+            inference_output: frame.get_inference_output().clone(),
+            user_data_changes: UserDataChanges::diff(input_user_data, frame.get_user_data()),
+        };
+        stream.previous_run = stream.last_run.replace(run);
+    }
+
+    /// Sets the outputs of the last run on a frame for which the stage did not run
+    pub fn apply_outputs(&self, frame: &mut pipeless::data::Frame) {
+        let frame_number = *frame.get_frame_number();
+        let frame_width = frame.get_width() as f32;
+        let frame_height = frame.get_height() as f32;
+        let (mut inference_output, user_data_changes, motion) = {
+            let streams = self.streams.lock().unwrap();
+            let stream = match streams.get(frame.get_pipeline_id()) {
+                Some(stream) => stream,
+                None => return,
+            };
+            let last_run = match &stream.last_run {
+                Some(last_run) => last_run,
+                None => return, // The stage did not finish any run yet for the stream
+            };
+            let motion = match (self.params.propagation, &stream.previous_run) {
+                (Propagation::Linear, Some(previous_run)) if frame_number > last_run.frame_number => {
+                    let elapsed = (frame_number - last_run.frame_number) as f32;
+                    let run_distance = (last_run.frame_number - previous_run.frame_number) as f32;
+                    get_detections(&previous_run.inference_output)
+                        .map(|previous_detections| (previous_detections.to_owned(), elapsed / run_distance))
+                },
+                _ => None,
+            };
+            (last_run.inference_output.clone(), last_run.user_data_changes.clone(), motion)
+        };
+
+        if let Some((previous_detections, step)) = motion {
+            if let Some(detections) = get_detections_mut(&mut inference_output) {
+                extrapolate_detections(detections, previous_detections.view(), step, frame_width, frame_height);
+            }
+        }
+        frame.set_inference_output(inference_output);
+        // The values written by the previous stages for this frame are kept
+        let mut user_data = frame.get_user_data().clone();
+        user_data_changes.apply(&mut user_data);
+        frame.set_user_data(user_data);
+    }
+
+    /// Removes the data of a stream that ended
+    pub fn forget(&self, pipeline_id: &uuid::Uuid) {
+        self.streams.lock().unwrap().remove(pipeline_id);
+    }
+}
+
+/// Returns the decoded detections of an inference output, with shape (N, 6)
+fn get_detections(inference_output: &pipeless::data::InferenceOutput) -> Option<ndarray::ArrayView2<f32>> {
+    let detections = match inference_output {
+        pipeless::data::InferenceOutput::Default(output) => output,
+        pipeless::data::InferenceOutput::OnnxInferenceOutput(outputs) =>
+            outputs.get(pipeless::stages::inference::postprocessing::DETECTIONS_OUTPUT_NAME)?,
+    };
+    detections.view().into_dimensionality::<ndarray::Ix2>().ok()
+        .filter(|detections| detections.ncols() == 6)
+}
+
+fn get_detections_mut(inference_output: &mut pipeless::data::InferenceOutput) -> Option<ndarray::ArrayViewMut2<f32>> {
+    let detections = match inference_output {
+        pipeless::data::InferenceOutput::Default(output) => output,
+        pipeless::data::InferenceOutput::OnnxInferenceOutput(outputs) =>
+            outputs.get_mut(pipeless::stages::inference::postprocessing::DETECTIONS_OUTPUT_NAME)?,
+    };
+    detections.view_mut().into_dimensionality::<ndarray::Ix2>().ok()
+        .filter(|detections| detections.ncols() == 6)
+}
+
+fn iou(a: ndarray::ArrayView1<f32>, b: ndarray::ArrayView1<f32>) -> f32 {
+    let inter_w = (a[2].min(b[2]) - a[0].max(b[0])).max(0.0);
+    let inter_h = (a[3].min(b[3]) - a[1].max(b[1])).max(0.0);
+    let intersection = inter_w * inter_h;
+    let union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection;
+    if union <= 0.0 { 0.0 } else { intersection / union }
+}
+
+/// Moves every detection of the last run by its displacement from the matching detection
+/// of the previous run, scaled by step. Detections are matched greedily by class and IoU,
+/// the ones without a match are held in place.
+fn extrapolate_detections(
+    mut detections: ndarray::ArrayViewMut2<f32>,
+    previous_detections: ndarray::ArrayView2<f32>,
+    step: f32,
+    frame_width: f32, frame_height: f32,
+) {
+    if !step.is_finite() {
+        warn!("Unable to extrapolate detections, invalid step");
+        return;
+    }
+    let mut candidates = vec![];
+    for (i, detection) in detections.rows().into_iter().enumerate() {
+        for (j, previous) in previous_detections.rows().into_iter().enumerate() {
+            if detection[5] != previous[5] {
+                continue;
+            }
+            let overlap = iou(detection, previous);
+            if overlap >= MIN_MATCH_IOU {
+                candidates.push((overlap, i, j));
+            }
+        }
+    }
+    candidates.sort_by(|a, b| b.0.total_cmp(&a.0));
+
+    let mut matched = vec![false; detections.nrows()];
+    let mut previous_matched = vec![false; previous_detections.nrows()];
+    for (_, i, j) in candidates {
+        if matched[i] || previous_matched[j] {
+            continue;
+        }
+        matched[i] = true;
+        previous_matched[j] = true;
+        let previous = previous_detections.row(j);
+        let mut detection = detections.row_mut(i);
+        for coord in 0..4 {
+            let limit = if coord % 2 == 0 { frame_width } else { frame_height };
+            let moved = detection[coord] + (detection[coord] - previous[coord]) * step;
+            detection[coord] = moved.clamp(0.0, limit);
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use pipeless::data::UserData;
+
+    fn dict(entries: Vec<(&str, UserData)>) -> UserData {
+        UserData::Dictionary(entries.into_iter().map(|(key, value)| (key.to_string(), value)).collect())
+    }
+
+    #[test]
+    fn test_carried_user_data_keeps_upstream_values() {
+        // The stage added 'plates' to the data of the previous stages
+        let input = dict(vec![("detections", UserData::Integer(1)), ("stale", UserData::Bool(true))]);
+        let output = dict(vec![("detections", UserData::Integer(1)), ("plates", UserData::Integer(2))]);
+        let changes = UserDataChanges::diff(&input, &output);
+
+        // The previous stages wrote new values for a later frame
+        let mut user_data = dict(vec![("detections", UserData::Integer(5)), ("stale", UserData::Bool(true))]);
+        changes.apply(&mut user_data);
+        assert!(user_data == dict(vec![("detections", UserData::Integer(5)), ("plates", UserData::Integer(2))]));
+    }
+
+    #[test]
+    fn test_carried_user_data_unchanged_and_replaced() {
+        let input = dict(vec![("detections", UserData::Integer(1))]);
+        let mut user_data = dict(vec![("detections", UserData::Integer(5))]);
+        UserDataChanges::diff(&input, &input).apply(&mut user_data);
+        assert!(user_data == dict(vec![("detections", UserData::Integer(5))]));
+
+        UserDataChanges::diff(&input, &UserData::String("done".to_string())).apply(&mut user_data);
+        assert!(user_data == UserData::String("done".to_string()));
+
+        let mut user_data = UserData::Empty;
+        UserDataChanges::diff(&UserData::Empty, &input).apply(&mut user_data);
+        assert!(user_data == input);
+    }
+}
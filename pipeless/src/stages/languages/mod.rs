@@ -1,3 +1,4 @@
 pub mod language;
 pub mod python;
+pub mod python_workers;
 pub mod rust;
\ No newline at end of file
@@ -1,151 +1,444 @@
 use std::collections::HashMap;
-use log::{error, warn};
-use pyo3::{PyObject, prelude::*};
-use numpy::{self, ToPyArray};
+use log::{debug, error, warn};
+use pyo3::{PyObject, prelude::*, types::IntoPyDict};
+use numpy;
 
-use crate::{data::{Frame, InferenceOutput, RgbFrame, UserData}, kvs::store, stages::{hook::{HookTrait, HookType}, stage::{Context, ContextTrait}}};
+use crate::{data::{Frame, InferenceInput, InferenceOutput, RgbFrame, Tensor, UserData, UserDataDictionary}, kvs::store, stages::{hook::{HookTrait, HookType}, inference::onnx::OnnxInferenceOutput, stage::{Context, ContextTrait}}};
 
-/// Allows a Frame to be converted from Rust to Python
-impl IntoPy<Py<PyAny>> for Frame {
-    fn into_py(self, py: Python) -> Py<PyAny> {
-        match self {
-            Frame::RgbFrame(frame) => frame.into_py(py),
+/// Keys that can be accessed on the frame from the Python hooks
+const FRAME_KEYS: &[&str] = &[
+    "uuid", "original", "modified", "width", "height",
+    "pts", "dts", "duration", "fps", "input_ts",
+    "inference_input", "inference_output",
+    "pipeline_id", "user_data", "frame_number", "letterbox",
+];
+
+/// Frame provided to the Python hooks. Exposed to Python as `pipeless.Frame`.
+/// It can be used as a dict, however, the frame buffers are not copied. They are
+/// provided to NumPy as views of the Rust frame data, so the hooks can modify
+/// 'modified' in place. 'original' is provided as a read-only view.
+/// When the hook returns, only the fields assigned by the hook are converted back.
+#[pyclass(name = "Frame", module = "pipeless")]
+pub struct PyFrame {
+    frame: Option<RgbFrame>,
+    // Objects already provided to the hook, so accessing a key twice returns the same object
+    views: HashMap<String, PyObject>,
+    // Objects assigned by the hook. Only the frame fields are converted back to Rust
+    assigned: HashMap<String, PyObject>,
+    // View provided for each inference output. Used to find the outputs replaced by the hook
+    output_views: HashMap<String, PyObject>,
+    // View provided for each named inference input. Used to find the inputs replaced by the hook
+    input_views: HashMap<String, PyObject>,
+}
+
+/// Changes done by a hook to the inference input of a frame
+enum InferenceInputUpdate {
+    Default(Tensor),
+    // None means the input was not replaced, so the existing Rust tensor is kept
+    Named(Vec<(String, Option<Tensor>)>),
+}
+
+/// Changes done by a hook to the inference output of a frame
+enum InferenceOutputUpdate {
+    Default(ndarray::ArrayBase<ndarray::OwnedRepr<f32>, ndarray::Dim<ndarray::IxDynImpl>>),
+    // None means the output was not replaced, so the existing Rust array is kept
+    Onnx(Vec<(String, Option<ndarray::ArrayBase<ndarray::OwnedRepr<f32>, ndarray::Dim<ndarray::IxDynImpl>>>)>),
+}
+
+fn is_same_object(view: Option<&PyObject>, obj: &PyObject) -> bool {
+    view.map_or(false, |v| v.is(obj))
+}
+
+/// Provides a tensor to Python as a NumPy view of the Rust data
+///
+/// SAFETY: the container must keep the tensor alive while the view exists
+unsafe fn borrow_tensor(py: Python, tensor: &Tensor, container: &PyAny) -> PyObject {
+    match tensor {
+        Tensor::U8(t) => numpy::PyArrayDyn::<u8>::borrow_from_array(t, container).into_py(py),
+        Tensor::I8(t) => numpy::PyArrayDyn::<i8>::borrow_from_array(t, container).into_py(py),
+        Tensor::F16(t) => numpy::PyArrayDyn::<half::f16>::borrow_from_array(t, container).into_py(py),
+        Tensor::F32(t) => numpy::PyArrayDyn::<f32>::borrow_from_array(t, container).into_py(py),
+        Tensor::I64(t) => numpy::PyArrayDyn::<i64>::borrow_from_array(t, container).into_py(py),
+    }
+}
+
+/// Converts a NumPy array into a tensor keeping its dtype.
+/// Other float arrays are converted to float32 and other integer arrays to int64.
+fn extract_tensor(obj: &PyAny) -> PyResult<Tensor> {
+    let array = obj.downcast::<numpy::PyUntypedArray>().map_err(|_| {
+        pyo3::exceptions::PyTypeError::new_err("Unable to obtain data from 'inference_input'. Is it a NumPy array or a dict of NumPy arrays by model input name?")
+    })?;
+    if let Ok(arr) = array.downcast::<numpy::PyArrayDyn<f32>>() {
+        return Ok(Tensor::F32(arr.to_owned_array()));
+    }
+    if let Ok(arr) = array.downcast::<numpy::PyArrayDyn<u8>>() {
+        return Ok(Tensor::U8(arr.to_owned_array()));
+    }
+    if let Ok(arr) = array.downcast::<numpy::PyArrayDyn<i8>>() {
+        return Ok(Tensor::I8(arr.to_owned_array()));
+    }
+    if let Ok(arr) = array.downcast::<numpy::PyArrayDyn<half::f16>>() {
+        return Ok(Tensor::F16(arr.to_owned_array()));
+    }
+    if let Ok(arr) = array.downcast::<numpy::PyArrayDyn<i64>>() {
+        return Ok(Tensor::I64(arr.to_owned_array()));
+    }
+
+    let dtype = match array.dtype().kind() {
+        b'f' => "float32",
+        b'i' | b'u' | b'b' => "int64",
+        kind => return Err(pyo3::exceptions::PyTypeError::new_err(format!(
+            "Unsupported NumPy array kind '{}' for 'inference_input'. Use uint8, int8, float16, float32 or int64 arrays.", kind as char
+        ))),
+    };
+    extract_tensor(array.call_method1("astype", (dtype,))?)
+}
+
+fn extract_inference_input(
+    py: Python,
+    obj: &PyObject,
+    view: Option<&PyObject>,
+    input_views: &HashMap<String, PyObject>,
+) -> PyResult<Option<InferenceInputUpdate>> {
+    let obj_ref = obj.as_ref(py);
+    if let Ok(dict) = obj_ref.downcast::<pyo3::types::PyDict>() {
+        let mut inputs = Vec::new();
+        for (key, value) in dict.iter() {
+            let key_str = key.extract::<String>()?;
+            if input_views.get(&key_str).map_or(false, |v| v.as_ref(py).is(value)) {
+                // Not replaced by the hook. In-place changes are already on the Rust tensor
+                inputs.push((key_str, None));
+                continue;
+            }
+            inputs.push((key_str, Some(extract_tensor(value)?)));
         }
+        Ok(Some(InferenceInputUpdate::Named(inputs)))
+    } else if is_same_object(view, obj) {
+        // The view was modified in place, nothing to convert
+        Ok(None)
+    } else {
+        Ok(Some(InferenceInputUpdate::Default(extract_tensor(obj_ref)?)))
     }
 }
-/// Allows the Frame to be converted from Python to Rust
-impl<'source> FromPyObject<'source> for Frame {
-    fn extract(ob: &'source PyAny) -> PyResult<Self> {
-        match RgbFrame::extract(ob) {
-            Ok(frame) => Ok(Frame::RgbFrame(frame)),
-            Err(err) => {
-                error!("Unable to convert Python object to any known Frame variant {}", err);
-                Err(err)
+
+fn extract_inference_output(
+    py: Python,
+    obj: &PyObject,
+    view: Option<&PyObject>,
+    output_views: &HashMap<String, PyObject>,
+) -> PyResult<Option<InferenceOutputUpdate>> {
+    let obj_ref = obj.as_ref(py);
+    if let Ok(dict) = obj_ref.downcast::<pyo3::types::PyDict>() {
+        let mut outputs = Vec::new();
+        for (key, value) in dict.iter() {
+            let key_str = key.extract::<String>()?;
+            if output_views.get(&key_str).map_or(false, |v| v.as_ref(py).is(value)) {
+                // Not replaced by the hook. In-place changes are already on the Rust array
+                outputs.push((key_str, None));
+                continue;
             }
+            let array = match value.extract::<&numpy::PyArrayDyn<f32>>() {
+                Ok(v) => v.to_owned_array(),
+                Err(err) => {
+                    warn!("Could not downcast Python object to PyArray. {}. Is it a NumPy array of float values? Hint: use .astype('float32') in your Python code", err.to_string());
+                    ndarray::ArrayBase::zeros(ndarray::IxDyn(&[]))
+                }
+            };
+            outputs.push((key_str, Some(array)));
         }
+        Ok(Some(InferenceOutputUpdate::Onnx(outputs)))
+    } else if is_same_object(view, obj) {
+        // The view was modified in place, nothing to convert
+        Ok(None)
+    } else if let Ok(array) = obj_ref.extract::<&numpy::PyArrayDyn<f32>>() {
+        Ok(Some(InferenceOutputUpdate::Default(array.to_owned_array())))
+    } else {
+        warn!("Unable to obtain data from 'inference_output'. Ensure it is either a dict of numpy arrays of float32 values or a NumPy array of float32 values. Hint: use .astype('float32') in your Python code");
+        Ok(Some(InferenceOutputUpdate::Default(ndarray::ArrayBase::zeros(ndarray::IxDyn(&[0])))))
     }
 }
-/// Allows the RgbFrame variant of Frame to be converted from Rust to Python
-impl IntoPy<Py<PyAny>> for RgbFrame {
-    fn into_py(mut self, py: Python) -> Py<PyAny> {
-        let dict = pyo3::types::PyDict::new(py);
-        dict.set_item("uuid", self.get_uuid().to_string()).unwrap();
-        dict.set_item("original", self.get_original_pixels().to_pyarray(py)).unwrap();
-        dict.set_item("modified", self.get_modified_pixels().to_pyarray(py)).unwrap();
-        dict.set_item("width", self.get_width()).unwrap();
-        dict.set_item("height", self.get_height()).unwrap();
-        dict.set_item("pts", self.get_pts().mseconds()).unwrap();
-        dict.set_item("dts", self.get_dts().mseconds()).unwrap();
-        dict.set_item("duration", self.get_duration().mseconds()).unwrap();
-        dict.set_item("fps", self.get_fps()).unwrap();
-        dict.set_item("input_ts", self.get_input_ts()).unwrap();
-        dict.set_item("inference_input", self.get_inference_input().to_pyarray(py)).unwrap();
-        match self.get_inference_output() {
-            crate::data::InferenceOutput::Default(out) => {
-                dict.set_item("inference_output", out.to_pyarray(py)).unwrap();
+
+impl PyFrame {
+    pub fn new(frame: Frame) -> Self {
+        match frame {
+            Frame::RgbFrame(frame) => Self {
+                frame: Some(frame),
+                views: HashMap::new(),
+                assigned: HashMap::new(),
+                output_views: HashMap::new(),
+                input_views: HashMap::new(),
+            }
+        }
+    }
+
+    fn get_field(slf: &PyCell<Self>, key: &str) -> PyResult<PyObject> {
+        let py = slf.py();
+        let container: &PyAny = slf.as_ref();
+        let mut this = slf.try_borrow_mut()?;
+        let PyFrame { frame, views, assigned, output_views, input_views } = &mut *this;
+        if let Some(obj) = assigned.get(key).or_else(|| views.get(key)) {
+            return Ok(obj.clone_ref(py));
+        }
+
+        let frame = frame.as_mut().ok_or_else(|| {
+            pyo3::exceptions::PyRuntimeError::new_err("The frame is no longer available. Frames can't be used after the hook returns")
+        })?;
+        // SAFETY: the NumPy arrays use the Python frame as base object, so the Rust frame
+        // is alive as long as any view is alive. The Rust buffers are never replaced
+        // while there are views pointing to them. See PyFrame::into_frame.
+        let obj: PyObject = match key {
+            "uuid" => frame.get_uuid().to_string().into_py(py),
+            "original" => {
+                let view = unsafe {
+                    numpy::PyArray3::<u8>::borrow_from_array(&frame.get_original_pixels(), container)
+                };
+                // Avoid the user to accidentally modify the original frame
+                view.call_method("setflags", (), Some([("write", false)].into_py_dict(py)))?;
+                view.into_py(py)
             },
-            crate::data::InferenceOutput::OnnxInferenceOutput(out) => {
-                let out_dict = pyo3::types::PyDict::new(py);
-                for (key, value) in out {
-                    out_dict.set_item(key, value.to_pyarray(py)).unwrap();
-                }
-                dict.set_item("inference_output", out_dict).unwrap();
+            "modified" => unsafe {
+                numpy::PyArray3::<u8>::borrow_from_array(&frame.get_modified_pixels(), container)
+            }.into_py(py),
+            "width" => frame.get_width().into_py(py),
+            "height" => frame.get_height().into_py(py),
+            "pts" => frame.get_pts().mseconds().into_py(py),
+            "dts" => frame.get_dts().mseconds().into_py(py),
+            "duration" => frame.get_duration().mseconds().into_py(py),
+            "fps" => frame.get_fps().into_py(py),
+            "input_ts" => frame.get_input_ts().into_py(py),
+            "inference_input" => match frame.get_inference_input() {
+                InferenceInput::Default(tensor) => unsafe { borrow_tensor(py, tensor, container) },
+                InferenceInput::Named(tensors) => {
+                    let in_dict = pyo3::types::PyDict::new(py);
+                    for (in_name, in_value) in tensors {
+                        let view = unsafe { borrow_tensor(py, in_value, container) };
+                        in_dict.set_item(in_name, view.clone_ref(py))?;
+                        input_views.insert(in_name.clone(), view);
+                    }
+                    in_dict.into_py(py)
+                },
+            },
+            "inference_output" => match frame.get_inference_output() {
+                InferenceOutput::Default(out) => unsafe {
+                    numpy::PyArrayDyn::<f32>::borrow_from_array(out, container)
+                }.into_py(py),
+                InferenceOutput::OnnxInferenceOutput(out) => {
+                    let out_dict = pyo3::types::PyDict::new(py);
+                    for (out_name, out_value) in out {
+                        let view: PyObject = unsafe {
+                            numpy::PyArrayDyn::<f32>::borrow_from_array(out_value, container)
+                        }.into_py(py);
+                        out_dict.set_item(out_name, view.clone_ref(py))?;
+                        output_views.insert(out_name.clone(), view);
+                    }
+                    out_dict.into_py(py)
+                },
             },
+            "pipeline_id" => frame.get_pipeline_id().to_string().into_py(py),
+            "user_data" => frame.get_user_data().to_object(py),
+            "frame_number" => (*frame.get_frame_number()).into_py(py),
+            // Transformation applied by the native pre-processing. None when not used.
+            "letterbox" => match frame.get_letterbox() {
+                Some(letterbox) => [
+                    ("scale_x", letterbox.get_scale_x()),
+                    ("scale_y", letterbox.get_scale_y()),
+                    ("pad_x", letterbox.get_pad_x()),
+                    ("pad_y", letterbox.get_pad_y()),
+                ].into_py_dict(py).into_py(py),
+                None => py.None(),
+            },
+            _ => return Err(pyo3::exceptions::PyKeyError::new_err(key.to_string())),
         };
+        views.insert(key.to_string(), obj.clone_ref(py));
 
-        dict.set_item("pipeline_id", self.get_pipeline_id().to_string()).unwrap();
-        dict.set_item("user_data", self.get_user_data()).unwrap();
-        dict.set_item("frame_number", self.get_frame_number()).unwrap();
-        dict.into()
+        Ok(obj)
     }
-}
 
-// Allows the RgbFrame variant of Frame to be converted from Python to Rust
-impl<'source> FromPyObject<'source> for RgbFrame {
-    fn extract(ob: &'source PyAny) -> PyResult<Self> {
-        let original_py_array: &numpy::PyArray3<u8> = ob.get_item("original")?.downcast::<numpy::PyArray3<u8>>()?;
-        let original_ndarray: ndarray::Array3<u8> = original_py_array.to_owned_array();
-        let modified_py_array: &numpy::PyArray3<u8> = ob.get_item("modified")?.downcast::<numpy::PyArray3<u8>>()?;
-        let modified_ndarray: ndarray::Array3<u8> = modified_py_array.to_owned_array();
-
-        // TODO: support several inference inputs like for the runtimes. See how we use the inference output below
-        let inference_input_ndarray: ndarray::ArrayBase<_, ndarray::Dim<ndarray::IxDynImpl>>;
-        if let Ok(inference_input_py_array) = ob.get_item("inference_input")?.extract() {
-            let inference_input_py_array: &numpy::PyArrayDyn<f32> = inference_input_py_array;
-            inference_input_ndarray = inference_input_py_array.to_owned_array().into_dyn();
-        } else {
-            return Err(PyErr::new::<pyo3::exceptions::PyTypeError, _>("Unable to obtain data from 'inference_input'. Is it a NumPy array of float values? Hint: use .astype('float32') in your Python code"));
-        }
+    /// Recovers the Rust frame after the hook execution.
+    /// Only the fields assigned by the hook are converted back, the changes
+    /// done in place on the views are already on the Rust buffers.
+    /// If the hook kept references to the views (ex: stored them in the stage context)
+    /// the frame is copied, so those views keep pointing to valid memory.
+    pub fn into_frame(py_frame: Py<PyFrame>, py: Python) -> PyResult<Frame> {
+        let (views, assigned, output_views, input_views) = {
+            let mut this = py_frame.try_borrow_mut(py)?;
+            (
+                std::mem::take(&mut this.views),
+                std::mem::take(&mut this.assigned),
+                std::mem::take(&mut this.output_views),
+                std::mem::take(&mut this.input_views),
+            )
+        };
 
-        let inference_output = if ob.get_item("inference_output")?.is_instance_of::<pyo3::types::PyDict>() {
-            let dict = ob.get_item("inference_output")?.downcast::<pyo3::types::PyDict>()?;
-            let dict_keys = dict.keys();
-            let mut dict_items = HashMap::new();
-            for key in dict_keys {
-                let key_str = key.extract::<String>()?;
-                let value = dict.get_item(key)?;
-                match value {
-                    Some(v) => {
-                        let array = match v.extract::<&numpy::PyArray<f32, ndarray::Dim<ndarray::IxDynImpl>>>() {
-                            Ok(v) => {
-                                let inference_output_ndarray: ndarray::ArrayBase<_, ndarray::Dim<ndarray::IxDynImpl>> = v.to_owned_array().into_dyn();
-                                inference_output_ndarray
-                            },
-                            Err(err) => {
-                                warn!("Could not downcast Python object to PyArray. {}. Is it a NumPy array of float values? Hint: use .astype('float32') in your Python code", err.to_string());
-                                ndarray::ArrayBase::zeros(ndarray::IxDyn(&[]))
+        let modified = match assigned.get("modified") {
+            Some(obj) if !is_same_object(views.get("modified"), obj) => {
+                let array = obj.as_ref(py).downcast::<numpy::PyArray3<u8>>()?;
+                Some(array.to_owned_array())
+            },
+            _ => None,
+        };
+        let inference_input = match assigned.get("inference_input").or_else(|| views.get("inference_input")) {
+            Some(obj) => extract_inference_input(py, obj, views.get("inference_input"), &input_views)?,
+            None => None,
+        };
+        let inference_output = match assigned.get("inference_output").or_else(|| views.get("inference_output")) {
+            Some(obj) => extract_inference_output(py, obj, views.get("inference_output"), &output_views)?,
+            None => None,
+        };
+        // The user data can be modified in place (ex: appending to a list), so it is converted back when accessed
+        let user_data = match assigned.get("user_data").or_else(|| views.get("user_data")) {
+            Some(obj) => Some(UserData::extract(obj.as_ref(py))?),
+            None => None,
+        };
+
+        // Release the views so the only remaining reference to the Python frame is ours
+        drop(views);
+        drop(assigned);
+        drop(output_views);
+        drop(input_views);
+
+        let mut frame = {
+            let mut this = py_frame.try_borrow_mut(py)?;
+            let frame = if py_frame.get_refcnt(py) == 1 {
+                this.frame.take()
+            } else {
+                debug!("The Python hook kept references to the frame, copying the frame");
+                this.frame.clone()
+            };
+            frame.ok_or_else(|| {
+                pyo3::exceptions::PyRuntimeError::new_err("The frame was already taken from the Python frame")
+            })?
+        };
+
+        if let Some(modified) = modified {
+            frame.set_modified_pixels(modified);
+        }
+        match inference_input {
+            Some(InferenceInputUpdate::Default(tensor)) => {
+                frame.set_inference_input(InferenceInput::Default(tensor));
+            },
+            Some(InferenceInputUpdate::Named(inputs)) => {
+                let mut current_inputs = match frame.take_inference_input() {
+                    InferenceInput::Named(tensors) => tensors,
+                    InferenceInput::Default(_) => HashMap::new(),
+                };
+                let mut new_inputs = HashMap::new();
+                for (in_name, in_value) in inputs {
+                    if let Some(value) = in_value.or_else(|| current_inputs.remove(&in_name)) {
+                        new_inputs.insert(in_name, value);
+                    }
+                }
+                frame.set_inference_input(InferenceInput::Named(new_inputs));
+            },
+            None => {}
+        }
+        match inference_output {
+            Some(InferenceOutputUpdate::Default(out)) => {
+                frame.set_inference_output(InferenceOutput::Default(out));
+            },
+            Some(InferenceOutputUpdate::Onnx(outputs)) => {
+                let mut current_outputs = match frame.take_inference_output() {
+                    InferenceOutput::OnnxInferenceOutput(out) => out,
+                    InferenceOutput::Default(_) => OnnxInferenceOutput::new(),
+                };
+                let mut new_outputs = OnnxInferenceOutput::new();
+                for (out_name, out_value) in outputs {
+                    match out_value {
+                        Some(value) => { new_outputs.insert(out_name, value); },
+                        None => {
+                            if let Some(value) = current_outputs.remove(&out_name) {
+                                new_outputs.insert(out_name, value);
                             }
-                        };
-                        dict_items.insert(key_str, array);
-                    },
-                    None => { dict_items.insert(key_str, ndarray::ArrayBase::zeros(ndarray::IxDyn(&[]))); },
+                        }
+                    }
                 }
+                frame.set_inference_output(InferenceOutput::OnnxInferenceOutput(new_outputs));
+            },
+            None => {}
+        }
+        if let Some(user_data) = user_data {
+            frame.set_user_data(user_data);
+        }
+
+        Ok(Frame::RgbFrame(frame))
+    }
+}
+
+#[pymethods]
+impl PyFrame {
+    fn __getitem__(slf: &PyCell<Self>, key: &str) -> PyResult<PyObject> {
+        PyFrame::get_field(slf, key)
+    }
+
+    /// Any key can be assigned like on a dict, however, only 'modified', 'inference_input',
+    /// 'inference_output' and 'user_data' are kept after the hook. 'original' is read-only.
+    fn __setitem__(&mut self, key: &str, value: PyObject) {
+        self.assigned.insert(key.to_string(), value);
+    }
+
+    fn __contains__(&self, key: &str) -> bool {
+        FRAME_KEYS.contains(&key) || self.assigned.contains_key(key)
+    }
+
+    #[pyo3(signature = (key, default=None))]
+    fn get(slf: &PyCell<Self>, key: &str, default: Option<PyObject>) -> PyResult<PyObject> {
+        let py = slf.py();
+        match PyFrame::get_field(slf, key) {
+            Ok(value) => Ok(value),
+            Err(err) if err.is_instance_of::<pyo3::exceptions::PyKeyError>(py) => Ok(default.unwrap_or_else(|| py.None())),
+            Err(err) => Err(err),
+        }
+    }
+
+    fn keys(&self) -> Vec<String> {
+        let mut keys: Vec<String> = FRAME_KEYS.iter().map(|k| k.to_string()).collect();
+        for key in self.assigned.keys() {
+            if !FRAME_KEYS.contains(&key.as_str()) {
+                keys.push(key.clone());
             }
-            crate::data::InferenceOutput::OnnxInferenceOutput(dict_items)
-        } else if let Ok(inference_output_py_array) = ob.get_item("inference_output")?.extract() {
-            let inference_output_py_array: &numpy::PyArrayDyn<f32> = inference_output_py_array;
-            let inference_output_ndarray: ndarray::ArrayBase<_, ndarray::Dim<ndarray::IxDynImpl>> = inference_output_py_array.to_owned_array().into_dyn();
-            InferenceOutput::Default(inference_output_ndarray)
-        } else {
-            warn!("Unable to obtain data from 'inference_output'. Ensure it is either a dict of numpy arrays of float32 values or a NumPy array of float32 values. Hint: use .astype('float32') in your Python code");
-            InferenceOutput::Default(ndarray::ArrayBase::zeros(ndarray::IxDyn(&[0])))
-        };
+        }
+        keys
+    }
 
-        let uuid = ob.get_item("uuid").unwrap().extract()?;
-        let original = original_ndarray;
-        let modified = modified_ndarray;
-        let width = ob.get_item("width").unwrap().extract()?;
-        let height = ob.get_item("height").unwrap().extract()?;
-        let pts = ob.get_item("pts").unwrap().extract()?;
-        let dts = ob.get_item("dts").unwrap().extract()?;
-        let duration = ob.get_item("duration").unwrap().extract()?;
-        let fps = ob.get_item("fps").unwrap().extract()?;
-        let input_ts = ob.get_item("input_ts").unwrap().extract()?;
-        let inference_input = inference_input_ndarray;
-        let inference_output = inference_output;
-        let pipeline_id = ob.get_item("pipeline_id").unwrap().extract()?;
-        let user_data = ob.get_item("user_data").unwrap().extract()?;
-        let frame_number = ob.get_item("frame_number").unwrap().extract()?;
-
-        let frame = RgbFrame::from_values(
-            uuid, original, modified, width, height,
-            pts, dts, duration, fps, input_ts,
-            inference_input, inference_output,
-            pipeline_id, user_data, frame_number
-        );
-
-        Ok(frame)
+    fn __repr__(&self) -> String {
+        match &self.frame {
+            Some(frame) => format!(
+                "pipeless.Frame(uuid={}, pipeline_id={}, frame_number={}, width={}, height={})",
+                frame.get_uuid(), frame.get_pipeline_id(), frame.get_frame_number(),
+                frame.get_width(), frame.get_height()
+            ),
+            None => "pipeless.Frame(<released>)".to_string(),
+        }
     }
 }
 
-/// Allows to pass the user data to python and back
+/// Native Python module available to the hooks via `import pipeless`
+#[pymodule]
+#[pyo3(name = "pipeless")]
+pub fn pipeless_module(_py: Python, m: &PyModule) -> PyResult<()> {
+    m.add_class::<PyFrame>()?;
+    Ok(())
+}
+
+/// Allows a Frame to be converted from Rust to Python
+impl IntoPy<Py<PyAny>> for Frame {
+    fn into_py(self, py: Python) -> Py<PyAny> {
+        PyFrame::new(self).into_py(py)
+    }
+}
+
+/// Allows to pass the user data to python and back.
+/// Typed arrays are copied once into a NumPy array, without converting every element.
 impl ToPyObject for UserData {
     fn to_object(&self, py: Python<'_>) -> PyObject {
         match self {
             UserData::Empty => py.None(),
+            UserData::Bool(b) => b.into_py(py),
             UserData::Integer(i) => i.into_py(py),
+            UserData::Integer64(i) => i.into_py(py),
             UserData::Float(f) => f.into_py(py),
             UserData::String(s) => s.into_py(py),
+            UserData::Bytes(b) => pyo3::types::PyBytes::new(py, b).into_py(py),
             UserData::Array(arr) => {
                 let list = pyo3::types::PyList::empty(py);
                 for item in arr {
@@ -160,19 +453,85 @@ impl ToPyObject for UserData {
                 }
                 py_dict.into_py(py)
             }
+            UserData::F32Array(arr) => numpy::PyArrayDyn::from_array(py, arr).into_py(py),
+            UserData::F64Array(arr) => numpy::PyArrayDyn::from_array(py, arr).into_py(py),
+            UserData::I32Array(arr) => numpy::PyArrayDyn::from_array(py, arr).into_py(py),
+            UserData::I64Array(arr) => numpy::PyArrayDyn::from_array(py, arr).into_py(py),
+            UserData::U8Array(arr) => numpy::PyArrayDyn::from_array(py, arr).into_py(py),
+            UserData::BoolArray(arr) => numpy::PyArrayDyn::from_array(py, arr).into_py(py),
         }
     }
 }
 
+/// Converts a NumPy array to the user data typed array of its dtype.
+/// Other dtypes are converted to the smallest typed array that holds all their values,
+/// arrays whose values do not fit in any of them are rejected.
+fn extract_user_data_array(array: &numpy::PyUntypedArray) -> PyResult<UserData> {
+    if let Ok(arr) = array.downcast::<numpy::PyArrayDyn<f32>>() {
+        return Ok(UserData::F32Array(arr.to_owned_array()));
+    }
+    if let Ok(arr) = array.downcast::<numpy::PyArrayDyn<f64>>() {
+        return Ok(UserData::F64Array(arr.to_owned_array()));
+    }
+    if let Ok(arr) = array.downcast::<numpy::PyArrayDyn<i32>>() {
+        return Ok(UserData::I32Array(arr.to_owned_array()));
+    }
+    if let Ok(arr) = array.downcast::<numpy::PyArrayDyn<i64>>() {
+        return Ok(UserData::I64Array(arr.to_owned_array()));
+    }
+    if let Ok(arr) = array.downcast::<numpy::PyArrayDyn<u8>>() {
+        return Ok(UserData::U8Array(arr.to_owned_array()));
+    }
+    if let Ok(arr) = array.downcast::<numpy::PyArrayDyn<bool>>() {
+        return Ok(UserData::BoolArray(arr.to_owned_array()));
+    }
+
+    // Smaller dtypes and dtypes not in the native byte order
+    let kind = array.dtype().kind();
+    let dtype = match (kind, array.dtype().itemsize()) {
+        (b'f', size) if size <= 4 => "float32",
+        (b'f', 8) => "float64",
+        (b'i', size) if size <= 4 => "int32",
+        (b'u', size) if size <= 2 => "int32",
+        (b'i', 8) | (b'u', 4) => "int64",
+        (b'u', 8) => {
+            if array.len() > 0 && array.call_method0("max")?.extract::<u64>()? > i64::MAX as u64 {
+                return Err(pyo3::exceptions::PyTypeError::new_err(
+                    "The uint64 array assigned to 'user_data' has values that do not fit in int64"
+                ));
+            }
+            "int64"
+        },
+        (b'b', _) => "bool",
+        (b'f' | b'i' | b'u', size) => return Err(pyo3::exceptions::PyTypeError::new_err(format!(
+            "Unsupported NumPy array dtype '{}{}' assigned to 'user_data'. Use at most 64 bits numbers.", kind as char, size
+        ))),
+        _ => return Err(pyo3::exceptions::PyTypeError::new_err(format!(
+            "Unsupported NumPy array kind '{}' assigned to 'user_data'. Use float, integer or bool arrays.", kind as char
+        ))),
+    };
+    let converted = array.call_method1("astype", (dtype,))?;
+    extract_user_data_array(converted.downcast::<numpy::PyUntypedArray>()?)
+}
+
 /// Allows to pass the user data to python and back
 impl<'source> FromPyObject<'source> for UserData {
     fn extract(obj: &'source PyAny) -> PyResult<Self> {
-        if let Ok(integer) = obj.extract::<i32>() {
+        // bool must go first, Python bools are also ints
+        if let Ok(boolean) = obj.downcast::<pyo3::types::PyBool>() {
+            Ok(UserData::Bool(boolean.is_true()))
+        } else if let Ok(integer) = obj.extract::<i32>() {
             Ok(UserData::Integer(integer))
+        } else if let Ok(integer) = obj.extract::<i64>() {
+            Ok(UserData::Integer64(integer))
         } else if let Ok(float) = obj.extract::<f64>() {
             Ok(UserData::Float(float))
         } else if let Ok(string) = obj.extract::<String>() {
             Ok(UserData::String(string))
+        } else if let Ok(bytes) = obj.downcast::<pyo3::types::PyBytes>() {
+            Ok(UserData::Bytes(bytes.as_bytes().to_vec()))
+        } else if let Ok(array) = obj.downcast::<numpy::PyUntypedArray>() {
+            extract_user_data_array(array)
         } else if obj.is_instance_of::<pyo3::types::PyList>() {
             let array = obj.downcast::<pyo3::types::PyList>()?;
             let array_data = array.into_iter()
@@ -181,18 +540,10 @@ impl<'source> FromPyObject<'source> for UserData {
             Ok(UserData::Array(array_data))
         } else if obj.is_instance_of::<pyo3::types::PyDict>() {
             let dict = obj.downcast::<pyo3::types::PyDict>()?;
-            let dict_keys = dict.keys();
-            let mut dict_items = Vec::new();
-            for key in dict_keys {
+            let mut dict_items = UserDataDictionary::with_capacity(dict.len());
+            for (key, value) in dict.iter() {
                 let key_str = key.extract::<String>()?;
-                let value = dict.get_item(key)?;
-                match value {
-                    Some(v) => {
-                        let value_data = UserData::extract(v)?;
-                        dict_items.push((key_str, value_data));
-                    },
-                    None => { dict_items.push((key_str, UserData::Empty)); },
-                }
+                dict_items.insert(key_str, UserData::extract(value)?);
             }
             Ok(UserData::Dictionary(dict_items))
         } else if obj.is_none() {
@@ -248,18 +599,46 @@ impl IntoPy<Py<PyAny>> for &PythonStageContext {
     }
 }
 
+/// Records the time a Python hook held the GIL when dropped
+struct ExecTimer<'a> {
+    stage_metrics: &'a crate::metrics::StageMetrics,
+    start: std::time::Instant,
+}
+impl Drop for ExecTimer<'_> {
+    fn drop(&mut self) {
+        self.stage_metrics.observe_python_exec(self.start.elapsed());
+    }
+}
+
 /// Defines a Hook implemented in Python
 pub struct PythonHook {
     module: Py<pyo3::types::PyModule>,
+    stage_name: String,
+    // Modules removed from the interpreter when the hook is dropped. Only for hooks created per stream.
+    stream_modules: Vec<String>,
 }
 impl PythonHook {
     pub fn new(hook_type: HookType, stage_name: &str,py_code: &str) -> Self {
-        // The wrapper removes the need for the user to return a frame from each hook
-        // Also, injects the set and get functions for the KV store namespacing the keys
-        // to avoid conflicts between streams in the format stage_name:pipeline_id:user_provided_key
         // Since all executions share the Python interpreter, we have to create different names for
         // all the modules
         let module_name = format!("_{}_{}", stage_name, hook_type); // Prepend with underscore to allow modules starting with numbers
+        let module = PythonHook::create_module(stage_name, py_code, &module_name);
+        Self { module, stage_name: stage_name.to_string(), stream_modules: vec![] }
+    }
+
+    /// Creates an instance of the hook for a stream. Each instance has its own module, so
+    /// the global variables of the hook code are not shared with other streams.
+    pub fn new_for_stream(hook_type: HookType, stage_name: &str, py_code: &str, pipeline_id: &uuid::Uuid) -> Self {
+        let module_name = format!("_{}_{}_{}", stage_name, hook_type, pipeline_id.simple());
+        let module = PythonHook::create_module(stage_name, py_code, &module_name);
+        let stream_modules = vec![format!("{}_wrapper", module_name), module_name];
+        Self { module, stage_name: stage_name.to_string(), stream_modules }
+    }
+
+    fn create_module(stage_name: &str, py_code: &str, module_name: &str) -> Py<pyo3::types::PyModule> {
+        // The wrapper removes the need for the user to return a frame from each hook
+        // Also, injects the set and get functions for the KV store namespacing the keys
+        // to avoid conflicts between streams in the format stage_name:pipeline_id:user_provided_key
         let module_file_name = format!("{}.py", module_name);
         let wrapper_module_name = format!("{}_wrapper", module_name);
         let wrapper_module_file_name = format!("{}.py", wrapper_module_name);
@@ -270,19 +649,32 @@ import {0}
 
 def hook_wrapper(frame, context):
     pipeline_id = frame['pipeline_id']
-    def pipeless_kvs_set(key, value):
-        _pipeless_kvs_set(f'{{pipeline_id}}:{1}:{{key}}', str(value))
-    def pipeless_kvs_get(key):
-        return _pipeless_kvs_get(f'{{pipeline_id}}:{1}:{{key}}')
+    prefix = f'{{pipeline_id}}:{1}:'
+    def pipeless_kvs_set(key, value, ttl=None):
+        _pipeless_kvs_set(f'{{prefix}}{{key}}', value, ttl)
+    def pipeless_kvs_get(key, default=''):
+        return _pipeless_kvs_get(f'{{prefix}}{{key}}', default)
+    def pipeless_kvs_mset(entries, ttl=None):
+        _pipeless_kvs_mset({{f'{{prefix}}{{key}}': value for key, value in entries.items()}}, ttl)
+    def pipeless_kvs_mget(keys, default=''):
+        return _pipeless_kvs_mget([f'{{prefix}}{{key}}' for key in keys], default)
+    def pipeless_kvs_incr(key, amount=1):
+        return _pipeless_kvs_incr(f'{{prefix}}{{key}}', amount)
+    def pipeless_kvs_delete(key):
+        _pipeless_kvs_delete(f'{{prefix}}{{key}}')
     {0}.pipeless_kvs_set = pipeless_kvs_set
     {0}.pipeless_kvs_get = pipeless_kvs_get
+    {0}.pipeless_kvs_mset = pipeless_kvs_mset
+    {0}.pipeless_kvs_mget = pipeless_kvs_mget
+    {0}.pipeless_kvs_incr = pipeless_kvs_incr
+    {0}.pipeless_kvs_delete = pipeless_kvs_delete
     {0}.hook(frame, context)
     return frame
 ", module_name, stage_name);
         let module = Python::with_gil(|py| -> Py<pyo3::types::PyModule> {
             // Create the hook module from user code
             let hook_module = pyo3::types::PyModule::from_code(
-                py, py_code, &module_file_name, &module_name
+                py, py_code, &module_file_name, module_name
             ).expect("Unable to create Python module from hook");
 
             // Create the wrapper module
@@ -290,31 +682,84 @@ def hook_wrapper(frame, context):
                 py, &wrapper_py_code, &wrapper_module_file_name, &wrapper_module_name
             ).expect("Unable to create wrapper Python module");
             // Add some util functions that the user can invoke from the Python code
+            // The values are stored as user data, so numbers, bytes and NumPy arrays keep their type
+            fn ttl_from_secs(ttl: Option<f64>) -> PyResult<Option<std::time::Duration>> {
+                match ttl {
+                    Some(ttl) if !(ttl.is_finite() && ttl > 0.0) => Err(pyo3::exceptions::PyValueError::new_err("The TTL must be a positive number of seconds")),
+                    ttl => Ok(ttl.map(std::time::Duration::from_secs_f64)),
+                }
+            }
             #[pyfunction]
-            fn _pipeless_kvs_set(key: &str, value: &str) {
-                store::KV_STORE.set(key, value);
+            fn _pipeless_kvs_set(key: &str, value: UserData, ttl: Option<f64>) -> PyResult<()> {
+                store::KV_STORE.set_value(key, value, ttl_from_secs(ttl)?);
+                Ok(())
             }
             #[pyfunction]
-            fn _pipeless_kvs_get(key: &str) -> String {
-                store::KV_STORE.get(key)
+            fn _pipeless_kvs_get(py: Python, key: &str, default: PyObject) -> PyObject {
+                store::KV_STORE.get_value(key).map_or(default, |value| value.to_object(py))
+            }
+            #[pyfunction]
+            fn _pipeless_kvs_mset(entries: HashMap<String, UserData>, ttl: Option<f64>) -> PyResult<()> {
+                store::KV_STORE.mset(entries.into_iter().collect(), ttl_from_secs(ttl)?);
+                Ok(())
+            }
+            #[pyfunction]
+            fn _pipeless_kvs_mget(py: Python, keys: Vec<String>, default: PyObject) -> Vec<PyObject> {
+                store::KV_STORE.mget(&keys).into_iter()
+                    .map(|value| value.map_or_else(|| default.clone_ref(py), |value| value.to_object(py)))
+                    .collect()
+            }
+            #[pyfunction]
+            fn _pipeless_kvs_incr(key: &str, amount: i64) -> PyResult<i64> {
+                store::KV_STORE.incr(key, amount).map_err(pyo3::exceptions::PyValueError::new_err)
+            }
+            #[pyfunction]
+            fn _pipeless_kvs_delete(key: &str) {
+                store::KV_STORE.delete(key);
             }
             wrapper_module.add_function(wrap_pyfunction!(_pipeless_kvs_set, wrapper_module).unwrap()).expect("Failed to inject KV store set function");
             wrapper_module.add_function(wrap_pyfunction!(_pipeless_kvs_get, wrapper_module).unwrap()).expect("Failed to inject KV store get function");
-            wrapper_module.add(&module_name, hook_module).expect("Failed to inject Python hook module into wrapper module");
+            wrapper_module.add_function(wrap_pyfunction!(_pipeless_kvs_mset, wrapper_module).unwrap()).expect("Failed to inject KV store mset function");
+            wrapper_module.add_function(wrap_pyfunction!(_pipeless_kvs_mget, wrapper_module).unwrap()).expect("Failed to inject KV store mget function");
+            wrapper_module.add_function(wrap_pyfunction!(_pipeless_kvs_incr, wrapper_module).unwrap()).expect("Failed to inject KV store incr function");
+            wrapper_module.add_function(wrap_pyfunction!(_pipeless_kvs_delete, wrapper_module).unwrap()).expect("Failed to inject KV store delete function");
+            wrapper_module.add(module_name, hook_module).expect("Failed to inject Python hook module into wrapper module");
             wrapper_module.into()
         });
 
-        Self { module }
+        module
     }
     pub fn get_module(&self) -> &Py<pyo3::types::PyModule> {
         &self.module
     }
 }
+impl Drop for PythonHook {
+    fn drop(&mut self) {
+        if self.stream_modules.is_empty() {
+            return;
+        }
+        Python::with_gil(|py| {
+            if let Ok(sys_modules) = py.import("sys").and_then(|sys| sys.getattr("modules")) {
+                for module_name in &self.stream_modules {
+                    let _ = sys_modules.del_item(module_name);
+                }
+            }
+        });
+    }
+}
 impl HookTrait for PythonHook {
     /// Executes a Python hook by obtaining the GIL and passes the provided frame and stage context to it
-    fn exec_hook(&self, mut frame: Frame, _stage_context: &Context) -> Option<Frame> {
+    fn exec_hook(&self, frame: Frame, _stage_context: &Context) -> Option<Frame> {
         let py_module = self.get_module();
+        let stage_metrics = crate::metrics::get_stage_metrics(frame.get_pipeline_id(), &self.stage_name);
+        let gil_request = std::time::Instant::now();
         let out_frame = Python::with_gil(|py| -> Option<Frame> {
+            let gil_acquired = std::time::Instant::now();
+            if let Some(stage_metrics) = &stage_metrics {
+                stage_metrics.observe_python_gil_wait(gil_acquired - gil_request);
+            }
+            // Record the execution time on every return path
+            let _exec_timer = stage_metrics.as_deref().map(|stage_metrics| ExecTimer { stage_metrics, start: gil_acquired });
             let stage_context = match _stage_context {
                 crate::stages::stage::Context::PythonContext(python_context) => python_context.into_py(py),
                 crate::stages::stage::Context::EmptyContext => pyo3::types::PyDict::new(py).into_py(py),
@@ -325,19 +770,24 @@ impl HookTrait for PythonHook {
             };
 
             if let Ok(hook_func) = py_module.getattr(py, "hook_wrapper") {
-                let original_pixels = frame.get_original_pixels().to_owned(); // it seems that to_owned implies to copy data
+                // The frame buffers are provided to Python as views, no data is copied
+                let py_frame = match Py::new(py, PyFrame::new(frame)) {
+                    Ok(f) => f,
+                    Err(err) => {
+                        error!("Unable to create Python frame: {}", err);
+                        return None
+                    }
+                };
                 // TODO: we will probably need a pool of interpreters to avoid initializing a new one ever time because o cold starts
                 // TODO: this acquires the Python GIL, breaking the concurrency, except when we are running on different cores thanks
                 //       to how we invoke frame processing using the Tokio thread pool, becuase it runs threads on all the cores.
                 // See: Follow this to run async code in python even with GIL: https://pyo3.rs/v0.11.1/parallelism
-                match hook_func.call1(py, (frame, stage_context.into_py(py),)) {
+                match hook_func.call1(py, (py_frame.clone_ref(py), stage_context.into_py(py),)) {
                     Ok(ret) => {
-                        match ret.extract::<Frame>(py) {
-                            Ok(mut f) => {
-                                // Avoid the user to accidentally modify the original frame
-                                f.set_original_pixels(original_pixels);
-                                return Some(f)
-                            },
+                        // The wrapper returns the same frame object. Release it before recovering the Rust frame
+                        drop(ret);
+                        match PyFrame::into_frame(py_frame, py) {
+                            Ok(f) => return Some(f),
                             Err(err) => {
                                 error!("Error executing Python hook: {}", err);
                                 return None
@@ -0,0 +1,995 @@
+use std::{collections::HashMap, fs, io::{BufReader, BufWriter, Read, Write}, path::PathBuf, process::{Child, ChildStdin, ChildStdout, Command, Stdio}, sync::{atomic::{AtomicUsize, Ordering}, Condvar, Mutex}};
+use log::{error, info, warn};
+use rayon::prelude::*;
+use serde_json::{json, Value};
+
+use crate::{data::{Frame, InferenceInput, InferenceOutput, RgbFrame, Tensor, TensorType, UserData}, kvs::store, stages::{hook::{HookTrait, HookType}, inference::onnx::OnnxInferenceOutput, stage::Context}};
+
+/// Python interpreter used to run the workers. Must have NumPy installed.
+const PYTHON_EXECUTABLE_ENV: &str = "PIPELESS_PYTHON";
+/// Initial size of the shared memory of each worker. Grows with the frames.
+const INITIAL_SHM_SIZE: usize = 4096;
+/// Arrays are placed in the shared memory aligned to this number of bytes
+const SHM_ALIGNMENT: usize = 64;
+
+/// Code executed by the worker processes.
+/// The frame arrays are read from the shared memory. The rest of the frame is sent through
+/// stdin as length prefixed JSON messages, and the results are returned through stdout.
+/// Only the fields accessed by the hook are sent back. Arrays modified in place are read
+/// directly from the shared memory, arrays replaced by the hook are sent after the message.
+/// Typed arrays and bytes of the user data travel the same way, referenced from the user data
+/// JSON by {"__array__": ...} and {"__bytes__": ...} markers.
+const WORKER_CODE: &str = r##"
+import json, mmap, os, struct, sys, traceback, types
+import numpy as np
+
+# The original stdout is used to talk to Pipeless. Anything printed by the hooks goes to stderr.
+channel_out = os.fdopen(os.dup(1), 'wb')
+os.dup2(2, 1)
+channel_in = sys.stdin.buffer
+
+shm_fd = os.open(sys.argv[1], os.O_RDWR)
+shm = mmap.mmap(shm_fd, os.fstat(shm_fd).st_size)
+
+def read_exact(size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = channel_in.read(size - len(data))
+        if not chunk:
+            raise EOFError('Pipeless closed the worker channel')
+        data += chunk
+    return data
+
+def recv():
+    (size,) = struct.unpack('<I', read_exact(4))
+    return json.loads(read_exact(size))
+
+def to_json(obj):
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError(f'Unsupported data type {type(obj).__name__} assigned to user_data')
+
+def send(msg, payloads=()):
+    data = json.dumps(msg, default=to_json).encode()
+    channel_out.write(struct.pack('<I', len(data)))
+    channel_out.write(data)
+    for payload in payloads:
+        channel_out.write(payload)
+    channel_out.flush()
+
+def load_module(name, code):
+    module = types.ModuleType(name)
+    module.__file__ = f'{name}.py'
+    exec(compile(code, module.__file__, 'exec'), module.__dict__)
+    sys.modules[name] = module
+    return module
+
+class Frame(dict):
+    '''Frame provided to the hooks. Records the accessed keys to send back only those.'''
+    def __init__(self, fields, lazy):
+        super().__init__(fields)
+        self._lazy = lazy
+        self.accessed = set()
+    def __getitem__(self, key):
+        self.accessed.add(key)
+        if key in self._lazy:
+            dict.__setitem__(self, key, self._lazy.pop(key)())
+        return dict.__getitem__(self, key)
+    def __setitem__(self, key, value):
+        self.accessed.add(key)
+        self._lazy.pop(key, None)
+        dict.__setitem__(self, key, value)
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._lazy
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+    def keys(self):
+        return list(dict.keys(self)) + list(self._lazy)
+
+def view(spec):
+    return np.ndarray(spec['shape'], dtype=spec['dtype'], buffer=shm, offset=spec['offset'])
+
+def load_shm(spec):
+    return view(spec).copy()
+
+def decode_user_data(value, load=load_shm):
+    # load returns the array described by the spec of a marker
+    if isinstance(value, dict) and len(value) == 1:
+        if '__array__' in value:
+            return load(value['__array__'])
+        if '__bytes__' in value:
+            return load(value['__bytes__']).tobytes()
+    if isinstance(value, dict):
+        return {k: decode_user_data(v, load) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode_user_data(v, load) for v in value]
+    return value
+
+def encode_user_data(value, arrays, payloads):
+    # Arrays and bytes are sent after the message as inline arrays
+    if isinstance(value, np.ndarray):
+        kind, size = value.dtype.kind, value.dtype.itemsize
+        if kind == 'b':
+            dtype = 'bool'
+        elif kind == 'u' and size == 1:
+            dtype = 'uint8'
+        elif kind == 'f' and size <= 8:
+            dtype = 'float32' if size <= 4 else 'float64'
+        elif (kind == 'i' and size <= 4) or (kind == 'u' and size <= 2):
+            dtype = 'int32'
+        elif kind in 'iu' and size <= 8:
+            if kind == 'u' and size == 8 and value.size and value.max() > np.iinfo(np.int64).max:
+                raise TypeError('The uint64 array assigned to user_data has values that do not fit in int64')
+            dtype = 'int64'
+        else:
+            raise TypeError(f'Unsupported array dtype {value.dtype} assigned to user_data')
+        array = np.ascontiguousarray(value, dtype=dtype)
+        name = str(len(arrays))
+        arrays.append({'field': 'user_data', 'name': name, 'dtype': dtype, 'shape': list(array.shape), 'inline': True})
+        payloads.append(array.data)
+        return {'__array__': name}
+    if isinstance(value, (bytes, bytearray)):
+        name = str(len(arrays))
+        arrays.append({'field': 'user_data', 'name': name, 'dtype': 'bytes', 'shape': [len(value)], 'inline': True})
+        payloads.append(bytes(value))
+        return {'__bytes__': name}
+    if isinstance(value, dict):
+        return {str(k): encode_user_data(v, arrays, payloads) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_user_data(v, arrays, payloads) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def send_value(msg, value):
+    arrays, payloads = [], []
+    msg['value'] = encode_user_data(value, arrays, payloads)
+    msg['arrays'] = arrays
+    send(msg, payloads)
+
+def recv_values():
+    '''Receives the values of the KV store requested by a hook, None for the missing keys'''
+    msg = recv()
+    payloads = [read_exact(int(np.prod(spec['shape'])) * np.dtype(spec['dtype']).itemsize) for spec in msg['arrays']]
+    def load(spec):
+        return np.frombuffer(payloads[spec['index']], dtype=spec['dtype']).reshape(spec['shape'])
+    return [decode_user_data(value, load) if found else None for value, found in zip(msg['values'], msg['found'])]
+
+def check_ttl(ttl):
+    if ttl is not None and not ttl > 0:
+        raise ValueError('The TTL must be a positive number of seconds')
+
+def build_frame(msg):
+    fields = dict(msg['fields'])
+    fields['user_data'] = decode_user_data(msg['user_data'])
+    views = {}
+    original = view(msg['original'])
+    original.flags.writeable = False
+    fields['original'] = original
+    def init_modified():
+        # The modified frame is copied from the original on first access
+        spec = msg['modified']
+        modified = view(spec)
+        if not spec['initialized']:
+            modified[...] = original
+        views['modified'] = (modified, spec)
+        return modified
+    inp = msg['inference_input']
+    if inp['kind'] == 'dict':
+        inputs = {}
+        for name, spec in inp['arrays'].items():
+            inputs[name] = view(spec)
+            views[('inference_input', name)] = (inputs[name], spec)
+        fields['inference_input'] = inputs
+    else:
+        fields['inference_input'] = view(inp['array'])
+        views['inference_input'] = (fields['inference_input'], inp['array'])
+    out = msg['inference_output']
+    if out['kind'] == 'dict':
+        outputs = {}
+        for name, spec in out['arrays'].items():
+            outputs[name] = view(spec)
+            views[('inference_output', name)] = (outputs[name], spec)
+        fields['inference_output'] = outputs
+    else:
+        fields['inference_output'] = view(out['array'])
+        views['inference_output'] = (fields['inference_output'], out['array'])
+    return Frame(fields, {'modified': init_modified}), views
+
+TENSOR_DTYPES = ('uint8', 'int8', 'float16', 'float32', 'int64')
+
+def tensor_dtype(value):
+    # The inference inputs keep their dtype, the model input type is applied by Pipeless
+    dtype = np.asarray(value).dtype
+    if dtype.name in TENSOR_DTYPES:
+        return dtype.name
+    return 'float32' if dtype.kind == 'f' else 'int64'
+
+def collect_result(frame, views):
+    arrays, payloads = [], []
+    def add(field, value, dtype, view_key, name=None):
+        entry = {'field': field, 'name': name, 'dtype': dtype}
+        view_obj, spec = views.get(view_key, (None, None))
+        array = value if value is view_obj else np.ascontiguousarray(value, dtype=dtype)
+        if view_obj is not None and array.shape == view_obj.shape and array.dtype == view_obj.dtype:
+            if array is not view_obj:
+                view_obj[...] = array
+            entry.update(shape=list(view_obj.shape), offset=spec['offset'])
+        else:
+            entry.update(shape=list(array.shape), inline=True)
+            payloads.append(array.data)
+        arrays.append(entry)
+
+    result = {'type': 'result', 'arrays': arrays}
+    accessed = frame.accessed
+    if 'modified' in accessed and dict.__contains__(frame, 'modified'):
+        add('modified', dict.__getitem__(frame, 'modified'), 'uint8', 'modified')
+    if 'inference_input' in accessed:
+        inp = dict.__getitem__(frame, 'inference_input')
+        if isinstance(inp, dict):
+            result['inference_input_kind'] = 'dict'
+            for name, value in inp.items():
+                add('inference_input', value, tensor_dtype(value), ('inference_input', name), name)
+        else:
+            add('inference_input', inp, tensor_dtype(inp), 'inference_input')
+    if 'inference_output' in accessed:
+        out = dict.__getitem__(frame, 'inference_output')
+        if isinstance(out, dict):
+            result['inference_output_kind'] = 'dict'
+            for name, value in out.items():
+                add('inference_output', value, 'float32', ('inference_output', name), name)
+        else:
+            result['inference_output_kind'] = 'default'
+            add('inference_output', out, 'float32', 'inference_output')
+    if 'user_data' in accessed:
+        result['user_data'] = encode_user_data(dict.__getitem__(frame, 'user_data'), arrays, payloads)
+    return result, payloads
+
+def main():
+    global shm
+    init = recv()
+    stage_name = init['stage_name']
+    try:
+        hook_module = load_module(f"_{stage_name}_{init['hook_type']}", init['hook_code'])
+    except Exception:
+        send({'type': 'error', 'message': traceback.format_exc()})
+        return
+    context = {}
+    if init['init_code'] is not None:
+        try:
+            context = load_module(f'{stage_name}_init', init['init_code']).init()
+        except Exception:
+            print(f"Error executing stage init. Defaulting to empty stage context\n{traceback.format_exc()}", file=sys.stderr)
+    send({'type': 'ready'})
+
+    while True:
+        try:
+            msg = recv()
+        except EOFError:
+            return
+        if msg['shm_size'] != len(shm):
+            try:
+                shm.close()
+            except BufferError:
+                pass # The hook kept views of the previous mapping, it is released with them
+            shm = mmap.mmap(shm_fd, msg['shm_size'])
+        try:
+            frame, views = build_frame(msg)
+            prefix = f"{msg['fields']['pipeline_id']}:{stage_name}:"
+            def pipeless_kvs_set(key, value, ttl=None):
+                check_ttl(ttl)
+                send_value({'type': 'kvs_set', 'key': f'{prefix}{key}', 'ttl': ttl}, value)
+            def pipeless_kvs_get(key, default=''):
+                send({'type': 'kvs_mget', 'keys': [f'{prefix}{key}']})
+                (value,) = recv_values()
+                return default if value is None else value
+            def pipeless_kvs_mset(entries, ttl=None):
+                check_ttl(ttl)
+                send_value({'type': 'kvs_mset', 'ttl': ttl}, {f'{prefix}{key}': value for key, value in entries.items()})
+            def pipeless_kvs_mget(keys, default=''):
+                send({'type': 'kvs_mget', 'keys': [f'{prefix}{key}' for key in keys]})
+                return [default if value is None else value for value in recv_values()]
+            def pipeless_kvs_incr(key, amount=1):
+                send({'type': 'kvs_incr', 'key': f'{prefix}{key}', 'amount': amount})
+                response = recv()
+                if 'error' in response:
+                    raise ValueError(response['error'])
+                return response['value']
+            def pipeless_kvs_delete(key):
+                send({'type': 'kvs_delete', 'key': f'{prefix}{key}'})
+            hook_module.pipeless_kvs_set = pipeless_kvs_set
+            hook_module.pipeless_kvs_get = pipeless_kvs_get
+            hook_module.pipeless_kvs_mset = pipeless_kvs_mset
+            hook_module.pipeless_kvs_mget = pipeless_kvs_mget
+            hook_module.pipeless_kvs_incr = pipeless_kvs_incr
+            hook_module.pipeless_kvs_delete = pipeless_kvs_delete
+            hook_module.hook(frame, context)
+            result, payloads = collect_result(frame, views)
+        except Exception:
+            send({'type': 'error', 'message': traceback.format_exc()})
+            continue
+        send(result, payloads)
+
+main()
+"##;
+
+fn shm_dir() -> PathBuf {
+    let dev_shm = PathBuf::from("/dev/shm");
+    if dev_shm.is_dir() { dev_shm } else { std::env::temp_dir() }
+}
+
+fn align(offset: usize) -> usize {
+    (offset + SHM_ALIGNMENT - 1) / SHM_ALIGNMENT * SHM_ALIGNMENT
+}
+
+fn f32_as_bytes(data: &[f32]) -> &[u8] {
+    // SAFETY: f32 has no padding and any byte is a valid u8
+    unsafe { std::slice::from_raw_parts(data.as_ptr() as *const u8, std::mem::size_of_val(data)) }
+}
+
+fn f32_from_bytes(data: &[u8]) -> Vec<f32> {
+    data.chunks_exact(4)
+        .map(|b| f32::from_ne_bytes([b[0], b[1], b[2], b[3]]))
+        .collect()
+}
+
+fn i32_as_bytes(data: &[i32]) -> &[u8] {
+    // SAFETY: i32 has no padding and any byte is a valid u8
+    unsafe { std::slice::from_raw_parts(data.as_ptr() as *const u8, std::mem::size_of_val(data)) }
+}
+
+fn i32_from_bytes(data: &[u8]) -> Vec<i32> {
+    data.chunks_exact(4)
+        .map(|b| i32::from_ne_bytes([b[0], b[1], b[2], b[3]]))
+        .collect()
+}
+
+fn f64_as_bytes(data: &[f64]) -> &[u8] {
+    // SAFETY: f64 has no padding and any byte is a valid u8
+    unsafe { std::slice::from_raw_parts(data.as_ptr() as *const u8, std::mem::size_of_val(data)) }
+}
+
+fn f64_from_bytes(data: &[u8]) -> Vec<f64> {
+    data.chunks_exact(8)
+        .map(|b| f64::from_ne_bytes(b.try_into().unwrap()))
+        .collect()
+}
+
+fn i64_as_bytes(data: &[i64]) -> &[u8] {
+    // SAFETY: i64 has no padding and any byte is a valid u8
+    unsafe { std::slice::from_raw_parts(data.as_ptr() as *const u8, std::mem::size_of_val(data)) }
+}
+
+fn i64_from_bytes(data: &[u8]) -> Vec<i64> {
+    data.chunks_exact(8)
+        .map(|b| i64::from_ne_bytes(b.try_into().unwrap()))
+        .collect()
+}
+
+fn bool_as_bytes(data: &[bool]) -> &[u8] {
+    // SAFETY: bool is one byte and every bool is a valid u8
+    unsafe { std::slice::from_raw_parts(data.as_ptr() as *const u8, data.len()) }
+}
+
+/// Size of the items of an array exchanged with the workers
+fn dtype_item_size(dtype: &Value) -> usize {
+    match dtype.as_str() {
+        Some("bytes") | Some("bool") => 1,
+        Some("int32") => 4,
+        Some("int64") | Some("float64") => 8,
+        Some(dtype) => TensorType::from_str(dtype).map_or(4, |tensor_type| tensor_type.item_size()),
+        None => 4,
+    }
+}
+
+/// Copies the tensor when it is not in standard layout, so it can be copied to the shared memory
+fn standard_tensor(tensor: &Tensor) -> std::borrow::Cow<Tensor> {
+    let is_standard = match tensor {
+        Tensor::U8(t) => t.is_standard_layout(),
+        Tensor::I8(t) => t.is_standard_layout(),
+        Tensor::F16(t) => t.is_standard_layout(),
+        Tensor::F32(t) => t.is_standard_layout(),
+        Tensor::I64(t) => t.is_standard_layout(),
+    };
+    if is_standard {
+        return std::borrow::Cow::Borrowed(tensor);
+    }
+    std::borrow::Cow::Owned(match tensor {
+        Tensor::U8(t) => Tensor::U8(t.as_standard_layout().into_owned()),
+        Tensor::I8(t) => Tensor::I8(t.as_standard_layout().into_owned()),
+        Tensor::F16(t) => Tensor::F16(t.as_standard_layout().into_owned()),
+        Tensor::F32(t) => Tensor::F32(t.as_standard_layout().into_owned()),
+        Tensor::I64(t) => Tensor::I64(t.as_standard_layout().into_owned()),
+    })
+}
+
+/// Bytes of a tensor in standard layout
+fn tensor_as_bytes(tensor: &Tensor) -> &[u8] {
+    fn as_bytes<T>(data: &[T]) -> &[u8] {
+        // SAFETY: the tensor types have no padding and any byte is a valid u8
+        unsafe { std::slice::from_raw_parts(data.as_ptr() as *const u8, std::mem::size_of_val(data)) }
+    }
+    match tensor {
+        Tensor::U8(t) => t.as_slice().unwrap(),
+        Tensor::I8(t) => as_bytes(t.as_slice().unwrap()),
+        Tensor::F16(t) => as_bytes(t.as_slice().unwrap()),
+        Tensor::F32(t) => as_bytes(t.as_slice().unwrap()),
+        Tensor::I64(t) => as_bytes(t.as_slice().unwrap()),
+    }
+}
+
+fn tensor_from_bytes(tensor_type: TensorType, shape: Vec<usize>, data: &[u8]) -> Result<Tensor, ndarray::ShapeError> {
+    match tensor_type {
+        TensorType::U8 => ndarray::ArrayD::from_shape_vec(shape, data.to_vec()).map(Tensor::U8),
+        TensorType::I8 => ndarray::ArrayD::from_shape_vec(shape, data.iter().map(|b| *b as i8).collect()).map(Tensor::I8),
+        TensorType::F16 => ndarray::ArrayD::from_shape_vec(shape, data.chunks_exact(2)
+            .map(|b| half::f16::from_ne_bytes([b[0], b[1]]))
+            .collect()).map(Tensor::F16),
+        TensorType::F32 => ndarray::ArrayD::from_shape_vec(shape, f32_from_bytes(data)).map(Tensor::F32),
+        TensorType::I64 => ndarray::ArrayD::from_shape_vec(shape, data.chunks_exact(8)
+            .map(|b| i64::from_ne_bytes([b[0], b[1], b[2], b[3], b[4], b[5], b[6], b[7]]))
+            .collect()).map(Tensor::I64),
+    }
+}
+
+/// Converts the user data to JSON. Typed arrays and bytes are given to add_array,
+/// which returns the description of the array for the worker.
+fn user_data_to_json<'a>(user_data: &'a UserData, add_array: &mut dyn FnMut(&'a [u8], &[usize], &str) -> Value) -> Value {
+    match user_data {
+        UserData::Empty => Value::Null,
+        UserData::Bool(b) => json!(b),
+        UserData::Integer(i) => json!(i),
+        UserData::Integer64(i) => json!(i),
+        UserData::Float(f) => json!(f),
+        UserData::String(s) => json!(s),
+        UserData::Bytes(b) => json!({ "__bytes__": add_array(b, &[b.len()], "uint8") }),
+        UserData::Array(arr) => Value::Array(arr.iter().map(|item| user_data_to_json(item, add_array)).collect()),
+        UserData::Dictionary(dict) => Value::Object(
+            dict.iter().map(|(k, v)| (k.clone(), user_data_to_json(v, add_array))).collect()
+        ),
+        // Arrays not in standard layout are rare, they are sent as lists
+        UserData::F32Array(arr) => match arr.as_slice() {
+            Some(data) => json!({ "__array__": add_array(f32_as_bytes(data), arr.shape(), "float32") }),
+            None => json!(arr.iter().collect::<Vec<_>>()),
+        },
+        UserData::I32Array(arr) => match arr.as_slice() {
+            Some(data) => json!({ "__array__": add_array(i32_as_bytes(data), arr.shape(), "int32") }),
+            None => json!(arr.iter().collect::<Vec<_>>()),
+        },
+        UserData::U8Array(arr) => match arr.as_slice() {
+            Some(data) => json!({ "__array__": add_array(data, arr.shape(), "uint8") }),
+            None => json!(arr.iter().collect::<Vec<_>>()),
+        },
+        UserData::F64Array(arr) => match arr.as_slice() {
+            Some(data) => json!({ "__array__": add_array(f64_as_bytes(data), arr.shape(), "float64") }),
+            None => json!(arr.iter().collect::<Vec<_>>()),
+        },
+        UserData::I64Array(arr) => match arr.as_slice() {
+            Some(data) => json!({ "__array__": add_array(i64_as_bytes(data), arr.shape(), "int64") }),
+            None => json!(arr.iter().collect::<Vec<_>>()),
+        },
+        UserData::BoolArray(arr) => match arr.as_slice() {
+            Some(data) => json!({ "__array__": add_array(bool_as_bytes(data), arr.shape(), "bool") }),
+            None => json!(arr.iter().collect::<Vec<_>>()),
+        },
+    }
+}
+
+/// Converts the user data returned by a worker. The typed arrays and bytes referenced
+/// from the JSON are taken from the arrays returned with the result.
+fn user_data_from_json(value: &Value, arrays: &mut HashMap<String, UserData>) -> UserData {
+    match value {
+        Value::Null => UserData::Empty,
+        Value::Bool(b) => UserData::Bool(*b),
+        Value::Number(n) => match n.as_i64() {
+            Some(i) => match i32::try_from(i) {
+                Ok(i) => UserData::Integer(i),
+                Err(_) => UserData::Integer64(i),
+            },
+            None => UserData::Float(n.as_f64().unwrap_or_default()),
+        },
+        Value::String(s) => UserData::String(s.clone()),
+        Value::Array(arr) => UserData::Array(arr.iter().map(|item| user_data_from_json(item, arrays)).collect()),
+        Value::Object(obj) => {
+            let marker = obj.get("__array__").or_else(|| obj.get("__bytes__"));
+            if let (1, Some(Value::String(name))) = (obj.len(), marker) {
+                return arrays.remove(name).unwrap_or_else(|| {
+                    warn!("The Python worker did not return the user data array '{}'", name);
+                    UserData::Empty
+                });
+            }
+            UserData::Dictionary(
+                obj.iter().map(|(k, v)| (k.clone(), user_data_from_json(v, arrays))).collect()
+            )
+        },
+    }
+}
+
+/// Converts a user data array returned by a worker
+fn user_data_array_from_bytes(dtype: &Value, shape: Vec<usize>, bytes: &[u8]) -> Result<UserData, ndarray::ShapeError> {
+    match dtype.as_str() {
+        Some("bytes") => Ok(UserData::Bytes(bytes.to_vec())),
+        Some("uint8") => ndarray::ArrayD::from_shape_vec(shape, bytes.to_vec()).map(UserData::U8Array),
+        Some("int32") => ndarray::ArrayD::from_shape_vec(shape, i32_from_bytes(bytes)).map(UserData::I32Array),
+        Some("int64") => ndarray::ArrayD::from_shape_vec(shape, i64_from_bytes(bytes)).map(UserData::I64Array),
+        Some("float64") => ndarray::ArrayD::from_shape_vec(shape, f64_from_bytes(bytes)).map(UserData::F64Array),
+        Some("bool") => ndarray::ArrayD::from_shape_vec(shape, bytes.iter().map(|b| *b != 0).collect()).map(UserData::BoolArray),
+        _ => ndarray::ArrayD::from_shape_vec(shape, f32_from_bytes(bytes)).map(UserData::F32Array),
+    }
+}
+
+fn array_shape(array: &Value) -> Vec<usize> {
+    array["shape"].as_array()
+        .map_or_else(Vec::new, |shape| shape.iter().map(|d| d.as_u64().unwrap_or_default() as usize).collect())
+}
+
+/// Placement of the arrays sent to a worker in the shared memory
+struct ShmLayout<'a> {
+    size: usize,
+    arrays: Vec<(usize, &'a [u8])>, // Offset and data of the arrays to copy
+}
+impl<'a> ShmLayout<'a> {
+    fn new() -> Self {
+        Self { size: 0, arrays: Vec::new() }
+    }
+
+    /// Reserves space for an array and returns its description for the worker
+    fn add(&mut self, data: &'a [u8], shape: &[usize], dtype: &str, copy: bool) -> Value {
+        let offset = align(self.size);
+        self.size = offset + data.len();
+        if copy {
+            self.arrays.push((offset, data));
+        }
+        json!({ "shape": shape, "dtype": dtype, "offset": offset })
+    }
+}
+
+/// Array returned by the worker, either modified in place in the shared memory or sent after the result
+enum ReturnedArray {
+    Shm(usize, usize), // offset, size
+    Inline(Vec<u8>),
+}
+
+/// A Python process that executes a hook
+struct PythonWorker {
+    process: Child,
+    stdin: BufWriter<ChildStdin>,
+    stdout: BufReader<ChildStdout>,
+    shm_file: fs::File,
+    shm: memmap2::MmapMut,
+}
+impl PythonWorker {
+    fn spawn(hook_type: HookType, stage_name: &str, hook_code: &str, init_code: Option<&str>) -> Result<Self, String> {
+        let shm_path = shm_dir().join(format!("pipeless-{}", uuid::Uuid::new_v4()));
+        let worker = Self::spawn_with_shm(&shm_path, hook_type, stage_name, hook_code, init_code);
+        // Both processes keep the shared memory mapped, the file is no longer required
+        let _ = fs::remove_file(&shm_path);
+        worker
+    }
+
+    fn spawn_with_shm(
+        shm_path: &PathBuf,
+        hook_type: HookType, stage_name: &str, hook_code: &str, init_code: Option<&str>
+    ) -> Result<Self, String> {
+        let shm_file = fs::OpenOptions::new()
+            .read(true).write(true).create_new(true)
+            .open(shm_path)
+            .map_err(|err| format!("Unable to create the worker shared memory: {}", err))?;
+        shm_file.set_len(INITIAL_SHM_SIZE as u64)
+            .map_err(|err| format!("Unable to set the worker shared memory size: {}", err))?;
+        // SAFETY: the file is only modified by this worker and its process, which never access it concurrently
+        let shm = unsafe { memmap2::MmapMut::map_mut(&shm_file) }
+            .map_err(|err| format!("Unable to map the worker shared memory: {}", err))?;
+
+        let python = std::env::var(PYTHON_EXECUTABLE_ENV).unwrap_or("python3".to_string());
+        let mut process = Command::new(&python)
+            .arg("-c").arg(WORKER_CODE).arg(shm_path)
+            .stdin(Stdio::piped())
+            .stdout(Stdio::piped())
+            .stderr(Stdio::inherit())
+            .spawn()
+            .map_err(|err| format!("Unable to start Python worker with '{}': {}", python, err))?;
+        let stdin = BufWriter::new(process.stdin.take().ok_or("Unable to get the worker stdin")?);
+        let stdout = BufReader::new(process.stdout.take().ok_or("Unable to get the worker stdout")?);
+
+        let mut worker = Self { process, stdin, stdout, shm_file, shm };
+        worker.send(&json!({
+            "type": "init",
+            "stage_name": stage_name,
+            "hook_type": hook_type.to_string(),
+            "hook_code": hook_code,
+            "init_code": init_code,
+        }))?;
+        let msg = worker.recv()?;
+        match msg["type"].as_str() {
+            Some("ready") => Ok(worker),
+            Some("error") => Err(format!("Unable to load the hook in the Python worker: {}", msg["message"].as_str().unwrap_or_default())),
+            _ => Err(format!("Unexpected message from the Python worker: {}", msg)),
+        }
+    }
+
+    fn send(&mut self, msg: &Value) -> Result<(), String> {
+        self.send_with_payloads(msg, &[])
+    }
+
+    /// Sends a message followed by the data of its inline arrays
+    fn send_with_payloads(&mut self, msg: &Value, payloads: &[&[u8]]) -> Result<(), String> {
+        let data = serde_json::to_vec(msg)
+            .map_err(|err| format!("Unable to serialize message for the Python worker: {}", err))?;
+        self.stdin.write_all(&(data.len() as u32).to_le_bytes())
+            .and_then(|_| self.stdin.write_all(&data))
+            .and_then(|_| payloads.iter().try_for_each(|payload| self.stdin.write_all(payload)))
+            .and_then(|_| self.stdin.flush())
+            .map_err(|err| format!("Unable to send message to the Python worker: {}", err))
+    }
+
+    fn recv_bytes(&mut self, size: usize) -> Result<Vec<u8>, String> {
+        let mut data = vec![0u8; size];
+        self.stdout.read_exact(&mut data)
+            .map_err(|err| format!("Unable to read from the Python worker: {}", err))?;
+        Ok(data)
+    }
+
+    fn recv(&mut self) -> Result<Value, String> {
+        let size_bytes = self.recv_bytes(4)?;
+        let size = u32::from_le_bytes([size_bytes[0], size_bytes[1], size_bytes[2], size_bytes[3]]) as usize;
+        let data = self.recv_bytes(size)?;
+        serde_json::from_slice(&data)
+            .map_err(|err| format!("Unable to parse message from the Python worker: {}", err))
+    }
+
+    /// Receives the value of a KV store message and its inline arrays
+    fn recv_value(&mut self, msg: &Value) -> Result<UserData, String> {
+        let mut arrays = HashMap::new();
+        for array in msg["arrays"].as_array().map_or(&[][..], |arrays| &arrays[..]) {
+            let shape = array_shape(array);
+            let bytes = self.recv_bytes(shape.iter().product::<usize>() * dtype_item_size(&array["dtype"]))?;
+            match user_data_array_from_bytes(&array["dtype"], shape, &bytes) {
+                Ok(value) => { arrays.insert(array["name"].as_str().unwrap_or_default().to_string(), value); },
+                Err(err) => warn!("Unable to recover a KV store array from the Python worker: {}", err),
+            }
+        }
+        Ok(user_data_from_json(&msg["value"], &mut arrays))
+    }
+
+    /// Sends the values requested by the hook. The arrays follow the message.
+    fn send_values(&mut self, values: &[Option<UserData>]) -> Result<(), String> {
+        let mut specs = Vec::new();
+        let mut payloads = Vec::new();
+        let mut json_values = Vec::with_capacity(values.len());
+        for value in values {
+            json_values.push(match value {
+                Some(value) => user_data_to_json(value, &mut |data, shape, dtype| {
+                    payloads.push(data);
+                    specs.push(json!({ "shape": shape, "dtype": dtype }));
+                    json!({ "shape": shape, "dtype": dtype, "index": specs.len() - 1 })
+                }),
+                None => Value::Null,
+            });
+        }
+        let found: Vec<bool> = values.iter().map(Option::is_some).collect();
+        self.send_with_payloads(&json!({ "values": json_values, "found": found, "arrays": specs }), &payloads)
+    }
+
+    /// Receives messages until the hook result, serving the KV store requests of the hook
+    fn recv_result(&mut self) -> Result<Value, String> {
+        loop {
+            let msg = self.recv()?;
+            let ttl = msg["ttl"].as_f64().filter(|ttl| *ttl > 0.0).map(std::time::Duration::from_secs_f64);
+            match msg["type"].as_str() {
+                Some("kvs_set") => {
+                    let value = self.recv_value(&msg)?;
+                    store::KV_STORE.set_value(msg["key"].as_str().unwrap_or_default(), value, ttl);
+                },
+                Some("kvs_mset") => {
+                    if let UserData::Dictionary(entries) = self.recv_value(&msg)? {
+                        store::KV_STORE.mset(entries.into_iter().collect(), ttl);
+                    }
+                },
+                Some("kvs_mget") => {
+                    let keys: Vec<String> = msg["keys"].as_array().map_or_else(Vec::new, |keys| {
+                        keys.iter().map(|key| key.as_str().unwrap_or_default().to_string()).collect()
+                    });
+                    let values = store::KV_STORE.mget(&keys);
+                    self.send_values(&values)?;
+                },
+                Some("kvs_incr") => {
+                    let response = match store::KV_STORE.incr(msg["key"].as_str().unwrap_or_default(), msg["amount"].as_i64().unwrap_or(1)) {
+                        Ok(value) => json!({ "value": value }),
+                        Err(err) => json!({ "error": err }),
+                    };
+                    self.send(&response)?;
+                },
+                Some("kvs_delete") => store::KV_STORE.delete(msg["key"].as_str().unwrap_or_default()),
+                _ => return Ok(msg),
+            }
+        }
+    }
+
+    fn ensure_shm_size(&mut self, size: usize) -> Result<(), String> {
+        if size <= self.shm.len() {
+            return Ok(());
+        }
+        self.shm_file.set_len(size as u64)
+            .map_err(|err| format!("Unable to grow the worker shared memory: {}", err))?;
+        // SAFETY: see spawn_with_shm
+        self.shm = unsafe { memmap2::MmapMut::map_mut(&self.shm_file) }
+            .map_err(|err| format!("Unable to map the worker shared memory: {}", err))?;
+        Ok(())
+    }
+
+    /// Executes the hook for a frame. Returns an error when the worker can't be used anymore.
+    fn exec(&mut self, mut frame: RgbFrame) -> Result<Option<Frame>, String> {
+        let request = {
+            // The arrays are copied to the shared memory in standard layout
+            let original_view = frame.get_original_pixels();
+            let original = original_view.as_standard_layout();
+            let modified_shared = frame.is_modified_shared();
+            let modified_view = frame.get_modified_pixels_view();
+            let modified = modified_view.as_standard_layout();
+            let inference_input: Vec<(Option<&String>, std::borrow::Cow<Tensor>)> = match frame.get_inference_input() {
+                InferenceInput::Default(tensor) => vec![(None, standard_tensor(tensor))],
+                InferenceInput::Named(tensors) => tensors.iter()
+                    .map(|(name, tensor)| (Some(name), standard_tensor(tensor)))
+                    .collect(),
+            };
+            let inference_output: Vec<(Option<&String>, ndarray::CowArray<f32, ndarray::IxDyn>)> = match frame.get_inference_output() {
+                InferenceOutput::Default(out) => vec![(None, out.as_standard_layout())],
+                InferenceOutput::OnnxInferenceOutput(outputs) => outputs.iter()
+                    .map(|(name, out)| (Some(name), out.as_standard_layout()))
+                    .collect(),
+            };
+
+            let mut layout = ShmLayout::new();
+            let original_spec = layout.add(original.as_slice().unwrap(), original.shape(), "uint8", true);
+            // When the modified pixels were not modified yet, the worker copies them from the original
+            let mut modified_spec = layout.add(modified.as_slice().unwrap(), modified.shape(), "uint8", !modified_shared);
+            modified_spec["initialized"] = json!(!modified_shared);
+            let mut input_specs = serde_json::Map::new();
+            let mut default_input_spec = Value::Null;
+            for (name, tensor) in &inference_input {
+                let spec = layout.add(tensor_as_bytes(tensor), tensor.shape(), tensor.get_type().as_str(), true);
+                match name {
+                    Some(name) => { input_specs.insert(name.to_string(), spec); },
+                    None => default_input_spec = spec,
+                }
+            }
+            let inference_input_spec = match frame.get_inference_input() {
+                InferenceInput::Default(_) => json!({ "kind": "default", "array": default_input_spec }),
+                InferenceInput::Named(_) => json!({ "kind": "dict", "arrays": input_specs }),
+            };
+            let mut output_specs = serde_json::Map::new();
+            let mut default_output_spec = Value::Null;
+            for (name, out) in &inference_output {
+                let spec = layout.add(f32_as_bytes(out.as_slice().unwrap()), out.shape(), "float32", true);
+                match name {
+                    Some(name) => { output_specs.insert(name.to_string(), spec); },
+                    None => default_output_spec = spec,
+                }
+            }
+            let inference_output_spec = match frame.get_inference_output() {
+                InferenceOutput::Default(_) => json!({ "kind": "default", "array": default_output_spec }),
+                InferenceOutput::OnnxInferenceOutput(_) => json!({ "kind": "dict", "arrays": output_specs }),
+            };
+
+            let user_data = user_data_to_json(frame.get_user_data(), &mut |data, shape, dtype| layout.add(data, shape, dtype, true));
+
+            self.ensure_shm_size(layout.size)?;
+            for (offset, data) in layout.arrays {
+                self.shm[offset..offset + data.len()].copy_from_slice(data);
+            }
+
+            json!({
+                "type": "frame",
+                "shm_size": self.shm.len(),
+                "fields": {
+                    "uuid": frame.get_uuid().to_string(),
+                    "width": frame.get_width(),
+                    "height": frame.get_height(),
+                    "pts": frame.get_pts().mseconds(),
+                    "dts": frame.get_dts().mseconds(),
+                    "duration": frame.get_duration().mseconds(),
+                    "fps": frame.get_fps(),
+                    "input_ts": frame.get_input_ts(),
+                    "pipeline_id": frame.get_pipeline_id().to_string(),
+                    "frame_number": frame.get_frame_number(),
+                    "letterbox": frame.get_letterbox().map(|letterbox| json!({
+                        "scale_x": letterbox.get_scale_x(),
+                        "scale_y": letterbox.get_scale_y(),
+                        "pad_x": letterbox.get_pad_x(),
+                        "pad_y": letterbox.get_pad_y(),
+                    })),
+                },
+                "user_data": user_data,
+                "original": original_spec,
+                "modified": modified_spec,
+                "inference_input": inference_input_spec,
+                "inference_output": inference_output_spec,
+            })
+        };
+        self.send(&request)?;
+
+        let result = self.recv_result()?;
+        match result["type"].as_str() {
+            Some("result") => {},
+            Some("error") => {
+                error!("Error executing hook: {}", result["message"].as_str().unwrap_or_default());
+                return Ok(None);
+            },
+            _ => return Err(format!("Unexpected message from the Python worker: {}", result)),
+        }
+
+        let empty_arrays = vec![];
+        let arrays = result["arrays"].as_array().unwrap_or(&empty_arrays);
+        // Read all the inline payloads first, they follow the result in order
+        let mut returned = Vec::with_capacity(arrays.len());
+        for array in arrays {
+            let shape = array_shape(array);
+            let item_size = dtype_item_size(&array["dtype"]);
+            let size = shape.iter().product::<usize>() * item_size;
+            let data = if array["inline"].as_bool().unwrap_or(false) {
+                ReturnedArray::Inline(self.recv_bytes(size)?)
+            } else {
+                let offset = array["offset"].as_u64().unwrap_or_default() as usize;
+                if offset + size > self.shm.len() {
+                    return Err("The Python worker returned an array out of the shared memory".to_string());
+                }
+                ReturnedArray::Shm(offset, size)
+            };
+            returned.push((array, shape, data));
+        }
+
+        let mut onnx_outputs = OnnxInferenceOutput::new();
+        let mut named_inputs = HashMap::new();
+        let mut user_data_arrays = HashMap::new();
+        for (array, shape, data) in returned {
+            let bytes = match &data {
+                ReturnedArray::Shm(offset, size) => &self.shm[*offset..*offset + *size],
+                ReturnedArray::Inline(bytes) => &bytes[..],
+            };
+            match array["field"].as_str() {
+                Some("modified") => match ndarray::ArrayD::from_shape_vec(shape, bytes.to_vec())
+                    .and_then(|modified| modified.into_dimensionality::<ndarray::Ix3>()) {
+                    Ok(modified) => frame.set_modified_pixels(modified),
+                    Err(err) => warn!("Unable to recover 'modified' from the Python worker: {}", err),
+                },
+                Some("inference_input") => {
+                    let tensor_type = array["dtype"].as_str().and_then(TensorType::from_str).unwrap_or(TensorType::F32);
+                    match tensor_from_bytes(tensor_type, shape, bytes) {
+                        Ok(tensor) => match array["name"].as_str() {
+                            Some(name) => { named_inputs.insert(name.to_string(), tensor); },
+                            None => frame.set_inference_input(InferenceInput::Default(tensor)),
+                        },
+                        Err(err) => warn!("Unable to recover 'inference_input' from the Python worker: {}", err),
+                    }
+                },
+                Some("user_data") => {
+                    let name = array["name"].as_str().unwrap_or_default().to_string();
+                    match user_data_array_from_bytes(&array["dtype"], shape, bytes) {
+                        Ok(value) => { user_data_arrays.insert(name, value); },
+                        Err(err) => warn!("Unable to recover a user data array from the Python worker: {}", err),
+                    }
+                },
+                Some(field) => match ndarray::ArrayD::from_shape_vec(shape, f32_from_bytes(bytes)) {
+                    Ok(value) => match (field, array["name"].as_str()) {
+                        ("inference_output", Some(name)) => { onnx_outputs.insert(name.to_string(), value); },
+                        ("inference_output", None) => frame.set_inference_output(InferenceOutput::Default(value)),
+                        _ => warn!("Ignoring unknown field '{}' returned by the Python worker", field),
+                    },
+                    Err(err) => warn!("Unable to recover '{}' from the Python worker: {}", field, err),
+                },
+                None => warn!("The Python worker returned an array without field"),
+            }
+        }
+        if result["inference_input_kind"] == "dict" {
+            frame.set_inference_input(InferenceInput::Named(named_inputs));
+        }
+        if result["inference_output_kind"] == "dict" {
+            frame.set_inference_output(InferenceOutput::OnnxInferenceOutput(onnx_outputs));
+        }
+        if let Some(user_data) = result.get("user_data") {
+            frame.set_user_data(user_data_from_json(user_data, &mut user_data_arrays));
+        }
+
+        Ok(Some(Frame::RgbFrame(frame)))
+    }
+}
+impl Drop for PythonWorker {
+    fn drop(&mut self) {
+        let _ = self.process.kill();
+        let _ = self.process.wait();
+    }
+}
+
+/// Executes a stateless Python hook on a pool of worker processes instead of the embedded
+/// interpreter, so hooks of different frames run in parallel without sharing the GIL.
+/// Each worker loads the hook module and runs the stage init to create its own context,
+/// thus, the stage context is not shared between workers.
+/// The frame arrays are shared with the workers through shared memory.
+pub struct PythonWorkerPool {
+    idle_workers: Mutex<Vec<PythonWorker>>,
+    worker_available: Condvar,
+    alive_workers: AtomicUsize,
+    hook_type: HookType,
+    stage_name: String,
+    hook_code: String,
+    init_code: Option<String>,
+}
+impl PythonWorkerPool {
+    pub fn new(
+        hook_type: HookType, stage_name: &str, hook_code: &str, init_code: Option<&str>, num_workers: usize
+    ) -> Result<Self, String> {
+        let workers = (0..num_workers).into_par_iter()
+            .map(|_| PythonWorker::spawn(hook_type, stage_name, hook_code, init_code))
+            .collect::<Result<Vec<PythonWorker>, String>>()?;
+        info!("\t\tStarted {} Python workers for {}-{}", workers.len(), stage_name, hook_type);
+
+        Ok(Self {
+            alive_workers: AtomicUsize::new(workers.len()),
+            idle_workers: Mutex::new(workers),
+            worker_available: Condvar::new(),
+            hook_type,
+            stage_name: stage_name.to_string(),
+            hook_code: hook_code.to_string(),
+            init_code: init_code.map(|c| c.to_string()),
+        })
+    }
+
+    fn acquire_worker(&self) -> Option<PythonWorker> {
+        let mut idle_workers = self.idle_workers.lock().unwrap();
+        loop {
+            if let Some(worker) = idle_workers.pop() {
+                return Some(worker);
+            }
+            if self.alive_workers.load(Ordering::SeqCst) == 0 {
+                return None;
+            }
+            idle_workers = self.worker_available.wait(idle_workers).unwrap();
+        }
+    }
+
+    fn release_worker(&self, worker: PythonWorker) {
+        self.idle_workers.lock().unwrap().push(worker);
+        self.worker_available.notify_one();
+    }
+
+    /// Replaces a worker that failed. The pool shrinks if it can't be replaced.
+    fn replace_worker(&self) {
+        match PythonWorker::spawn(self.hook_type, &self.stage_name, &self.hook_code, self.init_code.as_deref()) {
+            Ok(worker) => self.release_worker(worker),
+            Err(err) => {
+                error!("Unable to restart Python worker for {}-{}: {}", self.stage_name, self.hook_type, err);
+                self.alive_workers.fetch_sub(1, Ordering::SeqCst);
+                // Wake up the waiting frames in case there are no workers left
+                self.worker_available.notify_all();
+            }
+        }
+    }
+}
+impl HookTrait for PythonWorkerPool {
+    /// Executes the hook on the next idle worker. The stage context is created by each worker.
+    fn exec_hook(&self, frame: Frame, _stage_context: &Context) -> Option<Frame> {
+        let mut worker = match self.acquire_worker() {
+            Some(w) => w,
+            None => {
+                error!("There are no Python workers alive for {}-{}. Skipping execution", self.stage_name, self.hook_type);
+                return None;
+            }
+        };
+        let res = match frame {
+            Frame::RgbFrame(rgb_frame) => worker.exec(rgb_frame),
+        };
+        match res {
+            Ok(out_frame) => {
+                self.release_worker(worker);
+                out_frame
+            },
+            Err(err) => {
+                error!("Python worker for {}-{} failed, restarting it: {}", self.stage_name, self.hook_type, err);
+                drop(worker);
+                self.replace_worker();
+                None
+            }
+        }
+    }
+}
@@ -2,5 +2,8 @@ pub mod hook;
 pub mod parser;
 pub mod stage;
 pub mod path;
+pub mod sequencer;
+pub mod interval;
+pub mod watcher;
 pub mod languages;
 pub mod inference;
\ No newline at end of file
@@ -1,4 +1,4 @@
-use std::{fs, path::PathBuf, collections::HashMap, sync::Arc};
+use std::{fs, path::PathBuf, sync::Arc};
 use log::{warn, info, error};
 
 use crate as pipeless;
@@ -27,9 +27,10 @@ fn for_each_dir_file<F>(dir_path: &str, mut func: F)
     }
 }
 
-pub fn load_stages(dir_path: &str) -> HashMap<String, pipeless::stages::stage::Stage> {
-    info!("⚙️  Loading stages from {}", dir_path);
-    let mut stages = HashMap::<String, pipeless::stages::stage::Stage>::new();
+/// Returns the name and directory of every stage of the project, without loading them
+pub fn find_stages(dir_path: &str) -> Vec<(String, PathBuf)> {
+    info!("⚙️  Finding stages in {}", dir_path);
+    let mut stages = vec![];
     for_each_dir_file(dir_path, |path_str, path| {
         if path.is_file() {
             warn!("
@@ -44,20 +45,31 @@ pub fn load_stages(dir_path: &str) -> HashMap<String, pipeless::stages::stage::S
                 error!("⚠️  Could not get directory name from path: {}", path_str);
                 return;
             }
-            info!("⏳ Loading stage '{}' from {}", stage_name, path_str);
-            let mut stage = pipeless::stages::stage::Stage::new(&stage_name);
-            for_each_dir_file(path_str, |hook_path_str, hook_path| {
-                info!("\tLoading hook from {}", hook_path_str);
-                parse_hook(hook_path, &mut stage);
-            });
-            stages.insert(stage_name.to_string(), stage);
+            stages.push((stage_name, path.clone()));
         }
     });
 
     stages
 }
 
-fn parse_hook(path: &PathBuf, stage: &mut pipeless::stages::stage::Stage) {
+/// Loads a stage from its directory: compiles the hooks, runs the stage init and creates the inference sessions.
+/// When python_workers is greater than 0, stateless Python hooks run on that number of worker processes
+pub fn load_stage(stage_name: &str, path: &PathBuf, python_workers: usize) -> pipeless::stages::stage::Stage {
+    let path_str = path.to_string_lossy();
+    info!("⏳ Loading stage '{}' from {}", stage_name, path_str);
+    let mut stage = pipeless::stages::stage::Stage::new(stage_name);
+    // The hooks depend on the context mode, so it must be known before loading them
+    let context_per_stream = fs::read_to_string(path.join("init.py"))
+        .map(|init_code| init_code.lines().next() == Some("# make context per stream"))
+        .unwrap_or(false);
+    for_each_dir_file(&path_str, |hook_path_str, hook_path| {
+        info!("\tLoading hook from {}", hook_path_str);
+        parse_hook(hook_path, &mut stage, python_workers, context_per_stream);
+    });
+    stage
+}
+
+fn parse_hook(path: &PathBuf, stage: &mut pipeless::stages::stage::Stage, python_workers: usize, context_per_stream: bool) {
     if let Some(file_name) = path.file_name() {
         let hook_file_path = file_name.to_str()
             .expect("Unable to convert filename into string");
@@ -75,36 +87,83 @@ fn parse_hook(path: &PathBuf, stage: &mut pipeless::stages::stage::Stage) {
             //       or build the user application as a portable binary with the hooks embeeded?
             match fs::read_to_string(path) {
                 Ok(hook_code) =>  {
-                    if hook_type_str == "init" {
+                    if hook_type_str == "stage" {
+                        // stage.json contains the stage settings, it is not a hook
+                        if !matches!(hook_language.get_language(), pipeless::stages::languages::language::Language::Json) {
+                            warn!("Ignoring stage settings file {}. The stage settings must be defined in stage.json", hook_file_path);
+                            return;
+                        }
+                        let stage_def: serde_json::Value = serde_json::from_str(&hook_code)
+                            .expect(format!("Error parsing Json from the stage.json of stage '{}'", stage.get_name()).as_str());
+                        match pipeless::stages::interval::IntervalParams::from_raw_data(&stage_def) {
+                            Ok(Some(params)) => {
+                                info!("\t\tStage '{}' will not run on every frame", stage.get_name());
+                                stage.set_interval(pipeless::stages::interval::StageInterval::new(params));
+                            },
+                            Ok(None) => {},
+                            Err(err) => panic!("The stage.json of the stage '{}' is wrong. {}", stage.get_name(), err),
+                        }
+                    } else if hook_type_str == "init" {
                         // TODO: Right now the context can be accessed only from hooks written in the same
                         //       language as the context.
                         //       One should be able to create init.py and access the context rom pre-process.js
                         //       A way of supporting it could be to export an interfafce from Rust to each language to
                         //       manipulate the context instead of passing the object from Rust to the hook language.
-                        let stage_context =  build_context(stage.get_name(), hook_language, &hook_code);
-                        stage.set_context(stage_context);
+                        if context_per_stream && matches!(hook_language.get_language(), pipeless::stages::languages::language::Language::Python) {
+                            info!("\t\tThe context of stage '{}' will be created per stream", stage.get_name());
+                            let stage_name = stage.get_name().to_string();
+                            let language = *hook_language.get_language();
+                            let factory = move |_pipeline_id: &uuid::Uuid| -> pipeless::stages::stage::Context {
+                                build_context(&stage_name, &language, &hook_code)
+                            };
+                            stage.set_context_per_stream(Arc::new(factory));
+                        } else {
+                            let stage_context =  build_context(stage.get_name(), hook_language.get_language(), &hook_code);
+                            stage.set_context(stage_context);
+                        }
                     } else {
+                        // The Python workers run the stage init by themselves, so they can't keep a context per stream
+                        let python_workers = if context_per_stream && python_workers > 0 {
+                            warn!("Python workers are not used by stage '{}' because its context is created per stream", stage.get_name());
+                            0
+                        } else {
+                            python_workers
+                        };
+                        let init_code = match hook_language.get_language() {
+                            pipeless::stages::languages::language::Language::Python if python_workers > 0 =>
+                                fs::read_to_string(path.with_file_name("init.py")).ok(),
+                            _ => None,
+                        };
                         let hook;
                         if hook_type_str == "pre-process" || hook_type_str == "pre_process" {
                             hook = build_hook(
                                 stage.get_name(),
                                 hook_language,
                                 pipeless::stages::hook::HookType::PreProcess,
-                                &hook_code
+                                &hook_code,
+                                python_workers,
+                                init_code.as_deref(),
+                                context_per_stream,
                             );
                         } else if hook_type_str == "process" {
                             hook = build_hook(
                                 stage.get_name(),
                                 hook_language,
                                 pipeless::stages::hook::HookType::Process,
-                                &hook_code
+                                &hook_code,
+                                python_workers,
+                                init_code.as_deref(),
+                                context_per_stream,
                             );
                         } else if hook_type_str == "post-process" ||  hook_type_str == "post_process" {
                             hook = build_hook(
                                 stage.get_name(),
                                 hook_language,
                                 pipeless::stages::hook::HookType::PostProcess,
-                                &hook_code
+                                &hook_code,
+                                python_workers,
+                                init_code.as_deref(),
+                                context_per_stream,
                             );
                         } else {
                             warn!("Ignoring unsupported hook type: {}", hook_type_str);
@@ -130,28 +189,60 @@ fn build_hook(
     lang: &pipeless::stages::languages::language::LanguageDef,
     hook_type: HookType,
     hook_code: &str,
+    python_workers: usize,
+    init_code: Option<&str>,
+    context_per_stream: bool,
 ) -> pipeless::stages::hook::Hook {
     match lang.get_language() {
         pipeless::stages::languages::language::Language::Python => {
-            let py_hook = pipeless::stages::languages::python::PythonHook::new(
-                hook_type, stage_name, hook_code
-            );
-
             // The first line of the file can indicate if the hook must be stateful
+            // and if the state must be kept per stream
             let mut is_stateful = false;
+            let mut is_stateful_per_stream = false;
             if let Some(first_line) = hook_code.lines().next() {
                 if first_line == "# make stateful" {
                     is_stateful = true;
+                } else if first_line == "# make stateful per stream" {
+                    is_stateful_per_stream = true;
                 }
             } else {
                 warn!("The hook is empty");
             }
+            // The state of the stage lives in the stream context, so there is no need to lock the hook for all the streams
+            if is_stateful && context_per_stream {
+                is_stateful = false;
+                is_stateful_per_stream = true;
+            }
 
-            if is_stateful {
+            if is_stateful_per_stream {
+                info!("\t\tCreating stateful per stream hook for {}-{}", stage_name, hook_type);
+                let stage_name = stage_name.to_string();
+                let hook_code = hook_code.to_string();
+                let factory = move |pipeline_id: &uuid::Uuid| -> Arc<tokio::sync::Mutex<dyn pipeless::stages::hook::HookTrait>> {
+                    Arc::new(tokio::sync::Mutex::new(
+                        pipeless::stages::languages::python::PythonHook::new_for_stream(
+                            hook_type, &stage_name, &hook_code, pipeline_id
+                        )
+                    ))
+                };
+                pipeless::stages::hook::Hook::new_stateful_per_stream(hook_type, Arc::new(factory))
+            } else if is_stateful {
                 info!("\t\tCreating stateful hook for {}-{}", stage_name, hook_type);
+                let py_hook = pipeless::stages::languages::python::PythonHook::new(
+                    hook_type, stage_name, hook_code
+                );
                 pipeless::stages::hook::Hook::new_stateful(hook_type, Arc::new(tokio::sync::Mutex::new(py_hook)))
+            } else if python_workers > 0 {
+                info!("\t\tCreating stateless hook for {}-{} on {} Python workers", stage_name, hook_type, python_workers);
+                let py_pool = pipeless::stages::languages::python_workers::PythonWorkerPool::new(
+                    hook_type, stage_name, hook_code, init_code, python_workers
+                ).unwrap_or_else(|err| panic!("Unable to start the Python workers for {}-{}. {}", stage_name, hook_type, err));
+                pipeless::stages::hook::Hook::new_stateless(hook_type, Arc::new(py_pool))
             } else {
                 info!("\t\tCreating stateless hook for {}-{}", stage_name, hook_type);
+                let py_hook = pipeless::stages::languages::python::PythonHook::new(
+                    hook_type, stage_name, hook_code
+                );
                 pipeless::stages::hook::Hook::new_stateless(hook_type, Arc::new(py_hook))
             }
         },
@@ -180,7 +271,6 @@ fn build_hook(
                 panic!("The json definition of the hook '{}' from the stage '{}' should include the field 'inference_params' as an object", hook_type, stage_name);
             }
             let session_params = pipeless::stages::inference::session::SessionParams::from_raw_data(stage_name, &runtime, raw_session_params);
-            let inference_hook = pipeless::stages::inference::hook::InferenceHook::new(&runtime, session_params, model_uri.as_str().unwrap());
 
             let mut is_stateful = false;
             let make_stateful_v = &inference_def["make_stateful"];
@@ -192,6 +282,32 @@ fn build_hook(
                 }
             }
 
+            let mut batching_params = pipeless::stages::inference::batching::BatchingParams::from_raw_data(&inference_def);
+            if batching_params.is_some() && is_stateful {
+                // Stateful hooks process a single frame at a time
+                warn!("Batching is not supported for stateful hooks. Disabling batching for {}-{}", stage_name, hook_type);
+                batching_params = None;
+            }
+            let pre_process = match pipeless::stages::inference::preprocessing::PreProcessParams::from_raw_data(&inference_def["pre_process"]) {
+                Ok(params) => params,
+                Err(err) => panic!("The json definition of the hook '{}' from the stage '{}' is wrong. {}", hook_type, stage_name, err),
+            };
+
+            let post_process = match pipeless::stages::inference::postprocessing::PostProcessParams::from_raw_data(&inference_def["post_process"]) {
+                Ok(params) => params,
+                Err(err) => panic!("The json definition of the hook '{}' from the stage '{}' is wrong. {}", hook_type, stage_name, err),
+            };
+
+            let motion_gate = match pipeless::stages::inference::motion::MotionGateParams::from_raw_data(&inference_def["motion_gate"]) {
+                Ok(params) => params.map(|params| pipeless::stages::inference::motion::MotionGate::new(params, stage_name)),
+                Err(err) => panic!("The json definition of the hook '{}' from the stage '{}' is wrong. {}", hook_type, stage_name, err),
+            };
+
+            let inference_hook = pipeless::stages::inference::hook::InferenceHook::new(
+                stage_name, &runtime, session_params, model_uri.as_str().unwrap(),
+                batching_params, pre_process, post_process, motion_gate
+            );
+
             if is_stateful {
                 info!("\t\tCreating stateful hook for {}-{}", stage_name, hook_type);
                 pipeless::stages::hook::Hook::new_stateful(hook_type, Arc::new(tokio::sync::Mutex::new(inference_hook)))
@@ -205,10 +321,10 @@ fn build_hook(
 
 fn build_context(
     stage_name: &str,
-    lang: &pipeless::stages::languages::language::LanguageDef,
+    lang: &pipeless::stages::languages::language::Language,
     init_code: &str
 ) -> pipeless::stages::stage::Context {
-    let stage_context =  match lang.get_language() {
+    let stage_context =  match lang {
         pipeless::stages::languages::language::Language::Python => pipeless::stages::stage::Context::PythonContext(
             pipeless::stages::languages::python::PythonStageContext::init_context(stage_name, init_code)
         ),
@@ -1,52 +1,321 @@
-use std::{collections::HashMap, fmt};
-use log::warn;
+use std::{collections::HashMap, fmt, path::PathBuf, sync::{Arc, RwLock}};
+use futures::future::{BoxFuture, FutureExt, join_all};
+use log::{error, info, warn};
+use rayon::prelude::*;
 use serde_derive::{Serialize, Deserialize};
 
 use crate as pipeless;
 
-/// The frame path is the ordered list of stages names through which a frame have to pass.
+/// Predicate over the frame user data that decides if a branch of the frame path runs
+#[derive(
+    Clone,Debug,Serialize,Deserialize,PartialEq
+)]
+pub enum BranchCondition {
+    IsSet(String), // [key]: the user data has the key with a truthy value
+    IsNotSet(String), // [!key]
+    Equals(String, String), // [key=value]
+}
+impl BranchCondition {
+    fn parse(condition: &str) -> Result<Self, String> {
+        let condition = condition.trim();
+        let parsed = if let Some(key) = condition.strip_prefix('!') {
+            BranchCondition::IsNotSet(key.trim().to_string())
+        } else if let Some((key, value)) = condition.split_once('=') {
+            BranchCondition::Equals(key.trim().to_string(), value.trim().to_string())
+        } else {
+            BranchCondition::IsSet(condition.to_string())
+        };
+        match &parsed {
+            BranchCondition::IsSet(key) | BranchCondition::IsNotSet(key) | BranchCondition::Equals(key, _) if key.is_empty() =>
+                Err(format!("Missing user data key in condition '[{}]'", condition)),
+            _ => Ok(parsed),
+        }
+    }
+
+    fn matches(&self, user_data: &pipeless::data::UserData) -> bool {
+        match self {
+            BranchCondition::IsSet(key) => user_data.get(key).map_or(false, is_truthy),
+            BranchCondition::IsNotSet(key) => !user_data.get(key).map_or(false, is_truthy),
+            BranchCondition::Equals(key, expected) => match user_data.get(key) {
+                Some(pipeless::data::UserData::String(value)) => value == expected,
+                Some(pipeless::data::UserData::Bool(value)) => value.to_string() == *expected,
+                Some(pipeless::data::UserData::Integer(value)) => value.to_string() == *expected,
+                Some(pipeless::data::UserData::Integer64(value)) => value.to_string() == *expected,
+                Some(pipeless::data::UserData::Float(value)) => expected.parse::<f64>().map_or(false, |expected| *value == expected),
+                _ => false,
+            },
+        }
+    }
+}
+impl fmt::Display for BranchCondition {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        match self {
+            BranchCondition::IsSet(key) => write!(f, "[{}]", key),
+            BranchCondition::IsNotSet(key) => write!(f, "[!{}]", key),
+            BranchCondition::Equals(key, value) => write!(f, "[{}={}]", key, value),
+        }
+    }
+}
+
+fn is_truthy(value: &pipeless::data::UserData) -> bool {
+    match value {
+        pipeless::data::UserData::Empty => false,
+        pipeless::data::UserData::Bool(b) => *b,
+        pipeless::data::UserData::Integer(i) => *i != 0,
+        pipeless::data::UserData::Integer64(i) => *i != 0,
+        pipeless::data::UserData::Float(f) => *f != 0.0,
+        pipeless::data::UserData::String(s) => !s.is_empty(),
+        pipeless::data::UserData::Bytes(b) => !b.is_empty(),
+        pipeless::data::UserData::Array(arr) => !arr.is_empty(),
+        pipeless::data::UserData::Dictionary(dict) => !dict.is_empty(),
+        pipeless::data::UserData::F32Array(arr) => arr.len() > 0,
+        pipeless::data::UserData::F64Array(arr) => arr.len() > 0,
+        pipeless::data::UserData::I32Array(arr) => arr.len() > 0,
+        pipeless::data::UserData::I64Array(arr) => arr.len() > 0,
+        pipeless::data::UserData::U8Array(arr) => arr.len() > 0,
+        pipeless::data::UserData::BoolArray(arr) => arr.len() > 0,
+    }
+}
+
+/// Branch of a parallel group of the frame path
+#[derive(
+    Clone,Debug,Serialize,Deserialize,PartialEq
+)]
+pub struct PathBranch {
+    condition: Option<BranchCondition>,
+    nodes: Vec<PathNode>,
+}
+impl PathBranch {
+    /// Name used for the outputs of the branch when they can't be merged. The last stage of the branch.
+    fn get_name(&self) -> String {
+        match self.nodes.last() {
+            Some(PathNode::Stage(stage_name)) => stage_name.clone(),
+            Some(PathNode::Parallel(branches)) => branches.iter().map(|b| b.get_name()).collect::<Vec<_>>().join("_"),
+            None => String::new(),
+        }
+    }
+}
+
+#[derive(
+    Clone,Debug,Serialize,Deserialize,PartialEq
+)]
+pub enum PathNode {
+    Stage(String),
+    Parallel(Vec<PathBranch>), // Branches that run concurrently over the same frame
+}
+
+/// Recursive descent parser of the frame path:
+///   path   := step ("/" step)*
+///   step   := stage_name | "(" branch ("|" branch)* ")"
+///   branch := ["[" condition "]"] path
+struct PathParser<'a> {
+    chars: std::iter::Peekable<std::str::Chars<'a>>,
+}
+impl<'a> PathParser<'a> {
+    fn skip_whitespace(&mut self) {
+        while self.chars.next_if(|c| c.is_whitespace()).is_some() {}
+    }
+
+    fn parse_path(&mut self) -> Result<Vec<PathNode>, String> {
+        let mut nodes = vec![self.parse_step()?];
+        loop {
+            self.skip_whitespace();
+            if self.chars.next_if_eq(&'/').is_none() {
+                return Ok(nodes);
+            }
+            nodes.push(self.parse_step()?);
+        }
+    }
+
+    fn parse_step(&mut self) -> Result<PathNode, String> {
+        self.skip_whitespace();
+        if self.chars.next_if_eq(&'(').is_some() {
+            let mut branches = vec![self.parse_branch()?];
+            loop {
+                self.skip_whitespace();
+                match self.chars.next() {
+                    Some('|') => branches.push(self.parse_branch()?),
+                    Some(')') => return Ok(PathNode::Parallel(branches)),
+                    Some(c) => return Err(format!("Unexpected '{}' in parallel group, expected '|' or ')'", c)),
+                    None => return Err("Missing ')' at the end of parallel group".to_string()),
+                }
+            }
+        }
+
+        let mut stage_name = String::new();
+        while let Some(c) = self.chars.next_if(|c| !"/|()[]".contains(*c)) {
+            stage_name.push(c);
+        }
+        let stage_name = stage_name.trim();
+        if stage_name.is_empty() {
+            return Err(match self.chars.peek() {
+                Some(c) => format!("Expected a stage name, found '{}'", c),
+                None => "Expected a stage name at the end of the path".to_string(),
+            });
+        }
+        Ok(PathNode::Stage(stage_name.to_string()))
+    }
+
+    fn parse_branch(&mut self) -> Result<PathBranch, String> {
+        self.skip_whitespace();
+        let mut condition = None;
+        if self.chars.next_if_eq(&'[').is_some() {
+            let mut condition_str = String::new();
+            loop {
+                match self.chars.next() {
+                    Some(']') => break,
+                    Some(c) => condition_str.push(c),
+                    None => return Err("Missing ']' at the end of branch condition".to_string()),
+                }
+            }
+            condition = Some(BranchCondition::parse(&condition_str)?);
+        }
+        Ok(PathBranch { condition, nodes: self.parse_path()? })
+    }
+}
+
+/// The frame path is the graph of stages through which a frame has to pass.
+/// Stages are separated by slashes and run in order. A group of branches between parentheses,
+/// separated by '|', runs concurrently over the same frame and the results are merged when all
+/// the branches finish. A branch can start with a condition over the user data, between square
+/// brackets, to run only when the condition matches. For example:
+///   detector/(faces | [vehicle] plates/ocr)/publish
+/// The conditions are [key] (the key is set with a truthy value), [!key] and [key=value].
 #[derive(
     Clone,Debug,Serialize,Deserialize,PartialEq
 )]
 pub struct FramePath {
-    path: Vec<String>,
+    path: String,
+    nodes: Vec<PathNode>,
 }
 impl FramePath {
-    /// Receives a string with the stages list separated by slashes.
+    /// Receives a string with the stages graph.
     /// Returns a Result with the framepath or with an error when the path is invalid
     pub fn new(path: &str, frame_path_executor: &FramePathExecutor) -> Result<Self, String> {
-        let stages_names: Vec<String> =
-            path.trim().split("/").map(|s| s.to_string()).collect();
+        let mut parser = PathParser { chars: path.trim().chars().peekable() };
+        let nodes = parser.parse_path()
+            .map_err(|err| format!("Invalid frame path '{}': {}", path, err))?;
+        if let Some(c) = parser.chars.next() {
+            return Err(format!("Invalid frame path '{}': unexpected '{}'", path, c));
+        }
 
         let frame_path = Self {
-            path: stages_names
+            path: path.trim().to_string(),
+            nodes,
         };
 
         frame_path_executor.check_path(frame_path)
     }
 
-    fn get_path(&self) -> &Vec<String> {
-        &self.path
+    fn get_nodes(&self) -> &Vec<PathNode> {
+        &self.nodes
     }
 }
 // Allow to_string in frame_path
 impl fmt::Display for FramePath {
     fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
-        write!(f, "{}", self.path.join("/"))
+        write!(f, "{}", self.path)
     }
 }
 
 /// The same FramePathExecutor instance is created when pipeless is called
 /// and the same instance is used by all pipelines and streams.
 /// It maintains an instance of each user defined stage.
+/// The stages are loaded in parallel at start or, when lazy, on the first frame that reaches them.
+/// A stage can be replaced by a new version at any time. The frames take the stage
+/// when they reach it, so the frames already running finish on the previous version.
 pub struct FramePathExecutor {
-    stages: HashMap<String, pipeless::stages::stage::Stage>,
+    stages: RwLock<HashMap<String, Arc<pipeless::stages::stage::LazyStage>>>,
 }
 impl FramePathExecutor {
-    pub fn new(project_dir: &str) -> Self {
-        Self {
-            stages: pipeless::stages::parser::load_stages(project_dir)
+    pub fn new(project_dir: &str, python_workers: usize, lazy_stages: bool) -> Self {
+        let stages: HashMap<String, Arc<pipeless::stages::stage::LazyStage>> =
+            pipeless::stages::parser::find_stages(project_dir).into_iter()
+                .map(|(stage_name, path)| {
+                    let stage = pipeless::stages::stage::LazyStage::new(&stage_name, path, python_workers);
+                    (stage_name, Arc::new(stage))
+                })
+                .collect();
+
+        if !lazy_stages {
+            let start = std::time::Instant::now();
+            stages.par_iter().for_each(|(_, stage)| stage.load_blocking());
+            info!("✅ {} stages loaded in {:.2?}", stages.len(), start.elapsed());
         }
+
+        Self { stages: RwLock::new(stages) }
+    }
+
+    /// Creates the executor from stages that are already loaded
+    pub fn from_stages(stages: Vec<pipeless::stages::stage::Stage>) -> Self {
+        let stages = stages.into_iter()
+            .map(|stage| {
+                let stage = pipeless::stages::stage::LazyStage::from_stage(stage);
+                (stage.get_name().to_string(), Arc::new(stage))
+            })
+            .collect();
+        Self { stages: RwLock::new(stages) }
+    }
+
+    /// Returns the version of the stage in use
+    fn get_stage(&self, stage_name: &str) -> Option<Arc<pipeless::stages::stage::LazyStage>> {
+        self.stages.read().unwrap().get(stage_name).cloned()
+    }
+
+    /// Returns the name and directory of every stage
+    pub fn get_stage_paths(&self) -> Vec<(String, PathBuf)> {
+        self.stages.read().unwrap().values()
+            .map(|stage| (stage.get_name().to_string(), stage.get_path().clone()))
+            .collect()
+    }
+
+    /// Loads a new version of the stage from its directory and replaces the current one once it is ready.
+    /// The frames already running finish on the previous version. Stages that were not loaded yet
+    /// are only replaced, they load the new version when first used.
+    /// When the new version fails to load the current one is kept.
+    pub async fn reload_stage(&self, stage_name: &str) -> Result<pipeless::stages::stage::StageStatus, String> {
+        let current_stage = self.get_stage(stage_name)
+            .ok_or_else(|| format!("{} stage does not exist", stage_name))?;
+        let new_stage = Arc::new(current_stage.new_version()?);
+        info!("⏳ Reloading stage '{}' as version {}", stage_name, new_stage.get_version());
+        if current_stage.get_state() != pipeless::stages::stage::StageState::Cold {
+            match new_stage.get_or_load().await {
+                // The streams that are running continue from their current frame
+                Some(stage) => stage.resume_streams(),
+                None => return Err(format!(
+                    "Unable to load the new version of the stage '{}', keeping version {}",
+                    stage_name, current_stage.get_version()
+                )),
+            }
+        }
+        self.stages.write().unwrap().insert(stage_name.to_string(), new_stage.clone());
+        // The cached outputs were produced by the previous version
+        pipeless::stages::inference::motion::INFERENCE_CACHE.clean_stage(stage_name);
+        info!("✅ Stage '{}' replaced by version {}", stage_name, new_stage.get_version());
+        Ok(new_stage.get_status())
+    }
+
+    /// Starts loading in the background the stages of a frame path that are not loaded yet,
+    /// so the first frames of the stream don't wait for all of them in sequence
+    pub fn preload(&self, frame_path: &FramePath) {
+        let mut stage_names = vec![];
+        collect_stage_names(frame_path.get_nodes(), &mut stage_names);
+        for stage_name in stage_names {
+            if let Some(stage) = self.get_stage(stage_name) {
+                if stage.get_state() == pipeless::stages::stage::StageState::Cold {
+                    tokio::spawn(async move {
+                        stage.get_or_load().await;
+                    });
+                }
+            }
+        }
+    }
+
+    /// Returns the load state of every stage of the project
+    pub fn get_stages_status(&self) -> Vec<pipeless::stages::stage::StageStatus> {
+        let mut status: Vec<_> = self.stages.read().unwrap().values().map(|stage| stage.get_status()).collect();
+        status.sort_by(|a, b| a.get_name().cmp(b.get_name()));
+        status
     }
 
     /// Execute the provided frame path over the provided frame
@@ -57,38 +326,175 @@ impl FramePathExecutor {
         frame: pipeless::data::Frame,
         path: FramePath
     ) -> Option<pipeless::data::Frame> {
-        let mut frame = Some(frame);
-        for stage_name in path.get_path().iter() {
-            if let Some(stage) = self.stages.get(stage_name) {
-                let stage_hooks = stage.get_hooks();
+        // Used to notify the hooks after a frame is dropped, so they don't wait for it
+        let pipeline_id = *frame.get_pipeline_id();
+        let frame_number = *frame.get_frame_number();
+        self.execute_nodes(path.get_nodes(), Some(frame), &pipeline_id, frame_number).await
+    }
 
-                // FIXME: we have the code duplicated per hook type just to match the hook type to guarantee the hooks order
+    fn execute_nodes<'a>(
+        &'a self,
+        nodes: &'a [PathNode],
+        frame: Option<pipeless::data::Frame>,
+        pipeline_id: &'a uuid::Uuid,
+        frame_number: u64,
+    ) -> BoxFuture<'a, Option<pipeless::data::Frame>> {
+        async move {
+            let mut frame = frame;
+            for node in nodes {
+                frame = match node {
+                    PathNode::Stage(stage_name) => self.execute_stage(stage_name, frame, pipeline_id, frame_number).await,
+                    PathNode::Parallel(branches) => self.execute_branches(branches, frame, pipeline_id, frame_number).await,
+                };
+            }
+            frame
+        }.boxed()
+    }
 
-                let pre_process_hook = find_hook(stage_hooks,  pipeless::stages::hook::HookType::PreProcess);
-                if let Some(hook) = pre_process_hook {
-                   frame = run_hook(&hook, stage, frame).await;
-                }
+    async fn execute_stage(
+        &self,
+        stage_name: &str,
+        mut frame: Option<pipeless::data::Frame>,
+        pipeline_id: &uuid::Uuid,
+        frame_number: u64,
+    ) -> Option<pipeless::data::Frame> {
+        // Keep the version of the stage until the frame leaves it, even if the stage is reloaded meanwhile
+        let lazy_stage = match self.get_stage(stage_name) {
+            Some(lazy_stage) => lazy_stage,
+            None => {
+                warn!("Stage '{}' not found, skipping execution", stage_name);
+                return frame;
+            }
+        };
+        let stage = lazy_stage.get_or_load().await;
+        if let Some(stage) = stage {
+            let stage_hooks = stage.get_hooks();
+            let stage_metrics = pipeless::metrics::get_stage_metrics(pipeline_id, stage_name);
 
-                let process_hook = find_hook(stage_hooks,  pipeless::stages::hook::HookType::Process);
-                if let Some(hook) = process_hook {
-                    frame = run_hook(&hook, stage, frame).await;
+            // The stage only carries forward the user data it changes
+            let mut input_user_data = None;
+            if let (Some(interval), Some(current_frame)) = (stage.get_interval(), frame.as_mut()) {
+                if !interval.should_run(current_frame) {
+                    // Carry forward the outputs of the last run of the stage
+                    interval.apply_outputs(current_frame);
+                    for hook in stage_hooks {
+                        hook.skip_frame(pipeline_id, frame_number);
+                    }
+                    return frame;
                 }
+                input_user_data = Some(current_frame.get_user_data().clone());
+            }
+
+            // FIXME: we have the code duplicated per hook type just to match the hook type to guarantee the hooks order
+
+            let pre_process_hook = find_hook(stage_hooks,  pipeless::stages::hook::HookType::PreProcess);
+            if let Some(hook) = pre_process_hook {
+               frame = run_hook(&hook, stage, frame, pipeline_id, frame_number, stage_metrics.as_deref()).await;
+            }
+
+            let process_hook = find_hook(stage_hooks,  pipeless::stages::hook::HookType::Process);
+            if let Some(hook) = process_hook {
+                frame = run_hook(&hook, stage, frame, pipeline_id, frame_number, stage_metrics.as_deref()).await;
+            }
+
+            let post_process_hook = find_hook(stage_hooks,  pipeless::stages::hook::HookType::PostProcess);
+            if let Some(hook) = post_process_hook {
+                frame = run_hook(&hook, stage, frame, pipeline_id, frame_number, stage_metrics.as_deref()).await;
+            }
 
-                let post_process_hook = find_hook(stage_hooks,  pipeless::stages::hook::HookType::PostProcess);
-                if let Some(hook) = post_process_hook {
-                    frame = run_hook(&hook, stage, frame).await;
+            if let (Some(interval), Some(current_frame), Some(input_user_data)) = (stage.get_interval(), frame.as_ref(), input_user_data) {
+                interval.store_outputs(current_frame, &input_user_data);
+            }
+        } else {
+            error!("Stage '{}' failed to load, skipping execution", stage_name);
+        }
+
+        frame
+    }
+
+    /// Runs the branches whose condition matches concurrently, each one over a copy of the frame.
+    /// The frame is dropped when any branch drops it.
+    async fn execute_branches(
+        &self,
+        branches: &[PathBranch],
+        frame: Option<pipeless::data::Frame>,
+        pipeline_id: &uuid::Uuid,
+        frame_number: u64,
+    ) -> Option<pipeless::data::Frame> {
+        let frame = match frame {
+            Some(frame) => frame,
+            None => {
+                for branch in branches {
+                    self.skip_nodes(&branch.nodes, pipeline_id, frame_number);
                 }
+                return None;
+            }
+        };
+
+        let mut running_branches = vec![];
+        for branch in branches {
+            let runs = branch.condition.as_ref()
+                .map_or(true, |condition| condition.matches(frame.get_user_data()));
+            if runs {
+                running_branches.push(branch);
             } else {
-                warn!("Stage '{}' not found, skipping execution", stage_name);
+                self.skip_nodes(&branch.nodes, pipeline_id, frame_number);
             }
         }
 
-        frame
+        match running_branches.len() {
+            0 => Some(frame),
+            1 => self.execute_nodes(&running_branches[0].nodes, Some(frame), pipeline_id, frame_number).await,
+            num_branches => {
+                // Only the values that the branches add or change are merged
+                let fork_output = frame.get_inference_output().clone();
+                let fork_user_data = frame.get_user_data().clone();
+                // The pixels are backed by the input buffer until a branch modifies them, so the copies are cheap
+                let mut branch_futures = Vec::with_capacity(num_branches);
+                for branch in &running_branches[..num_branches - 1] {
+                    branch_futures.push(self.execute_nodes(&branch.nodes, Some(frame.clone()), pipeline_id, frame_number));
+                }
+                branch_futures.push(self.execute_nodes(&running_branches[num_branches - 1].nodes, Some(frame), pipeline_id, frame_number));
+
+                let results: Option<Vec<pipeless::data::Frame>> = join_all(branch_futures).await.into_iter().collect();
+                let branch_names: Vec<String> = running_branches.iter().map(|branch| branch.get_name()).collect();
+                results.map(|frames| merge_branch_frames(frames, &branch_names, fork_output, fork_user_data))
+            },
+        }
+    }
+
+    /// Notifies the hooks of the nodes that the frame will not reach them
+    fn skip_nodes(&self, nodes: &[PathNode], pipeline_id: &uuid::Uuid, frame_number: u64) {
+        for node in nodes {
+            match node {
+                PathNode::Stage(stage_name) => {
+                    if let Some(lazy_stage) = self.get_stage(stage_name) {
+                        if let Some(stage) = lazy_stage.get() {
+                            for hook in stage.get_hooks() {
+                                hook.skip_frame(pipeline_id, frame_number);
+                            }
+                        }
+                    }
+                },
+                PathNode::Parallel(branches) => {
+                    for branch in branches {
+                        self.skip_nodes(&branch.nodes, pipeline_id, frame_number);
+                    }
+                },
+            }
+        }
+    }
+
+    /// Releases the data kept by the stages for a stream that ended
+    pub fn forget_stream(&self, pipeline_id: &uuid::Uuid) {
+        for stage in self.stages.read().unwrap().values().filter_map(|stage| stage.get()) {
+            stage.forget_stream(pipeline_id);
+        }
     }
 
     /// Validates if all the stages of a frame path exist
     fn check_path(&self, frame_path: FramePath) -> Result<FramePath, String> {
-        if let Some(not_found) = frame_path.get_path().iter().find(|s| !self.stages.contains_key(*s)) {
+        if let Some(not_found) = find_missing_stage(frame_path.get_nodes(), &self.stages.read().unwrap()) {
             Err(format!("{} stage does not exist", not_found))
         } else {
             Ok(frame_path)
@@ -96,16 +502,183 @@ impl FramePathExecutor {
     }
 }
 
+fn find_missing_stage<'a>(
+    nodes: &'a [PathNode],
+    stages: &HashMap<String, Arc<pipeless::stages::stage::LazyStage>>,
+) -> Option<&'a str> {
+    nodes.iter().find_map(|node| match node {
+        PathNode::Stage(stage_name) => (!stages.contains_key(stage_name)).then(|| stage_name.as_str()),
+        PathNode::Parallel(branches) => branches.iter().find_map(|branch| find_missing_stage(&branch.nodes, stages)),
+    })
+}
+
+fn collect_stage_names<'a>(nodes: &'a [PathNode], stage_names: &mut Vec<&'a str>) {
+    for node in nodes {
+        match node {
+            PathNode::Stage(stage_name) => stage_names.push(stage_name),
+            PathNode::Parallel(branches) => {
+                for branch in branches {
+                    collect_stage_names(&branch.nodes, stage_names);
+                }
+            },
+        }
+    }
+}
+
+/// Joins the frames returned by the parallel branches.
+/// The pixels are taken from the first branch that modified them. The inference outputs and
+/// the user data are merged against their values before the fork, so only what a branch added
+/// or changed is merged and the branches that did not touch a value don't overwrite it with their copy.
+/// When several branches change the same key, the values are kept under '<branch name>.<key>'.
+fn merge_branch_frames(
+    mut frames: Vec<pipeless::data::Frame>,
+    branch_names: &[String],
+    fork_output: pipeless::data::InferenceOutput,
+    fork_user_data: pipeless::data::UserData,
+) -> pipeless::data::Frame {
+    let mut outputs = vec![];
+    let mut user_data = vec![];
+    for (frame, branch_name) in frames.iter_mut().zip(branch_names) {
+        outputs.push((branch_name.clone(), frame.take_inference_output()));
+        user_data.push((branch_name.clone(), frame.get_user_data().clone()));
+    }
+
+    let base_index = frames.iter().position(|frame| !frame.is_modified_shared()).unwrap_or(0);
+    let mut frame = frames.swap_remove(base_index);
+    frame.set_inference_output(merge_inference_outputs(fork_output, outputs));
+    frame.set_user_data(merge_user_data(fork_user_data, user_data));
+    frame
+}
+
+/// Name of a value changed by several branches
+fn branch_key(branch_name: &str, key: &str) -> String {
+    format!("{}.{}", branch_name, key)
+}
+
+/// Groups by key the values that the branches changed
+fn collect_changes<'a, T: PartialEq + 'a>(
+    base: impl Fn(&str) -> Option<&'a T>,
+    changes: &mut indexmap::IndexMap<String, Vec<(String, T)>>,
+    branch_name: &str,
+    entries: impl IntoIterator<Item = (String, T)>,
+) {
+    for (key, value) in entries {
+        if base(&key) != Some(&value) {
+            changes.entry(key).or_default().push((branch_name.to_string(), value));
+        }
+    }
+}
+
+fn merge_inference_outputs(
+    fork_output: pipeless::data::InferenceOutput,
+    outputs: Vec<(String, pipeless::data::InferenceOutput)>,
+) -> pipeless::data::InferenceOutput {
+    let mut changed: Vec<(String, pipeless::data::InferenceOutput)> = outputs.into_iter()
+        .filter(|(_, output)| *output != fork_output)
+        .collect();
+    match changed.len() {
+        0 => fork_output,
+        1 => changed.remove(0).1,
+        _ => {
+            let mut merged = match fork_output {
+                pipeless::data::InferenceOutput::OnnxInferenceOutput(outputs) => outputs,
+                pipeless::data::InferenceOutput::Default(_) => pipeless::stages::inference::onnx::OnnxInferenceOutput::new(),
+            };
+            let mut changes = indexmap::IndexMap::new();
+            for (branch_name, output) in changed {
+                match output {
+                    pipeless::data::InferenceOutput::Default(output) => {
+                        // Unnamed outputs are kept under the name of their branch
+                        if output.len() > 0 {
+                            changes.entry(branch_name.clone()).or_insert_with(Vec::new).push((branch_name, output));
+                        }
+                    },
+                    pipeless::data::InferenceOutput::OnnxInferenceOutput(outputs) => {
+                        collect_changes(|key: &str| merged.get(key), &mut changes, &branch_name, outputs);
+                    },
+                }
+            }
+            for (key, mut values) in changes {
+                if values.len() == 1 {
+                    merged.insert(key, values.remove(0).1);
+                } else {
+                    // The value before the fork is outdated
+                    merged.remove(&key);
+                    for (branch_name, value) in values {
+                        merged.insert(branch_key(&branch_name, &key), value);
+                    }
+                }
+            }
+            pipeless::data::InferenceOutput::OnnxInferenceOutput(merged)
+        },
+    }
+}
+
+fn merge_user_data(
+    fork_user_data: pipeless::data::UserData,
+    user_data: Vec<(String, pipeless::data::UserData)>,
+) -> pipeless::data::UserData {
+    let mut changed: Vec<(String, pipeless::data::UserData)> = user_data.into_iter()
+        .filter(|(_, data)| *data != fork_user_data)
+        .collect();
+    match changed.len() {
+        0 => fork_user_data,
+        1 => changed.remove(0).1,
+        _ => {
+            let mut merged = match fork_user_data {
+                pipeless::data::UserData::Dictionary(entries) => entries,
+                _ => pipeless::data::UserDataDictionary::new(),
+            };
+            let mut changes = indexmap::IndexMap::new();
+            for (branch_name, data) in changed {
+                match data {
+                    pipeless::data::UserData::Dictionary(entries) => {
+                        collect_changes(|key: &str| merged.get(key), &mut changes, &branch_name, entries);
+                    },
+                    pipeless::data::UserData::Empty => {},
+                    // Values that are not dictionaries are kept under the name of their branch
+                    value => changes.entry(branch_name.clone()).or_insert_with(Vec::new).push((branch_name, value)),
+                }
+            }
+            for (key, mut values) in changes {
+                if values.len() == 1 {
+                    merged.insert(key, values.remove(0).1);
+                } else {
+                    // The value before the fork is outdated
+                    merged.shift_remove(&key);
+                    for (branch_name, value) in values {
+                        merged.insert(branch_key(&branch_name, &key), value);
+                    }
+                }
+            }
+            pipeless::data::UserData::Dictionary(merged)
+        },
+    }
+}
+
 async fn run_hook(
     hook: &pipeless::stages::hook::Hook,
     stage: &pipeless::stages::stage::Stage,
     frame: Option<pipeless::data::Frame>,
+    pipeline_id: &uuid::Uuid,
+    frame_number: u64,
+    stage_metrics: Option<&pipeless::metrics::StageMetrics>,
 ) -> Option<pipeless::data::Frame> {
     if let Some(frame) = frame {
-        let context = stage.get_context();
-        return hook.exec_hook(frame, context).await;
+        let context = stage.get_context(pipeline_id).await;
+        let start = std::time::Instant::now();
+        let out_frame = hook.exec_hook(frame, context).await;
+        if let Some(stage_metrics) = stage_metrics {
+            stage_metrics.observe_hook(hook.get_hook_type(), start.elapsed());
+            if out_frame.is_none() {
+                stage_metrics.inc_dropped_frames();
+            }
+        }
+        return out_frame;
     }
 
+    // The frame was dropped by a previous hook
+    hook.skip_frame(pipeline_id, frame_number);
     None
 }
 
@@ -121,3 +694,162 @@ fn find_hook(
     }
     None
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use pipeless::data::{InferenceOutput, UserData, UserDataDictionary};
+
+    fn parse(path: &str) -> Result<Vec<PathNode>, String> {
+        let mut parser = PathParser { chars: path.trim().chars().peekable() };
+        let nodes = parser.parse_path()?;
+        match parser.chars.next() {
+            Some(c) => Err(format!("unexpected '{}'", c)),
+            None => Ok(nodes),
+        }
+    }
+
+    fn stage(name: &str) -> PathNode {
+        PathNode::Stage(name.to_string())
+    }
+
+    fn dict(entries: Vec<(&str, UserData)>) -> UserData {
+        UserData::Dictionary(entries.into_iter().map(|(key, value)| (key.to_string(), value)).collect())
+    }
+
+    fn tensor(value: f32) -> ndarray::ArrayD<f32> {
+        ndarray::ArrayD::from_elem(ndarray::IxDyn(&[2]), value)
+    }
+
+    fn outputs(entries: Vec<(&str, f32)>) -> InferenceOutput {
+        InferenceOutput::OnnxInferenceOutput(
+            entries.into_iter().map(|(key, value)| (key.to_string(), tensor(value))).collect()
+        )
+    }
+
+    #[test]
+    fn test_parse_sequential_path() {
+        assert_eq!(parse("a/b/c").unwrap(), vec![stage("a"), stage("b"), stage("c")]);
+        assert_eq!(parse(" a / b ").unwrap(), vec![stage("a"), stage("b")]);
+    }
+
+    #[test]
+    fn test_parse_parallel_branches() {
+        let nodes = parse("detector/(faces | [vehicle] plates/ocr | [!night] [color=red] )/publish");
+        assert!(nodes.is_err(), "A branch requires at least a stage");
+
+        let nodes = parse("detector/(faces | [vehicle] plates/ocr | [color = red] color)/publish").unwrap();
+        assert_eq!(nodes, vec![
+            stage("detector"),
+            PathNode::Parallel(vec![
+                PathBranch { condition: None, nodes: vec![stage("faces")] },
+                PathBranch {
+                    condition: Some(BranchCondition::IsSet("vehicle".to_string())),
+                    nodes: vec![stage("plates"), stage("ocr")],
+                },
+                PathBranch {
+                    condition: Some(BranchCondition::Equals("color".to_string(), "red".to_string())),
+                    nodes: vec![stage("color")],
+                },
+            ]),
+            stage("publish"),
+        ]);
+    }
+
+    #[test]
+    fn test_parse_nested_groups() {
+        let nodes = parse("(a | [!b] (c | d))").unwrap();
+        assert_eq!(nodes, vec![PathNode::Parallel(vec![
+            PathBranch { condition: None, nodes: vec![stage("a")] },
+            PathBranch {
+                condition: Some(BranchCondition::IsNotSet("b".to_string())),
+                nodes: vec![PathNode::Parallel(vec![
+                    PathBranch { condition: None, nodes: vec![stage("c")] },
+                    PathBranch { condition: None, nodes: vec![stage("d")] },
+                ])],
+            },
+        ])]);
+    }
+
+    #[test]
+    fn test_parse_invalid_paths() {
+        assert!(parse("").is_err());
+        assert!(parse("a/").is_err());
+        assert!(parse("a//b").is_err());
+        assert!(parse("(a | b").is_err());
+        assert!(parse("(a b").is_err());
+        assert!(parse("a)").is_err());
+        assert!(parse("([x a)").is_err());
+        assert!(parse("([] a)").is_err());
+        assert!(parse("(a | )").is_err());
+    }
+
+    #[test]
+    fn test_branch_conditions() {
+        let user_data = dict(vec![("vehicle", UserData::Bool(true)), ("color", UserData::String("red".to_string())), ("count", UserData::Integer(0))]);
+        assert!(BranchCondition::parse("vehicle").unwrap().matches(&user_data));
+        assert!(!BranchCondition::parse("count").unwrap().matches(&user_data));
+        assert!(BranchCondition::parse("!count").unwrap().matches(&user_data));
+        assert!(BranchCondition::parse("!missing").unwrap().matches(&user_data));
+        assert!(BranchCondition::parse("color=red").unwrap().matches(&user_data));
+        assert!(!BranchCondition::parse("color=blue").unwrap().matches(&user_data));
+    }
+
+    #[test]
+    fn test_merge_user_data_keeps_untouched_values() {
+        let fork = dict(vec![("detections", UserData::Integer(1))]);
+        // The first branch updates the detections, the second one adds a new key
+        let merged = merge_user_data(fork.clone(), vec![
+            ("a".to_string(), dict(vec![("detections", UserData::Integer(2))])),
+            ("b".to_string(), dict(vec![("detections", UserData::Integer(1)), ("faces", UserData::Integer(3))])),
+        ]);
+        assert!(merged == dict(vec![("detections", UserData::Integer(2)), ("faces", UserData::Integer(3))]));
+
+        // Branches that change nothing keep the value before the fork
+        let merged = merge_user_data(fork.clone(), vec![("a".to_string(), fork.clone()), ("b".to_string(), fork.clone())]);
+        assert!(merged == fork);
+    }
+
+    #[test]
+    fn test_merge_user_data_namespaces_collisions() {
+        let fork = dict(vec![("count", UserData::Integer(0)), ("other", UserData::Integer(5))]);
+        let merged = merge_user_data(fork, vec![
+            ("a".to_string(), dict(vec![("count", UserData::Integer(1)), ("other", UserData::Integer(5))])),
+            ("b".to_string(), dict(vec![("count", UserData::Integer(2)), ("other", UserData::Integer(5))])),
+            ("c".to_string(), UserData::String("value".to_string())),
+        ]);
+        let mut expected = UserDataDictionary::new();
+        expected.insert("other".to_string(), UserData::Integer(5));
+        expected.insert("a.count".to_string(), UserData::Integer(1));
+        expected.insert("b.count".to_string(), UserData::Integer(2));
+        expected.insert("c".to_string(), UserData::String("value".to_string()));
+        assert!(merged == UserData::Dictionary(expected));
+    }
+
+    #[test]
+    fn test_merge_inference_outputs() {
+        let fork = InferenceOutput::Default(ndarray::ArrayD::zeros(ndarray::IxDyn(&[0])));
+        // Two models producing the same output name
+        let merged = merge_inference_outputs(fork.clone(), vec![
+            ("yolo".to_string(), outputs(vec![("output0", 1.0)])),
+            ("pose".to_string(), outputs(vec![("output0", 2.0)])),
+            ("skip".to_string(), fork.clone()),
+        ]);
+        assert!(merged == outputs(vec![("yolo.output0", 1.0), ("pose.output0", 2.0)]));
+
+        // A branch that does not run inference keeps the outputs of the others
+        let merged = merge_inference_outputs(fork.clone(), vec![
+            ("yolo".to_string(), outputs(vec![("output0", 1.0)])),
+            ("skip".to_string(), fork.clone()),
+        ]);
+        assert!(merged == outputs(vec![("output0", 1.0)]));
+
+        // Outputs computed before the fork are only replaced when a branch changes them
+        let fork = outputs(vec![("detections", 1.0)]);
+        let merged = merge_inference_outputs(fork.clone(), vec![
+            ("a".to_string(), outputs(vec![("detections", 1.0), ("faces", 2.0)])),
+            ("b".to_string(), outputs(vec![("detections", 1.0), ("plates", 3.0)])),
+        ]);
+        assert!(merged == outputs(vec![("detections", 1.0), ("faces", 2.0), ("plates", 3.0)]));
+    }
+}
@@ -0,0 +1,141 @@
+use std::{collections::{BTreeMap, BTreeSet, HashMap}, sync::{Mutex, atomic::{AtomicBool, Ordering}}, time::Duration};
+use log::debug;
+use tokio::sync::oneshot;
+use uuid::Uuid;
+
+/// Time a frame waits for the previous frames of its stream, while the stream is idle,
+/// before assuming they were dropped and will never arrive
+const GAP_TIMEOUT: Duration = Duration::from_millis(200);
+
+struct StreamSequence {
+    next_frame: u64, // Number of the next frame allowed to run
+    running: bool, // A frame of the stream is being processed
+    waiting: BTreeMap<u64, oneshot::Sender<()>>, // Frames waiting for their turn
+    skipped: BTreeSet<u64>, // Frames that will never arrive
+}
+impl StreamSequence {
+    fn new(first_frame: u64) -> Self {
+        Self {
+            next_frame: first_frame,
+            running: false,
+            waiting: BTreeMap::new(),
+            skipped: BTreeSet::new(),
+        }
+    }
+
+    /// Moves the sequence to the given frame, jumping over the skipped frames,
+    /// and gives the turn to the next frame if it is already waiting
+    fn advance(&mut self, frame_number: u64) {
+        self.next_frame = self.next_frame.max(frame_number);
+        while self.skipped.remove(&self.next_frame) {
+            self.next_frame += 1;
+        }
+        self.skipped = self.skipped.split_off(&self.next_frame);
+        if let Some(sender) = self.waiting.remove(&self.next_frame) {
+            // If the frame stopped waiting it will find its turn when checking again
+            self.running = sender.send(()).is_ok();
+        }
+    }
+}
+
+/// Orders the frames of each stream that go through a stateful hook.
+/// Streams are ordered independently and, when a frame finishes, only the next frame of
+/// its stream is woken. Frames dropped before reaching the hook leave gaps in the sequence,
+/// they are either notified via skip or skipped after a timeout.
+pub struct FrameSequencer {
+    streams: Mutex<HashMap<Uuid, StreamSequence>>,
+    // When set, the sequences start at the first frame that arrives instead of at frame 1
+    resume_streams: AtomicBool,
+}
+impl FrameSequencer {
+    pub fn new() -> Self {
+        Self { streams: Mutex::new(HashMap::new()), resume_streams: AtomicBool::new(false) }
+    }
+
+    /// Makes the sequences start at the first frame that arrives. Used when the hook replaces
+    /// a previous version while streams are running, so it does not wait for the frames already processed.
+    pub fn resume_streams(&self) {
+        self.resume_streams.store(true, Ordering::SeqCst);
+    }
+
+    fn new_sequence(&self, frame_number: u64) -> StreamSequence {
+        if self.resume_streams.load(Ordering::SeqCst) {
+            StreamSequence::new(frame_number)
+        } else {
+            StreamSequence::new(1) // Frame numbers start at 1
+        }
+    }
+
+    /// Waits until it is the turn of the frame.
+    /// Returns false when the frame arrived after the sequence skipped it. In that case
+    /// the frame is not ordered and finish must not be invoked for it.
+    pub async fn wait_turn(&self, pipeline_id: &Uuid, frame_number: u64) -> bool {
+        loop {
+            let receiver = {
+                let mut streams = self.streams.lock().unwrap();
+                let sequence = streams.entry(*pipeline_id).or_insert_with(|| self.new_sequence(frame_number));
+                if frame_number < sequence.next_frame {
+                    debug!("Frame {} of pipeline {} arrived after being skipped, running it unordered", frame_number, pipeline_id);
+                    return false;
+                }
+                if frame_number == sequence.next_frame && !sequence.running {
+                    sequence.running = true;
+                    return true;
+                }
+                let (sender, receiver) = oneshot::channel();
+                sequence.waiting.insert(frame_number, sender);
+                receiver
+            };
+
+            match tokio::time::timeout(GAP_TIMEOUT, receiver).await {
+                Ok(Ok(_)) => return true,
+                Ok(Err(_)) => {}, // The stream was forgotten, check again
+                Err(_) => {
+                    let mut streams = self.streams.lock().unwrap();
+                    if let Some(sequence) = streams.get_mut(pipeline_id) {
+                        if !sequence.running {
+                            // The previous frames did not arrive. Jump to the first frame available.
+                            let first_waiting = sequence.waiting.keys().next()
+                                .map_or(frame_number, |first| frame_number.min(*first));
+                            if first_waiting > sequence.next_frame {
+                                debug!(
+                                    "Frames {} to {} of pipeline {} did not arrive, skipping them",
+                                    sequence.next_frame, first_waiting - 1, pipeline_id
+                                );
+                            }
+                            sequence.advance(first_waiting);
+                        }
+                    }
+                },
+            }
+        }
+    }
+
+    /// Invoked when a frame that got its turn finishes, to wake the next one
+    pub fn finish(&self, pipeline_id: &Uuid, frame_number: u64) {
+        let mut streams = self.streams.lock().unwrap();
+        if let Some(sequence) = streams.get_mut(pipeline_id) {
+            sequence.running = false;
+            sequence.advance(frame_number + 1);
+        }
+    }
+
+    /// Notifies a frame that will never arrive. For example, because a previous stage dropped it.
+    pub fn skip(&self, pipeline_id: &Uuid, frame_number: u64) {
+        let mut streams = self.streams.lock().unwrap();
+        let sequence = streams.entry(*pipeline_id).or_insert_with(|| self.new_sequence(frame_number));
+        if frame_number < sequence.next_frame {
+            return;
+        }
+        sequence.skipped.insert(frame_number);
+        if !sequence.running {
+            let next_frame = sequence.next_frame;
+            sequence.advance(next_frame);
+        }
+    }
+
+    /// Removes the sequence of a stream that ended
+    pub fn forget(&self, pipeline_id: &Uuid) {
+        self.streams.lock().unwrap().remove(pipeline_id);
+    }
+}
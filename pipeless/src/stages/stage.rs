@@ -1,5 +1,6 @@
-use std::sync::Arc;
-use log::error;
+use std::{collections::HashMap, path::PathBuf, sync::{Arc, Mutex, atomic::{AtomicBool, Ordering}}, time::{Duration, Instant}};
+use log::{error, info};
+use serde_derive::Serialize;
 
 use crate as pipeless;
 
@@ -8,8 +9,8 @@ use crate as pipeless;
 /// provided to all the calls to the stage hooks.
 /// This is usefull in many cases, for example, to maintain external connections
 /// with analytics servers.
-/// IMPORTANT: the context is global for the stage, which means it is global to all frame
-/// of all streams.
+/// IMPORTANT: by default the context is global for the stage, which means it is global to all frame
+/// of all streams. When the context is created per stream, every stream gets its own context.
 // The context (like hooks) can be initialized by the user in several languages
 // by returning data from the init function in the file init.{rs,py,...}
 // We pass it to hooks as read-only
@@ -21,6 +22,18 @@ pub enum Context {
 pub trait ContextTrait<T> {
     fn init_context(stage_name: &str, init_code: &str) -> T;
 }
+/// Creates the context of a stage for a stream
+pub type ContextFactory = dyn Fn(&uuid::Uuid) -> Context + Send + Sync;
+
+/// The context can be shared by all the streams or created per stream.
+/// Per stream contexts are created the first time the stream uses the stage.
+enum StageContext {
+    Shared(Arc<Context>),
+    PerStream {
+        factory: Arc<ContextFactory>,
+        contexts: Mutex<HashMap<uuid::Uuid, Arc<tokio::sync::OnceCell<Arc<Context>>>>>,
+    },
+}
 
 /// A Pipeless stage is the equivalent to a step that you would define when working
 /// with traditional pipelines. Each stage has pre-process, process and post-process
@@ -32,7 +45,9 @@ pub struct Stage {
     // A simple vector with all the hooks of this stage.
     // Note Hook is thread safe so the data of this vector is it too
     hooks: Vec<pipeless::stages::hook::Hook>,
-    context: Arc<Context>,
+    context: StageContext,
+    // When defined, the stage does not run for every frame
+    interval: Option<pipeless::stages::interval::StageInterval>,
 }
 impl Stage {
     pub fn new(name: &str) -> Self {
@@ -41,7 +56,8 @@ impl Stage {
             hooks: vec![],
             // Default empty stage context.
             // Arc because will be used among all frames in many threads
-            context: Arc::new(Context::EmptyContext)
+            context: StageContext::Shared(Arc::new(Context::EmptyContext)),
+            interval: None,
         }
     }
 
@@ -63,10 +79,225 @@ impl Stage {
     }
 
     pub fn set_context(&mut self, context: Context) {
-        self.context = Arc::new(context);
+        self.context = StageContext::Shared(Arc::new(context));
+    }
+
+    /// Creates a different context for every stream with the factory
+    pub fn set_context_per_stream(&mut self, factory: Arc<ContextFactory>) {
+        self.context = StageContext::PerStream {
+            factory,
+            contexts: Mutex::new(HashMap::new()),
+        };
+    }
+
+    pub fn has_context_per_stream(&self) -> bool {
+        matches!(self.context, StageContext::PerStream { .. })
+    }
+
+    /// Returns the context for the stream. Per stream contexts are created on first use,
+    /// concurrent calls for the same stream wait for a single creation.
+    pub async fn get_context(&self, pipeline_id: &uuid::Uuid) -> Arc<Context> {
+        match &self.context {
+            StageContext::Shared(context) => context.clone(),
+            StageContext::PerStream { factory, contexts } => {
+                let cell = contexts.lock().unwrap()
+                    .entry(*pipeline_id)
+                    .or_insert_with(|| Arc::new(tokio::sync::OnceCell::new()))
+                    .clone();
+                cell.get_or_init(|| async {
+                    let factory = factory.clone();
+                    let pipeline_id = *pipeline_id;
+                    // The init function of the stage usually blocks
+                    match tokio::task::spawn_blocking(move || factory(&pipeline_id)).await {
+                        Ok(context) => Arc::new(context),
+                        Err(err) => {
+                            error!("Unable to create the context of the stage '{}' for the stream. Defaulting to empty stage context. {}", self.name, err);
+                            Arc::new(Context::EmptyContext)
+                        }
+                    }
+                }).await.clone()
+            }
+        }
+    }
+
+    pub fn set_interval(&mut self, interval: pipeless::stages::interval::StageInterval) {
+        self.interval = Some(interval);
+    }
+
+    pub fn get_interval(&self) -> Option<&pipeless::stages::interval::StageInterval> {
+        self.interval.as_ref()
+    }
+
+    /// Prepares the stage to replace a previous version of it while streams are running
+    pub fn resume_streams(&self) {
+        for hook in &self.hooks {
+            hook.resume_streams();
+        }
+    }
+
+    /// Releases the data kept by the stage for a stream that ended
+    pub fn forget_stream(&self, pipeline_id: &uuid::Uuid) {
+        for hook in &self.hooks {
+            hook.forget_stream(pipeline_id);
+        }
+        if let Some(interval) = &self.interval {
+            interval.forget(pipeline_id);
+        }
+        if let StageContext::PerStream { contexts, .. } = &self.context {
+            contexts.lock().unwrap().remove(pipeline_id);
+        }
+    }
+}
+/// Load state of a stage
+#[derive(Clone, Copy, PartialEq, Debug, Serialize)]
+#[serde(rename_all = "lowercase")]
+pub enum StageState {
+    Cold, // Not loaded yet
+    Loading,
+    Warm, // Ready to process frames
+    Failed,
+}
+
+/// Load state of a stage reported by the readiness endpoint
+#[derive(Serialize)]
+pub struct StageStatus {
+    name: String,
+    version: u64,
+    state: StageState,
+    load_time_ms: Option<f64>,
+}
+impl StageStatus {
+    pub fn get_name(&self) -> &str {
+        &self.name
+    }
+    pub fn get_version(&self) -> u64 {
+        self.version
+    }
+    pub fn get_state(&self) -> StageState {
+        self.state
+    }
+}
+
+/// Stage of the project that is loaded at start or, when lazy, on first use by a stream
+pub struct LazyStage {
+    name: String,
+    path: PathBuf,
+    python_workers: usize,
+    // Increased every time the stage is reloaded
+    version: u64,
+    // None when the stage failed to load
+    stage: tokio::sync::OnceCell<Option<Stage>>,
+    loading: AtomicBool,
+    load_time: Mutex<Option<Duration>>,
+}
+impl LazyStage {
+    pub fn new(name: &str, path: PathBuf, python_workers: usize) -> Self {
+        Self {
+            name: name.to_string(),
+            path,
+            python_workers,
+            version: 1,
+            stage: tokio::sync::OnceCell::new(),
+            loading: AtomicBool::new(false),
+            load_time: Mutex::new(None),
+        }
+    }
+
+    /// Wraps a stage that is already loaded, for example, one created programmatically
+    pub fn from_stage(stage: Stage) -> Self {
+        let lazy_stage = Self::new(stage.get_name(), PathBuf::new(), 0);
+        let _ = lazy_stage.stage.set(Some(stage));
+        lazy_stage
     }
 
-    pub fn get_context(&self) -> Arc<Context> {
-        self.context.clone()
+    /// Creates the next version of the stage from its directory, without loading it
+    pub fn new_version(&self) -> Result<Self, String> {
+        if self.path.as_os_str().is_empty() {
+            return Err(format!("The stage '{}' was not loaded from a directory and can't be reloaded", self.name));
+        }
+        let mut stage = Self::new(&self.name, self.path.clone(), self.python_workers);
+        stage.version = self.version + 1;
+        Ok(stage)
     }
-}
\ No newline at end of file
+
+    fn record_load_time(&self, load_time: Duration) {
+        info!("✅ Stage '{}' loaded in {:.2?}", self.name, load_time);
+        *self.load_time.lock().unwrap() = Some(load_time);
+    }
+
+    /// Loads the stage on the current thread. Panics when the stage definition is wrong.
+    pub fn load_blocking(&self) {
+        if self.stage.initialized() {
+            return;
+        }
+        self.loading.store(true, Ordering::SeqCst);
+        let start = Instant::now();
+        let stage = pipeless::stages::parser::load_stage(&self.name, &self.path, self.python_workers);
+        self.record_load_time(start.elapsed());
+        let _ = self.stage.set(Some(stage));
+        self.loading.store(false, Ordering::SeqCst);
+    }
+
+    /// Returns the stage, loading it when it was not loaded yet.
+    /// Concurrent calls wait for a single load. Returns None when the stage failed to load.
+    pub async fn get_or_load(&self) -> Option<&Stage> {
+        self.stage.get_or_init(|| async {
+            self.loading.store(true, Ordering::SeqCst);
+            let name = self.name.clone();
+            let path = self.path.clone();
+            let python_workers = self.python_workers;
+            // Loading runs the stage init and creates the inference sessions, which block
+            let result = tokio::task::spawn_blocking(move || {
+                let start = Instant::now();
+                let stage = pipeless::stages::parser::load_stage(&name, &path, python_workers);
+                (stage, start.elapsed())
+            }).await;
+            self.loading.store(false, Ordering::SeqCst);
+            match result {
+                Ok((stage, load_time)) => {
+                    self.record_load_time(load_time);
+                    Some(stage)
+                },
+                Err(err) => {
+                    error!("⚠️  Unable to load the stage '{}': {}", self.name, err);
+                    None
+                }
+            }
+        }).await.as_ref()
+    }
+
+    pub fn get_name(&self) -> &str {
+        &self.name
+    }
+
+    pub fn get_path(&self) -> &PathBuf {
+        &self.path
+    }
+
+    pub fn get_version(&self) -> u64 {
+        self.version
+    }
+
+    /// Returns the stage only when it is already loaded
+    pub fn get(&self) -> Option<&Stage> {
+        self.stage.get().and_then(|stage| stage.as_ref())
+    }
+
+    pub fn get_state(&self) -> StageState {
+        match self.stage.get() {
+            Some(Some(_)) => StageState::Warm,
+            Some(None) => StageState::Failed,
+            None if self.loading.load(Ordering::SeqCst) => StageState::Loading,
+            None => StageState::Cold,
+        }
+    }
+
+    pub fn get_status(&self) -> StageStatus {
+        StageStatus {
+            name: self.name.clone(),
+            version: self.version,
+            state: self.get_state(),
+            load_time_ms: self.load_time.lock().unwrap().map(|load_time| load_time.as_secs_f64() * 1000.0),
+        }
+    }
+}
@@ -0,0 +1,79 @@
+use std::{collections::HashMap, fs, hash::{Hash, Hasher}, path::PathBuf, sync::Arc, time::Duration};
+use log::{error, info, warn};
+use tokio::sync::RwLock;
+
+use crate as pipeless;
+
+/// Time between checks of the stage files
+const WATCH_INTERVAL: Duration = Duration::from_secs(1);
+
+/// Returns a value that changes when any file of the stage directory is added, removed or modified.
+/// Only the files at the root of the directory are considered, like when loading the stage.
+fn stage_fingerprint(path: &PathBuf) -> Option<u64> {
+    let mut files = vec![];
+    for entry in fs::read_dir(path).ok()? {
+        let entry = entry.ok()?;
+        let metadata = entry.metadata().ok()?;
+        if metadata.is_file() {
+            files.push((entry.file_name(), metadata.len(), metadata.modified().ok()));
+        }
+    }
+    files.sort();
+    let mut hasher = std::collections::hash_map::DefaultHasher::new();
+    files.hash(&mut hasher);
+    Some(hasher.finish())
+}
+
+fn fingerprint_stages(stage_paths: Vec<(String, PathBuf)>) -> HashMap<String, u64> {
+    stage_paths.into_iter()
+        .filter_map(|(stage_name, path)| stage_fingerprint(&path).map(|fingerprint| (stage_name, fingerprint)))
+        .collect()
+}
+
+/// Watches the directories of the stages and reloads the stages whose files change.
+/// A stage is reloaded once its files stop changing for a whole interval, so half written files are not loaded.
+/// Stages added or removed from the project directory are not considered.
+pub fn start(frame_path_executor: Arc<RwLock<pipeless::stages::path::FramePathExecutor>>) {
+    tokio::spawn(async move {
+        let stage_paths = frame_path_executor.read().await.get_stage_paths();
+        let mut loaded = match tokio::task::spawn_blocking(move || fingerprint_stages(stage_paths)).await {
+            Ok(fingerprints) => fingerprints,
+            Err(err) => {
+                error!("Unable to read the stage files, stage hot reload disabled: {}", err);
+                return;
+            }
+        };
+        info!("👀 Watching {} stages for changes", loaded.len());
+        // Changes detected on the previous check that are waiting for the files to be stable
+        let mut pending: HashMap<String, u64> = HashMap::new();
+        loop {
+            tokio::time::sleep(WATCH_INTERVAL).await;
+            let stage_paths = frame_path_executor.read().await.get_stage_paths();
+            let current = match tokio::task::spawn_blocking(move || fingerprint_stages(stage_paths)).await {
+                Ok(fingerprints) => fingerprints,
+                Err(err) => {
+                    warn!("Unable to read the stage files: {}", err);
+                    continue;
+                }
+            };
+            for (stage_name, fingerprint) in current {
+                if loaded.get(&stage_name) == Some(&fingerprint) {
+                    pending.remove(&stage_name);
+                    continue;
+                }
+                if pending.get(&stage_name) != Some(&fingerprint) {
+                    // Wait for the next check to confirm the files stopped changing
+                    pending.insert(stage_name, fingerprint);
+                    continue;
+                }
+                pending.remove(&stage_name);
+                info!("Detected changes on stage '{}'", stage_name);
+                // Even if the reload fails, do not retry until the files change again
+                loaded.insert(stage_name.clone(), fingerprint);
+                if let Err(err) = frame_path_executor.read().await.reload_stage(&stage_name).await {
+                    error!("⚠️  {}", err);
+                }
+            }
+        }
+    });
+}